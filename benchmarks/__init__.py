@@ -0,0 +1 @@
+"""Benchmarks on synthetic vibrational models. Run with python -m vstr.benchmarks."""
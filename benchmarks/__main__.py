@@ -0,0 +1,94 @@
+"""Runs the benchmark suite and compares it against a baseline.
+
+    python -m vstr.benchmarks run --suite small --out current.json
+    python -m vstr.benchmarks run --suite production --baseline
+    python -m vstr.benchmarks compare baselines/production.json current.json
+    python -m vstr.benchmarks imports
+    python -m vstr.benchmarks precision --suite medium
+"""
+import os
+import sys
+import json
+import argparse
+from vstr.benchmarks.suite import SUITES, RunSuite, SaveRecord, LoadRecord, Compare
+from vstr.benchmarks.imports import CheckImports
+from vstr.benchmarks.precision import ComparePrecision
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+def main():
+    parser = argparse.ArgumentParser(prog = "python -m vstr.benchmarks")
+    sub = parser.add_subparsers(dest = "command")
+
+    run = sub.add_parser("run", help = "run a suite")
+    run.add_argument("--suite", default = "small", choices = sorted(SUITES))
+    run.add_argument("--cases", nargs = "*", help = "only run these cases of the suite")
+    run.add_argument("--set", nargs = "*", default = [], metavar = "KEY=VALUE", help = "override case parameters, values are parsed as JSON")
+    run.add_argument("--repeat", type = int, default = 1)
+    run.add_argument("--out", default = None, help = "JSON file for the results")
+    run.add_argument("--baseline", action = "store_true", help = "save the results as the baseline of the suite")
+    run.add_argument("--compare", action = "store_true", help = "compare the results against the baseline of the suite")
+    run.add_argument("--no-isolate", action = "store_true", help = "run every case in this process")
+    run.add_argument("--verbose", action = "store_true")
+
+    cmp = sub.add_parser("compare", help = "compare two result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    imp = sub.add_parser("imports", help = "time the import of the entry points and check that they do not load heavy dependencies")
+    imp.add_argument("--repeat", type = int, default = 5)
+    imp.add_argument("--max-time", type = float, default = None, help = "fail if an import takes longer than this many seconds")
+    imp.add_argument("--out", default = None, help = "JSON file for the results")
+    prc = sub.add_parser("precision", help = "compare the energies of the n-mode cases with the integrals in single and double precision")
+    prc.add_argument("--suite", default = "small", choices = sorted(SUITES))
+    prc.add_argument("--cases", nargs = "*", help = "only run these cases of the suite")
+    prc.add_argument("--tol", type = float, default = 0.01, help = "largest deviation of an energy in cm-1")
+    prc.add_argument("--no-isolate", action = "store_true", help = "run every case in this process")
+    prc.add_argument("--verbose", action = "store_true")
+    prc.add_argument("--out", default = None, help = "JSON file for the report and both records")
+
+    for p in [run, cmp]:
+        p.add_argument("--time-tol", type = float, default = 0.2)
+        p.add_argument("--mem-tol", type = float, default = 0.2)
+        p.add_argument("--min-time", type = float, default = 0.05)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        Cases = [c for c in SUITES[args.suite] if not args.cases or c["name"] in args.cases]
+        Overrides = dict()
+        for kv in args.set:
+            k, v = kv.split("=", 1)
+            Overrides[k] = json.loads(v)
+        Cases = [dict(c, **Overrides) for c in Cases]
+        Record = RunSuite(args.suite, Cases = Cases, Repeat = args.repeat, Isolate = not args.no_isolate, Quiet = not args.verbose, OutFile = args.out)
+        BaselineFile = os.path.join(BASELINE_DIR, args.suite + ".json")
+        NReg = 0
+        if args.compare and not os.path.exists(BaselineFile):
+            print("No baseline for suite %s, run with --baseline to make one" % args.suite, flush = True)
+        elif args.compare:
+            _, NReg = Compare(LoadRecord(BaselineFile), Record, TimeTol = args.time_tol, MemTol = args.mem_tol, MinTime = args.min_time)
+        if args.baseline:
+            os.makedirs(BASELINE_DIR, exist_ok = True)
+            SaveRecord(Record, BaselineFile)
+            print("Baseline written to", BaselineFile, flush = True)
+        NErr = sum("error" in c for c in Record["cases"].values())
+        if NErr > 0:
+            print("%d case(s) failed" % NErr, flush = True)
+        return 1 if NReg > 0 or NErr > 0 else 0
+    elif args.command == "compare":
+        _, NReg = Compare(LoadRecord(args.baseline), LoadRecord(args.current), TimeTol = args.time_tol, MemTol = args.mem_tol, MinTime = args.min_time)
+        return 1 if NReg > 0 else 0
+    elif args.command == "imports":
+        Results, NFail = CheckImports(Repeat = args.repeat, MaxTime = args.max_time)
+        if args.out is not None:
+            with open(args.out, "w") as f:
+                json.dump(Results, f, indent = 1)
+        return 1 if NFail > 0 else 0
+    elif args.command == "precision":
+        Cases = [c for c in SUITES[args.suite] if not args.cases or c["name"] in args.cases]
+        _, NFail = ComparePrecision(args.suite, Cases = Cases, Tol = args.tol, Isolate = not args.no_isolate, Quiet = not args.verbose, OutFile = args.out)
+        return 1 if NFail > 0 else 0
+    parser.print_help()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
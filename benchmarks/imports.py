@@ -0,0 +1,71 @@
+import sys
+import json
+import subprocess
+import numpy as np
+
+'''
+Import time of the entry points of vstr. Each module is imported in a fresh interpreter, which reports
+the time the import took and which of the heavy optional dependencies it pulled in. None of the entry
+points below should load any of them: PySCF, matplotlib, numdifftools, h5py and xfacpy are imported by
+the functions that use them.
+'''
+
+HEAVY = ['pyscf', 'matplotlib', 'numdifftools', 'h5py', 'xfacpy']
+
+# Entry points and the heavy modules they must not import
+ENTRY_POINTS = {
+    'vstr.utils.read_jf_input': HEAVY,
+    'vstr.mf.vscf': HEAVY,
+    'vstr.vhci.vhci': HEAVY,
+    'vstr.nmode.mol': HEAVY,
+    'vstr.spectra.ir_lr': HEAVY,
+    'vstr.spectra.ir_exact': HEAVY,
+}
+
+PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps({"time": t, "modules": sorted(set(m.split(".")[0] for m in sys.modules))}))
+'''
+
+def TimeImport(Module, Repeat = 5):
+    '''
+    Median wall time in seconds to import Module in a fresh interpreter and the top level packages
+    loaded with it
+    '''
+    Times = []
+    Modules = []
+    for r in range(Repeat):
+        Out = subprocess.run([sys.executable, "-c", PROBE % Module], capture_output = True, text = True)
+        if Out.returncode != 0:
+            raise RuntimeError("Importing %s failed:\n%s" % (Module, Out.stderr))
+        Result = json.loads(Out.stdout.strip().splitlines()[-1])
+        Times.append(Result["time"])
+        Modules = Result["modules"]
+    return float(np.median(Times)), Modules
+
+def CheckImports(EntryPoints = None, Repeat = 5, MaxTime = None):
+    '''
+    Times the import of every entry point and lists the forbidden heavy modules each one loaded. Returns
+    the results and the number of entry points that loaded a forbidden module or took longer than
+    MaxTime seconds.
+    '''
+    if EntryPoints is None:
+        EntryPoints = ENTRY_POINTS
+    Results = dict()
+    NFail = 0
+    print("%-28s %10s   %s" % ("Module", "Time (ms)", "Heavy modules"), flush = True)
+    for Module, Forbidden in EntryPoints.items():
+        Time, Modules = TimeImport(Module, Repeat = Repeat)
+        Loaded = [m for m in HEAVY if m in Modules]
+        Bad = [m for m in Loaded if m in Forbidden]
+        Slow = MaxTime is not None and Time > MaxTime
+        Results[Module] = {"time": Time, "heavy": Loaded, "forbidden": Bad}
+        Flag = ""
+        if Bad or Slow:
+            NFail += 1
+            Flag = "  FAIL" + (" (forbidden)" if Bad else "") + (" (slow)" if Slow else "")
+        print("%-28s %10.1f   %s%s" % (Module, 1000 * Time, ", ".join(Loaded) if Loaded else "-", Flag), flush = True)
+    return Results, NFail
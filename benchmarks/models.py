@@ -0,0 +1,232 @@
+import itertools
+from functools import reduce
+from math import factorial
+import numpy as np
+from vstr.utils import constants
+from vstr.ff.force_field import ScaleFC_me
+from vstr.nmode.mol import Molecule, NModePotential
+
+'''
+Synthetic vibrational models for benchmarking. Nothing here calls an electronic structure code, and
+every model is reproducible from its size and seed.
+'''
+
+def MorseTaylor(a, p, Order = 4):
+    '''
+    Taylor coefficients of (1 - exp(-a q))^p about q = 0 up to q^Order
+    '''
+    y = np.zeros(Order + 1)
+    for n in range(1, Order + 1):
+        y[n] = -(-a)**n / factorial(n)
+    yp = np.zeros(Order + 1)
+    yp[0] = 1.0
+    for _ in range(p):
+        yp = np.convolve(yp, y)[:Order + 1]
+    return yp
+
+class SyntheticNormalModes():
+    '''
+    Analytic stand-in for NormalModes. The potential and the dipole are sums of products of Morse
+    coordinates y_i = 1 - exp(-a_i q_i) in the mass-weighted normal coordinates. Terms are stored by
+    the sorted tuple of modes they couple as lists of (coefficient, powers), so the n-mode expansion
+    about q = 0 is exact once n reaches the largest coupling. Coordinates may be arrays, which are
+    broadcast against each other.
+    '''
+    def __init__(self, mol, freqs, a, VTerms, DTerms = None, mu0 = None):
+        self.mol = mol
+        self.freqs = np.asarray(freqs, dtype = float)
+        self.a = np.asarray(a, dtype = float)
+        self.nmodes = self.freqs.shape[0]
+        self.VTerms = VTerms
+        self.DTerms = {} if DTerms is None else DTerms
+        self.V0 = 0.0
+        self.mu0 = np.zeros(3) if mu0 is None else np.asarray(mu0)
+        self.B0 = np.zeros((9))
+        self.x0 = np.zeros((0, 3))
+        self.nm_coeff = None
+
+    def _evaluate(self, Terms, Modes, Qs, Dim = ()):
+        Order = sorted(range(len(Modes)), key = lambda k: Modes[k])
+        Key = tuple(Modes[k] for k in Order)
+        Ys = [1.0 - np.exp(-self.a[Modes[k]] * np.asarray(Qs[k], dtype = float)) for k in Order]
+        V = np.zeros(np.broadcast(*Ys).shape + Dim)
+        for Coeff, Powers in Terms.get(Key, []):
+            Y = reduce(np.multiply, [y**p for y, p in zip(Ys, Powers)])
+            V = V + np.multiply.outer(Y, Coeff)
+        return V[()]
+
+    def potential_1mode(self, i, qi):
+        return self._evaluate(self.VTerms, (i,), (qi,))
+
+    def potential_2mode(self, i, j, qi, qj):
+        return self._evaluate(self.VTerms, (i, j), (qi, qj))
+
+    def potential_3mode(self, i, j, k, qi, qj, qk):
+        return self._evaluate(self.VTerms, (i, j, k), (qi, qj, qk))
+
+    def potential_4mode(self, i, j, k, l, qi, qj, qk, ql):
+        return self._evaluate(self.VTerms, (i, j, k, l), (qi, qj, qk, ql))
+
+    def dipole_1mode(self, i, qi):
+        return self._evaluate(self.DTerms, (i,), (qi,), Dim = (3,))
+
+    def dipole_2mode(self, i, j, qi, qj):
+        return self._evaluate(self.DTerms, (i, j), (qi, qj), Dim = (3,))
+
+    def dipole_3mode(self, i, j, k, qi, qj, qk):
+        return self._evaluate(self.DTerms, (i, j, k), (qi, qj, qk), Dim = (3,))
+
+    def dipole_4mode(self, i, j, k, l, qi, qj, qk, ql):
+        return self._evaluate(self.DTerms, (i, j, k, l), (qi, qj, qk, ql), Dim = (3,))
+
+    def potential_nm(self, q):
+        '''
+        Full potential at normal coordinates q of shape (..., nmodes)
+        '''
+        q = np.asarray(q, dtype = float)
+        V = np.zeros(q.shape[:-1])
+        for Key in self.VTerms:
+            V = V + self._evaluate(self.VTerms, Key, [q[..., m] for m in Key])
+        return V[()]
+
+    def get_ff(self, Order = 4):
+        '''
+        Analytic cubic and quartic force constants, scaled and screened as in NormalModes.get_ff
+        '''
+        freq_cm = self.freqs * constants.AU_TO_INVCM
+        FC = dict()
+        for Key, Terms in self.VTerms.items():
+            for Coeff, Powers in Terms:
+                Taylor = [MorseTaylor(self.a[m], p, Order = Order) for m, p in zip(Key, Powers)]
+                for n in range(3, Order + 1):
+                    for Idx in itertools.combinations_with_replacement(range(len(Key)), n):
+                        Counts = [Idx.count(k) for k in range(len(Key))]
+                        if any(c < p for c, p in zip(Counts, Powers)):
+                            continue
+                        d = Coeff * np.prod([factorial(c) * t[c] for c, t in zip(Counts, Taylor)])
+                        Modes = tuple(Key[k] for k in Idx)
+                        FC[Modes] = FC.get(Modes, 0.0) + d
+        V3 = []
+        V4 = []
+        for Modes, d in sorted(FC.items()):
+            V = ScaleFC_me(d, freq_cm, list(Modes))
+            if abs(V) > 1.0:
+                if len(Modes) == 3:
+                    V3.append((V, list(Modes)))
+                else:
+                    V4.append((V, list(Modes)))
+        return V3, V4
+
+class SyntheticMolecule(Molecule):
+    '''
+    Molecule whose normal modes are a SyntheticNormalModes model rather than the minimum of a Cartesian
+    PES, so kernel() goes straight to the n-mode integrals and dipoles.
+    '''
+
+    def __init__(self, Frequencies, a, VTerms, DTerms = None, **kwargs):
+        Molecule.__init__(self, None, 0, [], **kwargs)
+        self.nm = SyntheticNormalModes(self, np.asarray(Frequencies) / constants.AU_TO_INVCM, a, VTerms, DTerms = DTerms)
+        self.Nm = self.nm.nmodes
+        self.CalcNM()
+
+    def CalcNM(self, x0 = None):
+        self.Nm = self.nm.nmodes
+        self.Frequencies = self.nm.freqs * constants.AU_TO_INVCM
+        self.x0 = self.nm.x0
+        self.V0 = self.nm.V0
+        self.mu0 = self.nm.mu0
+        self.CoM = np.zeros(3)
+
+    def IntegralsAsArrays(self):
+        '''
+        Replaces the object arrays made by CalcNModePotential and CalcNModeDipole with dense arrays in
+        the layout and precision of ReadIntegralsAsArrays and ReadDipolesAsArrays
+        '''
+        for n in range(self.Order):
+            self.ints[n] = np.array(self.ints[n].tolist(), dtype = self.IntsPrecision)
+            if self.calc_dipole:
+                self.dip_ints[n] = np.array(self.dip_ints[n].tolist(), dtype = self.IntsPrecision)
+
+    def CalcTT(self):
+        '''
+        Exact tensor train of the 1-mode terms and the couplings between neighbouring modes on the HEG
+        grid, contracted into core_tensors as in TCIMolecule.CalcTT. Each bond carries rank two plus
+        the number of coupling terms across it. Couplings between non-neighbouring modes are left out.
+        '''
+        K = self.ngridpts
+        gridpts, dvr_coeff = NModePotential(self.nm).get_heg([K] * self.Nm)
+        Bonds = [self.nm.VTerms.get((i, i + 1), []) for i in range(self.Nm - 1)]
+        cores = []
+        for i in range(self.Nm):
+            Left = Bonds[i - 1] if i > 0 else []
+            Right = Bonds[i] if i < self.Nm - 1 else []
+            y = 1.0 - np.exp(-self.nm.a[i] * gridpts[i])
+            G = np.zeros((2 + len(Left), K, 2 + len(Right)))
+            G[0, :, 0] = 1.0
+            G[0, :, 1] = self.nm.potential_1mode(i, gridpts[i])
+            G[1, :, 1] = 1.0
+            for t, (Coeff, Powers) in enumerate(Left):
+                G[2 + t, :, 1] = y**Powers[1]
+            for t, (Coeff, Powers) in enumerate(Right):
+                G[0, :, 2 + t] = Coeff * y**Powers[0]
+            if i == 0:
+                G = G[:1]
+            if i == self.Nm - 1:
+                G = G[:, :, 1:2]
+            cores.append(G)
+        self.gridpts, self.dvr_coeff = gridpts, dvr_coeff
+        self.cores = cores
+        self.core_tensors = [np.einsum('irj,nr,mr->ijnm', core, dvr_c, dvr_c, optimize = True) for core, dvr_c in zip(cores, dvr_coeff)]
+        self.tt_ranks = [core.shape[2] for core in cores[:-1]]
+
+def CoupledMorse(N, Seed = 0, FreqRange = (500, 3500), Anharmonicity = 0.02, Coupling = 0.05, CouplingRange = 2, Coupling3 = 0.01, DipoleCoupling = 0.1, **kwargs):
+    '''
+    N Morse oscillators with banded coupling. Frequencies are drawn from FreqRange in cm-1 and the
+    well depths set so that w_e x_e / w_e is about Anharmonicity. Modes i and j < i + CouplingRange
+    are coupled by one term lambda y_i^p y_j^q, and consecutive triples by mu y_i y_j y_k, each scaled
+    by Coupling or Coupling3 times the geometric mean of their well depths. The dipole is linear in
+    each y_i with bilinear terms between neighbours. Extra keyword arguments go to SyntheticMolecule.
+    '''
+    rng = np.random.default_rng(Seed)
+    w = np.sort(rng.uniform(FreqRange[0], FreqRange[1], N))[::-1]
+    wAU = w / constants.AU_TO_INVCM
+    D = wAU / (4 * Anharmonicity * rng.uniform(0.5, 1.5, N))
+    a = wAU / np.sqrt(2 * D)
+
+    VTerms = dict()
+    for i in range(N):
+        VTerms[(i,)] = [(D[i], (2,))]
+        for j in range(i + 1, min(i + CouplingRange + 1, N)):
+            Powers = [(1, 2), (2, 1), (2, 2)][rng.integers(3)]
+            VTerms[(i, j)] = [(Coupling * np.sqrt(D[i] * D[j]) * rng.standard_normal() / (j - i), Powers)]
+        if Coupling3 != 0 and i + 2 < N:
+            VTerms[(i, i + 1, i + 2)] = [(Coupling3 * np.cbrt(D[i] * D[i + 1] * D[i + 2]) * rng.standard_normal(), (1, 1, 1))]
+
+    DTerms = dict()
+    for i in range(N):
+        DTerms[(i,)] = [(1e-2 * rng.standard_normal(3) / a[i], (1,))]
+        if DipoleCoupling != 0 and i + 1 < N:
+            DTerms[(i, i + 1)] = [(1e-2 * DipoleCoupling * rng.standard_normal(3) / (a[i] * a[i + 1]), (1, 1))]
+
+    return SyntheticMolecule(w, a, VTerms, DTerms = DTerms, **kwargs)
+
+def RandomQFF(N, Seed = 0, FreqRange = (500, 3500), Cubic = 50.0, Quartic = 5.0, CouplingRange = 2):
+    '''
+    Random quartic force field in the format returned by utils.read_jf_input.Read, with cubic and
+    quartic constants in cm-1 between modes at most CouplingRange apart, decaying with that distance.
+    Diagonal quartic constants are positive. Returns the frequencies and [V3, V4].
+    '''
+    rng = np.random.default_rng(Seed)
+    w = np.sort(rng.uniform(FreqRange[0], FreqRange[1], N))[::-1]
+    V3 = []
+    V4 = []
+    for n, Scale, V in [(3, Cubic, V3), (4, Quartic, V4)]:
+        for i in range(N):
+            Window = range(i, min(i + CouplingRange + 1, N))
+            for Idx in itertools.combinations_with_replacement(Window, n - 1):
+                Modes = [i] + list(Idx)
+                fc = Scale * rng.standard_normal() * np.exp(-(Modes[-1] - Modes[0]) / CouplingRange)
+                if n == 4 and Modes.count(i) == 4:
+                    fc = abs(fc) * 2
+                V.append((fc, Modes))
+    return w, [V3, V4]
@@ -0,0 +1,52 @@
+import json
+import numpy as np
+from vstr.benchmarks.suite import SUITES, RunSuite
+
+'''
+Accuracy of the n-mode runs with the integrals and dipoles stored in single precision. Every n-mode case
+of a suite is run once with Molecule.IntsPrecision = 'float64' and once with 'float32', and the energies
+of the two runs are compared state by state. The kernels accumulate in double either way, so the
+deviations come only from rounding the integrals.
+'''
+
+ENERGIES = ["E_VSCF", "E_var", "E_PT2"]
+
+def ComparePrecision(Suite = "small", Cases = None, Tol = 0.01, Isolate = True, Quiet = True, OutFile = None):
+    '''
+    Runs the n-mode cases of Suite, or the given cases, in double and single precision and prints the
+    largest deviation of each energy in cm-1 and the memory of the integral and dipole tensors. Returns
+    the records of both runs and the number of cases that failed or deviate by more than Tol cm-1.
+    '''
+    if Cases is None:
+        Cases = SUITES[Suite]
+    Cases = [c for c in Cases if c["method"] == "nmode"]
+    Records = dict()
+    for Precision in ["float64", "float32"]:
+        print("Running the n-mode cases of suite %s in %s" % (Suite, Precision), flush = True)
+        Records[Precision] = RunSuite(Suite, Cases = [dict(c, IntsPrecision = Precision) for c in Cases], Isolate = Isolate, Quiet = Quiet)
+
+    NFail = 0
+    Report = dict()
+    print("%-14s %-8s %14s %12s %12s  %s" % ("Case", "Energy", "Max |dE| (cm-1)", "fp64 (MB)", "fp32 (MB)", "Status"), flush = True)
+    for Case in Cases:
+        Name = Case["name"]
+        Double = Records["float64"]["cases"][Name]
+        Single = Records["float32"]["cases"][Name]
+        if "error" in Double or "error" in Single:
+            NFail += 1
+            print("%-14s %-8s %s" % (Name, "", "ERROR " + Single.get("error", Double.get("error", ""))), flush = True)
+            continue
+        Report[Name] = dict()
+        for Key in ENERGIES:
+            if Key not in Double["results"]:
+                continue
+            dE = float(np.max(abs(np.asarray(Single["results"][Key]) - np.asarray(Double["results"][Key]))))
+            Report[Name][Key] = dE
+            Status = "ok" if dE <= Tol else "FAIL"
+            NFail += dE > Tol
+            print("%-14s %-8s %14.3e %12.1f %12.1f  %s" % (Name, Key, dE, Double["results"]["Integrals MB"], Single["results"]["Integrals MB"], Status), flush = True)
+    print("%d case(s) deviate by more than %.1e cm-1 or failed" % (NFail, Tol), flush = True)
+    if OutFile is not None:
+        with open(OutFile, "w") as f:
+            json.dump({"tol": Tol, "deviations": Report, "records": Records}, f, indent = 2)
+    return Records, NFail
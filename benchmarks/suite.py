@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import platform
+import contextlib
+import multiprocessing
+import numpy as np
+from vstr.utils.perf_utils import PROFILER, peak_rss, current_rss
+
+'''
+Benchmark suite over the synthetic models in benchmarks.models. Each case runs in a fresh process so
+that its peak memory is its own, and the times and memory of every stage are written to a JSON file
+which can be kept as a baseline and compared against later runs.
+'''
+
+QFF_DEFAULTS = {"method": "qff", "N": 10, "Seed": 0, "MaxQuanta": 4, "MaxTotalQuanta": 2, "NStates": 5, "eps1": 1.0, "eps2": 0.1}
+NMODE_DEFAULTS = {"method": "nmode", "N": 10, "Seed": 0, "Order": 2, "ngridpts": 6, "MaxTotalQuanta": 2, "NStates": 5, "eps1": 1.0, "eps2": 0.1, "HBMethod": "2mode", "VSCF": True, "IR": True, "NPoints": 20, "FreqRange": [0, 4000], "eta": 10, "IntsPrecision": "float64"}
+TCI_DEFAULTS = {"method": "tci", "N": 10, "Seed": 0, "ngridpts": 6, "MaxTotalQuanta": 2, "NStates": 5}
+
+SUITES = {
+    "small": [
+        dict(QFF_DEFAULTS, name = "qff_n10"),
+        dict(NMODE_DEFAULTS, name = "nmode2_n10"),
+        dict(TCI_DEFAULTS, name = "tci_n10"),
+    ],
+    "medium": [
+        dict(QFF_DEFAULTS, name = "qff_n30", N = 30, MaxTotalQuanta = 3),
+        dict(NMODE_DEFAULTS, name = "nmode2_n30", N = 30, ngridpts = 8),
+        dict(NMODE_DEFAULTS, name = "nmode3_n10", N = 10, Order = 3, IR = False),
+        dict(TCI_DEFAULTS, name = "tci_n30", N = 30, ngridpts = 8),
+    ],
+    "production": [
+        dict(QFF_DEFAULTS, name = "qff_n100", N = 100, MaxTotalQuanta = 3, eps1 = 0.5, eps2 = 0.05),
+        dict(NMODE_DEFAULTS, name = "nmode2_n60", N = 60, ngridpts = 8, IR = False),
+        dict(NMODE_DEFAULTS, name = "nmode2_n100", N = 100, ngridpts = 6, VSCF = False, IR = False),
+        dict(NMODE_DEFAULTS, name = "nmode3_n15", N = 15, Order = 3, IR = False),
+        dict(TCI_DEFAULTS, name = "tci_n100", N = 100, ngridpts = 8),
+    ],
+}
+
+def Harvest(Stages, Profiler, Names):
+    '''
+    Adds the regions of an object's profiler to Stages, renamed by Names. Times are exclusive of
+    nested regions, so a region wrapping another is not counted twice.
+    '''
+    for path, r in Profiler.regions.items():
+        Leaf = path.split("/")[-1]
+        if Leaf not in Names:
+            continue
+        Child = sum(c["time"] for p, c in Profiler.regions.items() if p.startswith(path + "/") and p.count("/") == path.count("/") + 1)
+        S = Stages.setdefault(Names[Leaf], {"time": 0., "calls": 0, "rss_mb": 0., "rss_growth_mb": 0., "counters": dict()})
+        S["time"] += r["time"] - Child
+        S["calls"] += r["calls"]
+        S["rss_mb"] = max(S["rss_mb"], r["rss_mb"])
+        S["rss_growth_mb"] = max(S["rss_growth_mb"], r["rss_growth_mb"])
+        for c, n in r["counters"].items():
+            S["counters"][c] = S["counters"].get(c, 0) + n
+
+VHCI_STAGES = {"Form Hamiltonian": "hamiltonian", "Diagonalize": "eigensolve", "Screen Basis": "screening", "PT2 correction": "pt2"}
+
+def RunQFF(Case, Prof, Stages):
+    from vstr.utils import init_funcs
+    from vstr.vhci.vhci import VHCI
+    from vstr.benchmarks.models import RandomQFF
+
+    N = Case["N"]
+    w, V = RandomQFF(N, Seed = Case["Seed"])
+    with Prof.region("basis"):
+        Basis = init_funcs.InitTruncatedBasis(N, w, [Case["MaxQuanta"]] * N, MaxTotalQuanta = Case["MaxTotalQuanta"])
+        Prof.count("configurations", len(Basis))
+    mVHCI = VHCI(w, V, MaxQuanta = Case["MaxQuanta"], MaxTotalQuanta = Case["MaxTotalQuanta"], NStates = Case["NStates"], eps1 = Case["eps1"], eps2 = Case["eps2"])
+    with Prof.region("vhci"):
+        mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = True)
+    Harvest(Stages, mVHCI.Timer, {k: v + "_qff" if v == "hamiltonian" else v for k, v in VHCI_STAGES.items()})
+    return {"NBasis": len(mVHCI.Basis), "E_var": mVHCI.E_HCI.tolist(), "E_PT2": mVHCI.E_HCI_PT2.tolist()}
+
+def RunNMode(Case, Prof, Stages):
+    from vstr.utils import init_funcs
+    from vstr.vhci.vhci import NModeVHCI
+    from vstr.mf.vscf import NModeVSCF
+    from vstr.spectra.ir_lr import LinearResponseIRNMode
+    from vstr.benchmarks.models import CoupledMorse
+
+    mol = CoupledMorse(Case["N"], Seed = Case["Seed"], Order = Case["Order"], ngridpts = Case["ngridpts"], calc_dipole = Case["IR"], IntsPrecision = Case["IntsPrecision"])
+    with Prof.region("nmode_ints"):
+        mol.kernel()
+        mol.IntegralsAsArrays()
+    Harvest(Stages, mol.Timer, {"%d-Mode Ints" % n: "nmode_ints_%d" % n for n in range(1, 6)})
+    Harvest(Stages, mol.Timer, {"%d-Mode Dips" % n: "nmode_dips_%d" % n for n in range(1, 6)})
+    Tensors = mol.ints[:mol.Order] + (mol.dip_ints[:mol.Order] if Case["IR"] else [])
+    Results = {"Integrals MB": sum(V.nbytes for V in Tensors) / 2**20}
+
+    if Case["VSCF"]:
+        mVSCF = NModeVSCF(mol, verbose = 0)
+        with Prof.region("vscf"):
+            Results["E_VSCF"] = float(mVSCF.kernel())
+            Prof.count("SCF iterations", mVSCF.Timer.counters.get("SCF iterations", 0))
+
+    mVHCI = NModeVHCI(mol, NStates = Case["NStates"], MaxTotalQuanta = Case["MaxTotalQuanta"], eps1 = Case["eps1"], eps2 = Case["eps2"], HBMethod = Case["HBMethod"])
+    with Prof.region("basis"):
+        Basis = init_funcs.InitTruncatedBasis(mVHCI.NModes, mVHCI.Frequencies, mVHCI.MaxQuanta, MaxTotalQuanta = mVHCI.MaxTotalQuanta)
+        Prof.count("configurations", len(Basis))
+    with Prof.region("vhci"):
+        mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = True)
+    Harvest(Stages, mVHCI.Timer, {k: v + "_nmode" if v == "hamiltonian" else v for k, v in VHCI_STAGES.items()})
+    Results.update({"NBasis": len(mVHCI.Basis), "E_var": mVHCI.E_HCI.tolist(), "E_PT2": mVHCI.E_HCI_PT2.tolist()})
+
+    if Case["IR"]:
+        mIR = LinearResponseIRNMode(mVHCI, FreqRange = Case["FreqRange"], NPoints = Case["NPoints"], eta = Case["eta"])
+        with Prof.region("ir_response"):
+            mIR.kernel()
+        Harvest(Stages, mIR.Timer, {"Axb Solve": "ir_solve", "Dipole Hamiltonian": "ir_dipole"})
+        Results["GMRES iterations"] = int(sum(mIR.GMRESIterations))
+    return Results
+
+def RunTCI(Case, Prof, Stages):
+    from vstr.vhci.vhci import TCIVHCI
+    from vstr.benchmarks.models import CoupledMorse
+
+    mol = CoupledMorse(Case["N"], Seed = Case["Seed"], ngridpts = Case["ngridpts"])
+    with Prof.region("tensor_train"):
+        mol.CalcTT()
+    mVHCI = TCIVHCI(mol, NStates = Case["NStates"], MaxTotalQuanta = Case["MaxTotalQuanta"])
+    with Prof.region("vhci"):
+        mVHCI.kernel(doVCI = True, doVHCI = False)
+    Harvest(Stages, mVHCI.Timer, {"Form Hamiltonian": "hamiltonian_tci", "Diagonalize": "eigensolve"})
+    return {"NBasis": len(mVHCI.Basis), "E_var": mVHCI.E_HCI.tolist(), "TT ranks": [int(r) for r in mol.tt_ranks]}
+
+RUNNERS = {"qff": RunQFF, "nmode": RunNMode, "tci": RunTCI}
+
+def RunCase(Case, Quiet = True):
+    '''
+    Runs one benchmark case in this process and returns its record
+    '''
+    Prof = PROFILER(name = Case["name"])
+    Stages = dict()
+    rss0 = current_rss()
+    with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+        if Quiet:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        t0 = time.perf_counter()
+        Results = RUNNERS[Case["method"]](Case, Prof, Stages)
+        Total = time.perf_counter() - t0
+    Harvest(Stages, Prof, {path: path for path in Prof.regions if "/" not in path})
+    return {"params": Case, "stages": Stages, "total_time": Total, "peak_rss_mb": peak_rss(), "start_rss_mb": rss0, "results": Results}
+
+def _RunCaseWorker(Case, Quiet):
+    try:
+        return RunCase(Case, Quiet = Quiet)
+    except Exception as e:
+        return {"params": Case, "error": "%s: %s" % (type(e).__name__, e)}
+
+def Metadata():
+    import scipy
+    Meta = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(), "platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__, "cpu_count": os.cpu_count()}
+    for v in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        Meta[v] = os.environ.get(v)
+    try:
+        import subprocess
+        Meta["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True).stdout.strip()
+    except Exception:
+        Meta["commit"] = None
+    return Meta
+
+def RunSuite(Suite = "small", Cases = None, Repeat = 1, Isolate = True, Quiet = True, OutFile = None):
+    '''
+    Runs the named suite, or the given list of cases, and returns the record of the run. With Isolate,
+    each repetition of each case runs in a fresh process. Over repetitions, the fastest time, the
+    largest memory and the largest value of each counter of every stage are kept.
+    '''
+    if Cases is None:
+        Cases = SUITES[Suite]
+    Record = {"suite": Suite, "meta": Metadata(), "repeat": Repeat, "cases": dict()}
+    ctx = multiprocessing.get_context("spawn")
+    for Case in Cases:
+        Runs = []
+        for r in range(Repeat):
+            print("Running benchmark %s (%d/%d)" % (Case["name"], r + 1, Repeat), flush = True)
+            if Isolate:
+                with ctx.Pool(1) as pool:
+                    Runs.append(pool.apply(_RunCaseWorker, (Case, Quiet)))
+            else:
+                Runs.append(_RunCaseWorker(Case, Quiet))
+            if "error" in Runs[-1]:
+                print("  failed with %s" % Runs[-1]["error"], flush = True)
+                break
+            print("  %.3f s, peak %.1f MB" % (Runs[-1]["total_time"], Runs[-1]["peak_rss_mb"]), flush = True)
+        Record["cases"][Case["name"]] = MergeRuns(Runs)
+    if OutFile is not None:
+        SaveRecord(Record, OutFile)
+    return Record
+
+def MergeRuns(Runs):
+    if "error" in Runs[-1]:
+        return Runs[-1]
+    Merged = Runs[0]
+    for Run in Runs[1:]:
+        Merged["total_time"] = min(Merged["total_time"], Run["total_time"])
+        Merged["peak_rss_mb"] = max(Merged["peak_rss_mb"], Run["peak_rss_mb"])
+        for s, S in Run["stages"].items():
+            if s not in Merged["stages"]:
+                Merged["stages"][s] = S
+                continue
+            M = Merged["stages"][s]
+            M["time"] = min(M["time"], S["time"])
+            M["rss_mb"] = max(M["rss_mb"], S["rss_mb"])
+            M["rss_growth_mb"] = max(M["rss_growth_mb"], S["rss_growth_mb"])
+            for c, n in S["counters"].items():
+                M["counters"][c] = max(M["counters"].get(c, 0), n)
+    return Merged
+
+def SaveRecord(Record, FileName):
+    with open(FileName, "w") as f:
+        json.dump(Record, f, indent = 2)
+
+def LoadRecord(FileName):
+    with open(FileName, "r") as f:
+        return json.load(f)
+
+def Compare(Baseline, Current, TimeTol = 0.2, MemTol = 0.2, MinTime = 0.05, MinMem = 10.0, EnergyTol = 1e-4, Print = True):
+    '''
+    Compares two benchmark records stage by stage. A stage is flagged SLOWER when its time grew by
+    more than TimeTol and exceeds MinTime seconds, and MEMORY when its memory growth rose by more than
+    MemTol and MinMem MB. Results of cases run with identical parameters are checked to EnergyTol cm-1.
+    Returns the report lines and the number of regressions.
+    '''
+    Lines = []
+    NReg = 0
+    Lines.append("%-14s %-20s %10s %10s %7s %10s %10s  %s" % ("Case", "Stage", "Base (s)", "New (s)", "Ratio", "Base (MB)", "New (MB)", "Status"))
+    for Name, New in Current["cases"].items():
+        Base = Baseline["cases"].get(Name)
+        if Base is None:
+            Lines.append("%-14s %-20s %s" % (Name, "", "NEW CASE"))
+            continue
+        if "error" in New or "error" in Base:
+            Lines.append("%-14s %-20s %s" % (Name, "", "ERROR " + New.get("error", Base.get("error", ""))))
+            NReg += "error" in New
+            continue
+        Stages = list(Base["stages"]) + [s for s in New["stages"] if s not in Base["stages"]]
+        for s in Stages + ["total"]:
+            if s == "total":
+                B = {"time": Base["total_time"], "rss_growth_mb": Base["peak_rss_mb"] - Base["start_rss_mb"]}
+                C = {"time": New["total_time"], "rss_growth_mb": New["peak_rss_mb"] - New["start_rss_mb"]}
+            else:
+                B = Base["stages"].get(s)
+                C = New["stages"].get(s)
+            if B is None or C is None:
+                Lines.append("%-14s %-20s %s" % (Name, s, "MISSING" if C is None else "NEW STAGE"))
+                continue
+            Ratio = C["time"] / B["time"] if B["time"] > 0 else float("inf")
+            Status = []
+            if C["time"] > MinTime and C["time"] > (1 + TimeTol) * B["time"]:
+                Status.append("SLOWER")
+            elif B["time"] > MinTime and B["time"] > (1 + TimeTol) * C["time"]:
+                Status.append("faster")
+            if C["rss_growth_mb"] > (1 + MemTol) * B["rss_growth_mb"] + MinMem:
+                Status.append("MEMORY")
+            NReg += sum(x.isupper() for x in Status)
+            Lines.append("%-14s %-20s %10.3f %10.3f %7.2f %10.1f %10.1f  %s" % (Name, s, B["time"], C["time"], Ratio, B["rss_growth_mb"], C["rss_growth_mb"], " ".join(Status)))
+        if Base["params"] == New["params"]:
+            for Key in ["E_var", "E_PT2", "E_VSCF"]:
+                if Key in Base["results"] and Key in New["results"]:
+                    dE = np.max(abs(np.asarray(New["results"][Key]) - np.asarray(Base["results"][Key])))
+                    if dE > EnergyTol:
+                        Lines.append("%-14s %-20s max deviation %.6e cm-1  CHANGED" % (Name, Key, dE))
+                        NReg += 1
+    Lines.append("%d regression(s) against baseline from %s (%s)" % (NReg, Baseline["meta"].get("date"), Baseline["meta"].get("commit")))
+    if Print:
+        print("\n".join(Lines), flush = True)
+    return Lines, NReg
@@ -1,8 +1,8 @@
 import numpy as np
 from vstr import utils
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, HOFunc # classes from JF's code
-from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import HeatBath_Sort_FC, DoPT2FromVSCF, DoSPT2FromVSCF, VCIHamFromVSCF, VCISparseHamFromVSCF, AddStatesHB, AddStatesHBWithMax, AddStatesHBFromVSCF, AddStatesHBStoreCoupling, ContractedAnharmonicPotential, ContractedHOTerms
-from vstr.utils.perf_utils import TIMER
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import HeatBath_Sort_FC, DoPT2FromVSCFBatched, DoSPT2FromVSCF, VCIHamFromVSCF, VCISparseHamFromVSCF, AddStatesHB, AddStatesHBWithMax, AddStatesHBFromVSCF, AddStatesHBStoreCoupling, ContractedAnharmonicPotential, ContractedHOTerms
+from vstr.utils.perf_utils import PROFILER
 from functools import reduce
 import itertools
 import math
@@ -86,14 +86,16 @@ def ScreenBasis(mVHCI, Ws = None, C = None, eps = 0.01):
     if C is None:
         C = mVHCI.C[0]
     
+    MCR = -1 if mVHCI.MaxExcitedModes is None else mVHCI.MaxExcitedModes
+
     if mVHCI.HBMethod == 'exact':
-        UniqueBasis = AddStatesHBFromVSCF(mVHCI.Basis, Ws, C, eps, mVHCI.Ys)
+        UniqueBasis = AddStatesHBFromVSCF(mVHCI.Basis, Ws, C, eps, mVHCI.Ys, MCR)
     elif mVHCI.HBMethod == 'ho_max':
-        UniqueBasis = AddStatesHBWithMax(mVHCI.Basis, Ws, C, eps, mVHCI.MaxQuanta, mVHCI.HighestQuanta)
+        UniqueBasis = AddStatesHBWithMax(mVHCI.Basis, Ws, C, eps, mVHCI.MaxQuanta, mVHCI.HighestQuanta, MCR)
     elif mVHCI.HBMethod == 'ho_orig':
-        UniqueBasis = AddStatesHB(mVHCI.Basis, Ws, C, eps)
+        UniqueBasis = AddStatesHB(mVHCI.Basis, Ws, C, eps, MCR)
     elif mVHCI.HBMethod == 'coupling':
-        UniqueBasis = AddStatesHBStoreCoupling(mVHCI.Basis, Ws, C, eps, mVHCI.Ys)
+        UniqueBasis = AddStatesHBStoreCoupling(mVHCI.Basis, Ws, C, eps, mVHCI.Ys, MCR)
         return UniqueBasis, len(UniqueBasis[0])
     return UniqueBasis, len(UniqueBasis)
 
@@ -135,7 +137,7 @@ def PT2(mVHCI, doStochastic = False):
             mVHCI.Timer.stop(5)
     else:
         mVHCI.Timer.start(3)
-        mVHCI.dE_PT2 = DoPT2FromVSCF(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.eps2, mVHCI.NStates, mVHCI.Ys, mVHCI.Xs)
+        mVHCI.dE_PT2 = DoPT2FromVSCFBatched(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.eps2, mVHCI.NStates, mVHCI.Ys, mVHCI.Xs, mVHCI.PT2Batches, mVHCI.PT2MaxMem)
         mVHCI.Timer.stop(3)
     mVHCI.E_HCI_PT2 = mVHCI.E_HCI + mVHCI.dE_PT2
 
@@ -240,7 +242,7 @@ def PrintResults(mVHCI):
 
 def InitBasisAndC(mVHCI, Basis = None):
     if Basis is None:
-        mVHCI.Basis = utils.init_funcs.InitTruncatedBasis(mVHCI.NModes, mVHCI.Frequencies, mVHCI.MaxQuanta, MaxTotalQuanta = mVHCI.MaxTotalQuanta)
+        mVHCI.Basis = utils.init_funcs.InitTruncatedBasis(mVHCI.NModes, mVHCI.Frequencies, mVHCI.MaxQuanta, MaxTotalQuanta = mVHCI.MaxTotalQuanta, MaxExcitedModes = mVHCI.MaxExcitedModes)
     else:
         mVHCI.Basis = Basis
     mVHCI.C = None #np.eye(len(mVHCI.Basis))
@@ -313,6 +315,7 @@ class VCI:
         self.GenericV = mVSCF.AnharmTensor
 
         self.MaxTotalQuanta = MaxTotalQuanta
+        self.MaxExcitedModes = None # Mode combination range, None means no limit
         self.IncludeSqrt = True
         for Nm in self.MaxQuanta:
             assert(Nm >= self.MaxTotalQuanta)
@@ -325,6 +328,8 @@ class VCI:
         self.NStates = NStates
         self.NWalkers = 200
         self.NSamples = 50
+        self.PT2Batches = 1 # Number of hash partitions of the PT2 external space
+        self.PT2MaxMem = 0.0 # GB per partition, more partitions are made if exceeded, <= 0 means no budget
         self.dE_PT2 = None
         self.sE_PT2 = None
         self.HBMethod = 'exact' # ['ho_orig', 'ho_max', 'exact']
@@ -336,8 +341,8 @@ class VCI:
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(6)
         self.TimerNames = ['Diagonalize', 'Form Hamiltonian', 'Screen Basis', 'PT2 correction', 'SPT2 correction', 'SSPT2 correction']
+        self.Timer = PROFILER(self.TimerNames, name = "VCI")
 
     def kernel(self, doVCI = True, doVHCI = True, doPT2 = False, doSPT2 = False, ComparePT2 = False):
         if self.SaveToFile or self.ReadFromFile:
@@ -346,7 +351,7 @@ class VCI:
         if self.ReadFromFile:
             self.ReadBasisFromFile(self.CHKFile)
         else:
-            self.Basis = utils.init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta)
+            self.Basis = utils.init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta, MaxExcitedModes = self.MaxExcitedModes)
 
         self.Ys = ContractedAnharmonicPotential(self.ModalCs, self.GenericV)
         self.Xs = ContractedHOTerms(self.ModalCs, self.Frequencies)
@@ -28,6 +28,8 @@ Headers, libraries, and data structures for VHCI
 #include <vector>
 #include <map>
 #include <unordered_set>
+#include <queue>
+#include <functional>
 #include <algorithm>
 #include <sys/stat.h>
 #include <Eigen/Core>
@@ -120,6 +122,41 @@ class WaveFunction
 
 };
 
+// Mode combination range (MCR): a configuration may have at most MaxExcitedModes modes with nonzero quanta, and
+// MaxExcitedModes < 0 means no limit. The screening kernels count the excited modes of every configuration in the
+// basis once and only update that count for the modes a coupling changes.
+inline int ExcitedModes(const WaveFunction &WF)
+{
+    int NExcited = 0;
+    for (const HOFunc &HO : WF.Modes) NExcited += (HO.Quanta != 0);
+    return NExcited;
+}
+
+inline std::vector<int> CountExcitedModes(std::vector<WaveFunction> &BasisSet)
+{
+    std::vector<int> NExcited;
+    NExcited.reserve(BasisSet.size());
+    for (const WaveFunction &WF : BasisSet) NExcited.push_back(ExcitedModes(WF));
+    return NExcited;
+}
+
+inline int ExcitationChange(int n, int m) // Change in the number of excited modes when a mode goes from n to m quanta
+{
+    return (m != 0) - (n != 0);
+}
+
+inline bool WithinMCR(int NExcited, int MaxExcitedModes)
+{
+    return MaxExcitedModes < 0 || NExcited <= MaxExcitedModes;
+}
+
+inline bool WithinMCR(const WaveFunction &From, const WaveFunction &To, const std::vector<int> &Modes, int NExcited, int MaxExcitedModes)
+{
+    if (MaxExcitedModes < 0) return true;
+    for (int m : Modes) NExcited += ExcitationChange(From.Modes[m].Quanta, To.Modes[m].Quanta);
+    return NExcited <= MaxExcitedModes;
+}
+
 /*
 WaveFunction::WaveFunction(std::vector<int> Quantas, std::vector<double> Frequencies)
 {
@@ -199,6 +236,17 @@ struct WfnHasher
 };
 
 typedef unordered_set<WaveFunction, WfnHasher> HashedStates;
+
+// Hash batch of a configuration. The Boost hash is passed through the splitmix64 finalizer first, since its
+// low bits are far from uniform and the batch count is often a power of two.
+inline int WfnBatch(const WaveFunction& key, int NBatch)
+{
+    unsigned long long z = WfnHasher()(key) + 0x9e3779b97f4a7c15ULL;
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    z = z ^ (z >> 31);
+    return (int)(z % (unsigned long long)NBatch);
+}
 //typedef SparseMatrix<double, 0, ptrdiff_t> SpMat;
 //typedef Triplet<double, ptrdiff_t> Trip;
 typedef Eigen::SparseMatrix<double> SpMat;
@@ -296,7 +344,7 @@ inline void QDiffVec(WaveFunction&, WaveFunction&, int&, int&, std::vector<int>&
 inline bool ScreenState(int, int, const std::vector<int>&, const FConst&);
 std::vector<WaveFunction> AddStatesHBWithMax2(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta);
 void InternalAddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, HashedStates &HashedNewStates, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, int n, double Cn, double eps, std::vector<int> &MaxQuanta);
-std::vector<WaveFunction> AddStatesHBFromVSCF2(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY);
+std::vector<WaveFunction> AddStatesHBFromVSCF2(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY, int NBatch = 1, int Batch = 0);
 std::vector<WaveFunction> InternalAddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSet, HashedStates &HashedNewStates, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, int n, double Cn, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY);
 
 //Function declarations
@@ -309,12 +357,17 @@ SpMat GenerateSparseHamV(std::vector<WaveFunction> &BasisSet, std::vector<double
 SpMat GenerateSparseHamAnharmV(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC); 
 Eigen::MatrixXd GenerateHamAnharmV(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC);
 SpMat GenerateSparseHamVOD(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC);
+SpMat GenerateSparseHamAnharmVOD(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC);
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> GatherFusedTriplets(std::vector<std::vector<int>> &Rows, std::vector<std::vector<int>> &Cols, std::vector<std::vector<double>> &Vals);
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> GenerateSparseDipoleAnharmV(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<std::vector<FConst>> &OddFC, std::vector<std::vector<FConst>> &EvenFC, bool DiagonalBlock);
 
-std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps);
+std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, int MaxExcitedModes = -1);
 std::vector<FConst> HeatBath_Sort_FC(std::vector<FConst> &AnharmHB);
 
 std::vector<double> DoPT2(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig);
+std::vector<double> DoPT2Batched(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int NBatch, double MaxMem);
 std::tuple<std::vector<double>, std::vector<double>> DoSPT2(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int Nd, int Ns, bool SemiStochastic, double PT2_Eps2);
+std::tuple<std::vector<double>, std::vector<double>, std::vector<int>> DoSPT2Adaptive(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int Nd, int NsBatch, int NsMax, double TargetSE, unsigned int Seed, bool SemiStochastic, double PT2_Eps2);
 
 std::vector<Eigen::MatrixXd> GetVEffSLOW1CPP(std::vector<Eigen::SparseMatrix<double>> &AnharmTensor, std::vector<WaveFunction> Basis, std::vector<Eigen::MatrixXd> &CByModes, std::vector<std::vector<std::vector<int>>> &ModalSlices, std::vector<int> &MaxQuanta, std::vector<int> &ModeOcc, bool FirstV);std::vector<Eigen::MatrixXd> MakeCTensorsCPP(std::vector<Eigen::MatrixXd> &Cs, std::vector<std::vector<int>> QUniques, std::vector<int> ModeOcc, std::vector<std::vector<WaveFunction>> &RestrictedBases);
 Eigen::MatrixXd MakeCTensorCPP(std::vector<Eigen::MatrixXd> &Cs, std::vector<int> QUnique, std::vector<std::vector<int>> ModeOccs, std::vector<WaveFunction> &RestrictedBasis);
@@ -326,10 +379,11 @@ std::vector<Eigen::MatrixXd> ContractedHOTerms(std::vector<Eigen::MatrixXd> &Cs,
 Eigen::MatrixXd VCIHamFromVSCF(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, std::vector<FConst> &FCs, std::vector<Eigen::MatrixXd> &Cs, std::vector<Eigen::SparseMatrix<double>> &GenericV);
 //std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta);
 //std::tuple<std::vector<WaveFunction>, std::vector<int>> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta);
-std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta);
-std::vector<WaveFunction> AddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys);
+std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta, int MaxExcitedModes = -1);
+std::vector<WaveFunction> AddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, int MaxExcitedModes = -1);
 SpMat VCISparseHamFromVSCF(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, std::vector<FConst> &FCs, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs, bool DiagonalBlock);
 std::vector<double> DoPT2FromVSCF(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, double PT2_Eps, int NEig, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs);
+std::vector<double> DoPT2FromVSCFBatched(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, double PT2_Eps, int NEig, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs, int NBatch, double MaxMem);
 std::tuple<std::vector<double>, std::vector<double>> DoSPT2FromVSCF(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, double PT2_Eps, int NEig, int Nd, int Ns, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs, bool SemiStochastic, double PT2_Eps2);
 
 
@@ -338,7 +392,7 @@ Eigen::Matrix2d SetUij(double &theta);
 std::vector<Eigen::Matrix2d> SetUs(std::vector<double> &thetas);
 std::vector<FConst> ContractFCCPP(double V3[], double V4[], double V5[], double V6[], Eigen::MatrixXd &U, int N);
 
-std::tuple<std::vector<WaveFunction>, std::vector<double>> AddStatesHBStoreCoupling(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys);
+std::tuple<std::vector<WaveFunction>, std::vector<double>> AddStatesHBStoreCoupling(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, int MaxExcitedModes = -1);
 std::vector<WaveFunction> SpectralFrequencyPrune(double w, double E0, double eta, std::vector<WaveFunction> &BasisSet, std::vector<double> &Coupling, std::vector<double> Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, double eps);
 std::vector<WaveFunction> SpectralFrequencyPruneFromVSCF(double w, double E0, double eta, std::vector<WaveFunction> &BasisSet, std::vector<double> &Coupling, std::vector<double> Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<Eigen::MatrixXd> &Xs, double eps);
 std::complex<double> DoSpectralPT2(MatrixXcd& Evecs, VectorXd& Evals, MatrixXd& C, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<FConst> &Mu, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, double w, double eta);
@@ -346,14 +400,28 @@ std::complex<double> DoSpectralPT2(MatrixXcd& Evecs, VectorXd& Evals, MatrixXd&
 
 SpMat VCISparseHamNMode(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<std::vector<std::vector<double>>> &OneModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential, bool DiagonalBlock);
 SpMat VCISparseHamNModeFromOM(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential, bool DiagonalBlock);
-std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order);
+std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order, int MaxExcitedModes = -1);
 std::vector<WaveFunction> AddStatesCIPSI(std::vector<WaveFunction> &BasisSet, std::vector<WaveFunction> &ConnectedBasis, Eigen::VectorXd &C, Eigen::VectorXd &EVal, std::vector<double> &Frequencies, double V0, std::vector<std::vector<std::vector<double>>> &OneModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential, double eps);
-std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, Eigen::VectorXd C, double eps, bool ExactSingles);
+std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, Eigen::VectorXd C, double eps, bool ExactSingles, int MaxExcitedModes = -1);
 complex<double> DoSpectralPT2NMode(MatrixXcd& Evecs, VectorXd& Evals, MatrixXd& C, std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, double PT2_Eps, int NEig, double w, double eta);
 std::vector<double> VCISparseHamDiagonalNModeFromOM(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential);
-SpMat VCISparseHamNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, double OneModePotential[], double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ);
-SpMat VCISparseHamNModeFromOMArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ);
-double VCISparseHamNModeElementFromOMArray(WaveFunction &BasisSet1, WaveFunction &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], int MaxQ);
-std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &BasisSet, double TwoModePotential[], int SortedIndices[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ);
+template <typename Scalar>
+SpMat VCISparseHamNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, Scalar OneModePotential[], Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ);
+template <typename Scalar>
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> DipoleSparseNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Mu0, Scalar OneModeDipole[], Scalar TwoModeDipole[], Scalar ThreeModeDipole[], Scalar FourModeDipole[], Scalar FiveModeDipole[], std::vector<long int> &Strides, bool DiagonalBlock, int MaxNMode, int MaxQ);
+template <typename Scalar>
+SpMat VCISparseHamNModeFromOMArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ);
+template <typename Scalar>
+double VCISparseHamNModeElementFromOMArray(WaveFunction &BasisSet1, WaveFunction &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int MaxQ, int MaxNMode = 2);
+template <typename Scalar>
+std::vector<double> VCISparseHamDiagonalNModeFromOMArray(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int MaxNMode, int MaxQ);
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesCIPSIStreamArray(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order, Eigen::VectorXd &C, Eigen::VectorXd &EVal, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], double eps, int MaxAdd, int MaxQ, int MaxExcitedModes = -1);
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &BasisSet, Scalar TwoModePotential[], int SortedIndices[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes = -1);
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesHB3ModeArray(std::vector<WaveFunction> &BasisSet, Scalar TwoModePotential[], int SortedIndices[], Scalar ThreeModePotential[], int Sorted3Mode[], double Max3Mode[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes = -1);
+template <typename Scalar>
+std::vector<double> DoPT2NModeArray(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int SortedIndices[], double PT2_Eps, int NEig, int MaxNMode, int NModes, int MaxQ);
 //SpMat VCISparseHamTCI(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<torch::Tensor> CoreTensors, bool DiagonalBlock);
 SpMat VCISparseT(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, bool DiagonalBlock);
@@ -177,12 +177,13 @@ std::vector<FConst> HeatBath_Sort_FC(std::vector<FConst> &AnharmHB){
     */
 }
 
-std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps){ // Expand basis via Heat Bath algorithm
+std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     std::vector<double> CVec;
     for (unsigned int n = 0; n < C.rows(); n++) CVec.push_back(abs(C[n]));
@@ -200,7 +201,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                             WaveFunction tmp = BasisSet[n];
                             tmp.Modes[AnharmHB[i].QUnique[0]].Quanta += a;
                             if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
-                                                                HashedBasisInit.count(tmp) == 0
+                                                                WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                     ){ //make sure a|0> = 0 and tmp does not exist in original basis
                                 HashedNewStates.insert(tmp); // add new state to set
                             }
@@ -216,7 +217,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                                 tmp.Modes[AnharmHB[i].QUnique[1]].Quanta += b;
                                 if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
                                        tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0 && 
-                                                                       HashedBasisInit.count(tmp) == 0
+                                                                       WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                        ){ //make sure a|0> = 0
                                     HashedNewStates.insert(tmp); // add new state to set
                                 }
@@ -236,7 +237,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                                     if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
                                            tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0  &&
                                            tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
-                                           HashedBasisInit.count(tmp) == 0
+                                           WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                            ){ //make sure a|0> = 0
                                         HashedNewStates.insert(tmp); // add new state
                                     }
@@ -260,7 +261,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                                                tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0  &&
                                                tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
                                                tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
-                                               HashedBasisInit.count(tmp) == 0
+                                               WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                ){ //make sure a|0> = 0
                                             HashedNewStates.insert(tmp); // add new state
                                         }
@@ -288,7 +289,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                                                    tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
                                                    tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
                                                    tmp.Modes[AnharmHB[i].QUnique[4]].Quanta >=0 && 
-                                                   HashedBasisInit.count(tmp) == 0
+                                                   WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                    ){ //make sure a|0> = 0
                                                 HashedNewStates.insert(tmp); // add new state
                                             }
@@ -320,7 +321,7 @@ std::vector<WaveFunction> AddStatesHB(std::vector<WaveFunction> &BasisSet, std::
                                                        tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
                                                        tmp.Modes[AnharmHB[i].QUnique[4]].Quanta >=0 &&
                                                        tmp.Modes[AnharmHB[i].QUnique[5]].Quanta >=0 &&
-                                                                                                       HashedBasisInit.count(tmp) == 0
+                                                                                                       WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                        ){ //make sure a|0> = 0
                                                     HashedNewStates.insert(tmp); // add new state
                                                 }
@@ -1204,6 +1205,90 @@ SpMat GenerateSparseHamAnharmV(std::vector<WaveFunction> &BasisSet, std::vector<
     return H;
 }
 
+SpMat GenerateSparseHamAnharmVOD(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC)
+{
+    SpMat H(BasisSet1.size(), BasisSet2.size());
+    MakeHamSparseOD(H, BasisSet1, BasisSet2, Frequencies, AnharmFC, CubicFC, QuarticFC, QuinticFC, SexticFC, false, true);
+    return H;
+}
+
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> GatherFusedTriplets(std::vector<std::vector<int>> &Rows, std::vector<std::vector<int>> &Cols, std::vector<std::vector<double>> &Vals)
+{
+    // Concatenates per thread triplets of a three component operator into shared row and column indices
+    long unsigned int NNZ = 0;
+    for (unsigned int t = 0; t < Rows.size(); t++) NNZ += Rows[t].size();
+    Eigen::VectorXi R(NNZ);
+    Eigen::VectorXi C(NNZ);
+    Eigen::MatrixXd V(NNZ, 3);
+    long unsigned int k = 0;
+    for (unsigned int t = 0; t < Rows.size(); t++)
+    {
+        for (unsigned int a = 0; a < Rows[t].size(); a++)
+        {
+            R[k] = Rows[t][a];
+            C[k] = Cols[t][a];
+            for (unsigned int x = 0; x < 3; x++) V(k, x) = Vals[t][3 * a + x];
+            k++;
+        }
+        Rows[t] = std::vector<int>();
+        Cols[t] = std::vector<int>();
+        Vals[t] = std::vector<double>();
+    }
+    return std::make_tuple(R, C, V);
+}
+
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> GenerateSparseDipoleAnharmV(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<std::vector<FConst>> &OddFC, std::vector<std::vector<FConst>> &EvenFC, bool DiagonalBlock)
+{
+    // Builds all three dipole components in one pass over the configuration pairs. OddFC[x] and EvenFC[x] hold the
+    // odd and even order terms of component x. Returns the shared row and column indices and the three value columns.
+    int fcmax = 0;
+    for (unsigned int x = 0; x < 3; x++)
+    {
+        for (unsigned int k = 0; k < OddFC[x].size(); k++) fcmax = std::max(fcmax, (int)OddFC[x][k].fcpow.size());
+        for (unsigned int k = 0; k < EvenFC[x].size(); k++) fcmax = std::max(fcmax, (int)EvenFC[x][k].fcpow.size());
+    }
+
+    int NThreads = omp_get_max_threads();
+    std::vector<std::vector<int>> Rows(NThreads);
+    std::vector<std::vector<int>> Cols(NThreads);
+    std::vector<std::vector<double>> Vals(NThreads);
+    #pragma omp parallel for schedule(dynamic)
+    for (unsigned int i = 0; i < BasisSet1.size(); i++)
+    {
+        int t = omp_get_thread_num();
+        vector<int> qdiffvec(BasisSet1[0].M, 0);
+        unsigned int jstart = 0;
+        if (DiagonalBlock) jstart = i;
+        for (unsigned int j = jstart; j < BasisSet2.size(); j++)
+        {
+            int mchange = 0;
+            int qdiff = 0;
+            QDiffVec(BasisSet1[i], BasisSet2[j], qdiff, mchange, qdiffvec);
+            if (qdiff > fcmax || mchange > fcmax) continue;
+            std::vector<std::vector<FConst>> &FCs = (qdiff % 2 == 0) ? EvenFC : OddFC;
+            double Vij[3] = {0.0, 0.0, 0.0};
+            for (unsigned int x = 0; x < 3; x++)
+            {
+                for (unsigned int k = 0; k < FCs[x].size(); k++)
+                {
+                    if (ScreenState(qdiff, mchange, qdiffvec, FCs[x][k])) Vij[x] += AnharmPot(BasisSet1[i], BasisSet2[j], FCs[x][k]);
+                }
+            }
+            if (abs(Vij[0]) < 1e-12 && abs(Vij[1]) < 1e-12 && abs(Vij[2]) < 1e-12) continue;
+            Rows[t].push_back(i);
+            Cols[t].push_back(j);
+            for (unsigned int x = 0; x < 3; x++) Vals[t].push_back(Vij[x]);
+            if (DiagonalBlock && i != j)
+            {
+                Rows[t].push_back(j);
+                Cols[t].push_back(i);
+                for (unsigned int x = 0; x < 3; x++) Vals[t].push_back(Vij[x]);
+            }
+        }
+    }
+    return GatherFusedTriplets(Rows, Cols, Vals);
+}
+
 // PT2.cpp
 
 std::vector<double> StateProbability(std::vector<double>& CMax)
@@ -1222,17 +1307,50 @@ std::vector<double> StateProbability(std::vector<double>& CMax)
     return CProbability;
 }
 
+void FillWalkers(std::map<int, int>& WalkerPopulation, std::vector<double>& C, int Nd, std::mt19937 &Gen)
+{
+    std::discrete_distribution<> Distribution(C.begin(), C.end());
+
+    for (unsigned int i = 0; i < Nd; i++) WalkerPopulation[Distribution(Gen)]++;
+}
+
 void FillWalkers(std::map<int, int>& WalkerPopulation, std::vector<double>& C, int Nd)
 {
     std::random_device RD;
     std::mt19937 Gen(RD());
+    FillWalkers(WalkerPopulation, C, Nd, Gen);
+}
 
-    std::discrete_distribution<> Distribution(C.begin(), C.end());
+// Rough footprint of one stored external state, counting the hashed set and the vector copy
+inline double PT2StateBytes(int M)
+{
+    return 2.0 * (sizeof(WaveFunction) + M * sizeof(HOFunc)) + 4.0 * sizeof(void*);
+}
 
-    for (unsigned int i = 0; i < Nd; i++) WalkerPopulation[Distribution(Gen)]++;
+// The external space is sized from a trial batch holding 1 / PT2SampleBatches of it before any batch is generated
+const int PT2SampleBatches = 64;
+
+// Returns the number of hash batches needed so that one batch fits in MaxMem (GB), given the size of the trial
+// batch. The estimate is padded by 10% for the spread of the batch sizes.
+inline int PT2NumBatches(long unsigned int NSample, int NBatch, int M, double MaxMem)
+{
+    if (MaxMem <= 0.0) return NBatch;
+    double Mem = 1.1 * NSample * PT2SampleBatches * PT2StateBytes(M) / 1e9;
+    return std::max(NBatch, (int)ceil(Mem / MaxMem));
 }
 
 std::vector<double> DoPT2(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, /*std::vector<int> &HighestQuanta*/ std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig)
+{
+    return DoPT2Batched(Evecs, Evals, BasisSet, AnharmHB, AnharmFC, CubicFC, QuarticFC, QuinticFC, SexticFC, Ys, PT2_Eps, NEig, 1, 0.0);
+}
+
+/*
+    Deterministic PT2 where the external space is split into NBatch disjoint batches by the hash of each
+    configuration. Each batch is generated and accumulated on its own, so only one batch is held in memory.
+    If MaxMem (GB) is positive, the number of batches is increased so that each batch fits, sized from a sample
+    of the external space taken before any batch is generated.
+*/
+std::vector<double> DoPT2Batched(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int NBatch, double MaxMem)
 {
     int N_opt;
     if(NEig > BasisSet.size()){ // If we don't have enough states to optimize for yet
@@ -1294,100 +1412,244 @@ std::vector<double> DoPT2(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunc
 
     for (unsigned int n = 0; n < N_opt; n++)
     {
-        std::vector<WaveFunction> PTBasisSet = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY);
-        std::cout << " Perturbative space for state " << n << " contains " << PTBasisSet.size() << " basis states." << std::endl;
-
-        #pragma omp parallel for
-        for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+        int NB = std::max(NBatch, 1);
+        if (MaxMem > 0.0)
         {
-            double HaiCi = 0.0;
-            vector<int> qdiffvec(BasisSet[0].M,0);
-            for (unsigned int i = 0; i < BasisSet.size(); i++)
+            std::vector<WaveFunction> PTSample = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY, PT2SampleBatches, 0);
+            int NBNew = PT2NumBatches(PTSample.size(), NB, BasisSet[0].M, MaxMem);
+            if (NBNew > NB)
             {
-                double Hai = 0;
-                int mchange = 0; // number of modes with nonzero change in quanta
-                int qdiff = 0; // total number of quanta difference 
-                QDiffVec(PTBasisSet[a], BasisSet[i], qdiff, mchange, qdiffvec);
-                if(qdiff <= fcmax && mchange <= fcmax && qdiff%2==0)
-                { 
-                    // States cannot differ by more than fcmax quanta
-                    for (unsigned int k=0;k<QuarticFC.size();k++)
-                    {
-                        if ( ScreenState(qdiff,mchange,qdiffvec,QuarticFC[k]) ){
-                            //Screen force constants for connection                      
-                            //Add anharmonic matrix elements
-                            Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuarticFC[k]);
+                std::cout << " Perturbative space exceeds memory budget, using " << NBNew << " batches." << std::endl;
+                NB = NBNew;
+            }
+        }
+        for (int b = 0; b < NB; b++)
+        {
+            std::vector<WaveFunction> PTBasisSet = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY, NB, b);
+            std::cout << " Perturbative space for state " << n << " batch " << b + 1 << "/" << NB << " contains " << PTBasisSet.size() << " basis states." << std::endl;
+
+            #pragma omp parallel for
+            for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+            {
+                double HaiCi = 0.0;
+                vector<int> qdiffvec(BasisSet[0].M,0);
+                for (unsigned int i = 0; i < BasisSet.size(); i++)
+                {
+                    double Hai = 0;
+                    int mchange = 0; // number of modes with nonzero change in quanta
+                    int qdiff = 0; // total number of quanta difference 
+                    QDiffVec(PTBasisSet[a], BasisSet[i], qdiff, mchange, qdiffvec);
+                    if(qdiff <= fcmax && mchange <= fcmax && qdiff%2==0)
+                    { 
+                        // States cannot differ by more than fcmax quanta
+                        for (unsigned int k=0;k<QuarticFC.size();k++)
+                        {
+                            if ( ScreenState(qdiff,mchange,qdiffvec,QuarticFC[k]) ){
+                                //Screen force constants for connection                      
+                                //Add anharmonic matrix elements
+                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuarticFC[k]);
+                            }
                         }
+                        for (unsigned int k=0;k<SexticFC.size();k++)
+                        {
+                            if ( ScreenState(qdiff,mchange,qdiffvec,SexticFC[k]) ){
+                                //Screen force constants for connection                      
+                                //Add anharmonic matrix elements
+                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], SexticFC[k]);
+                            }
+                        }
+                        HaiCi += Hai * Evecs(i, n); // C_i Hai for each eigenvalue of interest
                     }
-                    for (unsigned int k=0;k<SexticFC.size();k++)
-                    {
-                        if ( ScreenState(qdiff,mchange,qdiffvec,SexticFC[k]) ){
-                            //Screen force constants for connection                      
-                            //Add anharmonic matrix elements
-                            Hai += AnharmPot(PTBasisSet[a], BasisSet[i], SexticFC[k]);
+                    if(qdiff <= fcmax-1 && mchange <= fcmax-1 && qdiff%2==1)
+                    { 
+                        // fcmax-1 assumes 4th or 6th max order 
+                        // States cannot differ by more than fcmax quanta
+                        for (unsigned int k=0;k<CubicFC.size();k++)
+                        {
+                            if ( ScreenState(qdiff,mchange,qdiffvec,CubicFC[k]) ){
+                                //Screen force constants for connection                      
+                                //Add anharmonic matrix elements
+                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], CubicFC[k]);
+                            }
                         }
+                        for (unsigned int k=0;k<QuinticFC.size();k++)
+                        {
+                            if ( ScreenState(qdiff,mchange,qdiffvec,QuinticFC[k]) ){
+                                //Screen force constants for connection                      
+                                //Add anharmonic matrix elements
+                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuinticFC[k]);
+                            }
+                        }
+                        HaiCi += Hai * Evecs(i, n); // C_i Hai for each eigenvalue of interest
                     }
-                    HaiCi += Hai * Evecs(i, n); // C_i Hai for each eigenvalue of interest
                 }
-                if(qdiff <= fcmax-1 && mchange <= fcmax-1 && qdiff%2==1)
-                { 
-                    // fcmax-1 assumes 4th or 6th max order 
-                    // States cannot differ by more than fcmax quanta
-                    for (unsigned int k=0;k<CubicFC.size();k++)
+                double Ea = 0.; //Hii matrix element
+                for (unsigned int j = 0; j < PTBasisSet[a].M; j++)
+                {
+                  //Calculate partial energies
+                  double Ej = 0.5;
+                  Ej += PTBasisSet[a].Modes[j].Quanta;
+                  Ej *= PTBasisSet[a].Modes[j].Freq;
+                  //Update matrix element
+                  Ea += Ej;
+                }
+                vector<int> zerodiffvec(BasisSet[0].M,0);
+                int qdiff=0;
+                int mchange=0;
+                for (unsigned int k = 0; k < QuarticFC.size(); k++) // Only even-ordered fc can affect this
+                {
+                    if (ScreenState(qdiff, mchange, zerodiffvec, QuarticFC[k]))
                     {
-                        if ( ScreenState(qdiff,mchange,qdiffvec,CubicFC[k]) ){
-                            //Screen force constants for connection                      
-                            //Add anharmonic matrix elements
-                            Hai += AnharmPot(PTBasisSet[a], BasisSet[i], CubicFC[k]);
-                        }
+                        // Screen force constants that cannot connect basis states a and a
+                        //Add anharmonic matrix elements
+                        Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], QuarticFC[k]);
                     }
-                    for (unsigned int k=0;k<QuinticFC.size();k++)
+                }
+                for (unsigned int k = 0; k < SexticFC.size(); k++) // Only even-ordered fc can affect this
+                {    
+                    if (ScreenState(qdiff, mchange, zerodiffvec, SexticFC[k]))
                     {
-                        if ( ScreenState(qdiff,mchange,qdiffvec,QuinticFC[k]) ){
-                            //Screen force constants for connection                      
-                            //Add anharmonic matrix elements
-                            Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuinticFC[k]);
-                        }
+                        // Screen force constants that cannot connect basis states a and a
+                        //Add anharmonic matrix elements
+                        Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], SexticFC[k]);
                     }
-                    HaiCi += Hai * Evecs(i, n); // C_i Hai for each eigenvalue of interest
                 }
+                #pragma omp atomic // Will cause floating point error if blindly done in parallel
+                DeltaE[n] += pow(HaiCi, 2) / (Evals(n) - Ea);
             }
-            double Ea = 0.; //Hii matrix element
-            for (unsigned int j = 0; j < PTBasisSet[a].M; j++)
-            {
-              //Calculate partial energies
-              double Ej = 0.5;
-              Ej += PTBasisSet[a].Modes[j].Quanta;
-              Ej *= PTBasisSet[a].Modes[j].Freq;
-              //Update matrix element
-              Ea += Ej;
-            }
-            vector<int> zerodiffvec(BasisSet[0].M,0);
-            int qdiff=0;
-            int mchange=0;
-            for (unsigned int k = 0; k < QuarticFC.size(); k++) // Only even-ordered fc can affect this
-            {
-                if (ScreenState(qdiff, mchange, zerodiffvec, QuarticFC[k]))
+        }
+    }
+    return DeltaE;    
+}
+
+// One stochastic sample of the (S)SPT2 energy for state n, drawing Nd walkers with the given generator.
+// PTSize returns the size of the sampled perturbative space.
+double SPT2Sample(std::vector<double> &Cn, MatrixXd& Evecs, VectorXd& Evals, int n, int Nd, std::vector<WaveFunction> &BasisSet, std::vector<WaveFunction> &DetPTBasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY, int fcmax, double PT2_Eps, bool SemiStochastic, double PT2_Eps2, std::mt19937 &Gen, long unsigned int &PTSize)
+{
+    double DeltaE = 0.0;
+    std::vector<double> WalkerProbability = StateProbability(Cn);
+    std::map<int, int> WalkerPopulation;
+    FillWalkers(WalkerPopulation, WalkerProbability, Nd, Gen);
+
+    std::vector<WaveFunction> PTBasisSet;
+    HashedStates PTBasisSetHashed;
+    if (SemiStochastic)
+    {
+        std::vector<WaveFunction> VarDetBasisSet; // Actually I think this destructs outside of this if statement.
+        for (const WaveFunction &WF : BasisSet) VarDetBasisSet.push_back(WF);
+        for (const WaveFunction &WF : DetPTBasisSet) VarDetBasisSet.push_back(WF);
+        for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
+        {
+            int i = it->first;
+            InternalAddStatesHBFromVSCF(VarDetBasisSet, PTBasisSetHashed, AnharmHB, WVec, WSortedInd, i, Evecs(i, n), PT2_Eps2, Ys, YSortedColInd, MaxY);
+        }
+    }
+    else
+    {
+        for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
+        {
+            int i = it->first;
+            InternalAddStatesHBFromVSCF(BasisSet, PTBasisSetHashed, AnharmHB, WVec, WSortedInd, i, Evecs(i, n), PT2_Eps, Ys, YSortedColInd, MaxY);
+        }
+    }
+    for (const WaveFunction &WF : PTBasisSetHashed) PTBasisSet.push_back(WF);
+    PTBasisSetHashed = HashedStates();
+    PTSize = PTBasisSet.size();
+    //std::cout << " Perturbative space for state " << n << " and sample " << s << " contains " << PTBasisSet.size() << " stochastic basis states." << std::endl;
+
+    for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+    {
+        double HaiCi = 0.0;
+        double Hai2Ci2 = 0.0;
+        vector<int> qdiffvec(BasisSet[0].M,0);
+        for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
+        {
+            int i = it->first;
+            double Hai = 0;
+            int mchange = 0; // number of modes with nonzero change in quanta
+            int qdiff = 0; // total number of quanta difference 
+            QDiffVec(PTBasisSet[a], BasisSet[i], qdiff, mchange, qdiffvec);
+            if(qdiff <= fcmax && mchange <= fcmax && qdiff%2==0)
+            { 
+                // States cannot differ by more than fcmax quanta
+                for (unsigned int k=0;k<QuarticFC.size();k++)
                 {
-                    // Screen force constants that cannot connect basis states a and a
-                    //Add anharmonic matrix elements
-                    Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], QuarticFC[k]);
+                    if ( ScreenState(qdiff,mchange,qdiffvec,QuarticFC[k]) ){
+                        //Screen force constants for connection                      
+                        //Add anharmonic matrix elements
+                        Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuarticFC[k]);
+                    }
                 }
+                for (unsigned int k=0;k<SexticFC.size();k++)
+                {
+                    if ( ScreenState(qdiff,mchange,qdiffvec,SexticFC[k]) ){
+                        //Screen force constants for connection                      
+                        //Add anharmonic matrix elements
+                        Hai += AnharmPot(PTBasisSet[a], BasisSet[i], SexticFC[k]);
+                    }
+                }
+                HaiCi += (Hai * Evecs(i, n) * WalkerPopulation[i]) / WalkerProbability[i]; // C_i Hai for each eigenvalue of interest
+                Hai2Ci2 += (pow(Hai, 2) * pow(Evecs(i, n), 2)) * (WalkerPopulation[i] * (Nd - 1) / WalkerProbability[i] - pow(WalkerPopulation[i], 2) / pow(WalkerProbability[i], 2));
             }
-            for (unsigned int k = 0; k < SexticFC.size(); k++) // Only even-ordered fc can affect this
-            {    
-                if (ScreenState(qdiff, mchange, zerodiffvec, SexticFC[k]))
+            if(qdiff <= fcmax-1 && mchange <= fcmax-1 && qdiff%2==1)
+            { 
+                // fcmax-1 assumes 4th or 6th max order 
+                // States cannot differ by more than fcmax quanta
+                for (unsigned int k=0;k<CubicFC.size();k++)
                 {
-                    // Screen force constants that cannot connect basis states a and a
-                    //Add anharmonic matrix elements
-                    Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], SexticFC[k]);
+                    if ( ScreenState(qdiff,mchange,qdiffvec,CubicFC[k]) ){
+                        //Screen force constants for connection                      
+                        //Add anharmonic matrix elements
+                        Hai += AnharmPot(PTBasisSet[a], BasisSet[i], CubicFC[k]);
+                    }
+                }
+                for (unsigned int k=0;k<QuinticFC.size();k++)
+                {
+                    if ( ScreenState(qdiff,mchange,qdiffvec,QuinticFC[k]) ){
+                        //Screen force constants for connection                      
+                        //Add anharmonic matrix elements
+                        Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuinticFC[k]);
+                    }
                 }
+                HaiCi += (Hai * Evecs(i, n) * WalkerPopulation[i]) / WalkerProbability[i]; // C_i Hai for each eigenvalue of interest
+                Hai2Ci2 += (pow(Hai, 2) * pow(Evecs(i, n), 2)) * (WalkerPopulation[i] * (Nd - 1) / WalkerProbability[i] - pow(WalkerPopulation[i], 2) / pow(WalkerProbability[i], 2));
             }
-            #pragma omp atomic // Will cause floating point error if blindly done in parallel
-            DeltaE[n] += pow(HaiCi, 2) / (Evals(n) - Ea);
         }
+        double Ea = 0.; //Hii matrix element
+        for (unsigned int j = 0; j < PTBasisSet[a].M; j++)
+        {
+          //Calculate partial energies
+          double Ej = 0.5;
+          Ej += PTBasisSet[a].Modes[j].Quanta;
+          Ej *= PTBasisSet[a].Modes[j].Freq;
+          //Update matrix element
+          Ea += Ej;
+        }
+        vector<int> zerodiffvec(BasisSet[0].M,0);
+        int qdiff=0;
+        int mchange=0;
+        for (unsigned int k = 0; k < QuarticFC.size(); k++) // Only even-ordered fc can affect this
+        {
+            if (ScreenState(qdiff, mchange, zerodiffvec, QuarticFC[k]))
+            {
+                // Screen force constants that cannot connect basis states a and a
+                //Add anharmonic matrix elements
+                Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], QuarticFC[k]);
+            }
+        }
+        for (unsigned int k = 0; k < SexticFC.size(); k++) // Only even-ordered fc can affect this
+        {    
+            if (ScreenState(qdiff, mchange, zerodiffvec, SexticFC[k]))
+            {
+                // Screen force constants that cannot connect basis states a and a
+                //Add anharmonic matrix elements
+                Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], SexticFC[k]);
+            }
+        }
+        DeltaE += (pow(HaiCi, 2) + Hai2Ci2) / ((Evals(n) - Ea) * Nd * (Nd - 1));
     }
-    return DeltaE;    
+
+    return DeltaE;
 }
 
 std::tuple<std::vector<double>, std::vector<double>> DoSPT2(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, /*std::vector<int> &HighestQuanta*/ std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int Nd, int Ns, bool SemiStochastic = false, double PT2_Eps2 = 0.0)
@@ -1566,156 +1828,160 @@ std::tuple<std::vector<double>, std::vector<double>> DoSPT2(MatrixXd& Evecs, Vec
         #pragma omp parallel for
         for (unsigned int s = 0; s < Ns; s++)
         {
-            std::vector<double> WalkerProbability = StateProbability(Cn);
-            std::map<int, int> WalkerPopulation;
-            FillWalkers(WalkerPopulation, WalkerProbability, Nd);
+            std::random_device RD;
+            std::mt19937 Gen(RD());
+            long unsigned int PTSize = 0;
+            DeltaEs[s] = SPT2Sample(Cn, Evecs, Evals, n, Nd, BasisSet, DetPTBasisSet, AnharmHB, WVec, WSortedInd, CubicFC, QuarticFC, QuinticFC, SexticFC, Ys, YSortedColInd, MaxY, fcmax, PT2_Eps, SemiStochastic, PT2_Eps2, Gen, PTSize);
+            #pragma omp atomic
+            PTBasisSize += PTSize;
+        }
+        DeltaESample.push_back(DeltaEs);
+        std::cout << " Perturbative space for state " << n << " contains " << (float)PTBasisSize / (float)Ns << " stochastic basis states on average." << std::endl;
+    }
 
-            std::vector<WaveFunction> PTBasisSet;
-            HashedStates PTBasisSetHashed;
-            if (SemiStochastic)
-            {
-                std::vector<WaveFunction> VarDetBasisSet; // Actually I think this destructs outside of this if statement.
-                for (const WaveFunction &WF : BasisSet) VarDetBasisSet.push_back(WF);
-                for (const WaveFunction &WF : DetPTBasisSet) VarDetBasisSet.push_back(WF);
-                for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
-                {
-                    int i = it->first;
-                    InternalAddStatesHBFromVSCF(VarDetBasisSet, PTBasisSetHashed, AnharmHB, WVec, WSortedInd, i, Evecs(i, n), PT2_Eps2, Ys, YSortedColInd, MaxY);
-                }
-            }
-            else
-            {
-                for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
-                {
-                    int i = it->first;
-                    InternalAddStatesHBFromVSCF(BasisSet, PTBasisSetHashed, AnharmHB, WVec, WSortedInd, i, Evecs(i, n), PT2_Eps, Ys, YSortedColInd, MaxY);
-                }
-            }
-            for (const WaveFunction &WF : PTBasisSetHashed) PTBasisSet.push_back(WF);
-            PTBasisSetHashed = HashedStates();
-            PTBasisSize += PTBasisSet.size();
-            //std::cout << " Perturbative space for state " << n << " and sample " << s << " contains " << PTBasisSet.size() << " stochastic basis states." << std::endl;
+    std::vector<double> SigmaDeltaE(N_opt, 0.0);
+    for (unsigned int n = 0; n < N_opt; n++)
+    {
+        for (unsigned int s = 0; s < Ns; s++)
+        {
+            DeltaE[n] += DeltaESample[n][s];
+            //SigmaDeltaE[n] += pow(DeltaESample[n][s], 2);
+        }
+        //SigmaDeltaE[n] -= (pow(DeltaE[n], 2) / Ns);
+        DeltaE[n] /= Ns;
+        std::cout << setprecision(12);
+        for (unsigned int s = 0; s < Ns; s++)
+        {
+            SigmaDeltaE[n] += pow(DeltaESample[n][s] - DeltaE[n], 2);
+        }
+        if (SemiStochastic) DeltaE[n] += DeltaEDet[n];
+        SigmaDeltaE[n] /= (Ns - 1);
+        SigmaDeltaE[n] = sqrt(SigmaDeltaE[n]); // This is sample standard deviation
+        SigmaDeltaE[n] /= sqrt(Ns); // This is standard error
+        //cout << DeltaE[n] << " " << SigmaDeltaE[n] << std::endl;
+    }
 
-            for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+    return std::make_tuple(DeltaE, SigmaDeltaE);
+}
+
+// Adaptive version of DoSPT2. Samples are drawn in batches of NsBatch, each sample with its own generator seeded
+// by (Seed, state, sample index) so that results are reproducible regardless of the thread count. Sampling for
+// a state stops once its standard error drops below TargetSE or NsMax samples are drawn. Only the stochastic
+// part is returned, the deterministic part of the semi-stochastic correction is left to the caller.
+std::tuple<std::vector<double>, std::vector<double>, std::vector<int>> DoSPT2Adaptive(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, std::vector<FConst> &CubicFC, std::vector<FConst> &QuarticFC, std::vector<FConst> &QuinticFC, std::vector<FConst> &SexticFC, std::vector<std::vector<Eigen::MatrixXd>> &Ys, double PT2_Eps, int NEig, int Nd, int NsBatch, int NsMax, double TargetSE, unsigned int Seed, bool SemiStochastic, double PT2_Eps2)
+{
+    int N_opt;
+    if(NEig > BasisSet.size()){ // If we don't have enough states to optimize for yet
+        N_opt = BasisSet.size();
+    }else{ // If number of states exceeds the number selected to optimize
+        N_opt = NEig;
+    }
+    
+    std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> YSortedColInd; // mode, power, column
+    std::vector<std::vector<double>> MaxY; // mode, power
+    for (unsigned int m = 0; m < Ys.size(); m++)
+    {
+        std::vector<std::vector<std::vector<long unsigned int>>> YSorted_m;
+        std::vector<double> YMax_m;
+        for (unsigned int p = 0; p < Ys[m].size(); p++)
+        {
+            YMax_m.push_back((Ys[m][p]).cwiseAbs().maxCoeff());
+            std::vector<std::vector<long unsigned int>> YSorted_mp;
+            for (unsigned int n = 0; n < Ys[m][p].cols(); n++)
             {
-                double HaiCi = 0.0;
-                double Hai2Ci2 = 0.0;
-                vector<int> qdiffvec(BasisSet[0].M,0);
-                for (std::map<int, int>::iterator it = WalkerPopulation.begin(); it != WalkerPopulation.end(); ++it)
-                {
-                    int i = it->first;
-                    double Hai = 0;
-                    int mchange = 0; // number of modes with nonzero change in quanta
-                    int qdiff = 0; // total number of quanta difference 
-                    QDiffVec(PTBasisSet[a], BasisSet[i], qdiff, mchange, qdiffvec);
-                    if(qdiff <= fcmax && mchange <= fcmax && qdiff%2==0)
-                    { 
-                        // States cannot differ by more than fcmax quanta
-                        for (unsigned int k=0;k<QuarticFC.size();k++)
-                        {
-                            if ( ScreenState(qdiff,mchange,qdiffvec,QuarticFC[k]) ){
-                                //Screen force constants for connection                      
-                                //Add anharmonic matrix elements
-                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuarticFC[k]);
-                            }
-                        }
-                        for (unsigned int k=0;k<SexticFC.size();k++)
-                        {
-                            if ( ScreenState(qdiff,mchange,qdiffvec,SexticFC[k]) ){
-                                //Screen force constants for connection                      
-                                //Add anharmonic matrix elements
-                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], SexticFC[k]);
-                            }
-                        }
-                        HaiCi += (Hai * Evecs(i, n) * WalkerPopulation[i]) / WalkerProbability[i]; // C_i Hai for each eigenvalue of interest
-                        Hai2Ci2 += (pow(Hai, 2) * pow(Evecs(i, n), 2)) * (WalkerPopulation[i] * (Nd - 1) / WalkerProbability[i] - pow(WalkerPopulation[i], 2) / pow(WalkerProbability[i], 2));
-                    }
-                    if(qdiff <= fcmax-1 && mchange <= fcmax-1 && qdiff%2==1)
-                    { 
-                        // fcmax-1 assumes 4th or 6th max order 
-                        // States cannot differ by more than fcmax quanta
-                        for (unsigned int k=0;k<CubicFC.size();k++)
-                        {
-                            if ( ScreenState(qdiff,mchange,qdiffvec,CubicFC[k]) ){
-                                //Screen force constants for connection                      
-                                //Add anharmonic matrix elements
-                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], CubicFC[k]);
-                            }
-                        }
-                        for (unsigned int k=0;k<QuinticFC.size();k++)
-                        {
-                            if ( ScreenState(qdiff,mchange,qdiffvec,QuinticFC[k]) ){
-                                //Screen force constants for connection                      
-                                //Add anharmonic matrix elements
-                                Hai += AnharmPot(PTBasisSet[a], BasisSet[i], QuinticFC[k]);
-                            }
-                        }
-                        HaiCi += (Hai * Evecs(i, n) * WalkerPopulation[i]) / WalkerProbability[i]; // C_i Hai for each eigenvalue of interest
-                        Hai2Ci2 += (pow(Hai, 2) * pow(Evecs(i, n), 2)) * (WalkerPopulation[i] * (Nd - 1) / WalkerProbability[i] - pow(WalkerPopulation[i], 2) / pow(WalkerProbability[i], 2));
-                    }
-                }
-                double Ea = 0.; //Hii matrix element
-                for (unsigned int j = 0; j < PTBasisSet[a].M; j++)
-                {
-                  //Calculate partial energies
-                  double Ej = 0.5;
-                  Ej += PTBasisSet[a].Modes[j].Quanta;
-                  Ej *= PTBasisSet[a].Modes[j].Freq;
-                  //Update matrix element
-                  Ea += Ej;
-                }
-                vector<int> zerodiffvec(BasisSet[0].M,0);
-                int qdiff=0;
-                int mchange=0;
-                for (unsigned int k = 0; k < QuarticFC.size(); k++) // Only even-ordered fc can affect this
-                {
-                    if (ScreenState(qdiff, mchange, zerodiffvec, QuarticFC[k]))
-                    {
-                        // Screen force constants that cannot connect basis states a and a
-                        //Add anharmonic matrix elements
-                        Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], QuarticFC[k]);
-                    }
-                }
-                for (unsigned int k = 0; k < SexticFC.size(); k++) // Only even-ordered fc can affect this
-                {    
-                    if (ScreenState(qdiff, mchange, zerodiffvec, SexticFC[k]))
-                    {
-                        // Screen force constants that cannot connect basis states a and a
-                        //Add anharmonic matrix elements
-                        Ea += AnharmPot(PTBasisSet[a], PTBasisSet[a], SexticFC[k]);
-                    }
-                }
-                #pragma omp atomic // Will cause floating point error if blindly done in parallel
-                DeltaEs[s] += (pow(HaiCi, 2) + Hai2Ci2) / ((Evals(n) - Ea) * Nd * (Nd - 1));
+                std::vector<long unsigned int> YSorted_mpn = SortIndices((Ys[m][p].col(n)).cwiseAbs());
+                YSorted_mp.push_back(YSorted_mpn);
             }
+            YSorted_m.push_back(YSorted_mp);
+        }
+        YSortedColInd.push_back(YSorted_m);
+        MaxY.push_back(YMax_m);
+    }
+
+    std::vector<double> WVec;
+    for (FConst &FC : AnharmHB)
+    {
+        double fc = FC.fc;
+        for (unsigned int q = 0; q < FC.QUnique.size(); q++)
+        {
+            fc *= MaxY[FC.QUnique[q]][FC.QPowers[q]];
         }
-        DeltaESample.push_back(DeltaEs);
-        std::cout << " Perturbative space for state " << n << " contains " << (float)PTBasisSize / (float)Ns << " stochastic basis states on average." << std::endl;
+        WVec.push_back(abs(fc));
     }
 
+    /*for (FConst &FC : AnharmHB)
+    {
+        double W = FC.fc;
+        for (int q : FC.QIndices) W *= sqrt(HighestQuanta[q] + 1);
+        WVec.push_back(abs(W));
+    }
+    //HeatBath_Sort_FC(AnharmHB);*/
+    std::vector<long unsigned int> WSortedInd = SortIndices(WVec);
+
+    std::vector<int> MaxQuanta(Ys.size(), 10000);
+
+    std::vector<double> DeltaE(N_opt, 0.0);
     std::vector<double> SigmaDeltaE(N_opt, 0.0);
+    std::vector<int> NsUsed(N_opt, 0);
+    int fcmax=0;
+    for (unsigned int k=0;k<AnharmFC.size();k++){ //Order of maximum anharmonic term
+        if(AnharmFC[k].fcpow.size()>fcmax){
+            fcmax = AnharmFC[k].fcpow.size();
+        }
+    }
+
+    // The standard error needs two samples, so the first batch is never smaller than that
+    if (NsBatch < 2) NsBatch = 2;
+    if (NsMax < NsBatch) NsMax = NsBatch;
     for (unsigned int n = 0; n < N_opt; n++)
     {
-        for (unsigned int s = 0; s < Ns; s++)
+        std::vector<WaveFunction> DetPTBasisSet;
+        if (SemiStochastic)
         {
-            DeltaE[n] += DeltaESample[n][s];
-            //SigmaDeltaE[n] += pow(DeltaESample[n][s], 2);
+            DetPTBasisSet = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY);
+            std::cout << "Perturbative space for state " << n << " contains " << DetPTBasisSet.size() << " deterministic basis states." << std::endl;
         }
-        //SigmaDeltaE[n] -= (pow(DeltaE[n], 2) / Ns);
-        DeltaE[n] /= Ns;
-        std::cout << setprecision(12);
-        for (unsigned int s = 0; s < Ns; s++)
+
+        std::vector<double> Cn;
+        for (unsigned int i = 0; i < Evecs.rows(); i++) Cn.push_back(Evecs(i ,n));
+
+        // Running mean and sum of squared deviations, updated after each batch
+        int Ns = 0;
+        double Mean = 0.0;
+        double M2 = 0.0;
+        long unsigned int PTBasisSize = 0;
+        while (Ns < NsMax)
         {
-            SigmaDeltaE[n] += pow(DeltaESample[n][s] - DeltaE[n], 2);
+            int Nb = std::min(NsBatch, NsMax - Ns);
+            if (NsMax - Ns - Nb == 1) Nb++; // Never leave a batch of a single sample for the end
+            std::vector<double> DeltaEs(Nb, 0.0);
+            #pragma omp parallel for
+            for (unsigned int b = 0; b < Nb; b++)
+            {
+                std::seed_seq SS{Seed, (unsigned int)n, (unsigned int)(Ns + b)};
+                std::mt19937 Gen(SS);
+                long unsigned int PTSize = 0;
+                DeltaEs[b] = SPT2Sample(Cn, Evecs, Evals, n, Nd, BasisSet, DetPTBasisSet, AnharmHB, WVec, WSortedInd, CubicFC, QuarticFC, QuinticFC, SexticFC, Ys, YSortedColInd, MaxY, fcmax, PT2_Eps, SemiStochastic, PT2_Eps2, Gen, PTSize);
+                #pragma omp atomic
+                PTBasisSize += PTSize;
+            }
+            for (unsigned int b = 0; b < Nb; b++)
+            {
+                Ns++;
+                double Delta = DeltaEs[b] - Mean;
+                Mean += Delta / Ns;
+                M2 += Delta * (DeltaEs[b] - Mean);
+            }
+            SigmaDeltaE[n] = sqrt(M2 / (Ns - 1) / Ns);
+            std::cout << setprecision(12) << " State " << n << " after " << Ns << " samples: " << Mean << " +/- " << SigmaDeltaE[n] << std::endl;
+            if (SigmaDeltaE[n] <= TargetSE) break;
         }
-        if (SemiStochastic) DeltaE[n] += DeltaEDet[n];
-        SigmaDeltaE[n] /= (Ns - 1);
-        SigmaDeltaE[n] = sqrt(SigmaDeltaE[n]); // This is sample standard deviation
-        SigmaDeltaE[n] /= sqrt(Ns); // This is standard error
-        //cout << DeltaE[n] << " " << SigmaDeltaE[n] << std::endl;
+        DeltaE[n] = Mean;
+        NsUsed[n] = Ns;
+        std::cout << " Perturbative space for state " << n << " contains " << (float)PTBasisSize / (float)Ns << " stochastic basis states on average." << std::endl;
     }
 
-    return std::make_tuple(DeltaE, SigmaDeltaE);
+    return std::make_tuple(DeltaE, SigmaDeltaE, NsUsed);
 }
 
 /*************************************************************************************
@@ -2196,12 +2462,13 @@ double TrueSqrtTerm(WaveFunction &B, std::vector<int> &QIndices)
     return sqrt(Term);
 }
 
-std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta){ // Expand basis via Heat Bath algorithm
+std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<int> &MaxQuanta, std::vector<int> &HighestQuanta, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     // While we need the original FC later, we need to sort the max values.
     std::vector<double> WVec;
@@ -2240,7 +2507,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                 WaveFunction tmp = BasisSet[n];
                                 tmp.Modes[AnharmHB[i].QUnique[0]].Quanta += a;
                                 if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
-                                                                    HashedBasisInit.count(tmp) == 0
+                                                                    WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                         ){ //make sure a|0> = 0 and tmp does not exist in original basis
                                     if (FitsMaxQuanta(tmp, MaxQuanta))
                                     {
@@ -2264,7 +2531,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                     tmp.Modes[AnharmHB[i].QUnique[1]].Quanta += b;
                                     if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
                                            tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0 && 
-                                                                           HashedBasisInit.count(tmp) == 0
+                                                                           WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                            ){ //make sure a|0> = 0
                                             if (FitsMaxQuanta(tmp, MaxQuanta))
                                             {
@@ -2295,7 +2562,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                         if( tmp.Modes[AnharmHB[i].QUnique[0]].Quanta >=0 &&
                                                tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0  &&
                                                tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
-                                               HashedBasisInit.count(tmp) == 0
+                                               WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                ){ //make sure a|0> = 0
                                             if (FitsMaxQuanta(tmp, MaxQuanta))
                                             {
@@ -2334,7 +2601,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                                    tmp.Modes[AnharmHB[i].QUnique[1]].Quanta >=0  &&
                                                    tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
                                                    tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
-                                                   HashedBasisInit.count(tmp) == 0
+                                                   WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                    ){ //make sure a|0> = 0
                                                     if (FitsMaxQuanta(tmp, MaxQuanta))
                                                     {
@@ -2381,7 +2648,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                                        tmp.Modes[AnharmHB[i].QUnique[2]].Quanta >=0 &&
                                                        tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
                                                        tmp.Modes[AnharmHB[i].QUnique[4]].Quanta >=0 && 
-                                                       HashedBasisInit.count(tmp) == 0
+                                                       WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                        ){ //make sure a|0> = 0
                                                         if (FitsMaxQuanta(tmp, MaxQuanta))
                                                         {
@@ -2436,7 +2703,7 @@ std::vector<WaveFunction> AddStatesHBWithMax(std::vector<WaveFunction> &BasisSet
                                                            tmp.Modes[AnharmHB[i].QUnique[3]].Quanta >=0 &&
                                                            tmp.Modes[AnharmHB[i].QUnique[4]].Quanta >=0 &&
                                                            tmp.Modes[AnharmHB[i].QUnique[5]].Quanta >=0 &&
-                                                                                                           HashedBasisInit.count(tmp) == 0
+                                                                                                           WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0
                                                            ){ //make sure a|0> = 0
                                                             if (FitsMaxQuanta(tmp, MaxQuanta))
                                                             {
@@ -2509,12 +2776,13 @@ double HBFactor(std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<int>
     return Factor;
 }
 
-std::vector<WaveFunction> AddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys){ // Expand basis via Heat Bath algorithm
+std::vector<WaveFunction> AddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     // Begin by sorting the columns of Y
     unsigned int NModes = Ys.size();
@@ -2583,7 +2851,7 @@ std::vector<WaveFunction> AddStatesHBFromVSCF(std::vector<WaveFunction> &BasisSe
                     {
                         WaveFunction tmp = BasisSet[n];
                         for (unsigned int m = 0; m < KQuanta.size(); m++) tmp.Modes[m].Quanta = KQuanta[m];
-                        if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                        if (WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                         KQuantaInd[0] = KQuantaInd[0] - 1;
                     }
                     else // Need to increment something
@@ -2702,7 +2970,7 @@ HashedStates AddStatesHBFromVSCF2Hashed(std::vector<WaveFunction> &BasisSet, std
 
 
 // Does all sorting beforehand
-std::vector<WaveFunction> AddStatesHBFromVSCF2(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY){ // Expand basis via Heat Bath algorithm
+std::vector<WaveFunction> AddStatesHBFromVSCF2(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<double> &WVec, std::vector<long unsigned int> &WSortedInd, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<std::vector<std::vector<std::vector<long unsigned int>>>> &YSortedColInd, std::vector<std::vector<double>> &MaxY, int NBatch, int Batch){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
@@ -2744,7 +3012,7 @@ std::vector<WaveFunction> AddStatesHBFromVSCF2(std::vector<WaveFunction> &BasisS
                     {
                         WaveFunction tmp = BasisSet[n];
                         for (unsigned int m = 0; m < KQuanta.size(); m++) tmp.Modes[m].Quanta = KQuanta[m];
-                        if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                        if (HashedBasisInit.count(tmp) == 0 && (NBatch == 1 || WfnBatch(tmp, NBatch) == Batch)) HashedNewStates.insert(tmp); // Only keep states hashed into this batch
                         KQuantaInd[0] = KQuantaInd[0] - 1;
                     }
                     else // Need to increment something
@@ -3485,6 +3753,12 @@ SpMat VCISparseHamFromVSCF(std::vector<WaveFunction> &BasisSet1, std::vector<Wav
 };
 
 std::vector<double> DoPT2FromVSCF(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, double PT2_Eps, int NEig, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs)
+{
+    return DoPT2FromVSCFBatched(Evecs, Evals, BasisSet, AnharmHB, AnharmFC, PT2_Eps, NEig, Ys, Xs, 1, 0.0);
+}
+
+// Hash batched version of DoPT2FromVSCF, see DoPT2Batched
+std::vector<double> DoPT2FromVSCFBatched(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, std::vector<FConst> &AnharmFC, double PT2_Eps, int NEig, std::vector<std::vector<Eigen::MatrixXd>> &Ys, std::vector<Eigen::MatrixXd> &Xs, int NBatch, double MaxMem)
 {
     int N_opt;
     if(NEig > BasisSet.size()){ // If we don't have enough states to optimize for yet
@@ -3534,66 +3808,80 @@ std::vector<double> DoPT2FromVSCF(MatrixXd& Evecs, VectorXd& Evals, std::vector<
 
     for (unsigned int n = 0; n < N_opt; n++)
     {
-        std::vector<WaveFunction> PTBasisSet = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY);
-        std::cout << " Perturbative space for state " << n << " contains " << PTBasisSet.size() << " basis states." << std::endl;
-
-        #pragma omp parallel for
-        for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+        int NB = std::max(NBatch, 1);
+        if (MaxMem > 0.0)
         {
-            double HaiCi = 0.0;
-            std::vector<int> ModeOccA;
-            for (unsigned int m = 0; m < PTBasisSet[a].Modes.size(); m++) ModeOccA.push_back(PTBasisSet[a].Modes[m].Quanta);
+            std::vector<WaveFunction> PTSample = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY, PT2SampleBatches, 0);
+            int NBNew = PT2NumBatches(PTSample.size(), NB, BasisSet[0].M, MaxMem);
+            if (NBNew > NB)
+            {
+                std::cout << " Perturbative space exceeds memory budget, using " << NBNew << " batches." << std::endl;
+                NB = NBNew;
+            }
+        }
+        for (int b = 0; b < NB; b++)
+        {
+            std::vector<WaveFunction> PTBasisSet = AddStatesHBFromVSCF2(BasisSet, AnharmHB, WVec, WSortedInd, Evecs.col(n), PT2_Eps, Ys, YSortedColInd, MaxY, NB, b);
+            std::cout << " Perturbative space for state " << n << " batch " << b + 1 << "/" << NB << " contains " << PTBasisSet.size() << " basis states." << std::endl;
 
-            for (unsigned int i = 0; i < BasisSet.size(); i++)
+            #pragma omp parallel for
+            for (unsigned int a = 0; a < PTBasisSet.size(); a++)
             {
-                std::vector<int> ModeOccI;
-                for (unsigned int m = 0; m < BasisSet[i].Modes.size(); m++) ModeOccI.push_back(BasisSet[i].Modes[m].Quanta);
+                double HaiCi = 0.0;
+                std::vector<int> ModeOccA;
+                for (unsigned int m = 0; m < PTBasisSet[a].Modes.size(); m++) ModeOccA.push_back(PTBasisSet[a].Modes[m].Quanta);
 
-                std::vector<int> DiffModes = CalcDiffModes(PTBasisSet[a], BasisSet[i]);
-                if (DiffModes.size() == 1)
+                for (unsigned int i = 0; i < BasisSet.size(); i++)
                 {
-                    double Xm = Xs[DiffModes[0]].coeffRef(ModeOccA[DiffModes[0]], ModeOccI[DiffModes[0]]);
-                    HaiCi += Xm * Evecs(i, n);
-                }
+                    std::vector<int> ModeOccI;
+                    for (unsigned int m = 0; m < BasisSet[i].Modes.size(); m++) ModeOccI.push_back(BasisSet[i].Modes[m].Quanta);
 
-                for (FConst &FC : AnharmFC)
-                {
-                    double Haiq = 0.0;
-                
-                    if (VectorContainedIn(DiffModes, FC.QUnique))
+                    std::vector<int> DiffModes = CalcDiffModes(PTBasisSet[a], BasisSet[i]);
+                    if (DiffModes.size() == 1)
                     {
-                        Haiq = FC.fc;
-                        for (unsigned int m = 0; m < FC.QUnique.size(); m++)
+                        double Xm = Xs[DiffModes[0]].coeffRef(ModeOccA[DiffModes[0]], ModeOccI[DiffModes[0]]);
+                        HaiCi += Xm * Evecs(i, n);
+                    }
+
+                    for (FConst &FC : AnharmFC)
+                    {
+                        double Haiq = 0.0;
+                
+                        if (VectorContainedIn(DiffModes, FC.QUnique))
                         {
-                            Haiq *= Ys[FC.QUnique[m]][FC.QPowers[m]].coeffRef(ModeOccA[FC.QUnique[m]], ModeOccI[FC.QUnique[m]]);
+                            Haiq = FC.fc;
+                            for (unsigned int m = 0; m < FC.QUnique.size(); m++)
+                            {
+                                Haiq *= Ys[FC.QUnique[m]][FC.QPowers[m]].coeffRef(ModeOccA[FC.QUnique[m]], ModeOccI[FC.QUnique[m]]);
+                            }
                         }
+                        HaiCi += Haiq * Evecs(i, n);
                     }
-                    HaiCi += Haiq * Evecs(i, n);
                 }
-            }
            
-            double Ea = 0.; //Hii matrix element
+                double Ea = 0.; //Hii matrix element
             
-            // Harmonic Part
-            for (unsigned int m = 0; m < Xs.size(); m++)
-            {
-                Ea += Xs[m].coeffRef(ModeOccA[m], ModeOccA[m]);
-            }
-
-            // Anharmonic Part
-            for (FConst &FC : AnharmFC)
-            {   
-                // All FCs contribute
-                double Eaq = FC.fc;
-                for (unsigned int m = 0; m < FC.QUnique.size(); m++)
+                // Harmonic Part
+                for (unsigned int m = 0; m < Xs.size(); m++)
                 {
-                    Eaq *= Ys[FC.QUnique[m]][FC.QPowers[m]].coeffRef(ModeOccA[FC.QUnique[m]], ModeOccA[FC.QUnique[m]]);
+                    Ea += Xs[m].coeffRef(ModeOccA[m], ModeOccA[m]);
+                }
+
+                // Anharmonic Part
+                for (FConst &FC : AnharmFC)
+                {   
+                    // All FCs contribute
+                    double Eaq = FC.fc;
+                    for (unsigned int m = 0; m < FC.QUnique.size(); m++)
+                    {
+                        Eaq *= Ys[FC.QUnique[m]][FC.QPowers[m]].coeffRef(ModeOccA[FC.QUnique[m]], ModeOccA[FC.QUnique[m]]);
+                    }
+                    Ea += Eaq;
                 }
-                Ea += Eaq;
-            }
             
-            #pragma omp atomic // Will cause floating point error if blindly done in parallel
-            DeltaE[n] += pow(HaiCi, 2) / (Evals(n) - Ea);
+                #pragma omp atomic // Will cause floating point error if blindly done in parallel
+                DeltaE[n] += pow(HaiCi, 2) / (Evals(n) - Ea);
+            }
         }
     }
     return DeltaE;    
@@ -4163,12 +4451,13 @@ std::vector<FConst> ContractFCCPP(double V3[], double V4[], double V5[], double
 **********************************Spectral Functions *********************************
 *************************************************************************************/
 
-std::tuple<std::vector<WaveFunction>, std::vector<double>> AddStatesHBStoreCoupling(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys){ // Expand basis via Heat Bath algorithm
+std::tuple<std::vector<WaveFunction>, std::vector<double>> AddStatesHBStoreCoupling(std::vector<WaveFunction> &BasisSet, std::vector<FConst> &AnharmHB, Eigen::Ref<Eigen::VectorXd> C, double eps, std::vector<std::vector<Eigen::MatrixXd>> &Ys, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     std::vector<double> Coupling;
 
@@ -4239,7 +4528,7 @@ std::tuple<std::vector<WaveFunction>, std::vector<double>> AddStatesHBStoreCoupl
                     {
                         WaveFunction tmp = BasisSet[n];
                         for (unsigned int m = 0; m < KQuanta.size(); m++) tmp.Modes[m].Quanta = KQuanta[m];
-                        if (HashedBasisInit.count(tmp) == 0) 
+                        if (WithinMCR(BasisSet[n], tmp, AnharmHB[i].QUnique, NExcited[n], MaxExcitedModes) && HashedBasisInit.count(tmp) == 0)
                         {
                             HashedNewStates.insert(tmp);
                             Coupling.push_back(AnharmHB[i].fc);
@@ -4878,7 +5167,8 @@ SpMat VCISparseHamNModeFromOM(std::vector<WaveFunction> &BasisSet1, std::vector<
     return H;
 }
 
-SpMat VCISparseHamNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, double OneModePotential[], double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ)
+template <typename Scalar>
+SpMat VCISparseHamNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, Scalar OneModePotential[], Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ)
 {
     SpMat H(BasisSet1.size(), BasisSet2.size());
     std::vector<Trip> HTrip;
@@ -5219,7 +5509,93 @@ SpMat VCISparseHamNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<W
     return H;
 }
 
-SpMat VCISparseHamNModeFromOMArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ)
+template <typename Scalar>
+std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> DipoleSparseNModeArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Mu0, Scalar OneModeDipole[], Scalar TwoModeDipole[], Scalar ThreeModeDipole[], Scalar FourModeDipole[], Scalar FiveModeDipole[], std::vector<long int> &Strides, bool DiagonalBlock, int MaxNMode, int MaxQ)
+{
+    // Builds all three n-mode dipole components in one pass over the configuration pairs. Each potential array holds
+    // the x, y and z components contiguously, Strides[n - 1] apart. The mode difference analysis and the index into
+    // the n-mode arrays are shared by the three components.
+    int M = BasisSet1[0].M;
+    long int K = MaxQ;
+    Scalar* Dipoles[5] = {OneModeDipole, TwoModeDipole, ThreeModeDipole, FourModeDipole, FiveModeDipole};
+
+    auto IdxN = [&] (std::vector<int> &T, unsigned int n, std::vector<int> &ModeOccI, std::vector<int> &ModeOccJ)
+    {
+        long int Idx = 0;
+        for (unsigned int a = 0; a < n; a++) Idx = Idx * M + T[a];
+        for (unsigned int a = 0; a < n; a++) Idx = Idx * K + ModeOccI[T[a]];
+        for (unsigned int a = 0; a < n; a++) Idx = Idx * K + ModeOccJ[T[a]];
+        return Idx;
+    };
+
+    double thr = 1e-4;
+    int NThreads = omp_get_max_threads();
+    std::vector<std::vector<int>> Rows(NThreads);
+    std::vector<std::vector<int>> Cols(NThreads);
+    std::vector<std::vector<double>> Vals(NThreads);
+    #pragma omp parallel for schedule(dynamic)
+    for (unsigned int i = 0; i < BasisSet1.size(); i++)
+    {
+        int t = omp_get_thread_num();
+        std::vector<int> ModeOccI;
+        for (unsigned int m = 0; m < BasisSet1[i].Modes.size(); m++) ModeOccI.push_back(BasisSet1[i].Modes[m].Quanta);
+        std::vector<int> ModeOccJ(M);
+        std::vector<int> T(MaxNMode);
+        std::vector<int> Spectators;
+        std::vector<int> Comb;
+        unsigned int jstart = 0;
+        if (DiagonalBlock) jstart = i;
+        for (unsigned int j = jstart; j < BasisSet2.size(); j++)
+        {
+            std::vector<int> DiffModes = CalcDiffModes(BasisSet1[i], BasisSet2[j]);
+            int d = DiffModes.size();
+            if (d > MaxNMode) continue;
+            for (unsigned int m = 0; m < M; m++) ModeOccJ[m] = BasisSet2[j].Modes[m].Quanta;
+
+            double Vij[3] = {0.0, 0.0, 0.0};
+            if (d == 0) for (unsigned int x = 0; x < 3; x++) Vij[x] += Mu0[x];
+
+            // Every mode tuple containing the changed modes contributes, with the changed modes first and the
+            // spectators following in ascending order.
+            Spectators.clear();
+            for (int m = 0; m < M; m++) if (std::find(DiffModes.begin(), DiffModes.end(), m) == DiffModes.end()) Spectators.push_back(m);
+            for (int a = 0; a < d; a++) T[a] = DiffModes[a];
+            for (int n = std::max(d, 1); n <= MaxNMode; n++)
+            {
+                int s = n - d;
+                if (s > (int)Spectators.size()) break;
+                Comb.resize(s);
+                for (int a = 0; a < s; a++) Comb[a] = a;
+                while (true)
+                {
+                    for (int a = 0; a < s; a++) T[d + a] = Spectators[Comb[a]];
+                    long int Idx = IdxN(T, n, ModeOccI, ModeOccJ);
+                    for (unsigned int x = 0; x < 3; x++) Vij[x] += Dipoles[n - 1][x * Strides[n - 1] + Idx];
+                    int a = s - 1;
+                    while (a >= 0 && Comb[a] == (int)Spectators.size() - s + a) a--;
+                    if (a < 0) break;
+                    Comb[a]++;
+                    for (int b = a + 1; b < s; b++) Comb[b] = Comb[b - 1] + 1;
+                }
+            }
+
+            if (abs(Vij[0]) < thr && abs(Vij[1]) < thr && abs(Vij[2]) < thr) continue;
+            Rows[t].push_back(i);
+            Cols[t].push_back(j);
+            for (unsigned int x = 0; x < 3; x++) Vals[t].push_back(Vij[x]);
+            if (DiagonalBlock && i != j)
+            {
+                Rows[t].push_back(j);
+                Cols[t].push_back(i);
+                for (unsigned int x = 0; x < 3; x++) Vals[t].push_back(Vij[x]);
+            }
+        }
+    }
+    return GatherFusedTriplets(Rows, Cols, Vals);
+}
+
+template <typename Scalar>
+SpMat VCISparseHamNModeFromOMArray(std::vector<WaveFunction> &BasisSet1, std::vector<WaveFunction> &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], bool DiagonalBlock, int MaxNMode, int MaxQ)
 {
     SpMat H(BasisSet1.size(), BasisSet2.size());
     std::vector<Trip> HTrip;
@@ -5788,9 +6164,9 @@ double VCISparseHamNModeElementFromOM(WaveFunction &BasisSet1, WaveFunction &Bas
     return Vij;
 }
 
-double VCISparseHamNModeElementFromOMArray(WaveFunction &BasisSet1, WaveFunction &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, double TwoModePotential[], double ThreeModePotential[], double FourModePotential[], double FiveModePotential[], int MaxQ)
+template <typename Scalar>
+double VCISparseHamNModeElementFromOMArray(WaveFunction &BasisSet1, WaveFunction &BasisSet2, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int MaxQ, int MaxNMode)
 {
-    int MaxNMode = 2;
     auto Idx2 = [&] (int m, int n, int mi, int ni, int mj, int nj)
     {
         int M = Frequencies.size();
@@ -6048,10 +6424,22 @@ double VCISparseHamNModeElementFromOMArray(WaveFunction &BasisSet1, WaveFunction
 
 
 
+template <typename Scalar>
+std::vector<double> VCISparseHamDiagonalNModeFromOMArray(std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int MaxNMode, int MaxQ)
+{
+    std::vector<double> HamDiag(BasisSet.size());
+    #pragma omp parallel for
+    for (unsigned int i = 0; i < BasisSet.size(); i++)
+    {
+        HamDiag[i] = VCISparseHamNModeElementFromOMArray(BasisSet[i], BasisSet[i], Frequencies, V0, OneModeEig, TwoModePotential, ThreeModePotential, FourModePotential, FiveModePotential, MaxQ, MaxNMode);
+    }
+    return HamDiag;
+}
+
 /***********************************************************************************************/
 /************************************ CIPSI FUNCTIONS ******************************************/
 /***********************************************************************************************/
-std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order)
+std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order, int MaxExcitedModes)
 {
     HashedStates HashedBasisInit;
     HashedStates HashedNewStates;
@@ -6071,7 +6459,7 @@ std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisS
                 for (unsigned int a = 0; a < MaxQuanta[i]; a++)
                 {
                     tmp.Modes[i].Quanta = a;
-                    if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                    if (WithinMCR(ExcitedModes(tmp), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                 }
             }
         }
@@ -6092,7 +6480,7 @@ std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisS
                         for (unsigned int b = 0; b < MaxQuanta[j]; b++)
                         {
                             tmp.Modes[j].Quanta = b;
-                            if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                            if (WithinMCR(ExcitedModes(tmp), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                         }
                     }
                 }
@@ -6120,7 +6508,7 @@ std::vector<WaveFunction> ConnectedStatesCIPSI(std::vector<WaveFunction> &BasisS
                                 for (unsigned int c = 0; c < MaxQuanta[k]; c++)
                                 {
                                     tmp.Modes[k].Quanta = c;
-                                    if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                                    if (WithinMCR(ExcitedModes(tmp), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                                 }
                             }
                         }
@@ -6164,12 +6552,116 @@ std::vector<WaveFunction> AddStatesCIPSI(std::vector<WaveFunction> &BasisSet, st
     return NewBasis;
 }
 
-std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, Eigen::VectorXd C, double eps, bool ExactSingles){ // Expand basis via Heat Bath algorithm
+// Streaming version of ConnectedStatesCIPSI followed by AddStatesCIPSI. Connected configurations are generated
+// per source configuration and the CIPSI criterion is evaluated immediately, so the connected space is never stored.
+// A candidate is only evaluated from its lowest index source in the basis, which removes duplicates across sources
+// and threads without a shared hash set. Each thread keeps its own selection, either every candidate above eps or,
+// if MaxAdd > 0, a bounded heap of the MaxAdd largest candidates.
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesCIPSIStreamArray(std::vector<WaveFunction> &BasisSet, std::vector<int> MaxQuanta, int Order, Eigen::VectorXd &C, Eigen::VectorXd &EVal, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], double eps, int MaxAdd, int MaxQ, int MaxExcitedModes)
+{
+    HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
+    for( WaveFunction& wfn : BasisSet){
+        HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
+    }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
+
+    int N = BasisSet[0].M;
+    typedef std::pair<double, WaveFunction> Candidate;
+    // Larger criterion first, ties broken by the quanta, so the selection does not depend on the thread schedule
+    auto CandidateCmp = [N] (const Candidate &A, const Candidate &B)
+    {
+        if (A.first != B.first) return A.first > B.first;
+        for (int m = 0; m < N; m++)
+        {
+            if (A.second.Modes[m].Quanta != B.second.Modes[m].Quanta) return A.second.Modes[m].Quanta < B.second.Modes[m].Quanta;
+        }
+        return false;
+    }; // min heap on the criterion
+    std::vector<Candidate> Selected;
+    #pragma omp parallel
+    {
+        std::vector<Candidate> LocalSelected;
+        std::priority_queue<Candidate, std::vector<Candidate>, decltype(CandidateCmp)> LocalHeap(CandidateCmp);
+
+        auto Evaluate = [&] (WaveFunction &A, unsigned int Source)
+        {
+            if (HashedBasisInit.count(A) != 0) return;
+            double HaiCi = 0.0;
+            for (unsigned int j = 0; j < BasisSet.size(); j++)
+            {
+                int NDiff = 0;
+                for (unsigned int m = 0; m < N; m++)
+                {
+                    if (BasisSet[j].Modes[m].Quanta != A.Modes[m].Quanta) NDiff++;
+                    if (NDiff > Order) break;
+                }
+                if (NDiff > Order) continue;
+                if (j < Source) return; // Evaluated when streaming from source j
+                HaiCi += VCISparseHamNModeElementFromOMArray(BasisSet[j], A, Frequencies, V0, OneModeEig, TwoModePotential, ThreeModePotential, FourModePotential, FiveModePotential, MaxQ, Order) * C[j];
+            }
+            double Ea = VCISparseHamNModeElementFromOMArray(A, A, Frequencies, V0, OneModeEig, TwoModePotential, ThreeModePotential, FourModePotential, FiveModePotential, MaxQ, Order);
+            double DenomMin = (EVal - Ea * Eigen::VectorXd::Ones(EVal.size())).cwiseAbs().minCoeff();
+            double Criterion = pow(HaiCi, 2) / DenomMin;
+            if (Criterion <= eps) return;
+            if (MaxAdd <= 0) LocalSelected.push_back(std::make_pair(Criterion, A));
+            else if (LocalHeap.size() < MaxAdd) LocalHeap.push(std::make_pair(Criterion, A));
+            else if (CandidateCmp(std::make_pair(Criterion, A), LocalHeap.top()))
+            {
+                LocalHeap.pop();
+                LocalHeap.push(std::make_pair(Criterion, A));
+            }
+        };
+
+        // Changes the quanta of up to Order modes, each at most once, starting at mode Start. NExcitedA is the number of
+        // excited modes of A, and candidates outside the MCR are not evaluated but still streamed from.
+        std::function<void(WaveFunction&, unsigned int, int, int, int)> Stream = [&] (WaveFunction &A, unsigned int Source, int Start, int Depth, int NExcitedA)
+        {
+            for (unsigned int m = Start; m < N; m++)
+            {
+                int q0 = A.Modes[m].Quanta;
+                for (int q = 0; q < MaxQuanta[m]; q++)
+                {
+                    if (q == q0) continue;
+                    A.Modes[m].Quanta = q;
+                    int NExcitedQ = NExcitedA + ExcitationChange(q0, q);
+                    if (WithinMCR(NExcitedQ, MaxExcitedModes)) Evaluate(A, Source);
+                    if (Depth + 1 < Order) Stream(A, Source, m + 1, Depth + 1, NExcitedQ);
+                }
+                A.Modes[m].Quanta = q0;
+            }
+        };
+
+        #pragma omp for schedule(dynamic)
+        for (unsigned int i = 0; i < BasisSet.size(); i++)
+        {
+            WaveFunction tmp = BasisSet[i];
+            Stream(tmp, i, 0, 0, NExcited[i]);
+        }
+
+        while (!LocalHeap.empty())
+        {
+            LocalSelected.push_back(LocalHeap.top());
+            LocalHeap.pop();
+        }
+        #pragma omp critical
+        Selected.insert(Selected.end(), LocalSelected.begin(), LocalSelected.end());
+    }
+
+    std::sort(Selected.begin(), Selected.end(), CandidateCmp);
+    if (MaxAdd > 0 && Selected.size() > MaxAdd) Selected.erase(Selected.begin() + MaxAdd, Selected.end());
+    std::vector<WaveFunction> NewBasis;
+    for (const Candidate &A : Selected) NewBasis.push_back(A.second);
+    return NewBasis;
+}
+
+std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, Eigen::VectorXd C, double eps, bool ExactSingles, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     int NModes = SortedIndices.size();
     int MaxQ = SortedIndices[0][0].size();
@@ -6197,7 +6689,7 @@ std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet,
                         WaveFunction tmp = BasisSet[n];
                         tmp.Modes[i].Quanta = mi;
                         tmp.Modes[j].Quanta = mj;
-                        if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                        if (WithinMCR(NExcited[n] + ExcitationChange(ni, mi) + ExcitationChange(nj, mj), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                     }
                     //else break;
                 }
@@ -6230,7 +6722,7 @@ std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet,
                             double Hnnmn = VCISparseHamNModeElementFromOM(BasisSet[n], tmp, Freq, 0.0, tmpvV, TwoModePotential, tmp3Mode);
                             if (abs(CVec[n] * Hnnmn) >= eps)
                             {
-                                if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                                if (WithinMCR(NExcited[n] + ExcitationChange(ni, m), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                             }
                         }
                         if (m != nj)
@@ -6240,7 +6732,7 @@ std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet,
                             double Hnnmn = VCISparseHamNModeElementFromOM(BasisSet[n], tmp, Freq, 0.0, tmpvV, TwoModePotential, tmp3Mode);
                             if (abs(CVec[n] * Hnnmn) >= eps)
                             {
-                                if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                                if (WithinMCR(NExcited[n] + ExcitationChange(nj, m), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                             }
                         }
                     }
@@ -6254,12 +6746,14 @@ std::vector<WaveFunction> AddStatesHB2Mode(std::vector<WaveFunction> &BasisSet,
     return NewBasis;
 }
 
-std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &BasisSet, double TwoModePotential[], int SortedIndices[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ){ // Expand basis via Heat Bath algorithm
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &BasisSet, Scalar TwoModePotential[], int SortedIndices[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes){ // Expand basis via Heat Bath algorithm
     HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
     HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
     for( WaveFunction& wfn : BasisSet){
         HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
     }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
 
     auto IdxS = [&] (int i, int j, int ni, int nj, int m, int I)
     {
@@ -6297,7 +6791,7 @@ std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &Basis
                         WaveFunction tmp = BasisSet[n];
                         tmp.Modes[i].Quanta = mi;
                         tmp.Modes[j].Quanta = mj;
-                        if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                        if (WithinMCR(NExcited[n] + ExcitationChange(ni, mi) + ExcitationChange(nj, mj), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                     }
                     //else break;
                 }
@@ -6310,9 +6804,9 @@ std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &Basis
         std::vector<int> MaxQuanta;
         std::vector<double> Freq;
         std::vector<Eigen::VectorXd> tmpvV;
-        double tmp3Mode[0];
-        double tmp4Mode[0];
-        double tmp5Mode[0];
+        Scalar tmp3Mode[0];
+        Scalar tmp4Mode[0];
+        Scalar tmp5Mode[0];
 
         for (unsigned int i = 0; i < NModes; i++) Freq.push_back(1.0);
         for (unsigned int i = 0; i < NModes; i++) MaxQuanta.push_back(MaxQ);
@@ -6333,7 +6827,7 @@ std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &Basis
                             double Hnnmn = VCISparseHamNModeElementFromOMArray(BasisSet[n], tmp, Freq, 0.0, tmpvV, TwoModePotential, tmp3Mode, tmp4Mode, tmp5Mode, MaxQ);
                             if (abs(CVec[n] * Hnnmn) >= eps)
                             {
-                                if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                                if (WithinMCR(NExcited[n] + ExcitationChange(ni, m), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                             }
                         }
                         if (m != nj)
@@ -6343,7 +6837,7 @@ std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &Basis
                             double Hnnmn = VCISparseHamNModeElementFromOMArray(BasisSet[n], tmp, Freq, 0.0, tmpvV, TwoModePotential, tmp3Mode, tmp4Mode, tmp5Mode, MaxQ);
                             if (abs(CVec[n] * Hnnmn) >= eps)
                             {
-                                if (HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
+                                if (WithinMCR(NExcited[n] + ExcitationChange(nj, m), MaxExcitedModes) && HashedBasisInit.count(tmp) == 0) HashedNewStates.insert(tmp);
                             }
                         }
                     }
@@ -6359,6 +6853,132 @@ std::vector<WaveFunction> AddStatesHB2ModeArray(std::vector<WaveFunction> &Basis
 
 
 
+// Epstein-Nesbet PT2 for n-mode potentials in the one mode eigenbasis. The perturbative space of each state is
+// selected by heat bath screening on the sorted 2-mode integrals, and the couplings and diagonal energies use the
+// full n-mode potential up to MaxNMode.
+template <typename Scalar>
+std::vector<double> DoPT2NModeArray(MatrixXd& Evecs, VectorXd& Evals, std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, Scalar TwoModePotential[], Scalar ThreeModePotential[], Scalar FourModePotential[], Scalar FiveModePotential[], int SortedIndices[], double PT2_Eps, int NEig, int MaxNMode, int NModes, int MaxQ)
+{
+    int N_opt;
+    if(NEig > BasisSet.size()){ // If we don't have enough states to optimize for yet
+        N_opt = BasisSet.size();
+    }else{ // If number of states exceeds the number selected to optimize
+        N_opt = NEig;
+    }
+
+    std::vector<double> DeltaE(N_opt, 0.0);  // Vector will contain the PT correction for each eigenvalue
+    for (unsigned int n = 0; n < N_opt; n++)
+    {
+        std::vector<WaveFunction> PTBasisSet = AddStatesHB2ModeArray(BasisSet, TwoModePotential, SortedIndices, Evecs.col(n), PT2_Eps, true, NModes, MaxQ);
+        std::cout << "Perturbative space for state " << n << " contains " << PTBasisSet.size() << " basis states." << std::endl;
+        if (PTBasisSet.size() == 0) continue;
+
+        SpMat HIA = VCISparseHamNModeFromOMArray(BasisSet, PTBasisSet, Frequencies, V0, OneModeEig, TwoModePotential, ThreeModePotential, FourModePotential, FiveModePotential, false, MaxNMode, MaxQ);
+        Eigen::VectorXd Hx = HIA.transpose() * Evecs.col(n);
+
+        double DeltaEn = 0.0;
+        #pragma omp parallel for reduction(+:DeltaEn)
+        for (unsigned int a = 0; a < PTBasisSet.size(); a++)
+        {
+            if (Hx[a] == 0.0) continue;
+            double Ea = VCISparseHamNModeElementFromOMArray(PTBasisSet[a], PTBasisSet[a], Frequencies, V0, OneModeEig, TwoModePotential, ThreeModePotential, FourModePotential, FiveModePotential, MaxQ, MaxNMode);
+            DeltaEn += pow(Hx[a], 2) / (Evals(n) - Ea);
+        }
+        DeltaE[n] = DeltaEn;
+    }
+    return DeltaE;
+}
+
+// Heat bath screening on the 2-mode and 3-mode integrals. The 3-mode index is stored only for mode triples i < j < k,
+// in the order of itertools.combinations. For every triple and source occupation (ni, nj, nk), Sorted3Mode lists the
+// flattened target occupations mi * K^2 + mj * K + mk by decreasing |V|, and Max3Mode holds the largest |V| of that
+// block so that whole blocks can be skipped. Only targets which change all three modes are added here, the rest are
+// reached through the 2-mode screening.
+template <typename Scalar>
+std::vector<WaveFunction> AddStatesHB3ModeArray(std::vector<WaveFunction> &BasisSet, Scalar TwoModePotential[], int SortedIndices[], Scalar ThreeModePotential[], int Sorted3Mode[], double Max3Mode[], Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes)
+{
+    HashedStates HashedBasisInit; // hashed unordered_set containing BasisSet to check for duplicates
+    HashedStates HashedNewStates; // hashed unordered_set of new states that only allows unique states to be inserted
+    for( WaveFunction& wfn : BasisSet){
+        HashedBasisInit.insert(wfn); // Populate hashed unordered_set with initial basis states
+    }
+    std::vector<int> NExcited = CountExcitedModes(BasisSet);
+    for (WaveFunction &WF : AddStatesHB2ModeArray(BasisSet, TwoModePotential, SortedIndices, C, eps, ExactSingles, NModes, MaxQ, MaxExcitedModes)) HashedNewStates.insert(WF);
+
+    long unsigned int K = MaxQ;
+    long unsigned int K3 = K * K * K;
+    long unsigned int N = NModes;
+    auto Idx3 = [&] (long unsigned int m, long unsigned int n, long unsigned int o, long unsigned int mi, long unsigned int ni, long unsigned int oi, long unsigned int mj, long unsigned int nj, long unsigned int oj)
+    {
+        return ((((((((m * N + n) * N + o) * K + mi) * K + ni) * K + oi) * K + mj) * K + nj) * K + oj);
+    };
+    // Offset of each triple in combination order
+    std::vector<long unsigned int> TripleStart;
+    long unsigned int NTriples = 0;
+    for (unsigned int i = 0; i < NModes; i++)
+    {
+        for (unsigned int j = i + 1; j < NModes; j++)
+        {
+            TripleStart.push_back(NTriples);
+            NTriples += NModes - j - 1;
+        }
+    }
+    auto PairIdx = [&] (unsigned int i, unsigned int j)
+    {
+        return i * NModes - i * (i + 1) / 2 + (j - i - 1);
+    };
+
+    double MaxV = 0.0;
+    for (long unsigned int b = 0; b < NTriples * K3; b++) MaxV = std::max(MaxV, Max3Mode[b]);
+
+    #pragma omp parallel
+    {
+        HashedStates LocalNewStates;
+        #pragma omp for schedule(dynamic)
+        for (unsigned int n = 0; n < BasisSet.size(); n++)
+        {
+            double Cn = abs(C[n]);
+            if (Cn * MaxV < eps) continue;
+            for (unsigned int i = 0; i < NModes; i++)
+            {
+                int ni = BasisSet[n].Modes[i].Quanta;
+                for (unsigned int j = i + 1; j < NModes; j++)
+                {
+                    int nj = BasisSet[n].Modes[j].Quanta;
+                    long unsigned int T0 = TripleStart[PairIdx(i, j)];
+                    for (unsigned int k = j + 1; k < NModes; k++)
+                    {
+                        int nk = BasisSet[n].Modes[k].Quanta;
+                        long unsigned int Block = (T0 + k - j - 1) * K3 + (ni * K + nj) * K + nk;
+                        if (Cn * Max3Mode[Block] < eps) continue; // Nothing in this block passes
+                        for (long unsigned int m = 0; m < K3; m++)
+                        {
+                            int Target = Sorted3Mode[Block * K3 + m];
+                            int mi = Target / (K * K);
+                            int mj = (Target / K) % K;
+                            int mk = Target % K;
+                            if (Cn * abs(ThreeModePotential[Idx3(i, j, k, ni, nj, nk, mi, mj, mk)]) < eps) break;
+                            if (mi == ni || mj == nj || mk == nk) continue;
+                            if (!WithinMCR(NExcited[n] + ExcitationChange(ni, mi) + ExcitationChange(nj, mj) + ExcitationChange(nk, mk), MaxExcitedModes)) continue;
+                            WaveFunction tmp = BasisSet[n];
+                            tmp.Modes[i].Quanta = mi;
+                            tmp.Modes[j].Quanta = mj;
+                            tmp.Modes[k].Quanta = mk;
+                            if (HashedBasisInit.count(tmp) == 0) LocalNewStates.insert(tmp);
+                        }
+                    }
+                }
+            }
+        }
+        #pragma omp critical
+        HashedNewStates.insert(LocalNewStates.begin(), LocalNewStates.end());
+    }
+
+    std::vector<WaveFunction> NewBasis;
+    for (const WaveFunction &WF : HashedNewStates) NewBasis.push_back(WF);
+    return NewBasis;
+}
+
 complex<double> DoSpectralPT2NMode(MatrixXcd& Evecs, VectorXd& Evals, MatrixXd& C, std::vector<WaveFunction> &BasisSet, std::vector<double> &Frequencies, double V0, std::vector<Eigen::VectorXd> &OneModeEig, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>> &TwoModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<double>>>>>>>>> &ThreeModePotential, std::vector<std::vector<std::vector<std::vector<std::vector<std::vector<int>>>>>> &SortedIndices, double PT2_Eps, int NEig, double w, double eta)
 {
     int N_opt;
@@ -6643,3 +7263,25 @@ std::vector<WaveFunction> AddStatesHBMaxTensor(std::vector<WaveFunction> &BasisS
     return NewBasis;
 }
 */
+
+
+// The n-mode array kernels read the integrals in the precision they are stored in, double or float as chosen by
+// Molecule.IntsPrecision, and accumulate every matrix element in double.
+template SpMat VCISparseHamNModeArray<double>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, double, double*, double*, double*, double*, double*, bool, int, int);
+template std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> DipoleSparseNModeArray<double>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, double*, double*, double*, double*, double*, std::vector<long int>&, bool, int, int);
+template SpMat VCISparseHamNModeFromOMArray<double>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, double*, double*, double*, double*, bool, int, int);
+template double VCISparseHamNModeElementFromOMArray<double>(WaveFunction&, WaveFunction&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, double*, double*, double*, double*, int, int);
+template std::vector<double> VCISparseHamDiagonalNModeFromOMArray<double>(std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, double*, double*, double*, double*, int, int);
+template std::vector<WaveFunction> AddStatesCIPSIStreamArray<double>(std::vector<WaveFunction>&, std::vector<int>, int, Eigen::VectorXd&, Eigen::VectorXd&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, double*, double*, double*, double*, double, int, int, int);
+template std::vector<WaveFunction> AddStatesHB2ModeArray<double>(std::vector<WaveFunction>&, double*, int*, Eigen::VectorXd, double, bool, int, int, int);
+template std::vector<WaveFunction> AddStatesHB3ModeArray<double>(std::vector<WaveFunction>&, double*, int*, double*, int*, double*, Eigen::VectorXd, double, bool, int, int, int);
+template std::vector<double> DoPT2NModeArray<double>(MatrixXd&, VectorXd&, std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, double*, double*, double*, double*, int*, double, int, int, int, int);
+template SpMat VCISparseHamNModeArray<float>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, double, float*, float*, float*, float*, float*, bool, int, int);
+template std::tuple<Eigen::VectorXi, Eigen::VectorXi, Eigen::MatrixXd> DipoleSparseNModeArray<float>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, float*, float*, float*, float*, float*, std::vector<long int>&, bool, int, int);
+template SpMat VCISparseHamNModeFromOMArray<float>(std::vector<WaveFunction>&, std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, float*, float*, float*, float*, bool, int, int);
+template double VCISparseHamNModeElementFromOMArray<float>(WaveFunction&, WaveFunction&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, float*, float*, float*, float*, int, int);
+template std::vector<double> VCISparseHamDiagonalNModeFromOMArray<float>(std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, float*, float*, float*, float*, int, int);
+template std::vector<WaveFunction> AddStatesCIPSIStreamArray<float>(std::vector<WaveFunction>&, std::vector<int>, int, Eigen::VectorXd&, Eigen::VectorXd&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, float*, float*, float*, float*, double, int, int, int);
+template std::vector<WaveFunction> AddStatesHB2ModeArray<float>(std::vector<WaveFunction>&, float*, int*, Eigen::VectorXd, double, bool, int, int, int);
+template std::vector<WaveFunction> AddStatesHB3ModeArray<float>(std::vector<WaveFunction>&, float*, int*, float*, int*, double*, Eigen::VectorXd, double, bool, int, int, int);
+template std::vector<double> DoPT2NModeArray<float>(MatrixXd&, VectorXd&, std::vector<WaveFunction>&, std::vector<double>&, double, std::vector<Eigen::VectorXd>&, float*, float*, float*, float*, int*, double, int, int, int, int);
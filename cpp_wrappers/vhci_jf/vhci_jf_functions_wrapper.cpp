@@ -6,6 +6,80 @@
 #include "VCI_headers.h"
 #include <vector>
 
+// The n-mode integral and dipole arrays are taken in double or float, see Molecule.IntsPrecision. The double
+// overloads are registered first, so that arrays of either type are passed without a copy.
+template <typename Scalar>
+void DefNModeArrayKernels(pybind11::module &m)
+{
+    m.def("VCISparseHamNModeArray", [](std::vector<WaveFunction> BasisSet1, std::vector<WaveFunction> BasisSet2, std::vector<double> Frequencies, double V0, pybind11::array_t<Scalar> buffer2, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, bool DiagonalBlock, int MaxNMode, int MaxQ)
+            {
+                pybind11::buffer_info info2 = buffer2.request();
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                return VCISparseHamNModeArray(BasisSet1, BasisSet2, Frequencies, V0, static_cast<Scalar*>(info2.ptr), static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), DiagonalBlock, MaxNMode, MaxQ);
+            });
+    m.def("DipoleSparseNModeArray", [](std::vector<WaveFunction> BasisSet1, std::vector<WaveFunction> BasisSet2, std::vector<double> Mu0, pybind11::array_t<Scalar> buffer2, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, bool DiagonalBlock, int MaxNMode, int MaxQ)
+            {
+                pybind11::buffer_info info2 = buffer2.request();
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                std::vector<long int> Strides = {info2.size / 3, info3.size / 3, info4.size / 3, info5.size / 3, info6.size / 3};
+                return DipoleSparseNModeArray(BasisSet1, BasisSet2, Mu0, static_cast<Scalar*>(info2.ptr), static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), Strides, DiagonalBlock, MaxNMode, MaxQ);
+            }, "Forms the three n-mode dipole components on a shared sparsity pattern.");
+    m.def("VCISparseHamNModeFromOMArray", [](std::vector<WaveFunction> BasisSet1, std::vector<WaveFunction> BasisSet2, std::vector<double> Frequencies, double V0, std::vector<Eigen::VectorXd> OneMode_Eig, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, bool DiagonalBlock, int MaxNMode, int MaxQ)
+            {
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                return VCISparseHamNModeFromOMArray(BasisSet1, BasisSet2, Frequencies, V0, OneMode_Eig, static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), DiagonalBlock, MaxNMode, MaxQ);
+            });
+    m.def("AddStatesCIPSIStreamArray", [](std::vector<WaveFunction> BasisSet, std::vector<int> MaxQuanta, int Order, Eigen::VectorXd C, Eigen::VectorXd EVal, std::vector<double> Frequencies, double V0, std::vector<Eigen::VectorXd> OneMode_Eig, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, double eps, int MaxAdd, int MaxQ, int MaxExcitedModes)
+            {
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                return AddStatesCIPSIStreamArray(BasisSet, MaxQuanta, Order, C, EVal, Frequencies, V0, OneMode_Eig, static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), eps, MaxAdd, MaxQ, MaxExcitedModes);
+            }, "Selects configurations based on the CIPSI criterion while streaming the connected space.");
+    m.def("AddStatesHB2ModeArray", [](std::vector<WaveFunction> BasisSet1, pybind11::array_t<Scalar> buffer2, pybind11::array_t<int> buffer3, Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes)
+            {
+                pybind11::buffer_info info2 = buffer2.request();
+                pybind11::buffer_info info3 = buffer3.request();
+                return AddStatesHB2ModeArray(BasisSet1, static_cast<Scalar*>(info2.ptr), static_cast<int*>(info3.ptr), C, eps, ExactSingles, NModes, MaxQ, MaxExcitedModes);
+            });
+    m.def("AddStatesHB3ModeArray", [](std::vector<WaveFunction> BasisSet1, pybind11::array_t<Scalar> buffer2, pybind11::array_t<int> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<int> buffer5, pybind11::array_t<double> buffer6, Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ, int MaxExcitedModes)
+            {
+                pybind11::buffer_info info2 = buffer2.request();
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                return AddStatesHB3ModeArray(BasisSet1, static_cast<Scalar*>(info2.ptr), static_cast<int*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<int*>(info5.ptr), static_cast<double*>(info6.ptr), C, eps, ExactSingles, NModes, MaxQ, MaxExcitedModes);
+            }, "Selects configurations based on sorted 2-mode and 3-mode potentials.");
+    m.def("DoPT2NModeArray", [](Eigen::MatrixXd Evecs, Eigen::VectorXd Evals, std::vector<WaveFunction> BasisSet, std::vector<double> Frequencies, double V0, std::vector<Eigen::VectorXd> OneMode_Eig, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, pybind11::array_t<int> bufferS, double PT2_Eps, int NEig, int MaxNMode, int NModes, int MaxQ)
+            {
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                pybind11::buffer_info infoS = bufferS.request();
+                return DoPT2NModeArray(Evecs, Evals, BasisSet, Frequencies, V0, OneMode_Eig, static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), static_cast<int*>(infoS.ptr), PT2_Eps, NEig, MaxNMode, NModes, MaxQ);
+            }, "Runs Epstein-Nesbet PT2 corrections for nMode potential with 2-mode heat bath screening");
+    m.def("VCISparseHamDiagonalNModeFromOMArray", [](std::vector<WaveFunction> BasisSet, std::vector<double> Frequencies, double V0, std::vector<Eigen::VectorXd> OneMode_Eig, pybind11::array_t<Scalar> buffer3, pybind11::array_t<Scalar> buffer4, pybind11::array_t<Scalar> buffer5, pybind11::array_t<Scalar> buffer6, int MaxNMode, int MaxQ)
+            {
+                pybind11::buffer_info info3 = buffer3.request();
+                pybind11::buffer_info info4 = buffer4.request();
+                pybind11::buffer_info info5 = buffer5.request();
+                pybind11::buffer_info info6 = buffer6.request();
+                return VCISparseHamDiagonalNModeFromOMArray(BasisSet, Frequencies, V0, OneMode_Eig, static_cast<Scalar*>(info3.ptr), static_cast<Scalar*>(info4.ptr), static_cast<Scalar*>(info5.ptr), static_cast<Scalar*>(info6.ptr), MaxNMode, MaxQ);
+            }, "Generates H diagonal elements using n-Mode potential arrays in one mode eigenbasis");
+}
+
 PYBIND11_MODULE(vhci_jf_functions, m)
 {
     m.doc() = "Module for C++ implementations for VHCI based on JF's code.";
@@ -35,11 +109,15 @@ PYBIND11_MODULE(vhci_jf_functions, m)
     m.def("GenerateSparseHamV", GenerateSparseHamV, "Forms sparse vibrational Hamiltonian");
     m.def("GenerateSparseHamVOD", GenerateSparseHamVOD, "Forms sparse vibrational Hamiltonian");
     m.def("GenerateSparseHamAnharmV", GenerateSparseHamAnharmV, "Forms sparse vibrational Anharmonic Hamiltonian");
+    m.def("GenerateSparseHamAnharmVOD", GenerateSparseHamAnharmVOD, "Forms off diagonal block of sparse vibrational Anharmonic Hamiltonian");
+    m.def("GenerateSparseDipoleAnharmV", GenerateSparseDipoleAnharmV, "Forms the three dipole components on a shared sparsity pattern");
     m.def("GenerateHamAnharmV", GenerateHamAnharmV, "Forms vibrational Anharmonic Hamiltonian");
     m.def("AddStatesHB", AddStatesHB, "Screens for states above the HB threshold");
     m.def("HeatBath_Sort_FC", HeatBath_Sort_FC, "Sorts the force constants from highest to lowest");
     m.def("DoPT2", DoPT2, "Runs PT2 corrections");
     m.def("DoSPT2", DoSPT2, "Runs SPT2 corrections");
+    m.def("DoSPT2Adaptive", DoSPT2Adaptive, "Runs seeded SPT2 sampling in batches until a target standard error is reached");
+    m.def("DoPT2Batched", DoPT2Batched, "Runs PT2 corrections with the external space split into hash batches");
     m.def("GetVEffSLOW1CPP", GetVEffSLOW1CPP, "Generates the effective potential for each mode.");
     m.def("MakeCTensorsCPP", MakeCTensorsCPP, "Generates all C Tensors for each anharmonic term.");
     m.def("MakeCTensorCPP", MakeCTensorCPP, "Generates the C Tensor given the list of modes.");
@@ -53,6 +131,7 @@ PYBIND11_MODULE(vhci_jf_functions, m)
     m.def("AddStatesHBFromVSCF", AddStatesHBFromVSCF, "Screens for states above the HB with exact matrix elements in VSCF.");
     m.def("DoPT2FromVSCF", DoPT2FromVSCF, "Runs PT2 corrections in the modal basis.");
     m.def("DoSPT2FromVSCF", DoSPT2FromVSCF, "Runs stochastic PT2 corrections in the modal basis.");
+    m.def("DoPT2FromVSCFBatched", DoPT2FromVSCFBatched, "Runs PT2 corrections in the modal basis with the external space split into hash batches.");
     m.def("ProdU", ProdU, "Multiplies a list of 2 x 2 matrices.");
     m.def("SetUij", SetUij, "Makes a rotation metrix.");
     m.def("SetUs", SetUs, "Makes a list of rotation matrices");
@@ -70,35 +149,14 @@ PYBIND11_MODULE(vhci_jf_functions, m)
     m.def("SpectralFrequencyPruneFromVSCF", SpectralFrequencyPruneFromVSCF, "Prunes basis based on how close w is to Hnn-E0 using VSCF modals");
     m.def("DoSpectralPT2", DoSpectralPT2, "Runs spectral PT2 corrections");
     m.def("VCISparseHamNMode", VCISparseHamNMode, "Generates H using n-Mode potential.");
-    m.def("VCISparseHamNModeArray", [](std::vector<WaveFunction> BasisSet1, std::vector<WaveFunction> BasisSet2, std::vector<double> Frequencies, double V0, pybind11::array_t<double> buffer2, pybind11::array_t<double> buffer3, pybind11::array_t<double> buffer4, pybind11::array_t<double> buffer5, pybind11::array_t<double> buffer6, bool DiagonalBlock, int MaxNMode, int MaxQ)
-            {
-                pybind11::buffer_info info2 = buffer2.request();
-                pybind11::buffer_info info3 = buffer3.request();
-                pybind11::buffer_info info4 = buffer4.request();
-                pybind11::buffer_info info5 = buffer5.request();
-                pybind11::buffer_info info6 = buffer6.request();
-                return VCISparseHamNModeArray(BasisSet1, BasisSet2, Frequencies, V0, static_cast<double*>(info2.ptr), static_cast<double*>(info3.ptr), static_cast<double*>(info4.ptr), static_cast<double*>(info5.ptr), static_cast<double*>(info6.ptr), DiagonalBlock, MaxNMode, MaxQ);
-            });
     m.def("VCISparseHamNModeFromOM", VCISparseHamNModeFromOM, "Generates H using n-Mode potential in one mode eigenbasis.");
-    m.def("VCISparseHamNModeFromOMArray", [](std::vector<WaveFunction> BasisSet1, std::vector<WaveFunction> BasisSet2, std::vector<double> Frequencies, double V0, std::vector<Eigen::VectorXd> OneMode_Eig, pybind11::array_t<double> buffer3, pybind11::array_t<double> buffer4, pybind11::array_t<double> buffer5, pybind11::array_t<double> buffer6, bool DiagonalBlock, int MaxNMode, int MaxQ)
-            {
-                pybind11::buffer_info info3 = buffer3.request();
-                pybind11::buffer_info info4 = buffer4.request();
-                pybind11::buffer_info info5 = buffer5.request();
-                pybind11::buffer_info info6 = buffer6.request();
-                return VCISparseHamNModeFromOMArray(BasisSet1, BasisSet2, Frequencies, V0, OneMode_Eig, static_cast<double*>(info3.ptr), static_cast<double*>(info4.ptr), static_cast<double*>(info5.ptr), static_cast<double*>(info6.ptr), DiagonalBlock, MaxNMode, MaxQ);
-            });
     m.def("ConnectedStatesCIPSI", ConnectedStatesCIPSI, "Finds all connected configurations given an n-mode potential to a space of configurations.");
     m.def("AddStatesCIPSI", AddStatesCIPSI, "Selects configurations based on the CIPSI criterion.");
     m.def("AddStatesHB2Mode", AddStatesHB2Mode, "Selects configurations based on 2-mode potential sorting.");
-    m.def("AddStatesHB2ModeArray", [](std::vector<WaveFunction> BasisSet1, pybind11::array_t<double> buffer2, pybind11::array_t<int> buffer3, Eigen::VectorXd C, double eps, bool ExactSingles, int NModes, int MaxQ)
-            {
-                pybind11::buffer_info info2 = buffer2.request();
-                pybind11::buffer_info info3 = buffer3.request();
-                return AddStatesHB2ModeArray(BasisSet1, static_cast<double*>(info2.ptr), static_cast<int*>(info3.ptr), C, eps, ExactSingles, NModes, MaxQ);
-            });
     m.def("DoSpectralPT2NMode", DoSpectralPT2NMode, "Runs spectral PT2 corrections for nMode potential");
     m.def("VCISparseHamDiagonalNModeFromOM", VCISparseHamDiagonalNModeFromOM, "Generates H diagonal elements using n-Mode potential in one mode eigenbasis");
     m.def("VCISparseT", VCISparseT, "Generates kinetic energy in HO basis.");
     //m.def("VCISparseHamTCI", VCISparseHamTCI, "Generates H using TCI potential.");
+    DefNModeArrayKernels<double>(m);
+    DefNModeArrayKernels<float>(m);
 }
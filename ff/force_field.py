@@ -1,5 +1,4 @@
 import numpy as np
-from pyscf import gto, scf, hessian
 from vstr.ff.normal_modes import AtomToCoord, CoordToAtom, GetHessian, GetNumHessian
 from vstr.utils import constants
 
@@ -18,6 +17,7 @@ def PerturbCoord(X0, Modes, Coords, dx):
     return X
 
 def CoordToHessian(X, atom0, mol, Method = 'rhf'):
+    from pyscf import scf
     atom = CoordToAtom(atom0, X)
     mol.atom = atom
     mol.verbose = 0
@@ -32,6 +32,7 @@ def PerturbHessian(X0, Modes, Coords, dx, atom0, mol, Method = 'rhf'):
     return Coords.T @ H @ Coords
 
 def PerturbEnergy(X0, Modes, Coords, dx, atom0, mol, Method = 'rhf'):
+    from pyscf import scf
     X = PerturbCoord(X0, Modes, Coords, dx)
     atom = CoordToAtom(atom0, X)
     mol.atom = atom
@@ -420,6 +421,7 @@ def PruneVs(Vs, Max = None, type = []):
     return PrunedV
 
 if __name__ == "__main__":
+    from pyscf import gto, scf
     from vstr.ff.normal_modes import GetNormalModes
 
     mol = gto.M()
@@ -1,5 +1,3 @@
-from pyscf import gto, scf, hessian, cc
-from pyscf.grad import ccsd_t as ccsd_t_grad
 import numpy as np
 #from pyscf.data import nist
 from vstr.utils import constants
@@ -11,6 +9,8 @@ def PerturbCoord(X0, Modes, Coords, dx):
     return X
 
 def CoordToCCSDGrad(X, atom0, mol, _T = False):
+    from pyscf import scf, cc
+    from pyscf.grad import ccsd_t as ccsd_t_grad
     atom = CoordToAtom(atom0, X)
     mol.atom = atom
     mol.unit = 'B'
@@ -94,6 +94,7 @@ def CoordToAtom(atom, X):
     return atom_new
 
 def GetNumHessian(mf, Coords = None, Method = 'rhf', dx = 1e-4, MassWeighted = True, isotope_avg = True):
+    from pyscf import scf
     if Coords is None:
         Coords = np.eye(mf.mol.natm * 3)
     Mass = mf.mol.atom_mass_list(isotope_avg=isotope_avg)
@@ -181,6 +182,7 @@ def GetNumHessian(mf, Coords = None, Method = 'rhf', dx = 1e-4, MassWeighted = T
     return H
 
 def GetHessian(mf, Method = 'rhf', MassWeighted = False, isotope_avg=True):
+    from pyscf import hessian
     mass = mf.mol.atom_mass_list(isotope_avg=isotope_avg)
     if Method == 'rhf':
         mf.verbose = 0
@@ -231,6 +233,7 @@ def GetNormalModes(mf, H = None, Method = 'rhf', tol = 1e-4):
     return w, C
 
 if __name__ == '__main__':
+    from pyscf import gto, scf
     mol = gto.M()
     #mol.fromfile("h2o.xyz")
     mol.atom = '''
@@ -1,7 +1,7 @@
 import numpy as np
 from vstr.utils.init_funcs import FormW, InitTruncatedBasis, InitGridBasis
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, GenerateHam0V, GenerateSparseHamAnharmV, GenerateHamAnharmV, GetVEffCPP
-from vstr.utils.perf_utils import TIMER
+from vstr.utils.perf_utils import PROFILER
 
 def InitCs(mVSCF):
     Cs = []
@@ -420,6 +420,7 @@ def DIISUpdate(mVSCF):
         
 
 def SCFIteration(mVSCF, It, DoDIIS = True):
+    mVSCF.Timer.count("SCF iterations")
     mVSCF.Timer.start(2)
     mVSCF.Fs = mVSCF.GetFock(CalcE = True)
     mVSCF.Timer.stop(2)
@@ -664,9 +665,8 @@ class VSCF:
         self.Frequencies = Frequencies
         self.NModes = self.Frequencies.shape[0]
 
-        self.Timer = TIMER(5)
-        self.Timer.set_overhead(self.Timer.estimate_overhead())
         self.TimerNames = ["Basis Init", "Anharm Pot Init", "Fock Generation", "DIIS", "Solve Fock"]
+        self.Timer = PROFILER(self.TimerNames, name = "VSCF")
 
         self.Potential = [[], [], [], []]
         for V in UnscaledPotential:
@@ -717,6 +717,7 @@ class VSCF:
 
         self.verbose = 2
         self.Converged = False
+        self.ProfileFile = None
 
         self.__dict__.update(kwargs)
 
@@ -729,6 +730,8 @@ class VSCF:
         self.SCF(DoDIIS = self.DoDIIS)
         if self.verbose > 1:
             self.Timer.report(self.TimerNames)
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
         return self.ESCF
 
 class NModeVSCF(VSCF):
@@ -741,9 +744,8 @@ class NModeVSCF(VSCF):
         self.NModes = self.Frequencies.shape[0]
         self.Es = mol.onemode_eig
 
-        self.Timer = TIMER(5)
-        self.Timer.set_overhead(self.Timer.estimate_overhead())
         self.TimerNames = ["Basis Init", "Anharm Pot Init", "Fock Generation", "DIIS", "Solve Fock"]
+        self.Timer = PROFILER(self.TimerNames, name = "NModeVSCF")
         self.MaxQuanta = [mol.ngridpts] * self.NModes
         self.ModeOcc = [0] * self.NModes
         self.ESCF = 0.0
@@ -756,6 +758,7 @@ class NModeVSCF(VSCF):
 
         self.verbose = 2
         self.Converged = False
+        self.ProfileFile = None
 
         self.__dict__.update(kwargs)
 
@@ -2,19 +2,18 @@ import sys
 import os
 import numpy as np
 import scipy
-import numdifftools as nd
-import h5py
 from itertools import permutations
 from vstr.utils import init_funcs, constants
 from vstr.ff.force_field import ScaleFC_me
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import VCISparseHamNMode
 from vstr.spectra.dipole import GetDipole
-from vstr.utils.perf_utils import TIMER
-from pyscf import gto, scf, cc
+from vstr.utils.perf_utils import PROFILER
+from vstr.utils.memory_utils import GB, PlanMemory, CheckMemory
+from vstr.nmode.ooc import IntegralStore
+from vstr.utils.symmetry_utils import SymmetrizeModes
 
 #import tntorch as tn
 #import torch
-import xfacpy
 
 A2B = 1.88973
 AU2CM = 219474.63 
@@ -30,6 +29,7 @@ def ho_3d(x):
 #            + 0.25 * 100 * x[0, 1] * x[0, 1] * x[0, 2] * x[0, 2]) # + 0.001 * x[0, 0] * x[0, 1] * x[0, 2] + 0.01 * x[0, 0]**2 * x[0, 1]**2 * x[0, 2]**2)
 
 def PyPotential(x, pymol, Method = 'rhf'):
+    from pyscf import scf, cc
     new_mol = pymol.copy()
     new_mol.unit = 'B'
     atom = []
@@ -50,6 +50,7 @@ def PyPotential(x, pymol, Method = 'rhf'):
     return E
 
 def PyDipole(x, pymol, Method = 'rhf', ReturnE = False):
+    from pyscf import scf
     new_mol = pymol.copy()
     new_mol.unit = 'B'
     atom = []
@@ -90,14 +91,22 @@ class Molecule():
         self.ReadGeom = False
         self.doGeomOpt = True
         self.doShiftPotential = True
+        self.doSymmetrizeModes = False # Rotate degenerate normal modes to be symmetric or antisymmetric under each operation, see utils.symmetry_utils
         self.doSaveIntsOTF = False
+        self.MemoryBudget = None # GB for the n-mode tensors, None means the available physical memory
+        self.MemoryCheck = 'warn' # 'warn', 'refuse' or None when the tensors do not fit
+        self.Storage = 'auto' # 'dense', 'ooc' to read 3-mode and higher integrals from disk, or 'auto' to pick the first that fits
+        self.IntsCacheSize = 1.0 # GB of integral blocks kept in memory with Storage = 'ooc'
+        self.IntsPrecision = 'float64' # 'float32' stores the n-mode integrals and dipoles in single precision, in memory and on disk
+        self.IntsStore = None
 
         self.NonFrzCoords = None
+        self.ProfileFile = None
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(11)
         self.TimerNames = ["Opt + NM", "1-Mode Ints", "2-Mode Ints", "3-Mode Ints", "4-Mode Ints", "5-Mode Ints", "1-Mode Dips", "2-Mode Dips", "3-Mode Dips", "4-Mode Dips", "5-Mode Dips"]
+        self.Timer = PROFILER(self.TimerNames, name = "Molecule")
 
     def __str__(self):
         '''
@@ -173,6 +182,21 @@ class Molecule():
         com /= np.sum(self.mass)
         return com
 
+    def CountEvaluations(self):
+        """
+        Wraps the PES and dipole surface so every evaluation is counted by the profiler.
+        """
+        def counted(f, counter):
+            if f is None or getattr(f, "counted", False):
+                return f
+            def f_counted(x):
+                self.Timer.count(counter)
+                return f(x)
+            f_counted.counted = True
+            return f_counted
+        self.potential_cart = counted(self.potential_cart, "PES evaluations")
+        self.dipole_cart = counted(self.dipole_cart, "dipole evaluations")
+
     def _potential(self, x):
         """
         Calculate the potential with 3N-dimensional argument.
@@ -224,6 +248,11 @@ class Molecule():
             self.ReadGeometry()
         else:
             self.nm.kernel(x0 = x0, doGeomOpt = self.doGeomOpt, coords = self.NonFrzCoords)
+            if self.doSymmetrizeModes:
+                self.nm.nm_coeff, self.SymmetryOps, self.ModeCharacters = SymmetrizeModes(self.nm.x0, self.mass, self.nm.nm_coeff, self.nm.freqs)
+                print("Characters of the normal modes under", ", ".join(Op[0] for Op in self.SymmetryOps), flush = True)
+                for i in range(self.ModeCharacters.shape[0]):
+                    print("  %4d %12.4f  " % (i, self.nm.freqs[i] * constants.AU_TO_INVCM), " ".join("%+.2f" % c for c in self.ModeCharacters[i]), flush = True)
         self.Nm = self.nm.freqs.shape[0]
         #debug!!
         #c = np.zeros((self.natoms * 3, self.nm.nmodes))
@@ -257,7 +286,8 @@ class Molecule():
         else:
             for i in range(Order):
                 self.Timer.start(i + 1)
-                self.ints[i] = self.nmode.get_ints(i+1, ngridpts = self.ngridpts, onemode_coeff = self.onemode_coeff)
+                # Out of core, the 3-mode and higher integrals stay in the files written on the fly
+                self.ints[i] = self.nmode.get_ints(i+1, ngridpts = self.ngridpts, onemode_coeff = self.onemode_coeff, load = i < 2 or self.Storage != 'ooc')
                 self.Timer.stop(i + 1)
                 if i == 0 and self.use_onemode_states:
                     for j in range(self.Nm):
@@ -268,6 +298,10 @@ class Molecule():
                         self.onemode_eig.append(e)
                 if i == 0 and not self.use_onemode_states:
                     self.onemode_coeff = [np.eye(self.ngridpts)] * self.Nm
+            if self.Storage == 'ooc':
+                for i in range(2, Order):
+                    self.ints[i] = np.array([0.0], dtype = self.IntsPrecision)
+                self.IntsStore = IntegralStore(self.Nm, self.ngridpts, Order, IntsFile = None, CacheSize = self.IntsCacheSize, Dtype = self.IntsPrecision)
             if OrderPlus is not None:
                 for i in range(Order, OrderPlus):
                     if i == 2:
@@ -358,6 +392,7 @@ class Molecule():
         return FullBasis, IndexBasis, IndexOther
 
     def SaveIntegrals(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
 
@@ -372,25 +407,25 @@ class Molecule():
             g = f.create_group("ints")
             g1 = g.create_group("1")
             for i in range(self.Nm):
-                g1.create_dataset("%d" % (i + 1), data = self.ints[0][i])
+                g1.create_dataset("%d" % (i + 1), data = self.ints[0][i], dtype = self.IntsPrecision)
             if MaxOrder >= 2:
                 g2 = g.create_group("2")
                 for i in range(self.Nm):
                     for j in range(self.Nm):
-                        g2.create_dataset("%d_%d" % (i + 1, j + 1), data = self.ints[1][i, j])
+                        g2.create_dataset("%d_%d" % (i + 1, j + 1), data = self.ints[1][i, j], dtype = self.IntsPrecision)
                 if MaxOrder >= 3:
                     g3 = g.create_group("3")
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             for k in range(self.Nm):
-                                g3.create_dataset("%d_%d_%d" %(i + 1, j + 1, k + 1), data = self.ints[2][i, j, k])
+                                g3.create_dataset("%d_%d_%d" %(i + 1, j + 1, k + 1), data = self.ints[2][i, j, k], dtype = self.IntsPrecision)
                     if MaxOrder >= 4:
                         g4 = g.create_group("4")
                         for i in range(self.Nm):
                             for j in range(self.Nm):
                                 for k in range(self.Nm):
                                     for l in range(self.Nm):
-                                        g4.create_dataset("%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1), data = self.ints[3][i, j, k, l])
+                                        g4.create_dataset("%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1), data = self.ints[3][i, j, k, l], dtype = self.IntsPrecision)
                         if MaxOrder >= 5:
                             g5 = g.create_group("5")
                             for i in range(self.Nm):
@@ -398,7 +433,7 @@ class Molecule():
                                     for k in range(self.Nm):
                                         for l in range(self.Nm):
                                             for m in range(self.Nm):
-                                                g5.create_dataset("%d_%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1, m + 1), data = self.ints[4][i, j, k, l, m])
+                                                g5.create_dataset("%d_%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1, m + 1), data = self.ints[4][i, j, k, l, m], dtype = self.IntsPrecision)
 
             if "onemode_coeff" in f:
                 del f["onemode_coeff"]
@@ -427,6 +462,7 @@ class Molecule():
             f.create_dataset("freq", data = self.Frequencies)
 
     def SaveDipoles(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         cart_coord = ['x', 'y', 'z']
@@ -439,14 +475,14 @@ class Molecule():
             for x in range(3):
                 g1x = g1.create_group(cart_coord[x])
                 for i in range(self.Nm):
-                    g1x.create_dataset("%d" % (i + 1), data = self.dip_ints[0][x, i])
+                    g1x.create_dataset("%d" % (i + 1), data = self.dip_ints[0][x, i], dtype = self.IntsPrecision)
             if self.Order >= 2:
                 g2 = g.create_group("2")
                 for x in range(3):
                     g2x = g2.create_group(cart_coord[x])
                     for i in range(self.Nm):
                         for j in range(self.Nm):
-                            g2x.create_dataset("%d_%d" % (i + 1, j + 1), data = self.dip_ints[1][x, i, j])
+                            g2x.create_dataset("%d_%d" % (i + 1, j + 1), data = self.dip_ints[1][x, i, j], dtype = self.IntsPrecision)
                 if self.Order >= 3:
                     g3 = g.create_group("3")
                     for x in range(3):
@@ -454,7 +490,7 @@ class Molecule():
                         for i in range(self.Nm):
                             for j in range(self.Nm):
                                 for k in range(self.Nm):
-                                    g3x.create_dataset("%d_%d_%d" %(i + 1, j + 1, k + 1), data = self.dip_ints[2][x, i, j, k])
+                                    g3x.create_dataset("%d_%d_%d" %(i + 1, j + 1, k + 1), data = self.dip_ints[2][x, i, j, k], dtype = self.IntsPrecision)
                     if self.Order >= 4:
                         g4 = g.create_group("4")
                         for x in range(3):
@@ -463,7 +499,7 @@ class Molecule():
                                 for j in range(self.Nm):
                                     for k in range(self.Nm):
                                         for l in range(self.Nm):
-                                            g4x.create_dataset("%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1), data = self.dip_ints[3][x, i, j, k, l])
+                                            g4x.create_dataset("%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1), data = self.dip_ints[3][x, i, j, k, l], dtype = self.IntsPrecision)
                         if self.Order >= 5:
                             g5 = g.create_group("5")
                             for x in range(3):
@@ -473,7 +509,7 @@ class Molecule():
                                         for k in range(self.Nm):
                                             for l in range(self.Nm):
                                                 for m in range(self.Nm):
-                                                    g5x.create_dataset("%d_%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1, m + 1), data = self.dip_ints[4][x, i, j, k, l, m])
+                                                    g5x.create_dataset("%d_%d_%d_%d_%d" %(i + 1, j + 1, k + 1, l + 1, m + 1), data = self.dip_ints[4][x, i, j, k, l, m], dtype = self.IntsPrecision)
 
             if "onemode_coeff" in f:
                 del f["onemode_coeff"]
@@ -502,6 +538,7 @@ class Molecule():
             f.create_dataset("freq", data = self.Frequencies)
 
     def SaveInvInertia(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         cart_coord = ['xx', 'xy', 'xz', 'yx', 'yy', 'yz', 'zx', 'zy', 'zz']
@@ -527,6 +564,7 @@ class Molecule():
                                     g3x.create_dataset("%d_%d_%d" %(i + 1, j + 1, k + 1), data = self.inv_inertia_ints[2][x, i, j, k])
 
     def ReadGeometry(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
 
@@ -538,6 +576,7 @@ class Molecule():
             self.nm.mu0 = f["mu0"][()]
 
     def ReadIntegrals(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         MaxOrder = self.Order
@@ -570,6 +609,7 @@ class Molecule():
                 self.onemode_coeff.append(f["onemode_coeff/%d" % (i + 1)][()])
 
     def ReadDipoles(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         cart_coord = ['x', 'y', 'z']
@@ -595,39 +635,64 @@ class Molecule():
                                 for k in range(self.Nm):
                                     self.dip_ints[n][x, i, j, k] = f["dip_ints/%d/%s/%d_%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1, k + 1)][()]
 
+    def CheckMemory(self, Integrals = True, Dipole = False):
+        '''
+        Refuses or warns before the n-mode integrals or dipoles are allocated if they do not fit, and picks
+        the storage of the integrals when Storage = 'auto'. The integrals can only be read out of core
+        from an integral file or from the files written with doSaveIntsOTF.
+        '''
+        MaxOrder = self.Order
+        if self.OrderPlus is not None and Integrals:
+            MaxOrder = self.OrderPlus
+        OnDisk = self.ReadInt or self.doSaveIntsOTF
+        if Integrals and self.Storage == 'ooc' and not OnDisk:
+            raise ValueError("Storage = 'ooc' reads the integrals from disk and needs ReadInt or doSaveIntsOTF")
+        Budget = None if self.MemoryBudget is None else self.MemoryBudget * GB
+        Plan = PlanMemory(self.Nm, self.ngridpts, MaxOrder, Integrals = Integrals, Dipole = Dipole, Spaces = False, Storage = self.Storage if Integrals else 'dense', Layouts = ['dense', 'ooc'] if OnDisk else ['dense'], CacheSize = self.IntsCacheSize, Precision = self.IntsPrecision, Budget = Budget)
+        if Integrals:
+            self.Storage = Plan['Storage']
+        return CheckMemory(Plan, Mode = self.MemoryCheck)
+
     def ReadIntegralsAsArrays(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         MaxOrder = self.Order
         if self.OrderPlus is not None:
             MaxOrder = self.OrderPlus
+        self.CheckMemory()
+        if self.Storage == 'ooc':
+            self.IntsStore = IntegralStore(self.Nm, self.ngridpts, MaxOrder, IntsFile = IntsFile, CacheSize = self.IntsCacheSize, Dtype = self.IntsPrecision)
 
         with h5py.File(IntsFile, "r") as f:
             for n in range(MaxOrder):
+                if n >= 2 and self.Storage == 'ooc':
+                    self.ints[n] = np.array([0.0], dtype = self.IntsPrecision)
+                    continue
                 if n == 0:
-                    self.ints[n] = np.empty((self.Nm, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         self.ints[n][i] = f["ints/%d/%d" % (n + 1, i + 1)][()]
                 if n == 1:
-                    self.ints[n] = np.empty((self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             self.ints[n][i, j] = f["ints/%d/%d_%d" % (n + 1, i + 1, j + 1)][()]
                 if n == 2:
-                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             for k in range(self.Nm):
                                 self.ints[n][i, j, k] = f["ints/%d/%d_%d_%d" % (n + 1, i + 1, j + 1, k + 1)][()]
                 if n == 3:
-                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             for k in range(self.Nm):
                                 for l in range(self.Nm):
                                     self.ints[n][i, j, k, l] = f["ints/%d/%d_%d_%d_%d" % (n + 1, i + 1, j + 1, k + 1, l + 1)][()]
                 if n == 4:
-                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             for k in range(self.Nm):
@@ -635,7 +700,7 @@ class Molecule():
                                     for m in range(self.Nm):
                                         self.ints[n][i, j, k, l, m] = f["ints/%d/%d_%d_%d_%d_%d" % (n + 1, i + 1, j + 1, k + 1, l + 1, m + 1)][()]
                 if n == 5:
-                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.ints[n] = np.empty((self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for i in range(self.Nm):
                         for j in range(self.Nm):
                             for k in range(self.Nm):
@@ -652,32 +717,34 @@ class Molecule():
                 self.onemode_coeff.append(f["onemode_coeff/%d" % (i + 1)][()])
 
     def ReadDipolesAsArrays(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
+        self.CheckMemory(Integrals = False, Dipole = True)
         cart_coord = ['x', 'y', 'z']
 
         with h5py.File(IntsFile, "r") as f:
             for n in range(self.Order):
                 if n == 0:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             self.dip_ints[n][x, i] = f["dip_ints/%d/%s/%d" % (n + 1, cart_coord[x], i + 1)][()]
                 if n == 1:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             for j in range(self.Nm):
                                 self.dip_ints[n][x, i, j] = f["dip_ints/%d/%s/%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1)][()]
                 if n == 2:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             for j in range(self.Nm):
                                 for k in range(self.Nm):
                                     self.dip_ints[n][x, i, j, k] = f["dip_ints/%d/%s/%d_%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1, k + 1)][()]
                 if n == 3:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             for j in range(self.Nm):
@@ -685,7 +752,7 @@ class Molecule():
                                     for l in range(self.Nm):
                                         self.dip_ints[n][x, i, j, k, l] = f["dip_ints/%d/%s/%d_%d_%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1, k + 1, l + 1)][()]
                 if n == 4:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             for j in range(self.Nm):
@@ -694,7 +761,7 @@ class Molecule():
                                         for m in range(self.Nm):
                                             self.dip_ints[n][x, i, j, k, l, m] = f["dip_ints/%d/%s/%d_%d_%d_%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1, k + 1, l + 1, m + 1)][()]
                 if n == 5:
-                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = float)
+                    self.dip_ints[n] = np.empty((3, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.Nm, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts, self.ngridpts), dtype = self.IntsPrecision)
                     for x in range(3):
                         for i in range(self.Nm):
                             for j in range(self.Nm):
@@ -705,6 +772,7 @@ class Molecule():
                                                 self.dip_ints[n][x, i, j, k, l, m, o] = f["dip_ints/%d/%s/%d_%d_%d_%d_%d_%d" % (n + 1, cart_coord[x], i + 1, j + 1, k + 1, l + 1, m + 1, o + 1)][()]
 
     def ReadInvInertia(self, IntsFile = None):
+        import h5py
         if IntsFile is None:
             IntsFile = self.IntsFile
         cart_coord = ['xx', 'xy', 'xz', 'yx', 'yy', 'yz', 'zx', 'zy', 'zz']
@@ -786,6 +854,7 @@ class Molecule():
                         break
 
     def ScanPES(self, Modes, Range = None, PlottedModes = None, NPoints = 10, SavePES = None):
+        import h5py
         if Range is None:
             Range = [[-50, 50]] * len(Modes)
         ModePts = []
@@ -889,9 +958,11 @@ class Molecule():
         return DivergentTriplets
 
     def kernel(self, x0 = None):
+        self.CountEvaluations()
         self.Timer.start(0)
         self.CalcNM(x0 = x0)
         self.Timer.stop(0)
+        self.CheckMemory(Integrals = self.calc_integrals, Dipole = self.calc_dipole)
         if self.calc_integrals:
             print("Calculating integrals...", flush = True)
             self.CalcNModePotential(OrderPlus = self.OrderPlus)
@@ -903,6 +974,8 @@ class Molecule():
         print(self)
         
         self.Timer.report(self.TimerNames)
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 class NormalModes():
 
@@ -970,6 +1043,7 @@ class NormalModes():
         return self.freqs, self.nm_coeff
 
     def gradient(self, x):
+        import numdifftools as nd
         pes = self.mol._potential
         grad = nd.Gradient(pes)(x.reshape(-1))
         return grad.reshape((self.mol.natoms,3))
@@ -978,6 +1052,7 @@ class NormalModes():
         """
         Calculate the mass-weighted Hessian.
         """
+        import numdifftools as nd
         natoms = self.mol.natoms
         mass = self.mol.mass
         if coords is None:
@@ -1006,6 +1081,7 @@ class NormalModes():
         """
         Calculate the cubic and quartic derivatives of the potential with respect to normal modes
         """
+        import numdifftools as nd
         natoms = self.mol.natoms
         mass = self.mol.mass
         pes = self.mol._potential
@@ -1220,7 +1296,7 @@ class NormalModes():
         self.gridpts, self.dvr_coeff = nmode.get_heg(ngridpts)
     '''
 
-    def do_tci(self, gridpts, maxit = 121, tol = 1e-6):
+    def do_tci(self, gridpts, maxit = 121, tol = 1e-6, nworkers = 1, prefetch = False, oracle = None):
         # tntorch implementation
         '''
         gridpts_torch = [torch.tensor(grid) for grid in gridpts]
@@ -1228,20 +1304,28 @@ class NormalModes():
         print(t)
         return t.cores
         '''
+        import xfacpy
         # xfacpy implementation
+        if oracle is None:
+            oracle = TCIOracle(self, gridpts, nworkers = nworkers)
+        self.tci_oracle = oracle
         def f(x):
-            f.neval += 1
-            return self.potential_nm_i(*x)
-        f.neval = 0
+            v = oracle(x)
+            f.neval = oracle.neval
+            return v
+        f.neval = oracle.neval
+        if prefetch:
+            oracle.prefetch_fibers()
+            f.neval = oracle.neval
         ci = xfacpy.CTensorCI1(f, gridpts)
-        print("rank neval pivotError")
+        print("rank neval nhit pivotError")
         err = 1
         i = 0
         while(err > tol and i < maxit):
             i += 1
             ci.iterate()
             err = ci.pivotError[-1]
-            print(i, f.neval, ci.pivotError[-1], flush=True)
+            print(i, f.neval, oracle.nhit, ci.pivotError[-1], flush=True)
         return ci.get_TensorTrain().core
 
     def do_tt(self, gridpts, rank = 10):
@@ -1260,6 +1344,112 @@ class NormalModes():
         return t.cores
         
 
+class TCIOracle():
+    '''
+    Memoized potential oracle for TCI on a direct product grid of normal mode
+    coordinates. The Cartesian displacement of every grid point of every mode is
+    stored once, so a point costs a single gather and sum before the potential
+    call. Evaluated points are hashed by their grid multi-index, and neval only
+    counts real potential calls.
+    '''
+    def __init__(self, nm, gridpts, nworkers = 1):
+        self.nm = nm
+        self.gridpts = [np.asarray(grid, dtype = float) for grid in gridpts]
+        self.nworkers = nworkers
+        self.natoms = nm.mol.natoms
+        self.cache = {}
+        self.neval = 0
+        self.nhit = 0
+
+        # grid value -> grid index, xfacpy hands back the values we gave it
+        self.index = [{float(q): a for a, q in enumerate(grid)} for grid in self.gridpts]
+
+        # dX[offset[i] + a] is the displacement of mode i at grid point a
+        mass = np.asarray(nm.mol.mass)
+        dX = []
+        self.offset = np.zeros(len(self.gridpts), dtype = int)
+        n = 0
+        for i, grid in enumerate(self.gridpts):
+            self.offset[i] = n
+            dXi = np.einsum('n,nd,a->and', 1 / np.sqrt(mass), nm.nm_coeff[:, :, i], grid)
+            dX.append(dXi.reshape(grid.shape[0], -1))
+            n += grid.shape[0]
+        self.dX = np.vstack(dX)
+        self.x0 = np.asarray(nm.x0).reshape(-1)
+
+    def __call__(self, x):
+        return self.evaluate(self.to_index(x))
+
+    def to_index(self, x):
+        idx = []
+        for i, q in enumerate(x):
+            try:
+                idx.append(self.index[i][float(q)])
+            except KeyError:
+                idx.append(int(np.argmin(abs(self.gridpts[i] - q))))
+        return tuple(idx)
+
+    def cartesian(self, idx):
+        return (self.x0 + self.dX[self.offset + np.asarray(idx)].sum(axis = 0)).reshape((self.natoms, 3))
+
+    def _potential(self, idx):
+        return self.nm.mol.potential_cart(self.cartesian(idx))
+
+    def evaluate(self, idx):
+        try:
+            v = self.cache[idx]
+            self.nhit += 1
+            return v
+        except KeyError:
+            pass
+        v = self._potential(idx)
+        self.neval += 1
+        self.cache[idx] = v
+        return v
+
+    def evaluate_batch(self, idxs):
+        '''
+        Evaluates a list of grid multi-indices, only calling the potential on
+        points not yet in the cache. With nworkers > 1 the new points are
+        spread over a thread pool, which pays off for compiled potentials that
+        release the GIL.
+        '''
+        idxs = [tuple(int(a) for a in idx) for idx in idxs]
+        New = []
+        Seen = set()
+        for idx in idxs:
+            if idx in self.cache or idx in Seen:
+                self.nhit += 1
+            else:
+                Seen.add(idx)
+                New.append(idx)
+        if len(New) > 0:
+            if self.nworkers > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers = self.nworkers) as pool:
+                    Vs = list(pool.map(self._potential, New))
+            else:
+                Vs = [self._potential(idx) for idx in New]
+            for idx, v in zip(New, Vs):
+                self.cache[idx] = v
+            self.neval += len(New)
+        return np.asarray([self.cache[idx] for idx in idxs])
+
+    def prefetch_fibers(self, pivot = None):
+        '''
+        Batch evaluates every one mode fiber through the pivot, which is what
+        the first TCI sweep asks for.
+        '''
+        if pivot is None:
+            pivot = [int(np.argmin(abs(grid))) for grid in self.gridpts]
+        idxs = []
+        for i, grid in enumerate(self.gridpts):
+            for a in range(grid.shape[0]):
+                idx = list(pivot)
+                idx[i] = a
+                idxs.append(idx)
+        return self.evaluate_batch(idxs)
+
 def get_qmat_ho(omega, nmax):
     qmat = np.zeros((nmax,nmax))
     for n in range(nmax-1):
@@ -1275,6 +1465,16 @@ def get_tmat_ho(omega, nmax):
             tmat[n,n+2] = tmat[n+2,n] = -omega/4*np.sqrt((n+1)*(n+2))
     return tmat
 
+def PermutedBlocks(Modes, V):
+    '''
+    Yields every ordering of the mode tuple Modes with its n-mode block, transposed from the block V of
+    Modes so that the bra and ket occupations follow the same order as the modes. The kernels index the
+    block of modes (m, n, o) by the occupations of m, n and o in that order.
+    '''
+    k = len(Modes)
+    for P in permutations(range(k)):
+        yield tuple(Modes[p] for p in P), V.transpose(list(P) + [p + k for p in P]).copy()
+
 
 class HEG1Mode():
 
@@ -1348,7 +1548,8 @@ class NModePotential():
     def __init__(self, nm):
         self.nm = nm
 
-    def get_ints(self, nmode, ngridpts=None, optimized=False, ngridpts0=None, onemode_coeff = None, modes = None):
+    def get_ints(self, nmode, ngridpts=None, optimized=False, ngridpts0=None, onemode_coeff = None, modes = None, load = True):
+        import h5py
         print("Calculating n-Mode integrals for n =", nmode, flush = True) 
         if optimized is False:
             if ngridpts is None:
@@ -1385,7 +1586,7 @@ class NModePotential():
                     if self.nm.mol.doSaveIntsOTF:
                         intotf_name = "ints1_" + str(i) + ".h5"
                         with h5py.File(intotf_name, "w") as f:
-                            f.create_dataset("ints", data = vi * constants.AU_TO_INVCM)
+                            f.create_dataset("ints", data = vi * constants.AU_TO_INVCM, dtype = self.nm.mol.IntsPrecision)
                     else:
                         ints[i] = vi * constants.AU_TO_INVCM
             elif nmode == 2:
@@ -1403,7 +1604,7 @@ class NModePotential():
                         if self.nm.mol.doSaveIntsOTF:
                             intotf_name = "ints2_" + str(i) + "_" + str(j) + ".h5"
                             with h5py.File(intotf_name, "w") as f:
-                                f.create_dataset("ints", data = vij * constants.AU_TO_INVCM)    
+                                f.create_dataset("ints", data = vij * constants.AU_TO_INVCM, dtype = self.nm.mol.IntsPrecision)    
                         else:
                             ints[i, j] = vij * constants.AU_TO_INVCM
 
@@ -1424,14 +1625,10 @@ class NModePotential():
                             if self.nm.mol.doSaveIntsOTF:
                                 intotf_name = "ints3_" + str(i) + "_" + str(j) + "_" + str(k) + ".h5"
                                 with h5py.File(intotf_name, "w") as f:
-                                    f.create_dataset("ints", data = vijk * constants.AU_TO_INVCM)
+                                    f.create_dataset("ints", data = vijk * constants.AU_TO_INVCM, dtype = self.nm.mol.IntsPrecision)
                             else:   
-                                ints[i, j, k] = vijk * constants.AU_TO_INVCM
-                                ints[j, i, k] = vijk * constants.AU_TO_INVCM
-                                ints[i, k, j] = vijk * constants.AU_TO_INVCM
-                                ints[k, i, j] = vijk * constants.AU_TO_INVCM
-                                ints[j, k, i] = vijk * constants.AU_TO_INVCM
-                                ints[k, j, i] = vijk * constants.AU_TO_INVCM
+                                for I, V in PermutedBlocks((i, j, k), vijk * constants.AU_TO_INVCM):
+                                    ints[I] = V
             elif nmode == 4:
                 ints = np.empty((nmodes,nmodes,nmodes,nmodes), dtype=object)
                 for i in range(nmodes):
@@ -1451,11 +1648,10 @@ class NModePotential():
                                 if self.nm.mol.doSaveIntsOTF:
                                     intotf_name = "ints4_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + ".h5"
                                     with h5py.File(intotf_name, "w") as f:
-                                        f.create_dataset("ints", data = vijkl * constants.AU_TO_INVCM)
+                                        f.create_dataset("ints", data = vijkl * constants.AU_TO_INVCM, dtype = self.nm.mol.IntsPrecision)
                                 else:
-                                    Is = list(permutations([i, j, k, l]))
-                                    for I in Is:
-                                        ints[I] = vijkl * constants.AU_TO_INVCM
+                                    for I, V in PermutedBlocks((i, j, k, l), vijkl * constants.AU_TO_INVCM):
+                                        ints[I] = V
             elif nmode == 5:
                 ints = np.empty((nmodes,nmodes,nmodes,nmodes,nmodes), dtype=object)
                 for i in range(nmodes):
@@ -1477,11 +1673,10 @@ class NModePotential():
                                     if self.nm.mol.doSaveIntsOTF:
                                         intotf_name = "ints5_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + "_" + str(m) + ".h5"
                                         with h5py.File(intotf_name, "w") as f:
-                                            f.create_dataset("ints", data = vijklm * constants.AU_TO_INVCM)
+                                            f.create_dataset("ints", data = vijklm * constants.AU_TO_INVCM, dtype = self.nm.mol.IntsPrecision)
                                     else:
-                                        Is = list(permutations([i, j, k, l, m]))
-                                        for I in Is:
-                                            ints[I] = vijklm * constants.AU_TO_INVCM
+                                        for I, V in PermutedBlocks((i, j, k, l, m), vijklm * constants.AU_TO_INVCM):
+                                            ints[I] = V
         else:
             if nmode == 3:
                 ints = np.empty((nmodes,nmodes,nmodes), dtype=object)
@@ -1494,21 +1689,13 @@ class NModePotential():
                             if (i, j, k) in modes:
                                 vgrid = np.array([[[self.nm.potential_3mode(i,j,k,qi,qj,qk) for qk in gridpts[k]] for qj in gridpts[j]] for qi in gridpts[i]])
                                 vijk = np.einsum('gp,hq,fr,ghf,gs,ht,fu->pqrstu', Ci, Cj, Ck, vgrid, Ci, Cj, Ck, optimize=True)
-                                ints[i, j, k] = vijk * constants.AU_TO_INVCM
-                                ints[j, i, k] = vijk * constants.AU_TO_INVCM
-                                ints[i, k, j] = vijk * constants.AU_TO_INVCM
-                                ints[k, i, j] = vijk * constants.AU_TO_INVCM
-                                ints[j, k, i] = vijk * constants.AU_TO_INVCM
-                                ints[k, j, i] = vijk * constants.AU_TO_INVCM
+                                for I, V in PermutedBlocks((i, j, k), vijk * constants.AU_TO_INVCM):
+                                    ints[I] = V
                             else:
-                                ints[i, j, k] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
-                                ints[j, i, k] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
-                                ints[i, k, j] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
-                                ints[k, i, j] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
-                                ints[j, k, i] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
-                                ints[k, j, i] = np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))
+                                for I, V in PermutedBlocks((i, j, k), np.zeros((ngridpts[i], ngridpts[j], ngridpts[k], ngridpts[i], ngridpts[j], ngridpts[k]))):
+                                    ints[I] = V
 
-        if self.nm.mol.doSaveIntsOTF:
+        if self.nm.mol.doSaveIntsOTF and load:
             if nmode == 1:
                 ints = np.empty(nmodes, dtype=object)
                 for i in range(nmodes):
@@ -1529,12 +1716,8 @@ class NModePotential():
                         for k in range(j, nmodes):
                             intotf_name = "ints3_" + str(i) + "_" + str(j) + "_" + str(k) + ".h5"
                             with h5py.File(intotf_name, "r") as f:
-                                ints[i, j, k] = f["ints"][:]
-                                ints[j, i, k] = f["ints"][:]
-                                ints[i, k, j] = f["ints"][:]
-                                ints[k, i, j] = f["ints"][:]
-                                ints[j, k, i] = f["ints"][:]
-                                ints[k, j, i] = f["ints"][:]
+                                for I, V in PermutedBlocks((i, j, k), f["ints"][:]):
+                                    ints[I] = V
             elif nmode == 4:
                 ints = np.empty((nmodes,nmodes,nmodes,nmodes), dtype=object)
                 for i in range(nmodes):
@@ -1543,9 +1726,8 @@ class NModePotential():
                             for l in range(k, nmodes):
                                 intotf_name = "ints4_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + ".h5"
                                 with h5py.File(intotf_name, "r") as f:
-                                    Is = list(permutations([i, j, k, l]))
-                                    for I in Is:
-                                        ints[I] = f["ints"][:]
+                                    for I, V in PermutedBlocks((i, j, k, l), f["ints"][:]):
+                                        ints[I] = V
             elif nmode == 5:
                 ints = np.empty((nmodes,nmodes,nmodes,nmodes,nmodes), dtype=object)
                 for i in range(nmodes):
@@ -1555,12 +1737,12 @@ class NModePotential():
                                 for m in range(l, nmodes):
                                     intotf_name = "ints5_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + "_" + str(m) + ".h5"
                                     with h5py.File(intotf_name, "r") as f:
-                                        Is = list(permutations([i, j, k, l, m]))
-                                        for I in Is:
-                                            ints[I] = f["ints"][:]
+                                        for I, V in PermutedBlocks((i, j, k, l, m), f["ints"][:]):
+                                            ints[I] = V
         return ints
 
     def get_dipole_ints(self, nmode, ngridpts=None, optimized=False, ngridpts0=None, onemode_coeff = None, usePyPotDip = False):
+        import h5py
         print("Calculating n-Mode dipole integrals for n =", nmode, flush = True) 
         if optimized is False:
             if ngridpts is None:
@@ -1599,7 +1781,7 @@ class NModePotential():
                 if self.nm.mol.doSaveIntsOTF:
                     intotf_name = "dips1_" + str(i) + ".h5"
                     with h5py.File(intotf_name, "w") as f:
-                        f.create_dataset("dips", data = vi)
+                        f.create_dataset("dips", data = vi, dtype = self.nm.mol.IntsPrecision)
                 else:
                     ints[0, i] = vi[0]
                     ints[1, i] = vi[1]
@@ -1623,7 +1805,7 @@ class NModePotential():
                     if self.nm.mol.doSaveIntsOTF:
                         intotf_name = "dips2_" + str(i) + "_" + str(j) + ".h5"
                         with h5py.File(intotf_name, "w") as f:
-                            f.create_dataset("dips", data = vij)
+                            f.create_dataset("dips", data = vij, dtype = self.nm.mol.IntsPrecision)
                     else:
                         ints[0, i, j] = vij[0]
                         ints[1, i, j] = vij[1]
@@ -1651,33 +1833,14 @@ class NModePotential():
                         if self.nm.mol.doSaveIntsOTF:
                             intotf_name = "dips3_" + str(i) + "_" + str(j) + "_" + str(k) + ".h5"
                             with h5py.File(intotf_name, "w") as f:
-                                f.create_dataset("dips", data = vijk)
+                                f.create_dataset("dips", data = vijk, dtype = self.nm.mol.IntsPrecision)
                         else:
-                            ints[0, i, j, k] = vijk[0]
-                            ints[1, i, j, k] = vijk[1]
-                            ints[2, i, j, k] = vijk[2]
-                            ints[0, j, i, k] = vijk[0]
-                            ints[1, j, i, k] = vijk[1]
-                            ints[2, j, i, k] = vijk[2]
-                            ints[0, i, k, j] = vijk[0]
-                            ints[1, i, k, j] = vijk[1]
-                            ints[2, i, k, j] = vijk[2]
-                            ints[0, k, i, j] = vijk[0]
-                            ints[1, k, i, j] = vijk[1]
-                            ints[2, k, i, j] = vijk[2]
-                            ints[0, j, k, i] = vijk[0]
-                            ints[1, j, k, i] = vijk[1]
-                            ints[2, j, k, i] = vijk[2]
-                            ints[0, k, j, i] = vijk[0]
-                            ints[1, k, j, i] = vijk[1]
-                            ints[2, k, j, i] = vijk[2]
+                            for x in range(3):
+                                for I, V in PermutedBlocks((i, j, k), vijk[x]):
+                                    ints[x][I] = V
                             if usePyPotDip:
-                                ints[3, i, j, k] = vijk[3]
-                                ints[3, j, i, k] = vijk[3]
-                                ints[3, i, k, j] = vijk[3]
-                                ints[3, k, i, j] = vijk[3]
-                                ints[3, j, k, i] = vijk[3]
-                                ints[3, k, j, i] = vijk[3]
+                                for I, V in PermutedBlocks((i, j, k), vijk[3]):
+                                    ints[3][I] = V
 
         elif nmode == 4:
             ints = np.empty((3, nmodes, nmodes, nmodes, nmodes), dtype=object)
@@ -1701,15 +1864,14 @@ class NModePotential():
                             if self.nm.mol.doSaveIntsOTF:
                                 intotf_name = "dips4_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + ".h5"
                                 with h5py.File(intotf_name, "w") as f:
-                                    f.create_dataset("dips", data = vijkl)
+                                    f.create_dataset("dips", data = vijkl, dtype = self.nm.mol.IntsPrecision)
                             else:
-                                Is = list(permutations([i, j, k, l]))
                                 ncart = 3
                                 if usePyPotDip:
                                     ncart = 4
                                 for x in range(ncart):
-                                    for I in Is:
-                                        ints[x][I] = vijkl[x]
+                                    for I, V in PermutedBlocks((i, j, k, l), vijkl[x]):
+                                        ints[x][I] = V
         elif nmode == 5:
             ints = np.empty((3, nmodes, nmodes, nmodes, nmodes, nmodes), dtype=object)
             if usePyPotDip:
@@ -1733,15 +1895,14 @@ class NModePotential():
                                 if self.nm.mol.doSaveIntsOTF:
                                     intotf_name = "dips5_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + "_" + str(m) + ".h5"
                                     with h5py.File(intotf_name, "w") as f:
-                                        f.create_dataset("dips", data = vijklm)
+                                        f.create_dataset("dips", data = vijklm, dtype = self.nm.mol.IntsPrecision)
                                 else:
-                                    Is = list(permutations([i, j, k, l, m]))
                                     ncart = 3
                                     if usePyPotDip:
                                         ncart = 4
                                     for x in range(ncart):
-                                        for I in Is:
-                                            ints[x][I] = vijklm[x]
+                                        for I, V in PermutedBlocks((i, j, k, l, m), vijklm[x]):
+                                            ints[x][I] = V
 
         if self.nm.mol.doSaveIntsOTF:
             if nmode == 1:
@@ -1778,31 +1939,12 @@ class NModePotential():
                         for k in range(j, nmodes):
                             intotf_name = "dips3_" + str(i) + "_" + str(j) + "_" + str(k) + ".h5"
                             with h5py.File(intotf_name, "r") as f:
-                                ints[0, i, j, k] = f["dips"][0]
-                                ints[1, i, j, k] = f["dips"][1]
-                                ints[2, i, j, k] = f["dips"][2]
-                                ints[0, j, i, k] = f["dips"][0]
-                                ints[1, j, i, k] = f["dips"][1]
-                                ints[2, j, i, k] = f["dips"][2]
-                                ints[0, i, k, j] = f["dips"][0]
-                                ints[1, i, k, j] = f["dips"][1]
-                                ints[2, i, k, j] = f["dips"][2]
-                                ints[0, k, i, j] = f["dips"][0]
-                                ints[1, k, i, j] = f["dips"][1]
-                                ints[2, k, i, j] = f["dips"][2]
-                                ints[0, j, k, i] = f["dips"][0]
-                                ints[1, j, k, i] = f["dips"][1]
-                                ints[2, j, k, i] = f["dips"][2]
-                                ints[0, k, j, i] = f["dips"][0]
-                                ints[1, k, j, i] = f["dips"][1]
-                                ints[2, k, j, i] = f["dips"][2]
+                                for x in range(3):
+                                    for I, V in PermutedBlocks((i, j, k), f["dips"][x]):
+                                        ints[x][I] = V
                                 if usePyPotDip:
-                                    ints[3, i, j, k] = f["dips"][3]
-                                    ints[3, j, i, k] = f["dips"][3]
-                                    ints[3, i, k, j] = f["dips"][3]
-                                    ints[3, k, i, j] = f["dips"][3]
-                                    ints[3, j, k, i] = f["dips"][3]
-                                    ints[3, k, j, i] = f["dips"][3]
+                                    for I, V in PermutedBlocks((i, j, k), f["dips"][3]):
+                                        ints[3][I] = V
             elif nmode == 4:
                 ints = np.empty((3, nmodes, nmodes, nmodes, nmodes), dtype=object)
                 if usePyPotDip:
@@ -1813,13 +1955,12 @@ class NModePotential():
                             for l in range(k, nmodes):
                                 intotf_name = "dips4_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + ".h5"
                                 with h5py.File(intotf_name, "r") as f:
-                                    Is = list(permutations([i, j, k, l]))
                                     ncart = 3
                                     if usePyPotDip:
                                         ncart = 4
                                     for x in range(ncart):
-                                        for I in Is:
-                                            ints[x][I] = f["dips"][x]
+                                        for I, V in PermutedBlocks((i, j, k, l), f["dips"][x]):
+                                            ints[x][I] = V
             elif nmode == 5:
                 ints = np.empty((3, nmodes, nmodes, nmodes, nmodes, nmodes), dtype=object)
                 if usePyPotDip:
@@ -1831,13 +1972,12 @@ class NModePotential():
                                 for m in range(l, nmodes):
                                     intotf_name = "dips5_" + str(i) + "_" + str(j) + "_" + str(k) + "_" + str(l) + "_" + str(m) + ".h5"
                                     with h5py.File(intotf_name, "r") as f:
-                                        Is = list(permutations([i, j, k, l, m]))
                                         ncart = 3
                                         if usePyPotDip:
                                             ncart = 4
                                         for x in range(ncart):
-                                            for I in Is:
-                                                ints[x][I] = f["dips"][x]
+                                            for I, V in PermutedBlocks((i, j, k, l, m), f["dips"][x]):
+                                                ints[x][I] = V
         return ints
 
     def get_inv_inertia_ints(self, nmode, ngridpts=None, optimized=False, ngridpts0=None, onemode_coeff = None):
@@ -1959,6 +2099,7 @@ class NModePotential():
         return self.gridpts, self.coeff 
 
 if __name__ == '__main__':
+    from pyscf import gto
     from vstr.examples.potentials.h2o.h2o_pot import calc_h2o_pot
     def pot_cart(coords):
         if np.array(coords).ndim == 3:
@@ -0,0 +1,95 @@
+import itertools
+from collections import OrderedDict
+import numpy as np
+from vstr.utils.memory_utils import GB
+
+class IntegralStore():
+    '''
+    n-mode integral blocks of order three and higher read on demand from disk. Blocks are addressed by
+    their sorted mode tuple and read either from the ints group of an integral file written by
+    Molecule.SaveIntegrals, or from the per-block files written with doSaveIntsOTF when IntsFile is None.
+    Each block is a (K^k, K^k) array of type Dtype. The most recently used blocks are kept in memory up
+    to CacheSize GB. The largest magnitude of every row of a 3-mode block is kept once the block has
+    been read, which is all the heat bath screening needs to skip a block.
+
+    Examples:
+    >>> Store = IntegralStore(mol.Nm, mol.ngridpts, 4, IntsFile = "ints.h5", CacheSize = 8.0)
+    >>> V = Store.block((0, 3, 5))  # V[(n0 * K + n3) * K + n5, (m0 * K + m3) * K + m5]
+    >>> Store.stats()
+    '''
+    def __init__(self, Nm, ngridpts, Order, IntsFile = None, CacheSize = 1.0, Dtype = float):
+        self.Nm = Nm
+        self.K = ngridpts
+        self.Order = Order
+        self.IntsFile = IntsFile
+        self.Dtype = Dtype
+        self.CacheBytes = int(CacheSize * GB)
+        self.Cache = OrderedDict()
+        self.Bytes = 0
+        self.RowMax = dict()
+        self.Hits = 0
+        self.Misses = 0
+        self.BytesRead = 0
+        self.Sweeps = 0
+        self._file = None
+
+    def _read(self, Modes):
+        import h5py
+        k = len(Modes)
+        if self.IntsFile is not None:
+            if self._file is None:
+                self._file = h5py.File(self.IntsFile, "r")
+            V = self._file["ints/%d/%s" % (k, "_".join(str(m + 1) for m in Modes))][()]
+        else:
+            with h5py.File("ints%d_%s.h5" % (k, "_".join(str(m) for m in Modes)), "r") as f:
+                V = f["ints"][()]
+        return np.ascontiguousarray(V, dtype = self.Dtype).reshape(self.K**k, self.K**k)
+
+    def block(self, Modes):
+        '''
+        Integral block of the sorted mode tuple Modes, read from disk if it is not cached
+        '''
+        Modes = tuple(Modes)
+        V = self.Cache.get(Modes)
+        if V is not None:
+            self.Cache.move_to_end(Modes)
+            self.Hits += 1
+            return V
+        self.Misses += 1
+        V = self._read(Modes)
+        self.BytesRead += V.nbytes
+        if len(Modes) == 3:
+            self.RowMax[Modes] = abs(V).max(axis = 1)
+        self.Cache[Modes] = V
+        self.Bytes += V.nbytes
+        while self.Bytes > self.CacheBytes and len(self.Cache) > 1:
+            _, Old = self.Cache.popitem(last = False)
+            self.Bytes -= Old.nbytes
+        return V
+
+    def rowmax(self, Modes):
+        '''
+        Largest magnitude in each row of the block of Modes
+        '''
+        Modes = tuple(Modes)
+        if Modes not in self.RowMax:
+            self.block(Modes)
+        return self.RowMax[Modes]
+
+    def tuples(self, k):
+        '''
+        Sorted mode tuples of order k in the order of a sweep. Consecutive sweeps alternate direction so
+        that each starts with the blocks the previous one left in the cache.
+        '''
+        Tuples = list(itertools.combinations(range(self.Nm), k))
+        return Tuples[::-1] if self.Sweeps % 2 else Tuples
+
+    def stats(self):
+        return {"hits": self.Hits, "misses": self.Misses, "read_gb": self.BytesRead / GB, "cached_gb": self.Bytes / GB, "cached_blocks": len(self.Cache)}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.Cache.clear()
+        self.Bytes = 0
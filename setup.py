@@ -31,7 +31,7 @@ setup(
     description="Vibrational structure theory methods based on heat bath CI",
     entry_points={
         'console_scripts': [
-            'vstr=vstr.cli:main',
+            'vstr=vstr.vhci.cli:main',
         ],
     },
     install_requires=requirements,
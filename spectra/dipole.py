@@ -1,7 +1,4 @@
 import numpy as np
-from pyscf import gto, scf, hessian, cc
-from pyscf.cc import ccsd_t_lambda_slow as ccsd_t_lambda
-from pyscf.cc import ccsd_t_rdm_slow as ccsd_t_rdm
 from vstr.ff.force_field import PerturbCoord
 from vstr.ff.normal_modes import CoordToAtom, AtomToCoord
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import FConst
@@ -43,12 +40,16 @@ def GetDipole(mol, mf, Method = 'rhf', ReturnE = False):
         D = mf.dip_moment()
         E = mf.e_tot
     elif Method == 'ccsd':
+        from pyscf import cc
         mcc = cc.CCSD(mf)
         mcc.kernel()
         P = mcc.make_rdm1(ao_repr=True)
         D = mf.dip_moment(mol, P)
         E = mcc.e_tot
     elif Method == 'ccsd_t' or Method =='ccsd(t)':
+        from pyscf import cc
+        from pyscf.cc import ccsd_t_lambda_slow as ccsd_t_lambda
+        from pyscf.cc import ccsd_t_rdm_slow as ccsd_t_rdm
         mcc = cc.CCSD(mf)
         mcc.kernel()
         eris = mcc.ao2mo()
@@ -66,6 +67,7 @@ def GetDipole(mol, mf, Method = 'rhf', ReturnE = False):
         return D
 
 def PerturbDipole(X0, Modes, Coords, dx, atom0, mol, Method = 'rhf'):
+    from pyscf import scf
     X = PerturbCoord(X0, Modes, Coords, dx)
     atom = CoordToAtom(atom0, X)
     mol.atom = atom
@@ -256,6 +258,7 @@ def GetDipoleSurface(mf, Coords, Freq = None, Order = 1, dx = 1e-1, Method = 'rh
     return [DipoleX, DipoleY, DipoleZ]
 
 if __name__ == "__main__":
+    from pyscf import gto, scf
     from vstr.ff.normal_modes import GetNormalModes
 
     mol = gto.M()
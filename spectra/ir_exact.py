@@ -1,9 +1,9 @@
 import numpy as np
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, HOFunc, GenerateHamV, GenerateSparseHamV, GenerateSparseHamAnharmV, VCISparseHamFromVSCF
 from vstr.spectra.dipole import GetDipoleSurface, MakeDipoleList
-from vstr.utils.perf_utils import TIMER
+from vstr.utils.perf_utils import PROFILER
 from scipy import sparse
-import matplotlib.pyplot as plt
+from scipy.linalg import eigh_tridiagonal
 
 def GetTransitionDipoleMatrix(mIR, IncludeZeroth = False):
     mIR.D = []
@@ -38,22 +38,114 @@ def GetSpectralIntensities(mIR):
     for w in mIR.E[1:]:
         mIR.Excitations.append(w - mIR.E[0])
 
+def LanczosTridiagonal(H, v0, NIter, Reorthogonalize = True):
+    '''
+    Lanczos recursion on H starting from v0. Returns the diagonal a and off diagonal b of the tridiagonal
+    matrix along with the squared norm of v0. With Reorthogonalize, each new vector is orthogonalized twice
+    against the whole chain, which keeps ghost copies of converged Ritz values out of the spectrum at the
+    cost of storing the chain.
+    '''
+    v0 = np.asarray(v0).ravel()
+    Norm2 = np.dot(v0, v0)
+    if Norm2 == 0:
+        return np.zeros(1), np.zeros(0), 0.0
+    v = v0 / np.sqrt(Norm2)
+    vPrev = np.zeros_like(v)
+    NIter = min(NIter, v.shape[0])
+    if Reorthogonalize:
+        V = np.empty((NIter, v.shape[0]), dtype = v.dtype)
+        V[0] = v
+    a = []
+    b = []
+    bn = 0.0
+    for n in range(NIter):
+        u = np.asarray(H @ v).ravel() - bn * vPrev
+        an = np.dot(v, u)
+        u -= an * v
+        a.append(an)
+        if Reorthogonalize:
+            for _ in range(2):
+                u -= V[:n + 1].T @ (V[:n + 1] @ u)
+        bn = np.linalg.norm(u)
+        if bn < 1e-12:
+            break
+        b.append(bn)
+        vPrev = v
+        v = u / bn
+        if Reorthogonalize and n + 1 < NIter:
+            V[n + 1] = v
+    return np.asarray(a), np.asarray(b[:len(a) - 1]), Norm2
+
+def ContinuedFraction(z, a, b):
+    '''
+    Evaluates the Haydock continued fraction 1 / (z - a0 - b1^2 / (z - a1 - ...)) on an array of complex z
+    '''
+    G = np.zeros_like(z)
+    for n in range(len(a) - 1, 0, -1):
+        G = b[n - 1]**2 / (z - a[n] - G)
+    return 1 / (z - a[0] - G)
+
+def GetLanczosSpectrum(mIR):
+    '''
+    Builds the Lanczos chains from D c0 for each dipole component. The Ritz values and weights give the excitations
+    and intensities, and the chains are kept for the continued fraction on any frequency grid.
+    '''
+    if mIR.C is None:
+        c0 = np.zeros(mIR.D[0].shape[0])
+        c0[0] = 1.0
+        E0 = mIR.E[0]
+    else:
+        c0 = np.asarray(mIR.C[:, 0]).ravel()
+        E0 = mIR.E[0]
+    mIR.LanczosChains = []
+    Excitations = []
+    Weights = []
+    for xi in range(3):
+        v0 = np.asarray(mIR.D[xi] @ c0).ravel()
+        v0 -= np.dot(c0, v0) * c0
+        a, b, Norm2 = LanczosTridiagonal(mIR.H, v0, mIR.NLanczos, Reorthogonalize = mIR.LanczosReorthogonalize)
+        mIR.LanczosChains.append((a, b, Norm2))
+        Theta, U = eigh_tridiagonal(a, b)
+        Excitations.append(Theta - E0)
+        Weights.append(Norm2 * U[0, :]**2)
+    mIR.Excitations = np.concatenate(Excitations)
+    Order = np.argsort(mIR.Excitations)
+    mIR.Excitations = mIR.Excitations[Order]
+    mIR.Intensities = [None] * 3
+    Offset = 0
+    for xi in range(3):
+        I = np.zeros(mIR.Excitations.shape[0])
+        I[Offset:(Offset + Weights[xi].shape[0])] = Weights[xi]
+        mIR.Intensities[xi] = I[Order]
+        Offset += Weights[xi].shape[0]
+
+def LanczosSpectrum(mIR, ws, L = 100):
+    z = np.asarray(ws) + mIR.E[0] + 1.j * L
+    Is = np.zeros(z.shape[0])
+    for a, b, Norm2 in mIR.LanczosChains:
+        Is += -1 * (Norm2 * ContinuedFraction(z, a, b)).imag / np.pi
+    return Is
+
 def Lorentzian(x, x0, L):
     #return 0.5 * L / (np.pi * ((x - x0)**2 + 0.25 * L**2))
     return L / (np.pi * ((x - x0)**2 + L**2))
 
 def PlotSpectrum(mIR, PlotName, NPoints = 1000, L = 100, XLabel = "Frequency", YLabel = "Intensity", Title = "IR Spectrum", XMin = None, XMax = None):
+    import matplotlib.pyplot as plt
     if XMin is None:
         XMin = 0
     if XMax is None:
         XMax = mIR.Excitations[-1] + 100
     X = np.linspace(XMin, XMax, num = NPoints)
-    Y = []
-    for x in X:
-        y = 0
-        for n in range(len(mIR.Excitations)):
-            y += (mIR.Intensities[0][n] + mIR.Intensities[1][n] + mIR.Intensities[2][n]) * Lorentzian(x, mIR.Excitations[n], L = L)
-        Y.append(y)
+    if mIR.Lanczos:
+        Y = mIR.LanczosSpectrum(X, L = L)
+    else:
+        Y = []
+        for x in X:
+            y = 0
+            for n in range(len(mIR.Excitations)):
+                y += (mIR.Intensities[0][n] + mIR.Intensities[1][n] + mIR.Intensities[2][n]) * Lorentzian(x, mIR.Excitations[n], L = L)
+            Y.append(y)
     mIR.ws = X
     mIR.Is = np.asarray(Y)
     if mIR.Normalize:
@@ -81,6 +173,8 @@ def SaveSpectrum(mIR, SaveName):
 class IRSpectra:
     GetTransitionDipoleMatrix = GetTransitionDipoleMatrix
     GetSpectralIntensities = GetSpectralIntensities
+    GetLanczosSpectrum = GetLanczosSpectrum
+    LanczosSpectrum = LanczosSpectrum
     PlotSpectrum = PlotSpectrum
     SaveSpectrum = SaveSpectrum
 
@@ -90,15 +184,19 @@ class IRSpectra:
         self.E = mVHCI.E
         self.Frequencies = mVHCI.Frequencies
         self.Basis = mVHCI.Basis
+        self.H = getattr(mVHCI, 'H', None)
         self.NormalModes = NormalModes
         self.Order = 1
         self.DipoleSurface = DipoleSurface
         self.Normalize = False
+        self.Lanczos = False # Continued fraction spectrum from D c0, only the ground state is needed
+        self.NLanczos = 200
+        self.LanczosReorthogonalize = True # Full reorthogonalization of the chain, False saves its memory but lets ghost peaks appear
         
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(2)
         self.TimerNames = ["Generate Dipole Matrix", "Plot Spectrum"]
+        self.Timer = PROFILER(self.TimerNames, name = "IRSpectra")
 
     def kernel(self):
         if self.DipoleSurface is None:
@@ -133,7 +231,10 @@ class IRSpectra:
         self.GetTransitionDipoleMatrix()
         self.Timer.stop(0)
         self.Timer.start(1)
-        self.GetSpectralIntensities()
+        if self.Lanczos:
+            self.GetLanczosSpectrum()
+        else:
+            self.GetSpectralIntensities()
         self.Timer.stop(1)
 
 class VSCFIRSpectra(IRSpectra):
@@ -147,8 +248,9 @@ class VSCFIRSpectra(IRSpectra):
         self.Xs = mVHCI.Xs
 
 class IRSpectraNMode(IRSpectra):
-    from vstr.spectra.ir_lr import GetTransitionDipoleMatrixNMode
+    from vstr.spectra.ir_lr import GetTransitionDipoleMatrixNMode, MakeDipoleMatricesNMode
     GetTransitionDipoleMatrix = GetTransitionDipoleMatrixNMode
+    MakeDipoleMatrices = MakeDipoleMatricesNMode
 
     def __init__(self, mf, mVHCI, NormalModes = None, SpectralHBMethod = 2, **kwargs):
         IRSpectra.__init__(self, mf, mVHCI, NormalModes = NormalModes)
@@ -171,21 +273,24 @@ class IRSpectraNMode(IRSpectra):
                         if self.mol.Order >= 5:
                             self.mol.dip_ints[4].resize((3, N * N * N * N * N * K * K * K * K * K * K * K * K * K * K))
                         else:
-                            self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                            self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
                     else:
-                        self.mol.dip_ints[3] = [np.array([0.0])] * 3
-                        self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                        self.mol.dip_ints[3] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                        self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
                 else:
-                    self.mol.dip_ints[2] = [np.array([0.0])] * 3
-                    self.mol.dip_ints[3] = [np.array([0.0])] * 3
-                    self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                    self.mol.dip_ints[2] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                    self.mol.dip_ints[3] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                    self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
     
     def kernel(self):
         self.Timer.start(0)
         self.GetTransitionDipoleMatrix()
         self.Timer.stop(0)
         self.Timer.start(1)
-        self.GetSpectralIntensities()
+        if self.Lanczos:
+            self.GetLanczosSpectrum()
+        else:
+            self.GetSpectralIntensities()
         self.Timer.stop(1)
 
         self.Timer.report(self.TimerNames)
@@ -1,25 +1,55 @@
 import numpy as np
-from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, HOFunc, GenerateHamV, GenerateSparseHamV, GenerateSparseHamAnharmV, GenerateSparseHamVOD, VCISparseHamFromVSCF, HeatBath_Sort_FC, SpectralFrequencyPrune, SpectralFrequencyPruneFromVSCF, VCISparseHamNMode, VCISparseHamNModeArray, VCISparseHamNModeFromOM, VCISparseHamDiagonalNModeFromOM, VCISparseHamNModeFromOMArray
-from vstr.utils.perf_utils import TIMER
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, HOFunc, GenerateHamV, GenerateSparseHamV, GenerateSparseHamAnharmV, GenerateSparseDipoleAnharmV, GenerateSparseHamVOD, VCISparseHamFromVSCF, HeatBath_Sort_FC, SpectralFrequencyPrune, SpectralFrequencyPruneFromVSCF, VCISparseHamNMode, VCISparseHamNModeArray, DipoleSparseNModeArray, VCISparseHamNModeFromOMArray, VCISparseHamDiagonalNModeFromOMArray
+from vstr.vhci.vhci import BasisToArray
+from vstr.utils.perf_utils import PROFILER
+from vstr.utils.memory_utils import GB, PlanMemory, PrintMemoryPlan, CheckMemory
 from vstr.spectra.dipole import GetDipoleSurface, MakeDipoleList
-from vstr.utils.linalg_utils import gmres_counter
+from vstr.utils.linalg_utils import gmres_counter, MakePreconditioner
 from scipy import sparse
-import matplotlib.pyplot as plt
+import inspect
 import gc
 
+GMRES_TOL = 'rtol' if 'rtol' in inspect.signature(sparse.linalg.gmres).parameters else 'tol' # scipy 1.12 renamed tol to rtol
+
+def FusedToCSR(Rows, Cols, Vals, Shape, KeepDiagonal = True):
+    '''
+    Makes the three components returned by the fused dipole kernels into CSR matrices sharing one index structure
+    '''
+    Rows = np.asarray(Rows)
+    Cols = np.asarray(Cols)
+    if not KeepDiagonal:
+        OffDiag = Rows != Cols
+        Rows = Rows[OffDiag]
+        Cols = Cols[OffDiag]
+        Vals = Vals[OffDiag]
+    Order = np.lexsort((Cols, Rows))
+    Indices = Cols[Order].astype(np.int32)
+    IndPtr = np.zeros(Shape[0] + 1, dtype = np.int32)
+    np.cumsum(np.bincount(Rows, minlength = Shape[0]), out = IndPtr[1:])
+    return [sparse.csr_matrix((np.ascontiguousarray(Vals[Order, x]), Indices, IndPtr), shape = Shape) for x in range(3)]
+
+def MakeDipoleMatrices(mIR, Basis1, Basis2, DiagonalBlock = True):
+    OddFC = [mIR.DipoleSurface[x][3] + mIR.DipoleSurface[x][5] for x in range(3)]
+    EvenFC = [mIR.DipoleSurface[x][4] + mIR.DipoleSurface[x][6] for x in range(3)]
+    Rows, Cols, Vals = GenerateSparseDipoleAnharmV(Basis1, Basis2, OddFC, EvenFC, DiagonalBlock)
+    return FusedToCSR(Rows, Cols, Vals, (len(Basis1), len(Basis2)))
+
+def MakeDipoleMatricesNMode(mIR, Basis1, Basis2, DiagonalBlock = True, KeepDiagonal = True):
+    Rows, Cols, Vals = DipoleSparseNModeArray(Basis1, Basis2, list(mIR.mol.mu0), mIR.mol.dip_ints[0], mIR.mol.dip_ints[1], mIR.mol.dip_ints[2], mIR.mol.dip_ints[3], mIR.mol.dip_ints[4], DiagonalBlock, mIR.mol.Order, mIR.K)
+    return FusedToCSR(Rows, Cols, Vals, (len(Basis1), len(Basis2)), KeepDiagonal = KeepDiagonal)
+
 def GetTransitionDipoleMatrix(mIR, xi = None, IncludeZeroth = False):
     mIR.Timer.start(0)
     if xi is None:
-        mIR.D = []
+        mIR.D = mIR.MakeDipoleMatrices(mIR.mVCI.Basis, mIR.mVCI.Basis)
         for x in range(3):
-            Dx = GenerateSparseHamAnharmV(mIR.mVCI.Basis, list(mIR.mVCI.Frequencies), mIR.DipoleSurfaceList[x], mIR.DipoleSurface[x][3], mIR.DipoleSurface[x][4], mIR.DipoleSurface[x][5], mIR.DipoleSurface[x][6])
+            Dx = mIR.D[x]
             if IncludeZeroth:
                 D0 = Dx.diagonal()
                 D0 += mIR.DipoleSurface[x][0][0]
                 Dx.setdiag(D0)
             #else:
             #    Dx.setdiag(0)
-            mIR.D.append(Dx)
     else:
         Dx = GenerateSparseHamAnharmV(mIR.mVCI.Basis, list(mIR.mVCI.Frequencies), mIR.DipoleSurfaceList[xi], mIR.DipoleSurface[xi][3], mIR.DipoleSurface[xi][4], mIR.DipoleSurface[xi][5], mIR.DipoleSurface[xi][6])
         if IncludeZeroth:
@@ -34,13 +64,7 @@ def GetTransitionDipoleMatrix(mIR, xi = None, IncludeZeroth = False):
 def GetTransitionDipoleMatrixNMode(mIR, xi = None, IncludeZeroth = False):
     mIR.Timer.start(0)
     if xi is None:
-        mIR.D = []
-        for x in range(3):
-            #Dx = VCISparseHamNMode(mIR.mVCI.Basis, mIR.mVCI.Basis, list(np.zeros_like(mIR.mVCI.Frequencies)), mIR.mol.mu0[x], mIR.mol.dip_ints[0][x].tolist(), mIR.mol.dip_ints[1][x].tolist(), mIR.mol.dip_ints[2][x].tolist(), True)
-            Dx = VCISparseHamNModeArray(mIR.mVCI.Basis, mIR.mVCI.Basis, list(np.zeros_like(mIR.mVCI.Frequencies)), mIR.mol.mu0[x], mIR.mol.dip_ints[0][x], mIR.mol.dip_ints[1][x], mIR.mol.dip_ints[2][x], mIR.mol.dip_ints[3][x], mIR.mol.dip_ints[4][x], True, mIR.mol.Order, mIR.K)
-            if not IncludeZeroth:
-                Dx.setdiag(0)
-            mIR.D.append(Dx)
+        mIR.D = mIR.MakeDipoleMatrices(mIR.mVCI.Basis, mIR.mVCI.Basis, KeepDiagonal = IncludeZeroth)
     else:
         #Dx = VCISparseHamNMode(mIR.mVCI.Basis, mIR.mVCI.Basis, list(np.zeros_like(mIR.mVCI.Frequencies)), mIR.mol.mu0[xi], mIR.mol.dip_ints[0][xi].tolist(), mIR.mol.dip_ints[1][xi].tolist(), mIR.mol.dip_ints[2][xi].tolist(), True)
         Dx = VCISparseHamNModeArray(mIR.mVCI.Basis, mIR.mVCI.Basis, list(np.zeros_like(mIR.mVCI.Frequencies)), mIR.mol.mu0[xi], mIR.mol.dip_ints[0][xi], mIR.mol.dip_ints[1][xi], mIR.mol.dip_ints[2][xi], mIR.mol.dip_ints[3][xi], mIR.mol.dip_ints[4][xi], True, mIR.mol.Order, mIR.K)
@@ -73,6 +97,64 @@ def GetTransitionDipoleMatrixFromVSCF(mIR, xi = None, IncludeZeroth = False):
         mIR.D[xi] = Dx
     mIR.Timer.stop(0)
 
+def ExtendSymmetric(M, MIJ, MJJ):
+    return sparse.bmat([[M, MIJ], [MIJ.transpose(), MJJ]], format = 'csr')
+
+def GrowTransitionDipoleMatrix(mIR, NOld):
+    '''
+    Extends the dipole matrices, which are known on the first NOld configurations, to the current basis
+    '''
+    if NOld == len(mIR.mVCI.Basis):
+        return
+    mIR.Timer.start(0)
+    OldBasis = mIR.mVCI.Basis[:NOld]
+    NewBasis = mIR.mVCI.Basis[NOld:]
+    DIJ = mIR.MakeDipoleMatrices(OldBasis, NewBasis, DiagonalBlock = False)
+    DJJ = mIR.MakeDipoleMatrices(NewBasis, NewBasis)
+    for x in range(3):
+        mIR.D[x] = ExtendSymmetric(mIR.D[x], DIJ[x], DJJ[x])
+    mIR.Timer.stop(0)
+
+def GrowTransitionDipoleMatrixNMode(mIR, NOld):
+    if NOld == len(mIR.mVCI.Basis):
+        return
+    mIR.Timer.start(0)
+    OldBasis = mIR.mVCI.Basis[:NOld]
+    NewBasis = mIR.mVCI.Basis[NOld:]
+    DIJ = mIR.MakeDipoleMatrices(OldBasis, NewBasis, DiagonalBlock = False)
+    DJJ = mIR.MakeDipoleMatrices(NewBasis, NewBasis, KeepDiagonal = False)
+    for x in range(3):
+        mIR.D[x] = ExtendSymmetric(mIR.D[x], DIJ[x], DJJ[x])
+    mIR.Timer.stop(0)
+
+def GrowTransitionDipoleMatrixFromVSCF(mIR, NOld):
+    if NOld == len(mIR.mVCI.Basis):
+        return
+    mIR.Timer.start(0)
+    X0 = []
+    for X in mIR.Xs:
+        X0.append(np.zeros(X.shape))
+    OldBasis = mIR.mVCI.Basis[:NOld]
+    NewBasis = mIR.mVCI.Basis[NOld:]
+    for x in range(3):
+        DIJ = VCISparseHamFromVSCF(OldBasis, NewBasis, mIR.Frequencies, mIR.DipoleSurfaceList[x], mIR.Ys, X0, False)
+        DJJ = VCISparseHamFromVSCF(NewBasis, NewBasis, mIR.Frequencies, mIR.DipoleSurfaceList[x], mIR.Ys, X0, True)
+        mIR.D[x] = ExtendSymmetric(mIR.D[x], DIJ, DJJ)
+    mIR.Timer.stop(0)
+
+def UpdateTransitionDipoleMatrix(mIR, xi = None):
+    '''
+    With continuation, all three dipole matrices follow the basis incrementally. Otherwise they are rebuilt.
+    '''
+    if mIR.Continuation:
+        mIR.GrowTransitionDipoleMatrix(mIR.D[0].shape[0])
+    else:
+        mIR.GetTransitionDipoleMatrix(xi = xi, IncludeZeroth = False)
+
+def ShiftedOperator(H, z):
+    # A = z - H for a matrix-free H
+    return sparse.linalg.LinearOperator(H.shape, matvec = lambda x: z * np.asarray(x).ravel() - H @ np.asarray(x).ravel(), dtype = np.cdouble)
+
 def GetAb(mIR, w, Basis = None, xi = None):
     mIR.Timer.start(1)
     if Basis is None:
@@ -84,11 +166,14 @@ def GetAb(mIR, w, Basis = None, xi = None):
         E, C = sparse.linalg.eigsh(H, k = mIR.mVCI.NStates, which = 'SA')
 
     #A = np.eye(H.shape[0]) * (w + mIR.mVCI.E[0]) - H + np.eye(H.shape[0]) * mIR.eta * 1.j
-    HDiag = H.diagonal()
-    HDiag = (w + mIR.mVCI.E[0]) + mIR.eta * 1.j - HDiag
-    A = -1 * H
-    A.setdiag(HDiag)
-    A = A.tocsr()
+    if isinstance(H, sparse.linalg.LinearOperator):
+        A = ShiftedOperator(H, (w + mIR.mVCI.E[0]) + mIR.eta * 1.j)
+    else:
+        HDiag = H.diagonal()
+        HDiag = (w + mIR.mVCI.E[0]) + mIR.eta * 1.j - HDiag
+        A = -1 * H
+        A.setdiag(HDiag)
+        A = A.tocsr()
     b = [None] * 3
     if xi is None:
         for x in range(3):
@@ -110,12 +195,15 @@ def GetAbNMode(mIR, w, Basis = None, xi = None):
         E, C = sparse.linalg.eigsh(H, k = mIR.mVCI.NStates, which = 'SA')
 
     #A = np.eye(H.shape[0]) * (w + mIR.mVCI.E[0]) - H + np.eye(H.shape[0]) * mIR.eta * 1.j
-    HDiag = H.diagonal()
-    HDiag = np.array((w + mIR.mVCI.E[0]) + mIR.eta * 1.j - HDiag, dtype = np.cdouble) 
-    A = -1 * H
-    A = A.astype(np.cdouble)
-    A.setdiag(HDiag)
-    A = A.tocsr()
+    if isinstance(H, sparse.linalg.LinearOperator):
+        A = ShiftedOperator(H, (w + mIR.mVCI.E[0]) + mIR.eta * 1.j)
+    else:
+        HDiag = H.diagonal()
+        HDiag = np.array((w + mIR.mVCI.E[0]) + mIR.eta * 1.j - HDiag, dtype = np.cdouble) 
+        A = -1 * H
+        A = A.astype(np.cdouble)
+        A.setdiag(HDiag)
+        A = A.tocsr()
     b = [None] * 3
     if xi is None:
         for x in range(3):
@@ -165,6 +253,51 @@ def DoSpectralPT2(mIR, w, x, eta = None, eps_pt2 = None):
         dE_PT2 += (np.abs(HAI[a,:] @ x)**2.0) / (w - (Haa - mIR.mVCI.E[0]) + 1.j * eta)
     return dE_PT2
 
+def SpectralPT2SpaceNMode(mIR, PTBasis):
+    '''
+    Returns the coupling block and diagonal energies of PTBasis. Rows and columns are cached by their configurations,
+    so nearby frequencies only generate the external configurations they did not share, and the couplings of the
+    shared ones to variational configurations added since. When the variational basis gains configurations, or the
+    cache would hold more than PT2SpaceCacheSize configurations, only the rows of this frequency are kept.
+    '''
+    if mIR.PT2Space is None:
+        mIR.PT2Space = [{}, {}, [], sparse.csr_matrix((0, 0)), np.zeros(0)]
+    Rows, Cols, ColBasis, HAI, HAA = mIR.PT2Space
+    VarKeys = [Q.tobytes() for Q in BasisToArray(mIR.mVCI.Basis)]
+    Keys = [Q.tobytes() for Q in BasisToArray(PTBasis)]
+
+    Shared = [a for a, Key in enumerate(Keys) if Key in Rows]
+    NewCols = [I for I, Key in enumerate(VarKeys) if Key not in Cols]
+    if len(NewCols) > 0 or len(Rows) + len(Keys) - len(Shared) > mIR.PT2SpaceCacheSize:
+        Idx = np.asarray([Rows[Keys[a]] for a in Shared], dtype = int)
+        HAI, HAA = HAI[Idx], HAA[Idx]
+        if len(NewCols) > 0:
+            NewColBasis = [mIR.mVCI.Basis[I] for I in NewCols]
+            if len(Shared) > 0:
+                HAINew = VCISparseHamNModeFromOMArray([PTBasis[a] for a in Shared], NewColBasis, mIR.mVCI.Frequencies, mIR.mVCI.mol.V0, mIR.mVCI.mol.onemode_eig, mIR.mol.ints[1], mIR.mol.ints[2], mIR.mol.ints[3], mIR.mol.ints[4], False, mIR.mol.Order, mIR.K)
+            else:
+                HAINew = sparse.csr_matrix((0, len(NewCols)))
+            HAI = sparse.hstack([HAI, HAINew]).tocsr()
+            for c, I in enumerate(NewCols):
+                Cols[VarKeys[I]] = len(ColBasis) + c
+            ColBasis = ColBasis + NewColBasis
+        Rows = {Keys[a]: r for r, a in enumerate(Shared)}
+        mIR.PT2Space = [Rows, Cols, ColBasis, HAI, HAA]
+    New = [a for a, Key in enumerate(Keys) if Key not in Rows]
+    if len(New) > 0:
+        NewBasis = [PTBasis[a] for a in New]
+        HAINew = VCISparseHamNModeFromOMArray(NewBasis, ColBasis, mIR.mVCI.Frequencies, mIR.mVCI.mol.V0, mIR.mVCI.mol.onemode_eig, mIR.mol.ints[1], mIR.mol.ints[2], mIR.mol.ints[3], mIR.mol.ints[4], False, mIR.mol.Order, mIR.K)
+        HAANew = VCISparseHamDiagonalNModeFromOMArray(NewBasis, mIR.mVCI.Frequencies, mIR.mVCI.mol.V0, mIR.mVCI.mol.onemode_eig, mIR.mol.ints[1], mIR.mol.ints[2], mIR.mol.ints[3], mIR.mol.ints[4], mIR.mol.Order, mIR.K)
+        for a in New:
+            Rows[Keys[a]] = len(Rows)
+        HAI = sparse.vstack([HAI, HAINew]).tocsr()
+        HAA = np.concatenate((HAA, np.asarray(HAANew)))
+        mIR.PT2Space = [Rows, Cols, ColBasis, HAI, HAA]
+    mIR.Timer.count("PT2 configurations reused", len(Keys) - len(New))
+    print("-- PT2 Basis reused", len(Keys) - len(New), "of", len(Keys), "configurations and generated", len(NewCols), "new columns", flush = True)
+    Idx = np.asarray([Rows[Key] for Key in Keys], dtype = int)
+    return HAI[Idx][:, [Cols[Key] for Key in VarKeys]], HAA[Idx]
+
 def DoSpectralPT2NMode(mIR, w, x, eta = None, eps_pt2 = None):
     if eta is None:
         eta = mIR.eta
@@ -172,19 +305,44 @@ def DoSpectralPT2NMode(mIR, w, x, eta = None, eps_pt2 = None):
         eps_pt2 = mIR.eps2
     PTBasis, N_PT = mIR.SpectralScreenBasis(C = x.imag, eps = eps_pt2)
     print("-- PT2 Basis Size:", N_PT)
-    HAI = VCISparseHamNModeFromOM(PTBasis, mIR.mVCI.Basis, mIR.mVCI.Frequencies, mIR.mVCI.mol.V0, mIR.mVCI.mol.onemode_eig, mIR.mVCI.mol.ints[1].tolist(), mIR.mVCI.mol.ints[2].tolist(), False)
-    dE_PT2 = 0.0
-    HAA = VCISparseHamDiagonalNModeFromOM(PTBasis, mIR.mVCI.Frequencies, mIR.mVCI.mol.V0, mIR.mVCI.mol.onemode_eig, mIR.mVCI.mol.ints[1].tolist(), mIR.mVCI.mol.ints[2].tolist())
-    for a in range(N_PT):
-        dE_PT2 += (np.abs(HAI[a,:] @ x)**2.0) / (w - (HAA[a] - mIR.mVCI.E[0]) + 1.j * eta)
-    return dE_PT2
+    if N_PT == 0:
+        return 0.0
+    HAI, HAA = mIR.SpectralPT2Space(PTBasis)
+    HAIx = np.asarray(HAI @ x).ravel()
+    return np.sum(np.abs(HAIx)**2.0 / (w - (HAA - mIR.mVCI.E[0]) + 1.j * eta))
 
-def SolveAxb(A, b):
+def SolveAxb(A, b, x0 = None, M = None, counter = None, tol = 1e-8):
     #x = sparse.linalg.spsolve(A, b)
+    if counter is None:
+        counter = gmres_counter()
+    x, info = sparse.linalg.gmres(A, b, x0 = x0, M = M, callback = counter, **{GMRES_TOL: tol})
+    if info < 0:
+        raise RuntimeError("GMRES failed with illegal input or breakdown (info = %d)" % info)
+    if info > 0:
+        print("Warning: GMRES did not converge to %.1e after %d iterations, consider a stronger preconditioner" % (tol, counter.niter), flush = True)
+    return x
+
+def SolveResponse(mIR, A, b, x0 = None):
+    '''
+    Preconditioned GMRES solve of the shifted response equations, keeping track of the iteration counts
+    '''
+    mIR.Timer.start(2)
+    HDiag = None
+    if not isinstance(mIR.mVCI.H, sparse.linalg.LinearOperator):
+        HDiag = mIR.mVCI.H.diagonal()
+    M = MakePreconditioner(A, Method = mIR.Preconditioner, HDiag = HDiag, BlockSize = mIR.PrecondBlockSize, DropTol = mIR.PrecondDropTol, FillFactor = mIR.PrecondFillFactor)
     counter = gmres_counter()
-    x = sparse.linalg.gmres(A, b, callback = counter, tol = 1e-8)[0]
+    x = SolveAxb(A, b, x0 = x0, M = M, counter = counter)
+    mIR.GMRESIterations.append(counter.niter)
+    mIR.Timer.count("GMRES iterations", counter.niter)
+    mIR.Timer.stop(2)
     return x
 
+def GMRESReport(mIR):
+    if len(mIR.GMRESIterations) == 0:
+        return None
+    return "GMRES iterations (%s preconditioner): %d total, %d solves, %.1f average, %d max" % (mIR.Preconditioner, sum(mIR.GMRESIterations), len(mIR.GMRESIterations), np.mean(mIR.GMRESIterations), max(mIR.GMRESIterations))
+
 def ApproximateAInv(mIR, w, Order = 1):
     HOD = mIR.mVCI.H.todense()
     D = np.asarray(HOD.diagonal().copy() + (w + mIR.mVCI.E[0] + 1.j * mIR.eta)).ravel()
@@ -228,12 +386,10 @@ def SpectralHCIStep(mIR, w, xi, eps = 0.01, InitState = 0):
         del mIR.mVCI.NewBasis
         
         # HB using H and b/D
-        mIR.GetTransitionDipoleMatrix(xi = xi)
+        mIR.UpdateTransitionDipoleMatrix(xi = xi)
         A, b = mIR.GetAb(w, xi = xi)
         b[xi] = b[xi].ravel()
-        mIR.Timer.start(2)
-        x = SolveAxb(A, b[xi])
-        mIR.Timer.stop(2)
+        x = mIR.SolveResponse(A, b[xi])
         D = np.sqrt((w - mIR.mVCI.H.diagonal() + mIR.mVCI.E[0])**2.0 + mIR.eta**2.0)
         bD = abs(b[xi] / D)
         NewBasis, NAdded2 = mIR.SpectralScreenBasis(Ws = mIR.mVCI.PotentialListFull, C = bD, eps = eps, InitState = InitState)
@@ -251,12 +407,10 @@ def SpectralHCIStep(mIR, w, xi, eps = 0.01, InitState = 0):
         NAdded1 = 0
 
         # HB using H and x
-        mIR.GetTransitionDipoleMatrix(xi = xi)
+        mIR.UpdateTransitionDipoleMatrix(xi = xi)
         A, b = mIR.GetAb(w, xi = xi)
         b[xi] = b[xi].ravel()
-        mIR.Timer.start(2)
-        x = SolveAxb(A, b[xi])
-        mIR.Timer.stop(2)
+        x = mIR.SolveResponse(A, b[xi])
         mIR.Timer.start(3)
         NewBasis, NAdded2 = mIR.SpectralScreenBasis(Ws = mIR.mVCI.PotentialListFull, C = abs(x.imag), eps = eps, InitState = InitState)
         mIR.Timer.stop(3)
@@ -271,12 +425,10 @@ def SpectralHCIStep(mIR, w, xi, eps = 0.01, InitState = 0):
         del mIR.mVCI.NewBasis
 
         # HB using H and x
-        mIR.GetTransitionDipoleMatrix(xi = xi)
+        mIR.UpdateTransitionDipoleMatrix(xi = xi)
         A, b = mIR.GetAb(w, xi = xi)
         b[xi] = b[xi].ravel()
-        mIR.Timer.start(2)
-        x = SolveAxb(A, b[xi])
-        mIR.Timer.stop(2)
+        x = mIR.SolveResponse(A, b[xi])
         mIR.Timer.start(3)
         NewBasis, NAdded2 = mIR.SpectralScreenBasis(Ws = mIR.mVCI.PotentialListFull, C = abs(x.imag), eps = eps, InitState = InitState)
         mIR.Timer.stop(3)
@@ -291,6 +443,7 @@ def SpectralHCI(mIR, w, xi):
     it = 1
     while (float(NAdded) / float(len(mIR.mVCI.Basis))) > mIR.mVCI.tol:
         mIR.mVCI.NewBasis, NAdded = mIR.SpectralHCIStep(w, xi = xi, eps = mIR.eps1)
+        mIR.Timer.count("configurations added", NAdded)
         #print("VHCI Iteration", it, "for w =", w, "complete with", NAdded, "new configurations and a total of", len(mIR.mVCI.Basis), flush = True)
         mIR.Timer.start(4)
         mIR.mVCI.SparseDiagonalize()
@@ -315,17 +468,49 @@ def ResetVCI(mIR):
     
     gc.collect()
 
+def WarmStart(mIR, xi):
+    '''
+    Restores the space selected for component xi at the previous frequency, dropping configurations whose response
+    amplitude is below PruneThr relative to the largest. Returns the previous solution on the kept configurations.
+    '''
+    State = mIR.ContinuationState[xi]
+    if State is None:
+        mIR.ResetVCI()
+        mIR.D = list(mIR.D0)
+        return None
+    Basis, H, C, E, D, x = State
+    Keep = np.abs(x) >= mIR.PruneThr * np.abs(x).max()
+    Keep[:len(mIR.Basis0)] = True
+    mIR.mVCI.Basis, mIR.mVCI.H, mIR.mVCI.C, mIR.mVCI.E, mIR.D = Basis, H, C, E, D
+    if not Keep.all():
+        Idx = np.where(Keep)[0]
+        mIR.mVCI.Basis = [Basis[i] for i in Idx]
+        mIR.mVCI.H = H.tocsr()[Idx][:, Idx]
+        mIR.D = [Dx.tocsr()[Idx][:, Idx] for Dx in D]
+        x = x[Idx]
+        mIR.mVCI.NewBasis = []
+        mIR.Timer.start(4)
+        mIR.mVCI.SparseDiagonalize()
+        mIR.Timer.stop(4)
+        mIR.mVCI.NewBasis = None
+        del mIR.mVCI.NewBasis
+    print("Continuing from", len(Basis), "configurations,", len(Basis) - len(mIR.mVCI.Basis), "pruned.", flush = True)
+    return x
+
 def Intensity(mIR, w, state_thr = 1e-6):
     I = np.zeros((3,3))
     # Should define new basis with HCI and then solve VHCI here, be sure to update mVCI object 
     for xi in range(3):
+        x0 = None
+        if mIR.Continuation:
+            x0 = mIR.WarmStart(xi)
         mIR.SpectralHCI(w, xi = xi)
-        mIR.GetTransitionDipoleMatrix(IncludeZeroth = False)
+        mIR.UpdateTransitionDipoleMatrix()
         # Solve for intensity using updated VCI object
         A, b = mIR.GetAb(w)
-        mIR.Timer.start(2)
-        x = SolveAxb(A, b[xi])
-        mIR.Timer.stop(2)
+        if x0 is not None:
+            x0 = np.concatenate((x0, np.zeros(len(mIR.mVCI.Basis) - x0.shape[0], dtype = x0.dtype)))
+        x = mIR.SolveResponse(A, b[xi], x0 = x0)
         x = np.asarray(x).ravel()
         mIR.XString[xi].append(mIR.mVCI.LCLine(0, thr = state_thr, C = np.reshape(abs(x), (x.shape[0], 1))))
         for xj in range(3):
@@ -339,11 +524,35 @@ def Intensity(mIR, w, state_thr = 1e-6):
                     mIR.Timer.start(5)
                     I[xj, xi] -= mIR.DoSpectralPT2(w, x.reshape(x.shape[0], 1), eta = mIR.eta, eps_pt2 = mIR.eps2).imag / np.pi #DoSpectralPT2(x.reshape(x.shape[0], 1), mIR.mVCI.E, mIR.mVCI.C, mIR.mVCI.Basis, mIR.mVCI.PotentialListFull, mIR.mVCI.PotentialList, mIR.mVCI.Potential[0], mIR.mVCI.Potential[1], mIR.mVCI.Potential[2], mIR.mVCI.Potential[3], mIR.DipoleSurfaceList[xi], mIR.mVCI.Ys, mIR.eps2, 1, w, mIR.eta).real / np.pi
                     mIR.Timer.stop(5)
-        # Reset VCI object
-        mIR.ResetVCI()
+        if mIR.Continuation:
+            mIR.ContinuationState[xi] = [mIR.mVCI.Basis, mIR.mVCI.H, mIR.mVCI.C, mIR.mVCI.E, mIR.D, x]
+        else:
+            # Reset VCI object
+            mIR.ResetVCI()
     return I
 
+def Spectrum(mIR):
+    mIR.D0 = list(mIR.D)
+    mIR.ContinuationState = [None] * 3
+    mIR.ws = np.linspace(mIR.FreqRange[0], mIR.FreqRange[1], num = mIR.NPoints)
+    mIR.ITensors = []
+    mIR.XString = [[], [], []]
+    for w in mIR.ws:
+        mIR.ITensors.append(mIR.Intensity(w))
+    if mIR.Continuation:
+        mIR.ContinuationState = [None] * 3
+        mIR.ResetVCI()
+        mIR.D = mIR.D0
+    mIR.Is = []
+    for I in mIR.ITensors:
+        mIR.Is.append(I[0, 0] + I[1, 1] + I[2, 2])
+
+    mIR.Is = np.asarray(mIR.Is)
+    if mIR.Normalize:
+        mIR.Is = np.asarray(mIR.Is) / max(mIR.Is)
+
 def PlotSpectrum(mIR, PlotName, XLabel = "Frequency", YLabel = "Intensity", Title = "IR Spectrum"):
+    import matplotlib.pyplot as plt
     plt.plot(mIR.ws, mIR.Is, linestyle = '-', marker = None)
     plt.xlabel(XLabel)
     plt.ylabel(YLabel)
@@ -362,6 +571,7 @@ def SaveSpectrum(mIR, SaveName):
         
 
 def TestPowerSeries(mIR):
+    import matplotlib.pyplot as plt
     H = mIR.mVCI.H.todense()
     n = H.shape[0]
     for w in (mIR.mVCI.E - mIR.mVCI.E[0]): #range(1000,16000,1):
@@ -388,12 +598,19 @@ def TestPowerSeries(mIR):
 class LinearResponseIR:
     GetAb = GetAb
     GetTransitionDipoleMatrix = GetTransitionDipoleMatrix
+    MakeDipoleMatrices = MakeDipoleMatrices
     SpectralScreenBasis = SpectralScreenBasis
     SpectralHCIStep = SpectralHCIStep
     SpectralHCI = SpectralHCI
     DoSpectralPT2 = DoSpectralPT2
     ResetVCI = ResetVCI
+    WarmStart = WarmStart
+    GrowTransitionDipoleMatrix = GrowTransitionDipoleMatrix
+    UpdateTransitionDipoleMatrix = UpdateTransitionDipoleMatrix
     Intensity = Intensity
+    Spectrum = Spectrum
+    SolveResponse = SolveResponse
+    GMRESReport = GMRESReport
     ApproximateAInv = ApproximateAInv
     PlotSpectrum = PlotSpectrum
     SaveSpectrum = SaveSpectrum
@@ -425,11 +642,19 @@ class LinearResponseIR:
         self.DipoleSurface = DipoleSurface
         self.Normalize = False
         self.DoPT2 = False
+        self.Continuation = False # Warm start each frequency from the space selected at the previous one
+        self.PruneThr = 1e-4 # Relative response amplitude below which configurations are dropped when continuing
+        self.Preconditioner = 'jacobi' # None, 'jacobi', 'ilu', or 'block'
+        self.PrecondBlockSize = 500 # Number of lowest energy configurations treated exactly by the block preconditioner
+        self.PrecondDropTol = 1e-4
+        self.PrecondFillFactor = 10
+        self.GMRESIterations = []
+        self.ProfileFile = None
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(6)
         self.TimerNames = ["Dipole Hamiltonian", "A and b Generation", "Axb Solve", "Screen Basis", "Diagonalization", "PT2"]
+        self.Timer = PROFILER(self.TimerNames, name = "LinearResponseIR")
 
     def kernel(self):
         # Make dipole surface
@@ -463,23 +688,15 @@ class LinearResponseIR:
 
         self.GetTransitionDipoleMatrix(IncludeZeroth = False)
 
-        self.ws = np.linspace(self.FreqRange[0], self.FreqRange[1], num = self.NPoints)
-        self.ITensors = []
-        self.XString = [[], [], []]
-        for w in self.ws:
-            self.ITensors.append(self.Intensity(w))
-        self.Is = []
-        for I in self.ITensors:
-            self.Is.append(I[0, 0] + I[1, 1] + I[2, 2])
-
-        self.Is = np.asarray(self.Is)
-        if self.Normalize:
-            self.Is = np.asarray(self.Is) / max(self.Is)
+        self.Spectrum()
 
-        self.Timer.report(self.TimerNames)
+        self.Timer.report(self.TimerNames, comments = self.GMRESReport())
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 class VSCFLinearResponseIR(LinearResponseIR):
     GetTransitionDipoleMatrix = GetTransitionDipoleMatrixFromVSCF
+    GrowTransitionDipoleMatrix = GrowTransitionDipoleMatrixFromVSCF
     GetAb = GetAbFromVSCF
 
     def __init__(self, mf, mVCI, FreqRange = [0, 5000], NPoints = 100, eta = 10, NormalModes = None, DipoleSurface = None, **kwargs):
@@ -492,8 +709,11 @@ class VSCFLinearResponseIR(LinearResponseIR):
 
 class LinearResponseIRNMode(LinearResponseIR):
     GetTransitionDipoleMatrix = GetTransitionDipoleMatrixNMode
+    MakeDipoleMatrices = MakeDipoleMatricesNMode
+    GrowTransitionDipoleMatrix = GrowTransitionDipoleMatrixNMode
     GetAb = GetAbNMode
     DoSpectralPT2 = DoSpectralPT2NMode
+    SpectralPT2Space = SpectralPT2SpaceNMode
     
     def __init__(self, mVCI, FreqRange = [0, 5000], NPoints = 100, eta = 10, SpectralHBMethod = 3, NormalModes = None, **kwargs):
         self.mVCI = mVCI
@@ -515,11 +735,25 @@ class LinearResponseIRNMode(LinearResponseIR):
         self.eta = eta
         self.Normalize = False
         self.DoPT2 = False
+        self.Continuation = False # Warm start each frequency from the space selected at the previous one
+        self.PruneThr = 1e-4 # Relative response amplitude below which configurations are dropped when continuing
+        self.Preconditioner = 'jacobi' # None, 'jacobi', 'ilu', or 'block'
+        self.PrecondBlockSize = 500 # Number of lowest energy configurations treated exactly by the block preconditioner
+        self.PrecondDropTol = 1e-4
+        self.PrecondFillFactor = 10
+        self.GMRESIterations = []
+        self.ProfileFile = None
+        self.PT2Space = None
+        self.PT2SpaceCacheSize = 200000 # External configurations whose couplings are kept between frequencies
+        self.MemoryBudget = mVCI.MemoryBudget # GB, None means the available physical memory
+        self.MemoryCheck = mVCI.MemoryCheck
+        self.PrintMemory = mVCI.PrintMemory
+        self.MemoryPlan = None
 
         self.__dict__.update(kwargs)
         
-        self.Timer = TIMER(6)
         self.TimerNames = ["Dipole Hamiltonian", "A and b Generation", "Axb Solve", "Screen Basis", "Diagonalization", "PT2"]
+        self.Timer = PROFILER(self.TimerNames, name = "LinearResponseIRNMode")
 
 
     def kernel(self):
@@ -530,6 +764,14 @@ class LinearResponseIRNMode(LinearResponseIR):
         K4 = K * K * K * K
         N2 = N * N
 
+        if self.mVCI.Storage == 'ooc':
+            raise ValueError("LinearResponseIRNMode builds its Hamiltonians from the dense integrals and cannot run with Storage = 'ooc'")
+        Budget = None if self.MemoryBudget is None else self.MemoryBudget * GB
+        self.MemoryPlan = PlanMemory(N, K, self.mol.Order, Integrals = False, Dipole = True, HBMethod = self.mVCI.HBMethod, Precision = self.mol.IntsPrecision, Budget = Budget, Allocated = ['Dipoles'])
+        if self.PrintMemory:
+            PrintMemoryPlan(self.MemoryPlan)
+        CheckMemory(self.MemoryPlan, Mode = self.MemoryCheck)
+
         if self.mVCI.HBMethod.upper() == '2MODE':
             self.Sorted2ModeDip = []
             for x in range(3):
@@ -563,32 +805,23 @@ class LinearResponseIRNMode(LinearResponseIR):
                             #self.mol.dip_ints[4] = np.asarray(self.mol.dip_ints[4].tolist())
                             self.mol.dip_ints[4].resize((3, N * N * N * N * N * K4 * K4 * K * K))
                         else:
-                            self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                            self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
                     else:
-                        self.mol.dip_ints[3] = [np.array([0.0])] * 3
-                        self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                        self.mol.dip_ints[3] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                        self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
                 else:
-                    self.mol.dip_ints[2] = [np.array([0.0])] * 3
-                    self.mol.dip_ints[3] = [np.array([0.0])] * 3
-                    self.mol.dip_ints[4] = [np.array([0.0])] * 3
+                    self.mol.dip_ints[2] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                    self.mol.dip_ints[3] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
+                    self.mol.dip_ints[4] = np.zeros((3, 1), dtype = self.mol.IntsPrecision)
 
         self.GetTransitionDipoleMatrix(IncludeZeroth = False)
         self.DipoleSurfaceList = []
 
-        self.ws = np.linspace(self.FreqRange[0], self.FreqRange[1], num = self.NPoints)
-        self.ITensors = []
-        self.XString = [[], [], []]
-        for w in self.ws:
-            self.ITensors.append(self.Intensity(w))
-        self.Is = []
-        for I in self.ITensors:
-            self.Is.append(I[0, 0] + I[1, 1] + I[2, 2])
-
-        self.Is = np.asarray(self.Is)
-        if self.Normalize:
-            self.Is = np.asarray(self.Is) / max(self.Is)
+        self.Spectrum()
 
-        self.Timer.report(self.TimerNames)
+        self.Timer.report(self.TimerNames, comments = self.GMRESReport())
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 if __name__ == "__main__":
     from vstr.ff.normal_modes import GetNormalModes
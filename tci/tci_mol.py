@@ -10,7 +10,7 @@ from vstr.nmode.mol import NormalModes
 from vstr.spectra.dipole import GetDipole
 from vstr.nmode.mol import Molecule, get_qmat_ho, get_tmat_ho
 from vstr.mf.lo import NMBoys
-from vstr.utils.perf_utils import TIMER
+from vstr.utils.perf_utils import PROFILER
 from pyscf import gto, scf, cc
 import h5py
 
@@ -21,6 +21,60 @@ A2B = 1.88973
 AU2CM = 219474.63 
 AMU2AU = 1822.888486209
 
+def RoundTT(cores, tol = None, maxrank = None):
+    '''
+    SVD based TT rounding of cores with shape (r0, n, r1). The chain is right
+    orthogonalized with QR and then truncated left to right, keeping the smallest
+    rank whose discarded singular values are below tol * ||T|| / sqrt(d - 1), capped
+    at maxrank. Returns the new cores, the bond ranks and the relative truncation
+    error of each bond.
+    '''
+    d = len(cores)
+    cores = [np.asarray(core).copy() for core in cores]
+    for k in range(d - 1, 0, -1):
+        r0, n, r1 = cores[k].shape
+        Q, R = np.linalg.qr(cores[k].reshape(r0, n * r1).T)
+        cores[k] = Q.T.reshape(-1, n, r1)
+        cores[k - 1] = np.tensordot(cores[k - 1], R.T, axes = (2, 0))
+    norm = np.linalg.norm(cores[0])
+    delta = 0.0
+    if tol is not None and d > 1:
+        delta = tol * norm / np.sqrt(d - 1)
+
+    ranks = []
+    errs = []
+    for k in range(d - 1):
+        r0, n, r1 = cores[k].shape
+        U, S, Vt = np.linalg.svd(cores[k].reshape(r0 * n, r1), full_matrices = False)
+        tail = np.sqrt(np.cumsum(S[::-1]**2))[::-1]
+        keep = np.nonzero(tail > delta)[0]
+        r = keep[-1] + 1 if keep.shape[0] > 0 else 1
+        if maxrank is not None:
+            r = min(r, maxrank)
+        err = np.sqrt((S[r:]**2).sum()) / norm if norm > 0 else 0.0
+        cores[k] = U[:, :r].reshape(r0, n, r)
+        cores[k + 1] = np.tensordot(S[:r, None] * Vt[:r], cores[k + 1], axes = (1, 0))
+        ranks.append(int(r))
+        errs.append(float(err))
+    return cores, ranks, errs
+
+def RoundCoreTensors(core_tensors, tol = None, maxrank = None):
+    '''
+    Rounds the contracted cores with shape (r0, r1, n, m) by treating (n, m) as one
+    physical index.
+    '''
+    shapes = [core.shape for core in core_tensors]
+    cores = [core.transpose(0, 2, 3, 1).reshape(core.shape[0], core.shape[2] * core.shape[3], core.shape[1]) for core in core_tensors]
+    cores, ranks, errs = RoundTT(cores, tol = tol, maxrank = maxrank)
+    core_tensors = [core.reshape(core.shape[0], sh[2], sh[3], core.shape[2]).transpose(0, 3, 1, 2) for core, sh in zip(cores, shapes)]
+    return core_tensors, ranks, errs
+
+def PrintTTRanks(ranks, errs, title = "TT Rounding"):
+    print(title, flush = True)
+    print("Bond  Rank  Truncation Error")
+    for k, (r, err) in enumerate(zip(ranks, errs)):
+        print("%4d  %4d  %.6e" % (k, r, err), flush = True)
+
 class TCIMolecule(Molecule):
     '''
     Atomic units are used throughout. 
@@ -42,6 +96,13 @@ class TCIMolecule(Molecule):
         self.tt_method = 'tci'
         self.rank = 121
         self.tci_tol = 1e-6
+        self.tci_nworkers = 1
+        self.tci_prefetch = False
+        self.round_tol = None # relative tolerance for TT rounding
+        self.round_rank = None # maximum bond rank after TT rounding
+        self.tt_ranks = None
+        self.tt_trunc_err = None
+        self.ValidateSamples = 0 # number of sampled points to check the TT against, 0 skips
         self.loc_method = loc_method
         self.Order = 2
         self.OrderPlus = None
@@ -55,8 +116,8 @@ class TCIMolecule(Molecule):
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(3)
         self.TimerNames = ["Opt + NM", "Tensor Train", "ContractTT"]
+        self.Timer = PROFILER(self.TimerNames, name = "TCIMolecule")
 
     def __str__(self):
         mol_str = ""
@@ -73,6 +134,10 @@ class TCIMolecule(Molecule):
         mol_str += "Intergral Path        : %s\n" % self.IntsFile
         mol_str += "Minimum Energy        : %.6f cm-1\n" % self.V0
         mol_str += "Rank                  : %d\n" % self.core_tensors[0].shape[1]
+        if self.tt_ranks is not None:
+            mol_str += "Bond Ranks            : %s\n" % " ".join(str(r) for r in self.tt_ranks)
+        if self.tt_trunc_err is not None:
+            mol_str += "Max Truncation Error  : %.6e\n" % max(self.tt_trunc_err)
         mol_str += "TCI Tolerance         : %.6f\n" % self.tci_tol
         mol_str += "Minimum Geometry (A)  :\n"
         for i in range(self.x0.shape[0]):
@@ -128,16 +193,28 @@ class TCIMolecule(Molecule):
         gridpts, dvr_coeff = self.get_heg(self.ngridpts)
         self.Timer.start(1)
         if tt_method.upper() == 'TCI':
-            cores = self.nm.do_tci(gridpts, maxit = rank, tol = tci_tol)
+            cores = self.nm.do_tci(gridpts, maxit = rank, tol = tci_tol, nworkers = self.tci_nworkers, prefetch = self.tci_prefetch)
+            print("Potential Evaluations :", self.nm.tci_oracle.neval, "(%d cache hits)" % self.nm.tci_oracle.nhit)
             print("Tensor Ranks")
             for core in cores:
                 print(core.shape)
         else:
             cores = self.nm.do_tt(gridpts)
+        doRound = self.round_tol is not None or self.round_rank is not None
+        if doRound:
+            cores, ranks, errs = RoundTT(cores, tol = self.round_tol, maxrank = self.round_rank)
+            PrintTTRanks(ranks, errs, title = "TT Rounding (DVR)")
+            self.tt_ranks_dvr, self.tt_trunc_err_dvr = ranks, errs
+        self.cores = cores
         self.Timer.stop(1)
         #self.core_tensors = [np.einsum('irj,nr,mr->ijnm', core.detach().numpy(), dvr_c, dvr_c, optimize=True) for core, dvr_c in zip(cores, dvr_coeff)]
         self.Timer.start(2)
         self.core_tensors = [np.einsum('irj,nr,mr->ijnm', core, dvr_c, dvr_c, optimize=True) for core, dvr_c in zip(cores, dvr_coeff)]
+        if doRound:
+            self.core_tensors, self.tt_ranks, self.tt_trunc_err = RoundCoreTensors(self.core_tensors, tol = self.round_tol, maxrank = self.round_rank)
+            PrintTTRanks(self.tt_ranks, self.tt_trunc_err, title = "TT Rounding (HO)")
+        else:
+            self.tt_ranks = [core.shape[1] for core in self.core_tensors[:-1]]
         self.Timer.stop(2)
 
     def ContractTT(self):
@@ -147,13 +224,104 @@ class TCIMolecule(Molecule):
         return VTT[0, ..., 0]
 
     def ExplicitVTensor(self):
-        gridpts_mesh = np.meshgrid(*self.gridpts, indexing='ij')
-        for i in range(len(gridpts_mesh)):
-            gridpts_mesh[i] = gridpts_mesh[i].flatten()
-        return self.nm.potential_nm_vec(*gridpts_mesh).reshape([self.ngridpts]*self.nm.nmodes)
-        #gridpts_mesh_torch = [torch.tensor(gridpts_mesh[i], dtype=torch.float64) for i in range(len(gridpts_mesh))]
-        #del gridpts_mesh
-        #return self.nm.potential_nm_torch(*gridpts_mesh_torch).reshape([self.ngridpts]*self.nm.nmodes).detach().numpy()
+        '''
+        Deprecated, use ValidateTT. The exact PES on the full grid, which has ngridpts^Nm points.
+        '''
+        import warnings
+        warnings.warn("ExplicitVTensor evaluates the full grid and will be removed, use ValidateTT to check the TT", DeprecationWarning, stacklevel = 2)
+        gridpts_mesh = [q.flatten() for q in np.meshgrid(*self.gridpts, indexing='ij')]
+        return self.nm.potential_nm_vec(*gridpts_mesh).reshape([len(grid) for grid in self.gridpts])
+
+    def EvaluateTT(self, idx):
+        '''
+        Evaluates the grid TT at a batch of multi-indices of shape (B, d) by sweeping
+        the core chain, costing O(B d r^2) and never forming the full tensor.
+        '''
+        G = self.cores[0][0, idx[:, 0], :]
+        for k in range(1, len(self.cores)):
+            G = np.einsum('bi,ibj->bj', G, self.cores[k][:, idx[:, k], :], optimize = True)
+        return G[:, 0]
+
+    def SampleGrid(self, NSamples, SampleMode = 'both', SampleOrder = 2, rng = None):
+        '''
+        Draws grid multi-indices either uniformly over the full grid ('random'), or by
+        displacing at most SampleOrder random modes away from the grid point closest to
+        the reference geometry ('subspace'). 'both' splits the samples evenly.
+        '''
+        if rng is None:
+            rng = np.random.default_rng()
+        K = np.asarray([len(grid) for grid in self.gridpts])
+        d = K.shape[0]
+        if SampleMode == 'random':
+            NRandom = NSamples
+        elif SampleMode == 'subspace':
+            NRandom = 0
+        elif SampleMode == 'both':
+            NRandom = NSamples // 2
+        else:
+            raise ValueError("Unknown SampleMode %s" % SampleMode)
+        idx = np.zeros((NSamples, d), dtype = int)
+        idx[:NRandom] = (rng.random((NRandom, d)) * K).astype(int)
+        idx0 = np.asarray([np.argmin(abs(grid)) for grid in self.gridpts])
+        for s in range(NRandom, NSamples):
+            idx[s] = idx0
+            n = rng.integers(1, min(SampleOrder, d) + 1)
+            Modes = rng.choice(d, size = n, replace = False)
+            idx[s, Modes] = (rng.random(n) * K[Modes]).astype(int)
+        return idx
+
+    def ValidateTT(self, NSamples = 1000, BatchSize = 100, SampleMode = 'both', SampleOrder = 2, Seed = None, nworkers = 1):
+        '''
+        Sampled estimate of the TT error against the exact PES. Samples are drawn and
+        evaluated in batches, so memory is bounded by BatchSize, and only running sums
+        are kept. Reports RMS, mean and max error in cm-1 with 95% confidence intervals
+        from the central limit theorem.
+        '''
+        from vstr.nmode.mol import TCIOracle
+        rng = np.random.default_rng(Seed)
+        oracle = getattr(self.nm, "tci_oracle", None)
+        if oracle is None or len(oracle.gridpts) != len(self.gridpts) or any(len(g1) != len(g2) or np.any(g1 != g2) for g1, g2 in zip(oracle.gridpts, self.gridpts)):
+            oracle = TCIOracle(self.nm, self.gridpts, nworkers = nworkers)
+        oracle.nworkers = nworkers
+
+        n = 0
+        SumE = 0.0
+        SumE2 = 0.0
+        SumE4 = 0.0
+        SumV2 = 0.0
+        MaxE = 0.0
+        MaxIdx = None
+        while n < NSamples:
+            B = min(BatchSize, NSamples - n)
+            idx = self.SampleGrid(B, SampleMode = SampleMode, SampleOrder = SampleOrder, rng = rng)
+            VExact = oracle.evaluate_batch(idx)
+            VTT = self.EvaluateTT(idx)
+            E = (VTT - VExact) * constants.AU_TO_INVCM
+            SumE += E.sum()
+            SumE2 += (E**2).sum()
+            SumE4 += (E**4).sum()
+            SumV2 += ((VExact * constants.AU_TO_INVCM)**2).sum()
+            b = np.argmax(abs(E))
+            if abs(E[b]) > MaxE:
+                MaxE = abs(E[b])
+                MaxIdx = idx[b].copy()
+            n += B
+
+        Mean = SumE / n
+        MSE = SumE2 / n
+        SEMean = np.sqrt(max(MSE - Mean**2, 0.0) / n)
+        SEMSE = np.sqrt(max(SumE4 / n - MSE**2, 0.0) / n)
+        RMS = np.sqrt(MSE)
+        RMSLow = np.sqrt(max(MSE - 1.96 * SEMSE, 0.0))
+        RMSHigh = np.sqrt(MSE + 1.96 * SEMSE)
+        self.tt_validation = {"NSamples": n, "RMS": RMS, "RMS_CI": (RMSLow, RMSHigh), "Mean": Mean, "Mean_CI": (Mean - 1.96 * SEMean, Mean + 1.96 * SEMean), "Max": MaxE, "MaxIdx": MaxIdx, "RelRMS": RMS / np.sqrt(SumV2 / n) if SumV2 > 0 else 0.0}
+
+        print("TT Validation (%d samples, %s)" % (n, SampleMode), flush = True)
+        print("RMS Error  : %.6f cm-1  (95%% CI %.6f - %.6f)" % (RMS, RMSLow, RMSHigh))
+        print("Mean Error : %.6f cm-1  (95%% CI %.6f - %.6f)" % (Mean, Mean - 1.96 * SEMean, Mean + 1.96 * SEMean))
+        print("Max Error  : %.6f cm-1  at grid point %s" % (MaxE, MaxIdx))
+        print("Rel. RMS   : %.6e" % self.tt_validation["RelRMS"], flush = True)
+        return self.tt_validation
 
     def SaveCoreTensors(self, IntsFile = None):
         if IntsFile is None:
@@ -180,6 +348,15 @@ class TCIMolecule(Molecule):
                 del f["core_tensors"]
             for i, core in enumerate(self.core_tensors):
                 f.create_dataset("core_tensors/%d" % i, data = self.core_tensors[i])
+
+            if "tt_ranks" in f:
+                del f["tt_ranks"]
+            if self.tt_ranks is not None:
+                f.create_dataset("tt_ranks", data = np.asarray(self.tt_ranks))
+            if "tt_trunc_err" in f:
+                del f["tt_trunc_err"]
+            if self.tt_trunc_err is not None:
+                f.create_dataset("tt_trunc_err", data = np.asarray(self.tt_trunc_err))
     
     def ReadCoreTensors(self, IntsFile = None):
         if IntsFile is None:
@@ -187,6 +364,10 @@ class TCIMolecule(Molecule):
 
         with h5py.File(IntsFile, "r") as f:
             self.core_tensors = [f["core_tensors/%d" % i][()] for i in range(self.Nm)]
+            if "tt_ranks" in f:
+                self.tt_ranks = list(f["tt_ranks"][()])
+            if "tt_trunc_err" in f:
+                self.tt_trunc_err = list(f["tt_trunc_err"][()])
 
     def kernel(self, x0 = None):
         self.Timer.start(0)
@@ -201,6 +382,8 @@ class TCIMolecule(Molecule):
 
         if not self.ReadTensors:
             self.CalcTT(tt_method = self.tt_method, rank = self.rank, tci_tol = self.tci_tol)
+            if self.ValidateSamples > 0:
+                self.ValidateTT(NSamples = self.ValidateSamples, nworkers = self.tci_nworkers)
         else:
             self.ReadCoreTensors()
         print(self)
@@ -0,0 +1,16 @@
+"""Model runs shared by the tests."""
+
+
+from vstr.vhci.vhci import VHCI
+from vstr.benchmarks.models import RandomQFF
+
+
+def RunQFF(Symmetric = False, NStates = 3, eps1 = 1.0, eps2 = 0.05, doPT2 = False, doSPT2 = False, **kwargs):
+    """VHCI on a random six mode QFF. Symmetric keeps only the force constants even in modes 0 and 3,
+    so flipping either is a symmetry. Extra keyword arguments go to VHCI."""
+    w, V = RandomQFF(6, Seed = 1)
+    if Symmetric:
+        V = [[(fc, Modes) for fc, Modes in Vn if Modes.count(0) % 2 == 0 and Modes.count(3) % 2 == 0] for Vn in V]
+    mVHCI = VHCI(w, V, MaxQuanta = 4, MaxTotalQuanta = 2, NStates = NStates, eps1 = eps1, eps2 = eps2, **kwargs)
+    mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = doPT2, doSPT2 = doSPT2)
+    return mVHCI
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""Tests for the mode combination range of the basis."""
+
+
+import unittest
+
+from vstr.utils import init_funcs
+from vstr.vhci.vhci import VHCI, NModeVHCI, BasisToArray
+from vstr.benchmarks.models import RandomQFF, CoupledMorse
+
+
+def ExcitedModes(Basis):
+    return (BasisToArray(Basis) > 0).sum(axis = 1).max()
+
+
+class TestModeCombinationRange(unittest.TestCase):
+    """No configuration, enumerated or selected, may excite more than MaxExcitedModes modes."""
+
+    def test_truncated_basis(self):
+        w, _ = RandomQFF(6, Seed = 1)
+        self.assertEqual(ExcitedModes(init_funcs.InitTruncatedBasis(6, w, [4] * 6, MaxTotalQuanta = 3)), 3)
+        for MaxExcitedModes in [1, 2]:
+            Basis = init_funcs.InitTruncatedBasis(6, w, [4] * 6, MaxTotalQuanta = 3, MaxExcitedModes = MaxExcitedModes)
+            self.assertEqual(ExcitedModes(Basis), MaxExcitedModes)
+
+    def test_qff_screening(self):
+        w, V = RandomQFF(6, Seed = 1)
+        for MaxExcitedModes in [1, 2]:
+            mVHCI = VHCI(w, V, MaxQuanta = 4, MaxTotalQuanta = 1, NStates = 3, eps1 = 0.5, eps2 = 0.05, MaxExcitedModes = MaxExcitedModes)
+            mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = False)
+            self.assertEqual(ExcitedModes(mVHCI.Basis), MaxExcitedModes)
+
+    def test_nmode_screening(self):
+        mol = CoupledMorse(5, Seed = 0, Order = 3, ngridpts = 6, calc_dipole = False)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        mVHCI = NModeVHCI(mol, NStates = 4, MaxTotalQuanta = 1, eps1 = 0.5, eps2 = 0.05)
+        mVHCI.kernel(doVCI = True, doVHCI = True)
+        self.assertGreater(ExcitedModes(mVHCI.Basis), 2)
+        mVHCI = NModeVHCI(mol, NStates = 4, MaxTotalQuanta = 1, eps1 = 0.5, eps2 = 0.05, MaxExcitedModes = 2)
+        mVHCI.kernel(doVCI = True, doVHCI = True)
+        self.assertEqual(ExcitedModes(mVHCI.Basis), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
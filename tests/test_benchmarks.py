@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Tests for the benchmark suite."""
+
+
+import os
+import copy
+import tempfile
+import unittest
+import importlib.util
+
+from vstr.benchmarks.imports import CheckImports, ENTRY_POINTS, HEAVY
+from vstr.benchmarks.suite import RunSuite, MergeRuns, Compare, LoadRecord, QFF_DEFAULTS, NMODE_DEFAULTS, TCI_DEFAULTS
+
+
+TINY = [
+    dict(QFF_DEFAULTS, name = "qff_n4", N = 4, NStates = 3),
+    dict(NMODE_DEFAULTS, name = "nmode2_n4", N = 4, ngridpts = 4, NStates = 3, NPoints = 3),
+    dict(TCI_DEFAULTS, name = "tci_n4", N = 4, ngridpts = 4, NStates = 3),
+]
+
+
+def Stage(Time, Memory, **Counters):
+    return {"time": Time, "calls": 1, "rss_mb": 100.0 + Memory, "rss_growth_mb": Memory, "counters": Counters}
+
+
+def Run(Time, Memory, E, **Stages):
+    return {"params": {"name": "case"}, "stages": Stages, "total_time": Time, "peak_rss_mb": 100.0 + Memory, "start_rss_mb": 100.0, "results": {"E_var": E}}
+
+
+class TestRunSuite(unittest.TestCase):
+    """A tiny suite must run every method, write its record and compare clean against itself."""
+
+    def test_tiny_suite(self):
+        with tempfile.TemporaryDirectory() as Dir:
+            OutFile = os.path.join(Dir, "current.json")
+            Record = RunSuite("tiny", Cases = TINY, Repeat = 2, Isolate = False, OutFile = OutFile)
+            self.assertEqual(LoadRecord(OutFile)["cases"].keys(), Record["cases"].keys())
+        self.assertEqual(Record["repeat"], 2)
+        for Case in TINY:
+            R = Record["cases"][Case["name"]]
+            self.assertNotIn("error", R)
+            self.assertEqual(len(R["results"]["E_var"]), 3)
+            self.assertIn("eigensolve", R["stages"])
+            self.assertIn("vhci", R["stages"])
+        NMode = Record["cases"]["nmode2_n4"]
+        for s in ["nmode_ints_2", "vscf", "pt2", "ir_solve"]:
+            self.assertIn(s, NMode["stages"])
+        self.assertGreater(NMode["results"]["GMRES iterations"], 0)
+        _, NReg = Compare(Record, copy.deepcopy(Record), Print = False)
+        self.assertEqual(NReg, 0)
+
+    def test_failed_case(self):
+        Record = RunSuite("tiny", Cases = [dict(TINY[0], name = "broken", method = "none")], Repeat = 3, Isolate = False)
+        self.assertIn("KeyError", Record["cases"]["broken"]["error"])
+
+
+class TestMergeCompare(unittest.TestCase):
+    """Repetitions keep the fastest time and the largest memory, and regressions are flagged stage by stage."""
+
+    def test_merge_runs(self):
+        Merged = MergeRuns([Run(2.0, 10.0, [1.0], vhci = Stage(1.0, 5.0, n = 3)), Run(1.5, 20.0, [1.0], vhci = Stage(1.2, 2.0, n = 4), pt2 = Stage(0.1, 1.0))])
+        self.assertEqual(Merged["total_time"], 1.5)
+        self.assertEqual(Merged["peak_rss_mb"], 120.0)
+        self.assertEqual(Merged["stages"]["vhci"]["time"], 1.0)
+        self.assertEqual(Merged["stages"]["vhci"]["rss_growth_mb"], 5.0)
+        self.assertEqual(Merged["stages"]["vhci"]["counters"]["n"], 4)
+        self.assertIn("pt2", Merged["stages"])
+        Error = {"params": {}, "error": "RuntimeError: failed"}
+        self.assertIs(MergeRuns([Run(1.0, 1.0, [1.0]), Error]), Error)
+
+    def test_compare(self):
+        Base = {"meta": {}, "cases": {"case": Run(1.0, 10.0, [1.0, 2.0], vhci = Stage(1.0, 10.0))}}
+        Checks = [
+            (Run(1.05, 10.0, [1.0, 2.0], vhci = Stage(1.05, 10.0)), 0, ""),
+            (Run(2.0, 10.0, [1.0, 2.0], vhci = Stage(2.0, 10.0)), 2, "SLOWER"),
+            (Run(0.5, 10.0, [1.0, 2.0], vhci = Stage(0.5, 10.0)), 0, "faster"),
+            (Run(1.0, 100.0, [1.0, 2.0], vhci = Stage(1.0, 100.0)), 2, "MEMORY"),
+            (Run(1.0, 10.0, [1.0, 2.1], vhci = Stage(1.0, 10.0)), 1, "CHANGED"),
+            ({"params": {"name": "case"}, "error": "RuntimeError: failed"}, 1, "ERROR"),
+        ]
+        for New, NExpected, Status in Checks:
+            Lines, NReg = Compare(Base, {"meta": {}, "cases": {"case": New}}, Print = False)
+            self.assertEqual(NReg, NExpected)
+            if Status:
+                self.assertTrue(any(Status in Line for Line in Lines[1:-1]))
+
+
+
+class TestImports(unittest.TestCase):
+    """No entry point may pull in a heavy optional dependency on import."""
+
+    def test_entry_points(self):
+        Results, NFail = CheckImports(Repeat = 1)
+        self.assertEqual(NFail, 0)
+        self.assertEqual(Results.keys(), ENTRY_POINTS.keys())
+        for Module, R in Results.items():
+            self.assertEqual(R["heavy"], [], Module)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyscf"), "PySCF is not installed")
+    def test_forbidden(self):
+        Results, NFail = CheckImports({"vstr.mf.lo": HEAVY}, Repeat = 1)
+        self.assertEqual(NFail, 1)
+        self.assertIn("pyscf", Results["vstr.mf.lo"]["forbidden"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Tests for the sweep runner of the vhci console script."""
+
+
+import os
+import csv
+import json
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+from vstr.vhci import cli
+from vstr.vhci.vhci import VHCI
+from vstr.mf.vscf import VSCF
+from vstr.benchmarks.models import RandomQFF
+
+
+N = 4
+MAXQUANTA = 4
+
+
+def WriteJF(FileName, w, V, eps1 = 1.0, eps2 = 0.05, NStates = 3, MaxTotalQuanta = 2):
+    """Writes a QFF as a JF input."""
+    FCs = [(fc, Modes) for Vn in V for fc, Modes in Vn]
+    with open(FileName, "w") as f:
+        f.write("Random QFF\n")
+        f.write("eps1 %s\nNStates %d\ndoPT2 0\neps2 %s\nSPT2 1e-6 1000 10\n" % (eps1, NStates, eps2))
+        f.write("MaxQuanta %d\nNModes %d\n" % (MaxTotalQuanta, len(w)))
+        for i, wi in enumerate(w):
+            f.write("%d %.10f %d\n" % (i, wi, MAXQUANTA))
+        f.write("NFC %d\n" % len(FCs))
+        for fc, Modes in FCs:
+            f.write("%d %s %.10f\n" % (len(Modes), " ".join(str(i) for i in Modes), fc))
+
+
+class TestSweep(unittest.TestCase):
+    """Every job of a sweep must write the energies of a direct run to the CSV, and failed jobs an error."""
+
+    def test_tiny_sweep(self):
+        w, V = RandomQFF(N, Seed = 2)
+        with tempfile.TemporaryDirectory() as Dir:
+            Input = os.path.join(Dir, "qff.inp")
+            Missing = os.path.join(Dir, "missing.inp")
+            WriteJF(Input, w, V)
+            SweepFile = os.path.join(Dir, "sweep.json")
+            with open(SweepFile, "w") as f:
+                json.dump({"method": ["vhci", "vscf"], "eps1": [1.0, 0.1], "eps2": 0.05}, f)
+            OutFile = os.path.join(Dir, "results.csv")
+            LogDir = os.path.join(Dir, "logs")
+            Argv = ["vstr", Input, Missing, "--sweep", SweepFile, "--NStates", "3", "--pt2", "--jobs", "2", "--threads", "1", "--out", OutFile, "--log-dir", LogDir]
+            with mock.patch("sys.argv", Argv):
+                self.assertEqual(cli.main(), 1)
+            with open(OutFile, "r", newline = "") as f:
+                Rows = list(csv.DictReader(f))
+            self.assertEqual(len(os.listdir(LogDir)), 6)
+
+        self.assertEqual(list(Rows[0].keys()), cli.COLUMNS)
+        self.assertEqual(sorted(set(int(R["job"]) for R in Rows)), list(range(6)))
+        Failed = [R for R in Rows if R["input"] == Missing]
+        self.assertEqual(len(Failed), 3)
+        for R in Failed:
+            self.assertIn("FileNotFoundError", R["error"])
+            self.assertEqual(R["E_var"], "")
+        Rows = [R for R in Rows if R["input"] == Input]
+        for R in Rows:
+            self.assertEqual(R["error"], "")
+
+        VSCFRows = [R for R in Rows if R["method"] == "vscf"]
+        self.assertEqual(len(VSCFRows), 1)
+        E0 = VSCF(w, V, MaxQuanta = [MAXQUANTA] * N, verbose = 0).kernel()
+        np.testing.assert_allclose(float(VSCFRows[0]["E_var"]), E0, rtol = 0, atol = 1e-6)
+
+        for eps1 in [1.0, 0.1]:
+            Job = sorted([R for R in Rows if R["method"] == "vhci" and float(R["eps1"]) == eps1], key = lambda R: int(R["state"]))
+            self.assertEqual([int(R["state"]) for R in Job], [0, 1, 2])
+            mVHCI = VHCI(w, V, MaxQuanta = [MAXQUANTA] * N, MaxTotalQuanta = 2, NStates = 3, eps1 = eps1, eps2 = 0.05)
+            mVHCI.kernel(doPT2 = True)
+            self.assertEqual(int(Job[0]["NBasis"]), len(mVHCI.Basis))
+            np.testing.assert_allclose([float(R["E_var"]) for R in Job], mVHCI.E_HCI, rtol = 0, atol = 1e-6)
+            np.testing.assert_allclose([float(R["E_PT2"]) for R in Job], mVHCI.E_HCI_PT2, rtol = 0, atol = 1e-6)
+
+    def test_make_jobs(self):
+        Jobs = cli.MakeJobs(["a.inp"], {"method": ["vscf", "vhci"], "eps1": [0.1, 1.0], "MaxTotalQuanta": [2, 3]})
+        self.assertEqual(len(Jobs), 5)
+        self.assertEqual(Jobs[0]["method"], "vscf")
+        self.assertEqual([(J["MaxTotalQuanta"], J["eps1"]) for J in Jobs[1:]], [(3, 0.1), (3, 1.0), (2, 0.1), (2, 1.0)])
+        self.assertEqual([J["job"] for J in Jobs], list(range(5)))
+        with self.assertRaises(ValueError):
+            cli.MakeJobs(["a.inp"], {"method": ["vci"]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Tests for the memory planner and the storage choice of the n-mode tensors."""
+
+
+import os
+import itertools
+import contextlib
+import unittest
+import numpy as np
+
+from vstr.utils import init_funcs
+from vstr.utils.memory_utils import GB, INT_MAX, DenseLayout, OutOfCoreLayout, ChooseStorage, CountBasis, CountConnections, PlanMemory, CheckMemory
+from vstr.vhci.vhci import NModeVHCI
+from vstr.benchmarks.models import CoupledMorse
+
+
+@contextlib.contextmanager
+def Quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class TestCounts(unittest.TestCase):
+    """The configuration counts must match the enumerated basis and connections."""
+
+    def test_basis(self):
+        w = np.linspace(1000, 3000, 5)
+        for K, MaxTotalQuanta in [(3, 2), (4, 3), (5, 6)]:
+            self.assertEqual(CountBasis(5, K, MaxTotalQuanta), len(init_funcs.InitTruncatedBasis(5, w, [K] * 5, MaxTotalQuanta = MaxTotalQuanta)))
+
+    def test_connections(self):
+        N, K = 4, 3
+        Q = np.asarray(list(itertools.product(range(K), repeat = N)))
+        NDiff = (Q != Q[0]).sum(axis = 1)
+        for MaxModes in [1, 2, 3]:
+            self.assertEqual(CountConnections(N, K, MaxModes), np.count_nonzero((NDiff > 0) & (NDiff <= MaxModes)))
+
+
+class TestStorage(unittest.TestCase):
+    """Layouts must give the bytes the tensors take, and the choice must fall back to out of core only when needed."""
+
+    def test_dense_bytes(self):
+        with Quiet():
+            for Precision in ['float64', 'float32']:
+                mol = CoupledMorse(4, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = True, IntsPrecision = Precision)
+                mol.kernel()
+                mol.IntegralsAsArrays()
+                ElementBytes = np.dtype(Precision).itemsize
+                self.assertEqual(DenseLayout(4, 5, 3, ElementBytes = ElementBytes)[0], sum(V.nbytes for V in mol.ints[:3]))
+                self.assertEqual(DenseLayout(4, 5, 3, NComponents = 3, ElementBytes = ElementBytes)[0], sum(V.nbytes for V in mol.dip_ints[:3]))
+
+    def test_choose_storage(self):
+        N, K, Order = 20, 8, 3
+        Dense = DenseLayout(N, K, Order)[0]
+        OOC = OutOfCoreLayout(N, K, Order, CacheBytes = GB)[0]
+        self.assertLess(OOC, Dense)
+        self.assertEqual(ChooseStorage(N, K, Order), 'dense')
+        self.assertEqual(ChooseStorage(N, K, Order, Budget = Dense), 'dense')
+        self.assertEqual(ChooseStorage(N, K, Order, Budget = Dense - 1), 'ooc')
+        self.assertEqual(ChooseStorage(N, K, Order, Budget = Dense - 1, Precision = 'float32'), 'dense')
+        # Nothing fits, the smallest layout is reported
+        self.assertEqual(ChooseStorage(N, K, Order, Budget = OOC - 1), 'ooc')
+        self.assertEqual(ChooseStorage(N, K, Order, Budget = 1, Layouts = ['dense']), 'dense')
+        # Too many elements for the int indexing of the dense kernels
+        N = 60
+        self.assertGreater(N**3 * K**6, INT_MAX)
+        self.assertFalse(DenseLayout(N, K, Order)[1])
+        self.assertEqual(ChooseStorage(N, K, Order), 'ooc')
+
+
+class TestPlanMemory(unittest.TestCase):
+    """Plans must list the heat bath indices of the chosen storage and refuse only what is known not to fit."""
+
+    def test_components(self):
+        Plan = PlanMemory(20, 8, 3, HBMethod = '2mode', Use3ModeHB = True, doPT2 = True)
+        Names = [Name for Name, _, _ in Plan['Components']]
+        self.assertEqual(Plan['Storage'], 'dense')
+        self.assertEqual(Names, ['Integrals', 'Sorted2Mode', 'Sorted3Mode', 'Basis', 'Hamiltonian', 'PT2 space'])
+        self.assertEqual(Plan['Exact'], sum(B for _, B, Exact in Plan['Components'] if Exact))
+        Plan = PlanMemory(20, 8, 3, HBMethod = '2mode', Use3ModeHB = True, Budget = DenseLayout(20, 8, 3)[0] - 1)
+        self.assertEqual(Plan['Storage'], 'ooc')
+        self.assertIn('Max3Mode', [Name for Name, _, _ in Plan['Components']])
+        Plan = PlanMemory(20, 8, 3, Integrals = False, Dipole = True, Spaces = False)
+        self.assertEqual([Name for Name, _, _ in Plan['Components']], ['Dipoles'])
+
+    def test_check(self):
+        Plan = PlanMemory(10, 6, 3, HBMethod = '2mode')
+        with Quiet():
+            self.assertTrue(CheckMemory(dict(Plan, Budget = Plan['Total']), Mode = 'refuse'))
+            with self.assertRaises(MemoryError):
+                CheckMemory(dict(Plan, Budget = Plan['Exact'] - 1), Mode = 'refuse')
+            self.assertFalse(CheckMemory(dict(Plan, Budget = Plan['Exact'] - 1), Mode = 'warn'))
+            # The spaces are estimates, which only warn
+            self.assertFalse(CheckMemory(dict(Plan, Budget = Plan['Exact']), Mode = 'refuse'))
+            with self.assertRaises(RuntimeError):
+                CheckMemory(dict(Plan, Overflow = True), Mode = 'warn')
+            self.assertTrue(CheckMemory(dict(Plan, Overflow = True, Budget = 1), Mode = None))
+
+    def test_refuse_before_allocation(self):
+        with Quiet():
+            mol = CoupledMorse(4, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False, MemoryBudget = 1e-6, MemoryCheck = 'refuse')
+            with self.assertRaises(MemoryError):
+                mol.kernel()
+            self.assertFalse(hasattr(mol, 'ints'))
+            mol = CoupledMorse(4, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False)
+            mol.kernel()
+            mol.IntegralsAsArrays()
+            mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 2, eps1 = 1.0, eps2 = 0.1, HBMethod = '2mode', MemoryBudget = 1e-5, MemoryCheck = 'refuse')
+            with self.assertRaises(MemoryError):
+                mVHCI.kernel(doVCI = True, doVHCI = True)
+            self.assertIsNone(mVHCI.Sorted2Mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Tests for the n-mode Hamiltonian kernels."""
+
+
+import unittest
+import numpy as np
+from scipy import sparse
+
+from vstr.utils import init_funcs
+from vstr.vhci.vhci import NModeVHCI, VCISparseHamNModeOOC, AddStatesHB3ModeOOC, BasisToArray
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import VCISparseHamNModeFromOMArray, AddStatesCIPSIStreamArray, AddStatesHB2ModeArray, AddStatesHB3ModeArray
+from vstr.nmode.ooc import IntegralStore
+from vstr.utils.memory_utils import GB
+from vstr.benchmarks.models import CoupledMorse
+
+
+class MemoryStore(IntegralStore):
+    """IntegralStore that reads its blocks from the dense integrals of a molecule, as arrays or raveled, instead of a file."""
+
+    def __init__(self, mol, CacheSize = 1.0):
+        IntegralStore.__init__(self, mol.Nm, mol.ngridpts, mol.Order, CacheSize = CacheSize, Dtype = mol.IntsPrecision)
+        self.ints = list(mol.ints)
+
+    def _read(self, Modes):
+        k = len(Modes)
+        V = self.ints[k - 1].reshape((self.Nm,) * k + (self.K,) * (2 * k))[tuple(Modes)]
+        return np.ascontiguousarray(V, dtype = self.Dtype).reshape(self.K**k, self.K**k)
+
+
+class TestOutOfCoreHamiltonian(unittest.TestCase):
+    """The out of core Hamiltonian reads the sorted 3-mode blocks and must match the dense kernel."""
+
+    def setUp(self):
+        self.mol = CoupledMorse(6, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False)
+        self.mol.kernel()
+        self.mol.IntegralsAsArrays()
+        self.Basis = init_funcs.InitTruncatedBasis(self.mol.Nm, self.mol.Frequencies, [self.mol.ngridpts - 1] * self.mol.Nm, MaxTotalQuanta = 3)
+
+    def test_ooc_matches_dense(self):
+        mol = self.mol
+        K = mol.ngridpts
+        Zero = np.array([0.0])
+        HDense = VCISparseHamNModeFromOMArray(self.Basis, self.Basis, mol.Frequencies, mol.V0, mol.onemode_eig, mol.ints[1].ravel(), mol.ints[2].ravel(), Zero, Zero, True, mol.Order, K)
+        HOOC = VCISparseHamNModeOOC(self.Basis, self.Basis, mol.Frequencies, mol.V0, mol.onemode_eig, mol.ints[1].ravel(), MemoryStore(mol), True, mol.Order, K)
+        Diff = sparse.triu(HDense) - sparse.triu(HOOC)
+        self.assertLess(abs(Diff).max(), 1e-8)
+
+    def test_permuted_blocks(self):
+        ints3 = self.mol.ints[2]
+        V = ints3[0, 2, 4]
+        np.testing.assert_allclose(ints3[4, 0, 2], V.transpose(2, 0, 1, 5, 3, 4))
+        np.testing.assert_allclose(ints3[2, 4, 0], V.transpose(1, 2, 0, 4, 5, 3))
+
+    def test_ooc_energies(self):
+        mol = self.mol
+        Dense = NModeVHCI(mol, NStates = 4, MaxTotalQuanta = 2, eps1 = 0.5, eps2 = 0.05, Storage = 'dense', Use3ModeHB = True)
+        Dense.kernel(doVCI = True, doVHCI = True)
+        # Room for two 3-mode blocks, so every sweep over the twenty blocks evicts
+        Store = MemoryStore(mol, CacheSize = 2.5 * mol.ngridpts**6 * 8 / GB)
+        mol.IntsStore = Store
+        OOC = NModeVHCI(mol, NStates = 4, MaxTotalQuanta = 2, eps1 = 0.5, eps2 = 0.05, Storage = 'ooc', Use3ModeHB = True)
+        OOC.kernel(doVCI = True, doVHCI = True)
+        self.assertEqual(OOC.Storage, 'ooc')
+        self.assertGreater(Store.Misses, len(Store.tuples(3)))
+        self.assertLessEqual(len(Store.Cache), 2)
+        self.assertEqual(len(OOC.Basis), len(Dense.Basis))
+        np.testing.assert_allclose(OOC.E_HCI, Dense.E_HCI, rtol = 0, atol = 1e-8)
+
+
+class TestThreeModeHeatBath(unittest.TestCase):
+    """Screening through the sorted 3-mode index must add what a scan of every 3-mode block adds."""
+
+    def setUp(self):
+        mol = CoupledMorse(6, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        self.mol = mol
+        self.mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 2, eps1 = 1.0, eps2 = 0.1, HBMethod = '2mode', Use3ModeHB = True)
+        self.mVHCI.kernel(doVCI = True, doVHCI = False)
+        self.C = abs(self.mVHCI.C[:, :3]).max(axis = 1)
+
+    def test_matches_block_scan(self):
+        m, mol = self.mVHCI, self.mol
+        Store = MemoryStore(mol)
+        Configurations = lambda Basis: sorted(map(tuple, BasisToArray(Basis)))
+        for eps in [1.0, 0.3, 0.1]:
+            for MaxExcitedModes in [-1, 2]:
+                Sorted = AddStatesHB3ModeArray(m.Basis, mol.ints[1], m.Sorted2Mode, mol.ints[2], m.Sorted3Mode, m.Max3Mode, self.C, eps, True, m.N, m.K, MaxExcitedModes)
+                Scan = AddStatesHB3ModeOOC(m.Basis, mol.ints[1], m.Sorted2Mode, Store, self.C, eps, True, m.N, m.K, MaxExcitedModes)
+                self.assertEqual(Configurations(Sorted), Configurations(Scan))
+                if MaxExcitedModes < 0:
+                    TwoMode = AddStatesHB2ModeArray(m.Basis, mol.ints[1], m.Sorted2Mode, self.C, eps, True, m.N, m.K, MaxExcitedModes)
+                    self.assertTrue(set(Configurations(TwoMode)) <= set(Configurations(Sorted)))
+                    if eps < 1.0:
+                        self.assertGreater(len(Sorted), len(TwoMode))
+
+
+class TestStreamingCIPSI(unittest.TestCase):
+    """Streamed CIPSI selection must pick the configurations a dense evaluation of the criterion picks."""
+
+    def setUp(self):
+        mol = CoupledMorse(4, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        self.mol = mol
+        N, K = mol.Nm, mol.ngridpts
+        Zero = np.array([0.0])
+        self.ints = [mol.ints[1].ravel(), mol.ints[2].ravel(), Zero, Zero]
+        Full = init_funcs.InitTruncatedBasis(N, mol.Frequencies, [K] * N, MaxTotalQuanta = N * K)
+        H = VCISparseHamNModeFromOMArray(Full, Full, mol.Frequencies, mol.V0, mol.onemode_eig, *self.ints, True, mol.Order, K).toarray()
+        self.QFull = BasisToArray(Full)
+        self.Index = {Q.tobytes(): n for n, Q in enumerate(self.QFull)}
+        self.Basis = init_funcs.InitTruncatedBasis(N, mol.Frequencies, [K] * N, MaxTotalQuanta = 1)
+        QBasis = BasisToArray(self.Basis)
+        I = np.asarray([self.Index[Q.tobytes()] for Q in QBasis])
+        E, C = np.linalg.eigh(H[np.ix_(I, I)])
+        self.C, self.E = C[:, 0], E[:3].copy()
+        # Every configuration within Order changed modes of the basis, scored by (sum_i H_ai C_i)^2 / min_n |E_n - H_aa|
+        NDiff = (self.QFull[:, None, :] != QBasis[None, :, :]).sum(axis = 2).min(axis = 1)
+        self.A = np.setdiff1d(np.flatnonzero(NDiff <= mol.Order), I)
+        self.Criterion = (H[np.ix_(self.A, I)] @ self.C)**2 / abs(self.E[None, :] - np.diag(H)[self.A, None]).min(axis = 1)
+
+    def Select(self, eps, MaxAdd = 0, MaxExcitedModes = -1):
+        mol = self.mol
+        New = AddStatesCIPSIStreamArray(self.Basis, [mol.ngridpts] * mol.Nm, mol.Order, self.C, self.E, mol.Frequencies, mol.V0, mol.onemode_eig, *self.ints, eps, MaxAdd, mol.ngridpts, MaxExcitedModes)
+        return [self.Index[Q.tobytes()] for Q in BasisToArray(New)]
+
+    def test_threshold(self):
+        for eps in [1e-3, 1e-4]:
+            self.assertEqual(sorted(self.Select(eps)), sorted(self.A[self.Criterion > eps].tolist()))
+
+    def test_top_k(self):
+        Order = np.argsort(-self.Criterion)
+        self.assertEqual(self.Select(1e-6, MaxAdd = 5), self.A[Order[:5]].tolist())
+
+    def test_mode_combination_range(self):
+        Keep = (self.QFull[self.A] > 0).sum(axis = 1) <= 2
+        self.assertEqual(sorted(self.Select(1e-5, MaxExcitedModes = 2)), sorted(self.A[Keep & (self.Criterion > 1e-5)].tolist()))
+
+
+class TestSinglePrecision(unittest.TestCase):
+    """Integrals stored in float32 must give the float64 energies, the kernels accumulate in double either way."""
+
+    def RunNMode(self, IntsPrecision, **kwargs):
+        mol = CoupledMorse(5, Seed = 0, Order = 3, ngridpts = 6, calc_dipole = False, IntsPrecision = IntsPrecision)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        self.assertEqual(mol.ints[2].dtype, np.dtype(IntsPrecision))
+        mVHCI = NModeVHCI(mol, NStates = 4, MaxTotalQuanta = 2, eps1 = 1.0, eps2 = 0.05, **kwargs)
+        mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = True)
+        return mVHCI
+
+    def test_energies(self):
+        # Rounding the integrals to float32 moves these energies and PT2 corrections by about 4e-8 cm-1, checked to 1e-6 cm-1
+        for kwargs in [dict(), dict(HBMethod = '2mode', Use3ModeHB = True)]:
+            with self.subTest(**kwargs):
+                Double = self.RunNMode('float64', **kwargs)
+                Single = self.RunNMode('float32', **kwargs)
+                self.assertEqual(len(Single.Basis), len(Double.Basis))
+                np.testing.assert_allclose(Single.E_HCI, Double.E_HCI, rtol = 0, atol = 1e-6)
+                np.testing.assert_allclose(Single.E_HCI_PT2, Double.E_HCI_PT2, rtol = 0, atol = 1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Tests for the PT2 corrections."""
+
+
+import unittest
+import numpy as np
+
+from vstr.utils import init_funcs
+from vstr.vhci.vhci import NModeVHCI, BasisToArray, LinearExtrapolation
+from vstr.benchmarks.models import CoupledMorse
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import VCISparseHamNModeFromOMArray
+from tests.helpers import RunQFF
+
+
+def RunPT2(**kwargs):
+    return np.asarray(RunQFF(doPT2 = True, **kwargs).E_HCI_PT2)
+
+
+def RunSPT2(**kwargs):
+    return RunQFF(doSPT2 = True, NWalkers = 50, **kwargs)
+
+
+class TestBatchedPT2(unittest.TestCase):
+    """Splitting the external space into hash batches must not change the PT2 energies."""
+
+    def setUp(self):
+        self.E = RunPT2()
+
+    def test_fixed_batches(self):
+        for NBatch in [2, 3, 4]:
+            np.testing.assert_allclose(RunPT2(PT2Batches = NBatch), self.E, rtol = 0, atol = 1e-8)
+
+    def test_memory_budget(self):
+        np.testing.assert_allclose(RunPT2(PT2MaxMem = 1e-6), self.E, rtol = 0, atol = 1e-8)
+
+
+class TestAdaptiveSPT2(unittest.TestCase):
+    """Adaptive SPT2 must repeat exactly for a seed and stop at SPT2Tol or after NSamples samples."""
+
+    def test_seed(self):
+        A = RunSPT2(SPT2Tol = 1e-3, SPT2Seed = 7)
+        B = RunSPT2(SPT2Tol = 1e-3, SPT2Seed = 7)
+        self.assertEqual(A.SPT2SeedUsed, 7)
+        # The samples are fixed by the seed, only the order of the threaded sums may differ
+        np.testing.assert_allclose(A.dE_PT2, B.dE_PT2, rtol = 1e-10, atol = 0)
+        np.testing.assert_allclose(A.sE_PT2, B.sE_PT2, rtol = 1e-10, atol = 0)
+        np.testing.assert_array_equal(A.NSamplesPT2, B.NSamplesPT2)
+        # A run without a seed records the one it drew, which repeats it
+        C = RunSPT2(SPT2Tol = 1e-3)
+        D = RunSPT2(SPT2Tol = 1e-3, SPT2Seed = C.SPT2SeedUsed)
+        self.assertIsNone(C.SPT2Seed)
+        np.testing.assert_allclose(C.dE_PT2, D.dE_PT2, rtol = 1e-10, atol = 0)
+
+    def test_stopping(self):
+        for Tol in [1e-1, 1e-2, 1e-6]:
+            mVHCI = RunSPT2(SPT2Tol = Tol, SPT2Seed = 1, NSamples = 40, SPT2Batch = 5)
+            for sE, Ns in zip(mVHCI.sE_PT2, mVHCI.NSamplesPT2):
+                self.assertTrue(sE <= Tol or Ns == mVHCI.NSamples)
+                self.assertLessEqual(Ns, mVHCI.NSamples)
+        # No root reaches 1e-6 cm-1 in 40 samples, so every root draws all of them
+        self.assertTrue(np.all(np.asarray(mVHCI.NSamplesPT2) == 40))
+        mVHCI = RunSPT2(SPT2Tol = 1e3, SPT2Seed = 1, NSamples = 40, SPT2Batch = 5)
+        self.assertTrue(np.all(np.asarray(mVHCI.NSamplesPT2) < 40))
+        self.assertTrue(np.all(mVHCI.sE_PT2 <= 1e3))
+
+
+class TestNModePT2(unittest.TestCase):
+    """With eps2 near zero the n-mode PT2 must be the Epstein-Nesbet correction over the whole product space."""
+
+    def test_full_space(self):
+        for Order in [2, 3]:
+            mol = CoupledMorse(4, Seed = 0, Order = Order, ngridpts = 5, calc_dipole = False)
+            mol.kernel()
+            mol.IntegralsAsArrays()
+            mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 1, eps1 = 1.0, eps2 = 1e-10, HBMethod = '2mode')
+            mVHCI.kernel(doVCI = True, doVHCI = True, doPT2 = True)
+
+            K = mol.ngridpts
+            Full = init_funcs.InitTruncatedBasis(mol.Nm, mol.Frequencies, [K] * mol.Nm, MaxTotalQuanta = mol.Nm * K)
+            self.assertEqual(len(Full), K**mol.Nm)
+            H = VCISparseHamNModeFromOMArray(Full, Full, mVHCI.Frequencies, mol.V0, mol.onemode_eig, *mol.ints[1:5], True, mol.Order, K).toarray()
+            Index = {Q.tobytes(): n for n, Q in enumerate(BasisToArray(Full))}
+            I = np.asarray([Index[Q.tobytes()] for Q in BasisToArray(mVHCI.Basis)])
+            A = np.setdiff1d(np.arange(len(Full)), I)
+            E, C = np.linalg.eigh(H[np.ix_(I, I)])
+            HAI = H[np.ix_(A, I)] @ C[:, :3]
+            dE = (HAI**2 / (E[:3] - np.diag(H)[A, None])).sum(axis = 0)
+            np.testing.assert_allclose(mVHCI.E_HCI, E[:3], rtol = 0, atol = 1e-8)
+            np.testing.assert_allclose(mVHCI.dE_PT2, dE, rtol = 1e-5, atol = 1e-10)
+            np.testing.assert_allclose(mVHCI.E_HCI_PT2, E[:3] + dE, rtol = 0, atol = 1e-8)
+
+
+
+class TestSchedule(unittest.TestCase):
+    """Each stage of an eps1 schedule must match a run at its eps1, and the extrapolation the tight limit."""
+
+    def setUp(self):
+        self.mVHCI = RunQFF(eps2 = 1e-3, doPT2 = True, eps1Schedule = [0.1, 1.0, 0.3, 0.03])
+        self.Results = self.mVHCI.ScheduleResults
+
+    def test_stages(self):
+        self.assertEqual(self.Results["eps1"], [1.0, 0.3, 0.1, 0.03])
+        self.assertTrue(np.all(np.diff(self.Results["NBasis"]) > 0))
+        for s, eps1 in enumerate(self.Results["eps1"]):
+            mVHCI = RunQFF(eps1 = eps1, eps2 = 1e-3, doPT2 = True)
+            self.assertEqual(self.Results["NBasis"][s], len(mVHCI.Basis))
+            np.testing.assert_allclose(self.Results["E_var"][s], mVHCI.E_HCI, rtol = 0, atol = 1e-8)
+            np.testing.assert_allclose(self.Results["E_PT2"][s], mVHCI.E_HCI_PT2, rtol = 0, atol = 1e-8)
+        self.assertEqual(len(self.mVHCI.Basis), self.Results["NBasis"][-1])
+        np.testing.assert_allclose(self.mVHCI.E_HCI_PT2, self.Results["E_PT2"][-1], rtol = 0, atol = 1e-10)
+
+    def test_extrapolation(self):
+        E, Slope = LinearExtrapolation([[1.0, 2.0], [0.5, 1.5], [0.0, 1.0]], [[-2.0, -1.0], [-1.0, -0.5], [0.0, 0.0]])
+        np.testing.assert_allclose(E, [0.0, 1.0], rtol = 0, atol = 1e-12)
+        np.testing.assert_allclose(Slope, [-0.5, -1.0], rtol = 0, atol = 1e-12)
+        # The variational energies of the last stage are still about 5e-6 cm-1 above the limit
+        E_ref = RunPT2(eps1 = 3e-3, eps2 = 1e-3)
+        np.testing.assert_allclose(self.Results["E_extrap"], E_ref, rtol = 0, atol = 5e-7)
+        self.assertTrue(np.all(self.Results["E_var"][-1] - E_ref > 2e-6))
+
+    def test_single_stage(self):
+        mVHCI = RunQFF(doPT2 = True, eps1Schedule = [0.3])
+        self.assertNotIn("E_extrap", mVHCI.ScheduleResults)
+        mVHCI = RunQFF(eps1Schedule = [1.0, 0.3])
+        self.assertNotIn("E_extrap", mVHCI.ScheduleResults)
+        self.assertEqual(len(mVHCI.ScheduleResults["E_PT2"]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Tests for the IR spectra."""
+
+
+import os
+import contextlib
+import unittest
+import numpy as np
+from scipy import sparse
+from scipy.linalg import eigh_tridiagonal
+
+from vstr.utils import init_funcs
+from vstr.spectra.ir_exact import LanczosTridiagonal, ContinuedFraction
+from vstr.spectra.ir_lr import FusedToCSR, LinearResponseIRNMode, SolveAxb
+from vstr.utils.linalg_utils import MakePreconditioner, gmres_counter
+from vstr.vhci.vhci import NModeVHCI, BasisToArray
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import DipoleSparseNModeArray, VCISparseHamNModeArray, VCISparseHamNModeFromOMArray, VCISparseHamDiagonalNModeFromOMArray
+from vstr.benchmarks.models import CoupledMorse
+
+
+class TestLanczos(unittest.TestCase):
+    """The reorthogonalized Lanczos chain reproduces the exact spectrum without ghost eigenvalues."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.N = 200
+        # A dense cluster of eigenvalues below a few isolated ones, which converge early and ghost without reorthogonalization
+        self.E = np.sort(np.concatenate([rng.uniform(0, 1, self.N - 5), [5, 6, 7, 8, 9]]))
+        self.Q, _ = np.linalg.qr(rng.standard_normal((self.N, self.N)))
+        self.H = self.Q @ np.diag(self.E) @ self.Q.T
+        self.v0 = rng.standard_normal(self.N)
+
+    def test_ritz_values(self):
+        a, b, Norm2 = LanczosTridiagonal(self.H, self.v0, self.N)
+        Theta, U = eigh_tridiagonal(a, b)
+        np.testing.assert_allclose(Theta, self.E, rtol = 0, atol = 1e-10)
+        np.testing.assert_allclose(Norm2 * U[0]**2, (self.Q.T @ self.v0)**2, rtol = 1e-6, atol = 1e-10)
+
+    def test_continued_fraction(self):
+        a, b, Norm2 = LanczosTridiagonal(self.H, self.v0, 60)
+        z = np.linspace(4, 10, 50) + 0.1j
+        G = ((self.Q.T @ self.v0)**2 / (z[:, None] - self.E)).sum(axis = 1)
+        np.testing.assert_allclose(Norm2 * ContinuedFraction(z, a, b), G, rtol = 1e-6)
+        Theta = eigh_tridiagonal(a, b, eigvals_only = True)
+        self.assertEqual(np.sum(Theta > 4.5), 5)
+
+
+class TestFusedDipole(unittest.TestCase):
+    """The fused dipole kernel must give the three components of the per-component n-mode kernel."""
+
+    def setUp(self):
+        self.mol = CoupledMorse(5, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = True)
+        self.mol.kernel()
+        self.mol.IntegralsAsArrays()
+        self.Basis = init_funcs.InitTruncatedBasis(self.mol.Nm, self.mol.Frequencies, [self.mol.ngridpts - 1] * self.mol.Nm, MaxTotalQuanta = 3)
+
+    def test_fused_matches_components(self):
+        mol = self.mol
+        Zero = [0.0] * mol.Nm
+        thr = 1e-4 # Both kernels drop elements below this, the fused one only when all three components are below it
+        for B1, B2, DiagonalBlock in [(self.Basis, self.Basis, True), (self.Basis[:20], self.Basis[20:], False)]:
+            Rows, Cols, Vals = DipoleSparseNModeArray(B1, B2, list(mol.mu0), *mol.dip_ints, DiagonalBlock, mol.Order, mol.ngridpts)
+            D = FusedToCSR(Rows, Cols, Vals, (len(B1), len(B2)))
+            for x in range(3):
+                Dx = VCISparseHamNModeArray(B1, B2, Zero, mol.mu0[x], *[d[x] for d in mol.dip_ints], DiagonalBlock, mol.Order, mol.ngridpts)
+                self.assertLessEqual(abs(D[x] - Dx).max(), thr)
+                np.testing.assert_allclose(D[x][Dx.nonzero()], Dx[Dx.nonzero()], rtol = 0, atol = 1e-12)
+
+
+def RunLinearResponse(Direct = False, **kwargs):
+    """Linear response spectrum of a five mode model, solving every frequency directly if Direct."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        mol = CoupledMorse(5, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = True)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 2, eps1 = 1.0, eps2 = 0.1, HBMethod = '2mode')
+        mVHCI.kernel(doVCI = True, doVHCI = True)
+        mIR = LinearResponseIRNMode(mVHCI, FreqRange = [500, 4000], NPoints = 8, eta = 20, **kwargs)
+        if Direct:
+            mIR.SolveResponse = lambda A, b, x0 = None: sparse.linalg.spsolve(A.tocsc(), b)
+        mIR.kernel()
+    return mIR
+
+
+class TestContinuation(unittest.TestCase):
+    """Warm starting each frequency from the previous space must give the spectrum of the direct solves."""
+
+    def setUp(self):
+        self.Is = RunLinearResponse(Direct = True).Is
+
+    def test_spectrum(self):
+        Reset = RunLinearResponse()
+        for PruneThr in [1e-4, 0.0]:
+            mIR = RunLinearResponse(Continuation = True, PruneThr = PruneThr)
+            np.testing.assert_allclose(mIR.Is, self.Is, rtol = 0, atol = 1e-8 * abs(self.Is).max())
+            self.assertEqual(mIR.ContinuationState, [None] * 3)
+            self.assertEqual(len(mIR.mVCI.Basis), len(mIR.Basis0))
+        # Without pruning every solve starts from the previous solution on a superset of its space
+        self.assertLess(sum(mIR.GMRESIterations), sum(Reset.GMRESIterations))
+
+
+class TestPreconditioners(unittest.TestCase):
+    """Preconditioned GMRES must reach the direct solution of the shifted response equations in fewer iterations."""
+
+    def setUp(self):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            mol = CoupledMorse(6, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = False)
+            mol.kernel()
+            mol.IntegralsAsArrays()
+            mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 3, eps1 = 1.0, eps2 = 0.1, HBMethod = '2mode')
+            mVHCI.kernel(doVCI = True, doVHCI = False)
+        self.H = mVHCI.H.tocsr()
+        self.E0 = mVHCI.E[0]
+        self.b = np.random.default_rng(0).standard_normal(self.H.shape[0]).astype(np.cdouble)
+
+    def Solve(self, A, Method, BlockSize = 50):
+        counter = gmres_counter()
+        M = MakePreconditioner(A, Method = Method, HDiag = self.H.diagonal(), BlockSize = BlockSize)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            x = SolveAxb(A, self.b, M = M, counter = counter)
+        return x, counter.niter
+
+    def test_direct_solution(self):
+        NDim = self.H.shape[0]
+        for w in [1500.0, 3000.0]:
+            A = (sparse.identity(NDim) * (w + self.E0 + 10.j) - self.H).tocsr()
+            x = sparse.linalg.spsolve(A.tocsc(), self.b)
+            _, NNone = self.Solve(A, None)
+            for Method in ['jacobi', 'ilu', 'block']:
+                xM, NM = self.Solve(A, Method)
+                np.testing.assert_allclose(xM, x, rtol = 0, atol = 1e-7 * abs(x).max())
+                self.assertLess(NM, NNone)
+            # The block covering every configuration is the exact inverse
+            xM, NM = self.Solve(A, 'block', BlockSize = NDim)
+            self.assertEqual(NM, 1)
+            np.testing.assert_allclose(xM, x, rtol = 0, atol = 1e-12 * abs(x).max())
+
+    def test_methods(self):
+        A = (sparse.identity(self.H.shape[0]) * (2000.0 + self.E0 + 10.j) - self.H).tocsr()
+        self.assertIsNone(MakePreconditioner(A, Method = None))
+        self.assertIsNone(MakePreconditioner(sparse.linalg.aslinearoperator(A), Method = 'ilu'))
+        with self.assertRaises(ValueError):
+            MakePreconditioner(A, Method = 'ssor')
+
+    def test_spectrum(self):
+        Is = RunLinearResponse(Direct = True).Is
+        for Preconditioner in ['jacobi', 'ilu', 'block']:
+            mIR = RunLinearResponse(Preconditioner = Preconditioner, PrecondBlockSize = 20)
+            np.testing.assert_allclose(mIR.Is, Is, rtol = 0, atol = 1e-8 * abs(Is).max())
+
+
+class TestPT2SpaceCache(unittest.TestCase):
+    """The PT2 space cached by configuration must match a fresh build as the external and variational spaces change."""
+
+    def setUp(self):
+        mol = CoupledMorse(5, Seed = 0, Order = 3, ngridpts = 5, calc_dipole = True)
+        mol.kernel()
+        mol.IntegralsAsArrays()
+        self.mVHCI = NModeVHCI(mol, NStates = 3, MaxTotalQuanta = 1, eps1 = 1.0, eps2 = 0.1)
+        self.mVHCI.kernel(doVCI = True, doVHCI = False)
+        self.mIR = LinearResponseIRNMode(self.mVHCI, FreqRange = [0, 4000], NPoints = 10, eta = 10)
+        self.mIR.K = mol.ngridpts
+        self.Basis0 = list(self.mVHCI.Basis)
+        self.Outer = init_funcs.InitTruncatedBasis(mol.Nm, mol.Frequencies, [mol.ngridpts - 1] * mol.Nm, MaxTotalQuanta = 3)[len(self.Basis0):]
+
+    def Direct(self, PTBasis):
+        m, mol = self.mVHCI, self.mVHCI.mol
+        HAI = VCISparseHamNModeFromOMArray(PTBasis, m.Basis, m.Frequencies, mol.V0, mol.onemode_eig, *mol.ints[1:5], False, mol.Order, m.K)
+        HAA = VCISparseHamDiagonalNModeFromOMArray(PTBasis, m.Frequencies, mol.V0, mol.onemode_eig, *mol.ints[1:5], mol.Order, m.K)
+        return HAI, np.asarray(HAA)
+
+    def test_reuse(self):
+        rng = np.random.default_rng(0)
+        x = rng.standard_normal(len(self.Basis0) + 10) + 1.j * rng.standard_normal(len(self.Basis0) + 10)
+        Ext = self.Outer[10:]
+        # Overlapping external spaces while the variational basis grows by ten configurations and shrinks back
+        Steps = [(0, Ext[:40]), (10, Ext[20:60]), (10, Ext[30:70]), (0, Ext[:50])]
+        Reused = 0
+        for NAdd, PTBasis in Steps:
+            self.mVHCI.Basis = self.Basis0 + self.Outer[:NAdd]
+            if self.mIR.PT2Space is not None:
+                Reused += sum(Q.tobytes() in self.mIR.PT2Space[0] for Q in BasisToArray(PTBasis))
+            HAI, HAA = self.mIR.SpectralPT2Space(PTBasis)
+            HRef, HAARef = self.Direct(PTBasis)
+            self.assertLess(abs(HAI - HRef).max(), 1e-10)
+            np.testing.assert_allclose(HAA, HAARef, rtol = 0, atol = 1e-10)
+            # The PT2 correction the spectrum takes from the block at one frequency
+            xv = x[:len(self.mVHCI.Basis)]
+            w = 2000.0
+            dE = np.sum(np.abs(HAI @ xv)**2 / (w - (HAA - self.mVHCI.E[0]) + 10.j))
+            dERef = np.sum(np.abs(HRef @ xv)**2 / (w - (HAARef - self.mVHCI.E[0]) + 10.j))
+            np.testing.assert_allclose(dE, dERef, rtol = 1e-10)
+        self.assertEqual(self.mIR.Timer.counters["PT2 configurations reused"], Reused)
+        self.assertGreater(Reused, 40)
+
+    def test_cache_size(self):
+        self.mIR.PT2SpaceCacheSize = 50
+        Ext = self.Outer[10:]
+        for PTBasis in [Ext[:40], Ext[20:60], Ext[:30]]:
+            HAI, HAA = self.mIR.SpectralPT2Space(PTBasis)
+            self.assertLessEqual(len(self.mIR.PT2Space[0]), 50)
+            HRef, HAARef = self.Direct(PTBasis)
+            self.assertLess(abs(HAI - HRef).max(), 1e-10)
+            np.testing.assert_allclose(HAA, HAARef, rtol = 0, atol = 1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
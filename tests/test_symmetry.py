@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+"""Tests for the symmetry blocked Hamiltonian."""
+
+
+import unittest
+import numpy as np
+
+from tests.helpers import RunQFF
+
+
+def RunSymmetric(**kwargs):
+    return RunQFF(Symmetric = True, NStates = 6, **kwargs)
+
+
+class TestSymmetryBlocking(unittest.TestCase):
+    """Blocking H by irreps must give the energies of the unblocked Hamiltonian."""
+
+    def setUp(self):
+        self.mVHCI = RunSymmetric()
+
+    def test_blocked_energies(self):
+        mSym = RunSymmetric(Symmetry = True)
+        self.assertEqual(len(mSym.SymGenerators), 2)
+        self.assertEqual(len(mSym.Basis), len(self.mVHCI.Basis))
+        np.testing.assert_allclose(mSym.E_HCI, self.mVHCI.E_HCI, rtol = 0, atol = 1e-8)
+
+    def test_target_irreps(self):
+        mSym = RunSymmetric(Symmetry = True)
+        Irrep = mSym.StateIrreps[0]
+        mTarget = RunSymmetric(Symmetry = True, TargetIrreps = [Irrep])
+        self.assertTrue(np.all(np.asarray(mTarget.StateIrreps) == Irrep))
+        # The HCI steps only screen for states of the target irrep, so the selected basis differs slightly
+        np.testing.assert_allclose(mTarget.E_HCI[0], self.mVHCI.E_HCI[0], rtol = 0, atol = 1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
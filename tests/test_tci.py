@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""Tests for the tensor train Hamiltonian."""
+
+
+import unittest
+import numpy as np
+
+from vstr.utils import init_funcs, constants
+from vstr.nmode.mol import NormalModes, TCIOracle
+from vstr.vhci.vhci import VCISparseHamTCI, pyVCISparseHamTCI, TCIHamiltonianOperator, BasisToArray
+import warnings
+from vstr.tci.tci_mol import TCIMolecule, RoundTT, RoundCoreTensors
+from vstr.benchmarks.models import CoupledMorse
+
+
+def RandomCores(N, K, Rank, Seed = 0):
+    '''
+    Random TT cores of shape (r0, r1, K, K), symmetric in the last two indices so the potential is Hermitian
+    '''
+    rng = np.random.default_rng(Seed)
+    Ranks = [1] + [Rank] * (N - 1) + [1]
+    Cores = []
+    for m in range(N):
+        G = rng.standard_normal((Ranks[m], Ranks[m + 1], K, K)) * 1e-4
+        Cores.append(G + G.transpose(0, 1, 3, 2))
+    return Cores
+
+
+class QuarticMolecule():
+    """Stand-in for the molecule of NormalModes with an anharmonic Cartesian potential that counts its calls."""
+
+    def __init__(self, natoms, Seed = 0):
+        rng = np.random.default_rng(Seed)
+        self.natoms = natoms
+        self.mass = rng.uniform(1, 16, natoms)
+        self.K = rng.standard_normal((3 * natoms, 3 * natoms))
+        self.ncall = 0
+
+    def potential_cart(self, x):
+        self.ncall += 1
+        x = np.asarray(x).ravel()
+        return x @ self.K @ x + 0.1 * np.sum(x**4)
+
+
+class QuarticModes():
+    """Stand-in for NormalModes with random orthonormal mode vectors."""
+
+    def __init__(self, natoms, nmodes, Seed = 0):
+        rng = np.random.default_rng(Seed)
+        self.mol = QuarticMolecule(natoms, Seed = Seed)
+        self.x0 = rng.standard_normal((natoms, 3))
+        Q, _ = np.linalg.qr(rng.standard_normal((3 * natoms, nmodes)))
+        self.nm_coeff = Q.reshape(natoms, 3, nmodes)
+
+    def potential_nm_vec(self, *argv):
+        q = np.stack(argv, axis = -1)
+        return np.asarray([self.mol.potential_cart(NormalModes._normal2cart(self, qi)) for qi in q])
+
+
+def TTSVD(T):
+    '''
+    Exact TT of a full tensor by successive SVDs, cores of shape (r0, n, r1)
+    '''
+    Cores = []
+    r = 1
+    M = T
+    for n in T.shape[:-1]:
+        U, S, Vt = np.linalg.svd(M.reshape(r * n, -1), full_matrices = False)
+        Cores.append(U.reshape(r, n, -1))
+        M = S[:, None] * Vt
+        r = U.shape[1]
+    Cores.append(M.reshape(r, T.shape[-1], 1))
+    return Cores
+
+
+def ContractTT(Cores):
+    T = Cores[0]
+    for G in Cores[1:]:
+        T = np.tensordot(T, G, axes = (-1, 0))
+    return T[0, ..., 0]
+
+
+class TestTCIOracle(unittest.TestCase):
+    """The memoized oracle must return the potential on the grid and call it once per point."""
+
+    def setUp(self):
+        self.nm = QuarticModes(3, 4)
+        self.gridpts = [np.linspace(-1, 1, 5) + 0.1 * i for i in range(4)]
+
+    def test_values(self):
+        oracle = TCIOracle(self.nm, self.gridpts)
+        rng = np.random.default_rng(1)
+        for _ in range(10):
+            idx = [rng.integers(5) for _ in range(4)]
+            q = np.asarray([grid[a] for grid, a in zip(self.gridpts, idx)])
+            VRef = self.nm.mol.potential_cart(NormalModes._normal2cart(self.nm, q))
+            self.assertAlmostEqual(oracle(q), VRef, places = 10)
+            self.assertAlmostEqual(oracle(list(q)), VRef, places = 10)
+        # The second call at each point is always a cache hit
+        self.assertEqual(oracle.neval, len(oracle.cache))
+        self.assertEqual(oracle.nhit, 20 - oracle.neval)
+
+    def test_batch(self):
+        rng = np.random.default_rng(2)
+        idxs = [tuple(rng.integers(5, size = 4)) for _ in range(40)] * 2
+        Serial = TCIOracle(self.nm, self.gridpts)
+        VRef = np.asarray([Serial.evaluate(idx) for idx in idxs])
+        ncall = self.nm.mol.ncall
+        Threaded = TCIOracle(self.nm, self.gridpts, nworkers = 3)
+        np.testing.assert_allclose(Threaded.evaluate_batch(idxs), VRef, rtol = 1e-12)
+        self.assertEqual(Threaded.neval, len(set(idxs)))
+        self.assertEqual(self.nm.mol.ncall - ncall, len(set(idxs)))
+        self.assertEqual(Threaded.nhit, len(idxs) - len(set(idxs)))
+
+    def test_prefetch(self):
+        oracle = TCIOracle(self.nm, self.gridpts)
+        V = oracle.prefetch_fibers()
+        self.assertEqual(V.shape[0], 4 * 5)
+        # The pivot lies on every fiber, so it is evaluated once
+        self.assertEqual(oracle.neval, 4 * 5 - 3)
+
+
+class TestTTValidation(unittest.TestCase):
+    """TT rounding must meet its tolerance and the sampled validator must report the errors of the sampled points."""
+
+    def setUp(self):
+        self.nm = QuarticModes(3, 4)
+        self.mol = TCIMolecule.__new__(TCIMolecule)
+        self.mol.nm = self.nm
+        self.mol.gridpts = [np.linspace(-1, 1, 5) + 0.1 * i for i in range(4)]
+        self.mol.ngridpts = 5
+        with warnings.catch_warnings(record = True) as w:
+            warnings.simplefilter("always")
+            self.V = self.mol.ExplicitVTensor()
+        self.assertTrue(any(issubclass(x.category, DeprecationWarning) for x in w))
+
+    def test_explicit_tensor(self):
+        idx = (1, 4, 0, 2)
+        q = np.asarray([grid[a] for grid, a in zip(self.mol.gridpts, idx)])
+        self.assertAlmostEqual(self.V[idx], self.nm.mol.potential_cart(NormalModes._normal2cart(self.nm, q)), places = 10)
+
+    def test_round_tt(self):
+        Cores = TTSVD(self.V)
+        Norm = np.linalg.norm(self.V)
+        for tol in [1e-1, 1e-2, 1e-4]:
+            Rounded, Ranks, Errs = RoundTT(Cores, tol = tol)
+            Err = np.linalg.norm(ContractTT(Rounded) - self.V) / Norm
+            self.assertLessEqual(Err, tol)
+            # The bond errors bound the total error
+            self.assertLessEqual(Err, np.sqrt(np.sum(np.square(Errs))) + 1e-12)
+        self.assertLess(min(Ranks), max(G.shape[2] for G in Cores))
+        Rounded, Ranks, Errs = RoundTT(Cores, tol = 1e-1, maxrank = 1)
+        self.assertEqual(max(Ranks), 1)
+
+    def test_validate(self):
+        Rounded, _, _ = RoundTT(TTSVD(self.V), maxrank = 2)
+        self.mol.cores = Rounded
+        Result = self.mol.ValidateTT(NSamples = 200, BatchSize = 200, Seed = 3)
+        idx = self.mol.SampleGrid(200, rng = np.random.default_rng(3))
+        E = (ContractTT(Rounded) - self.V)[tuple(idx.T)] * constants.AU_TO_INVCM
+        self.assertAlmostEqual(Result["RMS"], np.sqrt(np.mean(E**2)), places = 8)
+        self.assertAlmostEqual(Result["Max"], abs(E).max(), places = 8)
+        self.assertLessEqual(Result["RMS_CI"][0], Result["RMS"])
+        self.assertLessEqual(Result["RMS"], Result["RMS_CI"][1])
+
+
+class TestTCIHamiltonian(unittest.TestCase):
+    """The batched and matrix-free TT Hamiltonians must reproduce the element by element contraction."""
+
+    def setUp(self):
+        self.N, self.K = 5, 4
+        self.w = np.linspace(1000, 3000, self.N)
+        self.Cores = RandomCores(self.N, self.K, 3)
+        self.Basis = init_funcs.InitTruncatedBasis(self.N, self.w, [self.K - 1] * self.N, MaxTotalQuanta = 3)
+        self.Old, self.New = self.Basis[:30], self.Basis[30:]
+
+    def test_batched(self):
+        for B1, B2, OffDiagonal in [(self.Basis, self.Basis, False), (self.Old, self.New, True)]:
+            HRef = pyVCISparseHamTCI(B1, B2, self.w, 0.0, self.Cores, OffDiagonal).toarray()
+            H = VCISparseHamTCI(B1, B2, self.w, 0.0, self.Cores, OffDiagonal, BlockSize = 1000).toarray()
+            np.testing.assert_allclose(H, HRef, rtol = 0, atol = 1e-10)
+
+    def test_max_coupled_modes(self):
+        for B1, B2, OffDiagonal in [(self.Basis, self.Basis, False), (self.Old, self.New, True)]:
+            NDiff = (BasisToArray(B1)[:, None, :] != BasisToArray(B2)[None, :, :]).sum(axis = 2)
+            HRef = pyVCISparseHamTCI(B1, B2, self.w, 0.0, self.Cores, OffDiagonal).toarray()
+            TRef = pyVCISparseHamTCI(B1, B2, self.w, 0.0, [0.0 * G for G in self.Cores], OffDiagonal).toarray()
+            HRef = TRef + np.where(NDiff <= 2, HRef - TRef, 0.0)
+            H = VCISparseHamTCI(B1, B2, self.w, 0.0, self.Cores, OffDiagonal, MaxCoupledModes = 2, BlockSize = 1000).toarray()
+            np.testing.assert_allclose(H, HRef, rtol = 0, atol = 1e-10)
+
+    def test_matrix_free(self):
+        H = VCISparseHamTCI(self.Basis, self.Basis, self.w, 0.0, self.Cores, False).toarray()
+        HOld = TCIHamiltonianOperator(self.Old, self.w, self.Cores, BlockSize = 500)
+        for Op in [TCIHamiltonianOperator(self.Basis, self.w, self.Cores, BlockSize = 500), TCIHamiltonianOperator(self.Basis, self.w, self.Cores, Previous = HOld, BlockSize = 500)]:
+            np.testing.assert_allclose(Op.diagonal(), np.diag(H), rtol = 0, atol = 1e-10)
+            c = np.random.default_rng(1).standard_normal((len(self.Basis), 2))
+            np.testing.assert_allclose(Op @ c, H @ c, rtol = 0, atol = 1e-9)
+            np.testing.assert_allclose(Op @ (1j * c[:, 0]), 1j * (H @ c[:, 0]), rtol = 0, atol = 1e-9)
+
+
+class TestRoundCoreTensors(unittest.TestCase):
+    """Rounding the contracted cores must remove redundant rank without changing H."""
+
+    def setUp(self):
+        self.mol = CoupledMorse(5, Seed = 0, ngridpts = 4)
+        self.mol.CalcTT()
+        Cores = self.mol.core_tensors
+        # The same TT written twice with half the weight, so every inner bond has twice the rank it needs
+        self.Doubled = [np.concatenate((0.5 * Cores[0], 0.5 * Cores[0]), axis = 1)]
+        for G in Cores[1:-1]:
+            D = np.zeros((2 * G.shape[0], 2 * G.shape[1]) + G.shape[2:])
+            D[:G.shape[0], :G.shape[1]] = G
+            D[G.shape[0]:, G.shape[1]:] = G
+            self.Doubled.append(D)
+        self.Doubled.append(np.concatenate((Cores[-1], Cores[-1]), axis = 0))
+        self.Basis = init_funcs.InitTruncatedBasis(self.mol.Nm, self.mol.Frequencies, [self.mol.ngridpts - 1] * self.mol.Nm, MaxTotalQuanta = 3)
+
+    def Hamiltonian(self, Cores):
+        return VCISparseHamTCI(self.Basis, self.Basis, self.mol.Frequencies, 0.0, Cores, False).toarray()
+
+    def test_redundant_rank(self):
+        H = self.Hamiltonian(self.mol.core_tensors)
+        np.testing.assert_allclose(self.Hamiltonian(self.Doubled), H, rtol = 0, atol = 1e-8)
+        Cores, Ranks, Errs = RoundCoreTensors(self.Doubled, tol = 1e-12)
+        self.assertTrue(all(r <= r0 for r, r0 in zip(Ranks, self.mol.tt_ranks)))
+        self.assertLess(max(Errs), 1e-12)
+        np.testing.assert_allclose(self.Hamiltonian(Cores), H, rtol = 0, atol = 1e-8)
+
+    def test_max_rank(self):
+        Cores, Ranks, Errs = RoundCoreTensors(self.Doubled, maxrank = 2)
+        self.assertEqual(max(Ranks), 2)
+        self.assertEqual([G.shape[1] for G in Cores[:-1]], Ranks)
+        self.assertGreater(max(Errs), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,12 @@ def FormW(V):
         Ws.append(W)
     return Ws
 
-def InitTruncatedBasis(NModes, Frequencies, MaxQuanta, MaxTotalQuanta = None):
+def InitTruncatedBasis(NModes, Frequencies, MaxQuanta, MaxTotalQuanta = None, MaxExcitedModes = None):
+    '''
+    Configurations with fewer than MaxQuanta[i] quanta in mode i and at most MaxTotalQuanta in total. If
+    MaxExcitedModes is given, only configurations exciting at most that many modes at once are kept, which
+    is the mode combination range (MCR) truncation.
+    '''
     Basis = []
     Bs = []
     B0 = [0] * NModes
@@ -24,6 +29,9 @@ def InitTruncatedBasis(NModes, Frequencies, MaxQuanta, MaxTotalQuanta = None):
                 NewB = B.copy()
                 NewB[i] += 1
                 if (NewB[i] < MaxQuanta[i]):
+                    # Adding quanta never lowers the number of excited modes, so nothing past the MCR is needed later
+                    if MaxExcitedModes is not None and NewB[i] == 1 and NModes - NewB.count(0) > MaxExcitedModes:
+                        continue
                     if NewB not in BNext and NewB not in Basis:
                         BNext.append(NewB)
         Basis = Basis + BNext
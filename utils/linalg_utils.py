@@ -0,0 +1,74 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, spilu
+from scipy.linalg import lu_factor, lu_solve
+
+class gmres_counter:
+    """ Callback for scipy's iterative solvers which counts the iterations.
+
+    Examples:
+    >>> counter = gmres_counter()
+    >>> x = sparse.linalg.gmres(A, b, callback = counter)[0]
+    >>> print(counter.niter)
+    """
+    def __init__(self, disp = False):
+        self._disp = disp
+        self.niter = 0
+
+    def __call__(self, rk = None):
+        self.niter += 1
+        if self._disp:
+            print('iter %3i\trk = %s' % (self.niter, str(rk)), flush = True)
+
+def JacobiPreconditioner(A):
+    '''
+    Inverse of the diagonal of A
+    '''
+    D = np.asarray(A.diagonal()).ravel()
+    D[D == 0] = 1.0
+    DInv = 1.0 / D
+    return LinearOperator(A.shape, matvec = lambda x: DInv * np.asarray(x).ravel(), dtype = DInv.dtype)
+
+def ILUPreconditioner(A, DropTol = 1e-4, FillFactor = 10):
+    '''
+    Incomplete LU of A. Complex shifted matrices are factored directly, so the shift is part of the factorization.
+    '''
+    ILU = spilu(sparse.csc_matrix(A), drop_tol = DropTol, fill_factor = FillFactor)
+    return LinearOperator(A.shape, matvec = lambda x: ILU.solve(np.asarray(x, dtype = ILU.L.dtype).ravel()), dtype = ILU.L.dtype)
+
+def BlockPreconditioner(A, Block):
+    '''
+    Exact inverse of A on the configurations in Block and the inverse diagonal everywhere else.
+    '''
+    Block = np.asarray(Block, dtype = int)
+    A = sparse.csr_matrix(A)
+    D = np.asarray(A.diagonal()).ravel()
+    D[D == 0] = 1.0
+    DInv = 1.0 / D
+    LU = lu_factor(A[Block][:, Block].toarray())
+    def matvec(x):
+        x = np.asarray(x).ravel()
+        y = DInv * x
+        y[Block] = lu_solve(LU, x[Block])
+        return y
+    return LinearOperator(A.shape, matvec = matvec, dtype = np.result_type(A.dtype, DInv.dtype))
+
+def MakePreconditioner(A, Method = None, HDiag = None, BlockSize = 500, DropTol = 1e-4, FillFactor = 10):
+    '''
+    Returns a preconditioner M ~ A^-1 for GMRES, or None if Method is None or A is matrix-free.
+        Method = 'jacobi', 'ilu', or 'block'. For 'block', the BlockSize configurations with the lowest
+        diagonal energies HDiag are treated exactly.
+    '''
+    if Method is None or isinstance(A, LinearOperator):
+        return None
+    if Method.upper() == 'JACOBI':
+        return JacobiPreconditioner(A)
+    elif Method.upper() == 'ILU':
+        return ILUPreconditioner(A, DropTol = DropTol, FillFactor = FillFactor)
+    elif Method.upper() == 'BLOCK':
+        if HDiag is None:
+            HDiag = -np.asarray(A.diagonal()).real
+        Block = np.sort(np.argsort(np.asarray(HDiag).ravel())[:BlockSize])
+        return BlockPreconditioner(A, Block)
+    else:
+        raise ValueError("Preconditioner must be None, 'jacobi', 'ilu', or 'block'")
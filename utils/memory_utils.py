@@ -0,0 +1,232 @@
+import os
+from math import comb
+import numpy as np
+
+'''
+Memory planning for n-mode runs. The integral and dipole tensors, the sorted heat bath indices, the
+Hamiltonian and the PT2 space are estimated from the number of modes N, the number of grid points K,
+the n-mode order and the screening thresholds, so that a run can be refused before it allocates more
+than the machine has instead of being killed half way through.
+'''
+
+GB = 1024**3
+INT_MAX = 2**31 - 1 # The n-mode kernels index the flattened tensors with int
+CONFIG_BYTES = 128 # Overhead of one WaveFunction, on top of 16 bytes per mode
+CSR_BYTES = 12 # double and int per stored Hamiltonian element
+TRIPLET_BYTES = 16 # row, column and value while the Hamiltonian is built
+PRECISION_BYTES = {'float64': 8, 'float32': 4} # Bytes per element of the n-mode tensors for Molecule.IntsPrecision
+
+def AvailableMemory():
+    '''
+    Physical memory available to this process in bytes, None if it cannot be determined. On Linux this is
+    MemAvailable, which unlike the free pages counts the page cache the kernel can reclaim.
+    '''
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for Line in f:
+                if Line.startswith('MemAvailable:'):
+                    return int(Line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def DenseLayout(N, K, Order, NComponents = 1, CacheBytes = GB, ElementBytes = 8):
+    '''
+    Full N^k K^2k blocks of ElementBytes per element, which the *Array kernels index directly. Returns
+    the bytes and whether every flattened tensor can be addressed with an int.
+    '''
+    Sizes = [N**k * K**(2 * k) for k in range(1, Order + 1)]
+    return ElementBytes * NComponents * sum(Sizes), all(S <= INT_MAX for S in Sizes)
+
+def OutOfCoreLayout(N, K, Order, NComponents = 1, CacheBytes = GB, ElementBytes = 8):
+    '''
+    Dense 1- and 2-mode tensors with the higher orders read from disk by nmode.ooc.IntegralStore, which
+    holds at most CacheBytes of blocks
+    '''
+    Resident, Addressable = DenseLayout(N, K, min(Order, 2), NComponents = NComponents, ElementBytes = ElementBytes)
+    Full, _ = DenseLayout(N, K, Order, NComponents = NComponents, ElementBytes = ElementBytes)
+    return Resident + min(Full - Resident, NComponents * CacheBytes), Addressable
+
+# Storage layouts for the n-mode tensors in order of preference
+STORAGE_LAYOUTS = {'dense': DenseLayout, 'ooc': OutOfCoreLayout}
+
+def ChooseStorage(N, K, Order, Budget = None, NComponents = 1, Layouts = None, CacheBytes = GB, Precision = 'float64'):
+    '''
+    Returns the first layout in Layouts that can be indexed and fits in Budget bytes with the tensors
+    stored in Precision. If none fits, the addressable layout with the smallest footprint is returned so
+    that the caller can report it.
+    '''
+    if Layouts is None:
+        Layouts = list(STORAGE_LAYOUTS)
+    Costs = []
+    for Name in Layouts:
+        Bytes, Addressable = STORAGE_LAYOUTS[Name](N, K, Order, NComponents = NComponents, CacheBytes = CacheBytes, ElementBytes = PRECISION_BYTES[Precision])
+        if Addressable and (Budget is None or Bytes <= Budget):
+            return Name
+        Costs.append((not Addressable, Bytes, Name))
+    return min(Costs)[2]
+
+def QuantaCounts(N, K, MaxTotalQuanta):
+    '''
+    Number of configurations of N modes with fewer than K quanta in each mode for each total number of
+    quanta up to MaxTotalQuanta
+    '''
+    Counts = np.zeros(MaxTotalQuanta + 1, dtype = object)
+    Counts[0] = 1
+    for i in range(N):
+        New = np.zeros_like(Counts)
+        for n in range(min(K, MaxTotalQuanta + 1)):
+            New[n:] += Counts[:MaxTotalQuanta + 1 - n]
+        Counts = New
+    return Counts
+
+def CountBasis(N, K, MaxTotalQuanta):
+    '''
+    Number of configurations with fewer than K quanta in each mode and at most MaxTotalQuanta in total,
+    which is the size of InitTruncatedBasis
+    '''
+    return int(QuantaCounts(N, K, MaxTotalQuanta).sum())
+
+def CountConnections(N, K, MaxModes, NBasis = None):
+    '''
+    Number of configurations that differ from a given one in between one and MaxModes modes. If NBasis
+    is given, only those inside the smallest total quanta truncation holding NBasis configurations are
+    counted, which is a closer estimate of the nonzeros in a row of the Hamiltonian.
+    '''
+    if NBasis is None:
+        return sum(comb(N, k) * (K - 1)**k for k in range(1, min(N, MaxModes) + 1))
+    QMax = N * (K - 1)
+    Q = 1
+    while Q < QMax and CountBasis(N, K, Q) < NBasis:
+        Q = min(2 * Q, QMax)
+    Cumulative = np.cumsum(QuantaCounts(N, K, Q))
+    Q = int(np.searchsorted(Cumulative, NBasis))
+    return sum(comb(N, k) * CountBasis(k, K - 1, Q - k) for k in range(1, min(N, MaxModes, Q) + 1))
+
+def ScreenedFraction(V, eps):
+    '''
+    Fraction of the elements of a dense integral tensor larger than eps in magnitude
+    '''
+    return float(np.count_nonzero(abs(V) > eps)) / max(V.size, 1)
+
+def PlanMemory(N, K, Order, NStates = 10, MaxTotalQuanta = 5, eps1 = 0.1, eps2 = 0.01, HBMethod = 'qff', Use3ModeHB = True, doPT2 = False, Dipole = False, Integrals = True, Spaces = True, NBasis = None, Density = None, Storage = 'auto', Layouts = None, CacheSize = 1.0, Precision = 'float64', Budget = None, Allocated = []):
+    '''
+    Estimates the memory of an n-mode run. The integral and dipole tensors and the heat bath indices
+    are known exactly. The sizes of the variational and PT2 spaces are rough: the variational space is
+    taken as the initial basis plus the connections of NStates configurations above eps1, and the PT2
+    space as the connections of the variational space above eps2. Density is the fraction of couplings
+    above a threshold, either a number or a function of the threshold, and defaults to one, so that
+    the estimates are upper bounds. Budget is in bytes. Components named in Allocated are already
+    held by the process. Spaces = False leaves out the basis, Hamiltonian and PT2 space. With
+    Storage = 'auto' the integrals are stored in the first of Layouts that fits, keeping CacheSize GB
+    of blocks in memory if they are read from disk. The integrals and dipoles are stored in Precision,
+    'float64' or 'float32'. The dipole kernels only take dense tensors.
+    '''
+    if Density is None:
+        Fraction = lambda eps: 1.0
+    elif callable(Density):
+        Fraction = Density
+    else:
+        Fraction = lambda eps: Density
+    CacheBytes = int(CacheSize * GB)
+    if Storage == 'auto':
+        Storage = ChooseStorage(N, K, Order, Budget = Budget, Layouts = Layouts, CacheBytes = CacheBytes, Precision = Precision) if Integrals else 'dense'
+    ElementBytes = PRECISION_BYTES[Precision]
+
+    Components = []
+    Overflow = False
+    if Integrals:
+        Bytes, Addressable = STORAGE_LAYOUTS[Storage](N, K, Order, CacheBytes = CacheBytes, ElementBytes = ElementBytes)
+        Components.append(('Integrals', Bytes, True))
+        Overflow = Overflow or not Addressable
+    if Dipole:
+        Bytes, Addressable = DenseLayout(N, K, Order, NComponents = 3, ElementBytes = ElementBytes)
+        Components.append(('Dipoles', Bytes, True))
+        Overflow = Overflow or not Addressable
+
+    HB = HBMethod.upper()
+    if Integrals and (HB == '2MODE' or (doPT2 and HB != 'QFF')):
+        Components.append(('Sorted2Mode', 4 * 2 * N**2 * K**4, True))
+        if HB == '2MODE' and Order >= 3 and Use3ModeHB and Storage == 'ooc':
+            Components.append(('Max3Mode', 8 * comb(N, 3) * K**3, True))
+        elif HB == '2MODE' and Order >= 3 and Use3ModeHB:
+            Components.append(('Sorted3Mode', 4 * comb(N, 3) * K**6 + 8 * comb(N, 3) * K**3, True))
+    if Dipole and HB == '2MODE':
+        Components.append(('Sorted2ModeDip', 3 * 2 * N**2 * K**4, True))
+
+    if Integrals and Spaces:
+        Space = K**N
+        Conn = CountConnections(N, K, Order)
+        if NBasis is None:
+            NBasis = CountBasis(N, K, MaxTotalQuanta)
+            NBasis = NBasis + int(NStates * Conn * Fraction(eps1))
+        NBasis = min(NBasis, Space)
+        NNZ = NBasis * min(NBasis, 1 + CountConnections(N, K, Order, NBasis = NBasis))
+        Components.append(('Basis', NBasis * (16 * N + CONFIG_BYTES), False))
+        Components.append(('Hamiltonian', NNZ * (CSR_BYTES + TRIPLET_BYTES), False))
+        if doPT2:
+            NPT2 = min(int(NBasis * Conn * Fraction(eps2)), Space - NBasis)
+            Components.append(('PT2 space', NPT2 * (16 * N + CONFIG_BYTES + 8 * NStates), False))
+
+    Plan = dict()
+    Plan['N'] = N
+    Plan['K'] = K
+    Plan['Order'] = Order
+    Plan['Storage'] = Storage
+    Plan['Precision'] = Precision
+    Plan['Overflow'] = Overflow
+    Plan['NBasis'] = NBasis
+    Plan['Components'] = Components
+    Plan['Exact'] = sum(B for _, B, Exact in Components if Exact)
+    Plan['Total'] = sum(B for _, B, _ in Components)
+    Plan['Allocated'] = sum(B for Name, B, _ in Components if Name in Allocated)
+    Plan['Budget'] = Budget
+    return Plan
+
+def PrintMemoryPlan(Plan):
+    print("Memory plan for N = %d, K = %d, Order = %d with %s storage in %s" % (Plan['N'], Plan['K'], Plan['Order'], Plan['Storage'], Plan['Precision']), flush = True)
+    for Name, Bytes, Exact in Plan['Components']:
+        print("  %-16s %14.3f GB%s" % (Name, Bytes / GB, "" if Exact else " (estimate)"), flush = True)
+    print("  %-16s %14.3f GB" % ("Total", Plan['Total'] / GB), flush = True)
+    if Plan['Budget'] is not None:
+        print("  %-16s %14.3f GB" % ("Budget", Plan['Budget'] / GB), flush = True)
+
+def CheckMemory(Plan, Mode = 'warn'):
+    '''
+    Checks a plan from PlanMemory against its budget, or against the available memory plus what is
+    already allocated when there is no budget. With Mode = 'refuse', a MemoryError is raised if the
+    exactly known components do not fit, and with Mode = 'warn' a warning is printed instead. Estimated
+    components only ever warn. Tensors too large for the int indexing of the kernels are always refused
+    unless Mode is None.
+    '''
+    if Mode is None:
+        return True
+    if Plan['Overflow']:
+        PrintMemoryPlan(Plan)
+        raise RuntimeError("The n-mode tensors have more than %d elements and cannot be indexed by the %s kernels" % (INT_MAX, Plan['Storage']))
+    Budget = Plan['Budget']
+    if Budget is None:
+        Available = AvailableMemory()
+        if Available is None:
+            return True
+        Budget = Available + Plan['Allocated']
+    if Plan['Exact'] > Budget:
+        PrintMemoryPlan(Plan)
+        Message = "The n-mode tensors need %.3f GB but only %.3f GB are available" % (Plan['Exact'] / GB, Budget / GB)
+        if Mode == 'refuse':
+            raise MemoryError(Message)
+        print("Warning:", Message, flush = True)
+        return False
+    if Plan['Total'] > Budget:
+        PrintMemoryPlan(Plan)
+        print("Warning: the run may need up to %.3f GB but only %.3f GB are available" % (Plan['Total'] / GB, Budget / GB), flush = True)
+        return False
+    return True
@@ -1,5 +1,6 @@
 import time
 import numpy as np
+from contextlib import contextmanager
 
 
 class TIMER:
@@ -113,6 +114,182 @@ class TIMER:
         print("  %20s  :::  %11.3f (100.00%%)\n" % (total_name.ljust(20), t_tot))
 
 
+def peak_rss():
+    """ Return the peak resident set size of the process in MB
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.
+    import sys
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux and in B on macOS
+    return r / 1024**2. if sys.platform == "darwin" else r / 1024.
+
+
+def current_rss():
+    """ Return the current resident set size of the process in MB, from
+    /proc/self/statm or psutil where there is no /proc
+    """
+    try:
+        import os
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2.
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return current_memory()
+    except ImportError:
+        return 0.
+
+
+class PROFILER:
+    """ Hierarchical profiler with named regions, counters and memory.
+
+    Regions nest in the order they are opened, so the same region name can
+    appear under different parents. Regions can be addressed by name or, for
+    compatibility with TIMER, by an index into the list of names given at
+    construction. Times use a monotonic clock. Each region keeps the largest
+    current RSS sampled when it starts, stops or counts, and the largest growth
+    of the RSS from its start to its stop. The peak RSS of the whole process is
+    only reported for the run.
+
+    Examples:
+    >>> prof = PROFILER(["Diagonalize", "Form Hamiltonian"], name = "VHCI")
+    >>> prof.start(0)               # same as prof.start("Diagonalize")
+    >>> with prof.region("Form Hamiltonian"):
+    >>>     H = ...
+    >>>     prof.count("matrix elements kept", H.nnz)
+    >>> prof.stop(0)
+    >>> prof.report()
+    >>> prof.export("vhci_profile.json")   # or .csv
+    """
+    def __init__(self, names=None, name=None):
+        self.names = [] if names is None else list(names)
+        self.name = "" if name is None else name
+        self.reset()
+
+    def reset(self):
+        self.regions = dict()   # path -> timings, counters and memory
+        self.counters = dict()  # totals over the run
+        self.__stack = []
+        self.__last = dict()    # name -> time of its last call
+
+    def __key(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.names[i]
+        return i
+
+    def __region(self, path):
+        if path not in self.regions:
+            self.regions[path] = {"time": 0., "last": 0., "calls": 0, "rss_mb": 0.,
+                "rss_growth_mb": 0., "counters": dict()}
+        return self.regions[path]
+
+    def start(self, i):
+        name = self.__key(i)
+        path = name if len(self.__stack) == 0 else self.__stack[-1][1] + "/" + name
+        r = self.__region(path)
+        rss = current_rss()
+        r["rss_mb"] = max(r["rss_mb"], rss)
+        self.__stack.append((name, path, time.perf_counter(), rss))
+
+    def stop(self, i):
+        name = self.__key(i)
+        for k in range(len(self.__stack) - 1, -1, -1):
+            if self.__stack[k][0] == name:
+                break
+        else:
+            raise ValueError("Region %s was stopped without being started." % name)
+        name, path, t0, rss0 = self.__stack.pop(k)
+        r = self.regions[path]
+        dt = time.perf_counter() - t0
+        r["time"] += dt
+        r["last"] = dt
+        r["calls"] += 1
+        self.__last[name] = dt
+        rss = current_rss()
+        r["rss_mb"] = max(r["rss_mb"], rss)
+        r["rss_growth_mb"] = max(r["rss_growth_mb"], rss - rss0)
+
+    @contextmanager
+    def region(self, i):
+        self.start(i)
+        try:
+            yield self
+        finally:
+            self.stop(i)
+
+    def count(self, counter, n=1):
+        """ Add n to a counter in the innermost open region and to the run total
+        """
+        if len(self.__stack) > 0:
+            r = self.regions[self.__stack[-1][1]]
+            r["counters"][counter] = r["counters"].get(counter, 0) + n
+            r["rss_mb"] = max(r["rss_mb"], current_rss())
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def read(self, i, last=False):
+        """ Total time of a region over all its parents, or with last the time
+        of its most recent call
+        """
+        name = self.__key(i)
+        if last:
+            return self.__last.get(name, 0.)
+        return sum(r["time"] for path, r in self.regions.items()
+            if path.split("/")[-1] == name)
+
+    def read_tot(self, last=False):
+        key = "last" if last else "time"
+        return sum(r[key] for path, r in self.regions.items() if "/" not in path)
+
+    def to_dict(self):
+        return {"name": self.name, "peak_rss_mb": peak_rss(),
+            "total_time": self.read_tot(), "counters": dict(self.counters),
+            "regions": [dict(path=path, **r) for path, r in self.regions.items()]}
+
+    def export(self, filename):
+        """ Write the profile as JSON, or as CSV with one column per counter if filename ends in .csv
+        """
+        if filename.lower().endswith(".csv"):
+            import csv
+            counters = sorted(self.counters)
+            with open(filename, "w", newline="") as f:
+                w = csv.writer(f)
+                w.writerow(["path", "time", "calls", "rss_mb", "rss_growth_mb"] + counters)
+                for path, r in self.regions.items():
+                    w.writerow([path, r["time"], r["calls"], r["rss_mb"], r["rss_growth_mb"]] +
+                        [r["counters"].get(c, 0) for c in counters])
+        else:
+            import json
+            with open(filename, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def report(self, tnames=None, trange=None, last=False, comments=None):
+        """ Formatted report of the region tree and the counters. The arguments
+        of TIMER.report are accepted, tnames may rename indexed regions.
+        """
+        if tnames is not None:
+            self.names = list(tnames)
+        if not comments is None:
+            print("%s" % comments)
+        t_tot = self.read_tot()
+        for path, r in self.regions.items():
+            depth = path.count("/")
+            tname = "  " * depth + path.split("/")[-1]
+            pct = r["time"] / t_tot * 100. if t_tot > 0 else 0.
+            print("  %-30s  :::  %11.3f (%6.2f%%)  %8d calls  %10.1f MB" %
+                (tname[:30], r["time"], pct, r["calls"], r["rss_mb"]))
+            for c, n in r["counters"].items():
+                print("  %-30s       %11d" % (("  " * (depth + 1) + "# " + c)[:30], n))
+
+        total_name = "Total " + self.name
+        print("  %-30s  :::  %11.3f (100.00%%)  peak %10.1f MB" % (total_name[:30], t_tot, peak_rss()))
+        for c, n in self.counters.items():
+            print("  %-30s       %11d" % (("# " + c)[:30], n))
+        print(flush=True)
+
+
 class TIMER_:
     """Void timer.
     """
@@ -124,11 +301,14 @@ class TIMER_:
         pass
 
 
+def prtvar(name, var, fmt):
+    print(("  %-20s  :::  " % name) + fmt.format(var), flush=True)
+
+
 def check_mem(obj, thr=1E-3):
     """Only print items > thr [MB]
     """
     from pympler.asizeof import asizeof as asz
-    from frankenstein.tools.io_utils import prtvar
     prtvar("Object class", str(obj.__class__), "{:s}")
     hasdict = hasattr(obj, "__dict__")
     if hasdict:
@@ -0,0 +1,192 @@
+import itertools
+import numpy as np
+
+'''
+Symmetry of the vibrational Hamiltonian. An operation of an abelian point group maps every symmetry adapted
+normal coordinate q_i to q_i or -q_i, so it is given by the binary pattern x of the modes it flips. A term of
+the potential in which mode i appears with parity p_i is left unchanged only if sum_i x_i p_i = 0 mod 2, and
+the patterns allowed by every term form a group over GF(2). A configuration with quanta n has the irrep
+sum_i x_i n_i mod 2 under each generator x of that group, which H conserves, so that H is block diagonal in
+the irrep labels made of these bits. Degenerate normal modes have to be rotated to symmetry adapted ones by
+SymmetrizeModes before the potential is expanded in them.
+'''
+
+def NullSpaceGF2(Rows, N):
+    '''
+    Basis of the binary vectors x of length N with Rows @ x = 0 mod 2, as the rows of an array
+    '''
+    A = np.array(Rows, dtype = np.uint8).reshape(-1, N) % 2
+    Pivots = []
+    r = 0
+    for c in range(N):
+        if r >= A.shape[0]:
+            break
+        p = np.flatnonzero(A[r:, c])
+        if len(p) == 0:
+            continue
+        A[[r, r + p[0]]] = A[[r + p[0], r]]
+        Others = np.flatnonzero(A[:, c])
+        Others = Others[Others != r]
+        A[Others] ^= A[r]
+        Pivots.append(c)
+        r += 1
+    Free = [c for c in range(N) if c not in Pivots]
+    Basis = np.zeros((len(Free), N), dtype = np.uint8)
+    for k, f in enumerate(Free):
+        Basis[k, f] = 1
+        for i, c in enumerate(Pivots):
+            Basis[k, c] = A[i, f]
+    return Basis
+
+def ParityRowsQFF(PotentialList, N, tol = 1e-12):
+    '''
+    Parities of the modes in each force constant of PotentialList
+    '''
+    Rows = set()
+    for W in PotentialList:
+        if abs(W.fc) <= tol:
+            continue
+        Row = np.zeros(N, dtype = np.uint8)
+        for i in W.QIndices:
+            Row[i] ^= 1
+        Rows.add(tuple(Row))
+    return sorted(Rows)
+
+def ParityRowsNMode(ints, N, K, Order, Store = None, tol = 1e-6):
+    '''
+    Parities n_i + m_i of the modes in each n-mode integral <n|V|m> larger than tol, from dense integrals in
+    the layout of Molecule.ReadIntegralsAsArrays, which may be flattened, or from Store for the 3-mode and
+    higher blocks out of core. The parities are those of one-mode states, which are (-1)^n as long as the
+    one-mode potential is even, and any odd 1-mode integral rules out flipping that mode.
+    '''
+    Rows = set()
+    for k in range(1, Order + 1):
+        # Bit a of Code is the parity of n_a + m_a for the element (n_1 .. n_k, m_1 .. m_k) of a block
+        Code = np.zeros((K,) * (2 * k), dtype = int)
+        for a in range(k):
+            Shape = [1] * (2 * k)
+            Shape[a] = K
+            n = np.arange(K).reshape(Shape)
+            Shape[a], Shape[k + a] = 1, K
+            m = np.arange(K).reshape(Shape)
+            Code = Code + (((n + m) % 2) << a)
+        if k >= 3 and Store is not None:
+            Blocks = ((Modes, Store.block(Modes)) for Modes in itertools.combinations(range(N), k))
+        else:
+            Vk = ints[k - 1].reshape((N,) * k + (K,) * (2 * k))
+            Blocks = ((Modes, Vk[Modes]) for Modes in itertools.combinations(range(N), k))
+        for Modes, V in Blocks:
+            for c in np.unique(Code[abs(V.reshape(Code.shape)) > tol]):
+                if c == 0:
+                    continue
+                Row = np.zeros(N, dtype = np.uint8)
+                for a in range(k):
+                    Row[Modes[a]] = (c >> a) & 1
+                Rows.add(tuple(Row))
+    return sorted(Rows)
+
+def IrrepLabels(Q, Generators):
+    '''
+    Irrep labels of the configurations with quanta Q (NBasis, N). Bit g of a label is the parity of the
+    configuration under generator g.
+    '''
+    if Q.shape[0] == 0 or Generators.shape[0] == 0:
+        return np.zeros(Q.shape[0], dtype = int)
+    Bits = (Q @ Generators.T.astype(int)) % 2
+    return Bits @ (1 << np.arange(Generators.shape[0]))
+
+def _AtomPermutation(xc, mass, R, tol):
+    y = xc @ R.T
+    Perm = np.empty(xc.shape[0], dtype = int)
+    for a in range(xc.shape[0]):
+        d = np.linalg.norm(xc - y[a], axis = 1)
+        b = np.argmin(d)
+        if d[b] > tol or not np.isclose(mass[b], mass[a]):
+            return None
+        Perm[a] = b
+    if len(set(Perm)) != len(Perm):
+        return None
+    return Perm
+
+def SymmetryOperations(x, mass, tol = 1e-2):
+    '''
+    Operations of the largest subgroup of D2h the geometry x (natoms, 3) in bohr has, not counting the
+    identity, as tuples of a name, the 3x3 matrix R and the atom Perm[a] that atom a is sent to. C2 axes
+    and mirror planes are searched for along the principal axes, the atoms, and the sums, differences and
+    normals of pairs of equivalent atoms.
+    '''
+    mass = np.asarray(mass, dtype = float)
+    xc = x - mass @ x / mass.sum()
+    I = np.eye(3) * np.einsum('a,ax,ax->', mass, xc, xc) - np.einsum('a,ax,ay->xy', mass, xc, xc)
+    Candidates = list(np.linalg.eigh(I)[1].T) + list(xc)
+    for a, b in itertools.combinations(range(xc.shape[0]), 2):
+        if np.isclose(mass[a], mass[b]):
+            Candidates += [xc[a] + xc[b], xc[a] - xc[b], np.cross(xc[a], xc[b])]
+    Axes = []
+    for u in Candidates:
+        if np.linalg.norm(u) < tol:
+            continue
+        u = u / np.linalg.norm(u)
+        if all(abs(u @ v) < 1 - 1e-6 for v in Axes):
+            Axes.append(u)
+
+    def Operations(Frame):
+        Ops = []
+        for u in Frame:
+            for Name, R in [("C2", 2 * np.outer(u, u) - np.eye(3)), ("sigma", np.eye(3) - 2 * np.outer(u, u))]:
+                Perm = _AtomPermutation(xc, mass, R, tol)
+                if Perm is not None:
+                    Ops.append(("%s (%.4f, %.4f, %.4f)" % ((Name,) + tuple(u)), R, Perm))
+        Perm = _AtomPermutation(xc, mass, -np.eye(3), tol)
+        if Perm is not None:
+            Ops.append(("i", -np.eye(3), Perm))
+        return Ops
+
+    Valid = [u for u in Axes if len(Operations([u])) > len(Operations([]))]
+    Best = Operations([])
+    for u in Valid:
+        Ops = Operations([u])
+        if len(Ops) > len(Best):
+            Best = Ops
+    for u, v in itertools.combinations(Valid, 2):
+        if abs(u @ v) < 1e-6:
+            Ops = Operations([u, v, np.cross(u, v)])
+            if len(Ops) > len(Best):
+                Best = Ops
+    return Best
+
+def ModeRepresentation(nm_coeff, R, Perm):
+    '''
+    Matrix of an operation in the basis of the orthonormal mass weighted normal modes nm_coeff (natoms, 3, Nm)
+    '''
+    T = np.zeros_like(nm_coeff)
+    T[Perm] = np.einsum('xy,ayk->axk', R, nm_coeff)
+    return np.einsum('axk,axl->kl', nm_coeff, T)
+
+def SymmetrizeModes(x, mass, nm_coeff, freqs, tol = 1e-2, DegTol = 1e-7):
+    '''
+    Rotates each set of normal modes whose frequencies (au) agree to DegTol so that every operation from
+    SymmetryOperations maps each mode to plus or minus itself. Returns the new nm_coeff, the operations and
+    the characters of the modes under them (Nm, NOps).
+    '''
+    Ops = SymmetryOperations(x, mass, tol = tol)
+    nm_coeff = nm_coeff.copy()
+    Order = np.argsort(freqs)
+    Sets = [[Order[0]]]
+    for i, j in zip(Order[:-1], Order[1:]):
+        if freqs[j] - freqs[i] < DegTol:
+            Sets[-1].append(j)
+        else:
+            Sets.append([j])
+    for S in Sets:
+        if len(S) == 1 or len(Ops) == 0:
+            continue
+        # The operations commute and square to one, so a combination that tells apart every pattern of their
+        # characters is diagonal only in the symmetry adapted modes
+        M = sum(2.0**k * ModeRepresentation(nm_coeff[:, :, S], R, Perm) for k, (_, R, Perm) in enumerate(Ops))
+        U = np.linalg.eigh(0.5 * (M + M.T))[1]
+        nm_coeff[:, :, S] = np.einsum('axk,kl->axl', nm_coeff[:, :, S], U)
+    Characters = np.zeros((nm_coeff.shape[2], len(Ops)))
+    for k, (_, R, Perm) in enumerate(Ops):
+        Characters[:, k] = np.diag(ModeRepresentation(nm_coeff, R, Perm))
+    return nm_coeff, Ops, Characters
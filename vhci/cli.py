@@ -1,18 +1,285 @@
-"""Console script for vhci."""
-import argparse
+"""Console script for vhci. Runs VHCI and VSCF over a sweep of parameters on a local pool of processes
+and writes every result to one CSV file with a row per state.
+
+    vstr C2H4.inp --eps1 1.0 0.5 0.1 --MaxTotalQuanta 3 4 --pt2 --jobs 4 --threads 2 --out c2h4.csv
+    vstr ints.h5 --sweep sweep.json --set HBMethod='"2mode"' --jobs 2 --log-dir logs
+
+Inputs ending in .h5 or .hdf5 are integral files written by Molecule.SaveIntegrals and are run with
+NModeVHCI and NModeVSCF, anything else is read as a JF input. A sweep file is a JSON dictionary whose
+keys in SWEEP_KEYS hold the lists of values to sweep over, any other key is passed to every job as a
+keyword argument of the VHCI object, as are the --set options.
+"""
+import os
 import sys
+import csv
+import copy
+import json
+import time
+import argparse
+import itertools
+import contextlib
+import multiprocessing
+import numpy as np
+
+SWEEP_KEYS = ["method", "eps1", "eps2", "MaxTotalQuanta", "NStates"]
+COLUMNS = ["job", "input"] + SWEEP_KEYS + ["state", "E_var", "E_PT2", "NBasis", "time", "error"]
+THREAD_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+MOL_KEYS = ["Order", "Storage", "MemoryBudget", "MemoryCheck", "IntsCacheSize", "IntsPrecision"]
+
+# Preprocessing of the input of the last job a worker ran, which the following jobs on the same input reuse
+_CACHE = dict()
+
+def IsIntegralFile(Input):
+    return os.path.splitext(Input)[1].lower() in [".h5", ".hdf5"]
+
+def MakeJobs(Inputs, Sweep):
+    '''
+    Every combination of the swept values for every input. Values not in Sweep are taken from the JF
+    input, or from the defaults of NModeVHCI for integral files. VSCF does not depend on the swept
+    values and is run once per input. Jobs on the same input are kept together, VSCF first since
+    NModeVHCI flattens the integrals it is given, and then the most expensive first so that the pool
+    finishes evenly.
+    '''
+    Jobs = []
+    for Input in Inputs:
+        Seen = set()
+        for Values in itertools.product(*[Sweep.get(k, [None]) for k in SWEEP_KEYS]):
+            Job = dict(zip(SWEEP_KEYS, Values))
+            if Job["method"] is None:
+                Job["method"] = "vhci"
+            if Job["method"] not in ["vhci", "vscf"]:
+                raise ValueError("Unknown method %s, use vhci or vscf" % Job["method"])
+            if Job["method"] == "vscf":
+                Job.update(eps1 = None, eps2 = None, MaxTotalQuanta = None, NStates = None)
+            Key = tuple(Job[k] for k in SWEEP_KEYS)
+            if Key in Seen:
+                continue
+            Seen.add(Key)
+            Job["input"] = Input
+            Jobs.append(Job)
+    Cost = lambda J: (Inputs.index(J["input"]), J["method"] != "vscf", -(J["MaxTotalQuanta"] or 0), J["eps1"] or 0.0)
+    Jobs.sort(key = Cost)
+    for i, Job in enumerate(Jobs):
+        Job["job"] = i
+    return Jobs
+
+def LoadJF(Input):
+    '''
+    VHCI built from a JF input, with its sorted force constants and anharmonic tensors, which every
+    job on the input copies
+    '''
+    if Input not in _CACHE:
+        from vstr.utils.read_jf_input import Read
+        from vstr.vhci.vhci import VHCI
+        _CACHE.clear()
+        w, MaxQuanta, MaxTotalQuanta, Vs, eps1, eps2, eps3, NWalkers, NSamples, NStates = Read(Input)
+        mVHCI = VHCI(np.asarray(w), Vs, MaxQuanta = MaxQuanta, MaxTotalQuanta = MaxTotalQuanta, eps1 = eps1, eps2 = eps2, eps3 = eps3, NWalkers = NWalkers, NSamples = NSamples, NStates = NStates)
+        mVHCI.Ys = [mVHCI.MakeAnharmTensor()] * mVHCI.NModes
+        _CACHE[Input] = {"vhci": mVHCI, "w": np.asarray(w), "V": Vs, "MaxQuanta": MaxQuanta}
+    return _CACHE[Input]
+
+def LoadIntegrals(Input, Options):
+    '''
+    Molecule holding the integrals of a file written by Molecule.SaveIntegrals. The order and number of
+    grid points are those of the file unless Order is given in Options.
+    '''
+    if Input not in _CACHE:
+        import h5py
+        from vstr.nmode.mol import Molecule
+        _CACHE.clear()
+        with h5py.File(Input, "r") as f:
+            natoms = f["x0"].shape[0]
+            Order = len(f["ints"])
+            ngridpts = f["ints/1/1"].shape[0]
+        Kwargs = dict(Order = Order)
+        Kwargs.update({k: v for k, v in Options.items() if k in MOL_KEYS})
+        mol = Molecule(None, natoms, [], ngridpts = ngridpts, IntsFile = Input, ReadGeom = True, ReadInt = True, doShiftPotential = False, **Kwargs)
+        mol.kernel()
+        _CACHE[Input] = {"mol": mol, "Sorted": dict()}
+    return _CACHE[Input]
 
+def FromTemplate(Template, **kwargs):
+    '''
+    Copy of a VHCI that has not run, sharing its potential, with the state changed by kernel reset
+    '''
+    from vstr.utils.perf_utils import PROFILER
+    mVHCI = copy.copy(Template)
+    mVHCI.NStatesPT2 = kwargs.get("NStates", Template.NStates)
+    mVHCI.__dict__.update(kwargs)
+    mVHCI._HighestQuanta = [mVHCI.MaxTotalQuanta] * mVHCI.NModes
+    mVHCI.PT2Cache = dict()
+    mVHCI.Timer = PROFILER(mVHCI.TimerNames, name = "VHCI")
+    return mVHCI
+
+def RunVHCI(Job, Options, doPT2):
+    Params = {k: Job[k] for k in ["eps1", "eps2", "MaxTotalQuanta", "NStates"] if Job[k] is not None}
+    if IsIntegralFile(Job["input"]):
+        from vstr.vhci.vhci import NModeVHCI
+        Cache = LoadIntegrals(Job["input"], Options)
+        Kwargs = dict(HBMethod = "2mode")
+        Kwargs.update({k: v for k, v in Options.items() if k != "Order"})
+        Kwargs.update(Cache["Sorted"])
+        Kwargs.update(Params)
+        mVHCI = NModeVHCI(Cache["mol"], **Kwargs)
+        mVHCI.kernel(doPT2 = doPT2)
+        for k in ["Sorted2Mode", "Sorted3Mode", "Max3Mode"]:
+            if getattr(mVHCI, k) is not None:
+                Cache["Sorted"][k] = getattr(mVHCI, k)
+    else:
+        Params.update(Options)
+        mVHCI = FromTemplate(LoadJF(Job["input"])["vhci"], **Params)
+        mVHCI.kernel(doPT2 = doPT2)
+    for k in ["eps1", "eps2", "MaxTotalQuanta", "NStates"]:
+        Job[k] = getattr(mVHCI, k)
+    EPT2 = mVHCI.E_HCI_PT2 if doPT2 else [None] * len(mVHCI.E_HCI)
+    return [{"state": n, "E_var": E, "E_PT2": EPT2[n] if n < len(EPT2) else None, "NBasis": len(mVHCI.Basis)} for n, E in enumerate(mVHCI.E_HCI)]
+
+def RunVSCF(Job, Options):
+    if IsIntegralFile(Job["input"]):
+        from vstr.mf.vscf import NModeVSCF
+        mVSCF = NModeVSCF(LoadIntegrals(Job["input"], Options)["mol"], verbose = 0)
+    else:
+        from vstr.mf.vscf import VSCF
+        Cache = LoadJF(Job["input"])
+        mVSCF = VSCF(Cache["w"], Cache["V"], MaxQuanta = Cache["MaxQuanta"], verbose = 0)
+    return [{"state": 0, "E_var": mVSCF.kernel(), "E_PT2": None, "NBasis": None}]
+
+def _FlushC():
+    try:
+        import ctypes
+        ctypes.CDLL(None).fflush(None)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+@contextlib.contextmanager
+def RedirectOutput(FileName):
+    '''
+    Sends everything written to the stdout and stderr file descriptors inside the context to FileName,
+    including the output of the C++ kernels, which bypasses sys.stdout
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    Saved = [os.dup(1), os.dup(2)]
+    try:
+        with open(FileName, "w") as f:
+            os.dup2(f.fileno(), 1)
+            os.dup2(f.fileno(), 2)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                _FlushC()
+                os.dup2(Saved[0], 1)
+                os.dup2(Saved[1], 2)
+    finally:
+        os.close(Saved[0])
+        os.close(Saved[1])
+
+def RunJob(Job, Options, doPT2 = False, LogDir = None):
+    '''
+    Runs one job in this process and returns its rows of the results file. Errors are recorded in the
+    rows instead of stopping the sweep.
+    '''
+    Job = dict(Job)
+    LogFile = os.devnull if LogDir is None else os.path.join(LogDir, "job%04d.log" % Job["job"])
+    t0 = time.perf_counter()
+    try:
+        with RedirectOutput(LogFile):
+            if Job["method"] == "vscf":
+                Rows = RunVSCF(Job, Options)
+            else:
+                Rows = RunVHCI(Job, Options, doPT2)
+        Error = None
+    except Exception as e:
+        Rows = [{"state": None, "E_var": None, "E_PT2": None, "NBasis": None}]
+        Error = "%s: %s" % (type(e).__name__, e)
+    Time = time.perf_counter() - t0
+    return [dict(Job, time = Time, error = Error, **Row) for Row in Rows]
+
+def _RunJobWorker(Args):
+    return RunJob(*Args)
+
+@contextlib.contextmanager
+def ThreadLimit(NThreads):
+    '''
+    Limits the OpenMP and BLAS threads of the processes started inside the context
+    '''
+    Old = {v: os.environ.get(v) for v in THREAD_VARS}
+    for v in THREAD_VARS:
+        os.environ[v] = str(NThreads)
+    try:
+        yield
+    finally:
+        for v, x in Old.items():
+            if x is None:
+                del os.environ[v]
+            else:
+                os.environ[v] = x
+
+def RunSweep(Inputs, Sweep, Options = dict(), doPT2 = False, NJobs = 1, NThreads = None, OutFile = "results.csv", LogDir = None):
+    '''
+    Runs every job of the sweep on a pool of NJobs processes of NThreads threads each and appends the
+    results to OutFile as they finish. Returns the number of failed jobs.
+    '''
+    Jobs = MakeJobs(Inputs, Sweep)
+    if NThreads is None:
+        NThreads = max(1, (os.cpu_count() or 1) // NJobs)
+    if LogDir is not None:
+        os.makedirs(LogDir, exist_ok = True)
+    print("Running %d jobs on %d processes with %d threads each" % (len(Jobs), NJobs, NThreads), flush = True)
+    NFail = 0
+    ctx = multiprocessing.get_context("spawn")
+    with open(OutFile, "w", newline = "") as f, ThreadLimit(NThreads), ctx.Pool(NJobs) as pool:
+        Writer = csv.DictWriter(f, fieldnames = COLUMNS)
+        Writer.writeheader()
+        for Rows in pool.imap_unordered(_RunJobWorker, [(Job, Options, doPT2, LogDir) for Job in Jobs]):
+            Writer.writerows(Rows)
+            f.flush()
+            Job = Rows[0]
+            Status = "%.3f s" % Job["time"] if Job["error"] is None else "failed with " + Job["error"]
+            print("  job %d (%s %s) %s" % (Job["job"], Job["method"], os.path.basename(Job["input"]), Status), flush = True)
+            NFail += Job["error"] is not None
+    print("Results written to", OutFile, flush = True)
+    return NFail
 
 def main():
     """Console script for vhci."""
-    parser = argparse.ArgumentParser()
-    parser.add_argument('_', nargs='*')
+    parser = argparse.ArgumentParser(prog = "vstr", description = "Runs VHCI and VSCF over a sweep of parameters")
+    parser.add_argument("inputs", nargs = "+", help = "JF inputs or integral files (.h5)")
+    parser.add_argument("--sweep", default = None, help = "JSON file with the values to sweep over and the options of every job")
+    parser.add_argument("--method", nargs = "*", choices = ["vhci", "vscf"])
+    parser.add_argument("--eps1", nargs = "*", type = float)
+    parser.add_argument("--eps2", nargs = "*", type = float)
+    parser.add_argument("--MaxTotalQuanta", nargs = "*", type = int)
+    parser.add_argument("--NStates", nargs = "*", type = int)
+    parser.add_argument("--set", nargs = "*", default = [], metavar = "KEY=VALUE", help = "options of every job, values are parsed as JSON")
+    parser.add_argument("--pt2", action = "store_true", help = "add the deterministic PT2 correction")
+    parser.add_argument("--jobs", type = int, default = 1, help = "number of jobs run at once")
+    parser.add_argument("--threads", type = int, default = None, help = "threads per job, the cores divided between the jobs by default")
+    parser.add_argument("--out", default = "results.csv", help = "CSV file for the results")
+    parser.add_argument("--log-dir", default = None, help = "directory for the output of every job, which is discarded otherwise")
     args = parser.parse_args()
 
-    print("Arguments: " + str(args._))
-    print("Replace this message by putting your code into "
-          "vhci.cli.main")
-    return 0
+    Sweep = dict()
+    Options = dict()
+    if args.sweep is not None:
+        with open(args.sweep, "r") as f:
+            for k, v in json.load(f).items():
+                if k in SWEEP_KEYS:
+                    Sweep[k] = v if isinstance(v, list) else [v]
+                else:
+                    Options[k] = v
+    for k in SWEEP_KEYS:
+        if getattr(args, k) is not None:
+            Sweep[k] = getattr(args, k)
+    for kv in args.set:
+        k, v = kv.split("=", 1)
+        Options[k] = json.loads(v)
+
+    Inputs = list(dict.fromkeys(os.path.abspath(i) for i in args.inputs))
+    NFail = RunSweep(Inputs, Sweep, Options = Options, doPT2 = args.pt2, NJobs = args.jobs, NThreads = args.threads, OutFile = args.out, LogDir = args.log_dir)
+    return 1 if NFail > 0 else 0
 
 
 if __name__ == "__main__":
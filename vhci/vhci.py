@@ -1,14 +1,15 @@
 import numpy as np
 from vstr.utils import init_funcs
-from vstr.utils.perf_utils import TIMER
+from vstr.utils.perf_utils import PROFILER
+from vstr.utils.memory_utils import GB, PlanMemory, PrintMemoryPlan, CheckMemory, ScreenedFraction
 from vstr.utils import constants
+from vstr.utils.symmetry_utils import NullSpaceGF2, ParityRowsQFF, ParityRowsNMode, IrrepLabels
 from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import WaveFunction, FConst, HOFunc # classes from JF's code
-from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import GenerateHamV, GenerateSparseHamV, GenerateSparseHamVOD, GenerateHamAnharmV, AddStatesHB, AddStatesHBWithMax, AddStatesHBFromVSCF, HeatBath_Sort_FC, DoPT2, DoSPT2, AddStatesHBStoreCoupling, VCISparseHamNMode, VCISparseHamNModeFromOM, VCISparseHamNModeFromOMArray, ConnectedStatesCIPSI, AddStatesCIPSI, AddStatesHB2Mode, AddStatesHB2ModeArray, VCISparseT
+from vstr.cpp_wrappers.vhci_jf.vhci_jf_functions import GenerateHamV, GenerateSparseHamV, GenerateSparseHamVOD, GenerateHamAnharmV, AddStatesHB, AddStatesHBWithMax, AddStatesHBFromVSCF, HeatBath_Sort_FC, DoPT2Batched, DoSPT2, DoSPT2Adaptive, AddStatesHBStoreCoupling, VCISparseHamNMode, VCISparseHamNModeFromOM, VCISparseHamNModeFromOMArray, ConnectedStatesCIPSI, AddStatesCIPSI, AddStatesCIPSIStreamArray, AddStatesHB2Mode, AddStatesHB2ModeArray, AddStatesHB3ModeArray, DoPT2NModeArray, VCISparseT
 from functools import reduce
 import itertools
 import math
 from scipy import sparse
-import numdifftools as nd
 
 def ReadBasisFromFile(mVHCI, FileName):
     mVHCI.Basis = []
@@ -121,27 +122,42 @@ def ScreenBasis(mVHCI, Ws = None, ints2 = None, ints2sorted = None, C = None, ep
         except:
             ints2sorted = None
 
+    MCR = -1 if mVHCI.MaxExcitedModes is None else mVHCI.MaxExcitedModes # < 0 means no limit in the kernels
+
     if mVHCI.HBMethod == 'orig':
-        UniqueBasis = AddStatesHB(mVHCI.Basis, Ws, C, eps)
+        UniqueBasis = AddStatesHB(mVHCI.Basis, Ws, C, eps, MCR)
     elif mVHCI.HBMethod == 'max':
-        UniqueBasis = AddStatesHBWithMax(mVHCI.Basis, Ws, C, eps, mVHCI.MaxQuanta, mVHCI.HighestQuanta)
+        UniqueBasis = AddStatesHBWithMax(mVHCI.Basis, Ws, C, eps, mVHCI.MaxQuanta, mVHCI.HighestQuanta, MCR)
     elif mVHCI.HBMethod == 'exact' or mVHCI.HBMethod.upper() == 'QFF':
-        UniqueBasis = AddStatesHBFromVSCF(mVHCI.Basis, Ws, C, eps, mVHCI.Ys)
+        UniqueBasis = AddStatesHBFromVSCF(mVHCI.Basis, Ws, C, eps, mVHCI.Ys, MCR)
     elif mVHCI.HBMethod == 'coupling':
-        UniqueBasis = AddStatesHBStoreCoupling(mVHCI.Basis, Ws, C, eps, mVHCI.Ys)
+        UniqueBasis = AddStatesHBStoreCoupling(mVHCI.Basis, Ws, C, eps, mVHCI.Ys, MCR)
         return UniqueBasis, len(UniqueBasis[0])
     elif mVHCI.HBMethod.upper() == '2MODE':
-        UniqueBasis = AddStatesHB2ModeArray(mVHCI.Basis, ints2, ints2sorted, C, eps, True, mVHCI.N, mVHCI.K) 
+        if mVHCI.mol.Order >= 3 and mVHCI.Storage == 'ooc' and mVHCI.Use3ModeHB:
+            UniqueBasis = AddStatesHB3ModeOOC(mVHCI.Basis, ints2, ints2sorted, mVHCI.mol.IntsStore, C, eps, True, mVHCI.N, mVHCI.K, MCR)
+        elif mVHCI.mol.Order >= 3 and mVHCI.Sorted3Mode is not None:
+            UniqueBasis = AddStatesHB3ModeArray(mVHCI.Basis, ints2, ints2sorted, mVHCI.mol.ints[2], mVHCI.Sorted3Mode, mVHCI.Max3Mode, C, eps, True, mVHCI.N, mVHCI.K, MCR)
+        else:
+            UniqueBasis = AddStatesHB2ModeArray(mVHCI.Basis, ints2, ints2sorted, C, eps, True, mVHCI.N, mVHCI.K, MCR)
     elif mVHCI.HBMethod.upper() == 'CIPSI':
-        ConnectedBasis = ConnectedStatesCIPSI(mVHCI.Basis, mVHCI.MaxQuanta, mVHCI.mol.Order)
-        UniqueBasis = AddStatesCIPSI(mVHCI.Basis, ConnectedBasis, C, mVHCI.E, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0], mVHCI.mol.ints[1], mVHCI.mol.ints[2], eps)
+        if mVHCI.mol.use_onemode_states:
+            UniqueBasis = AddStatesCIPSIStreamArray(mVHCI.Basis, mVHCI.MaxQuanta, mVHCI.mol.Order, C, mVHCI.E, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], eps, mVHCI.CIPSIMaxAdd, mVHCI.K, MCR)
+        else:
+            ConnectedBasis = ConnectedStatesCIPSI(mVHCI.Basis, mVHCI.MaxQuanta, mVHCI.mol.Order, MCR)
+            UniqueBasis = AddStatesCIPSI(mVHCI.Basis, ConnectedBasis, C, mVHCI.E, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0], mVHCI.mol.ints[1], mVHCI.mol.ints[2], eps)
 
     return UniqueBasis, len(UniqueBasis)
 
 def HCIStep(mVHCI, eps = 0.01):
     mVHCI.Timer.start(2)
     NewBasis, NAdded = mVHCI.ScreenBasis(Ws = mVHCI.PotentialListFull, C = abs(mVHCI.C[:, :mVHCI.NStates]).max(axis = 1), eps = eps)
+    if mVHCI.Symmetry and mVHCI.TargetIrreps is not None:
+        # H does not couple the target irreps to any other, so those configurations never enter
+        NewBasis = mVHCI.SelectIrreps(NewBasis)
+        NAdded = len(NewBasis)
     mVHCI.Basis += NewBasis
+    mVHCI.Timer.count("configurations added", NAdded)
     mVHCI.Timer.stop(2)
     return NAdded, NewBasis
 
@@ -162,21 +178,188 @@ def HCI(mVHCI):
     #mVHCI.H = None
     mVHCI.NewBasis = None
 
+def LinearExtrapolation(E_var, dE_PT2):
+    '''
+    Fits E_var = E_extrap + slope * dE_PT2 for each state over the stages of an eps1 schedule, both of shape
+    (stages, states), and returns the energies at dE_PT2 = 0 and the slopes
+    '''
+    E_var = np.asarray(E_var)
+    dE_PT2 = np.asarray(dE_PT2)
+    E_extrap = np.empty(E_var.shape[1])
+    Slope = np.empty(E_var.shape[1])
+    for n in range(E_var.shape[1]):
+        Slope[n], E_extrap[n] = np.polyfit(dE_PT2[:, n], E_var[:, n], 1)
+    return E_extrap, Slope
+
+def Continuation(mVHCI, doPT2 = False):
+    '''
+    Runs HCI down the descending eps1 values of eps1Schedule. Each stage grows the basis, Hamiltonian and
+    coefficients of the stage before, so that the whole schedule costs about as much as its last stage.
+    E_var and, with doPT2, the deterministic E_PT2 of every stage are kept in ScheduleResults, and with at
+    least two stages the variational energies are extrapolated linearly in dE_PT2 to dE_PT2 = 0.
+    '''
+    Schedule = sorted(mVHCI.eps1Schedule, reverse = True)
+    if doPT2:
+        assert(mVHCI.eps2 < Schedule[-1])
+    Results = {"eps1": [], "NBasis": [], "E_var": [], "E_PT2": []}
+    for eps1 in Schedule:
+        mVHCI.eps1 = eps1
+        mVHCI.HCI()
+        Results["eps1"].append(eps1)
+        Results["NBasis"].append(len(mVHCI.Basis))
+        Results["E_var"].append(mVHCI.E_HCI.copy())
+        if doPT2:
+            mVHCI.PT2(doStochastic = False)
+            Results["E_PT2"].append(mVHCI.E_HCI_PT2.copy())
+        print("eps1 stage", eps1, "complete with a basis of", len(mVHCI.Basis), flush = True)
+    for k in ["E_var", "E_PT2"]:
+        Results[k] = np.asarray(Results[k])
+    if doPT2 and len(Schedule) > 1:
+        NStates = Results["E_PT2"].shape[1]
+        Results["E_extrap"], Results["slope"] = LinearExtrapolation(Results["E_var"][:, :NStates], Results["E_PT2"] - Results["E_var"][:, :NStates])
+    mVHCI.ScheduleResults = Results
+    mVHCI.PrintSchedule()
+
+def PrintSchedule(mVHCI):
+    Results = mVHCI.ScheduleResults
+    print("===== eps1 SCHEDULE =====", flush = True)
+    for s, eps1 in enumerate(Results["eps1"]):
+        Outline = '{:.4E}\t{:d}'.format(eps1, Results["NBasis"][s])
+        for n in range(Results["E_var"].shape[1]):
+            Outline += '\t{:.8f}'.format(Results["E_var"][s, n])
+            if len(Results["E_PT2"]) > 0 and n < Results["E_PT2"].shape[1]:
+                Outline += ' ({:.8f})'.format(Results["E_PT2"][s, n])
+        print(Outline, flush = True)
+    if "E_extrap" in Results:
+        print("Extrapolated:\t" + '\t'.join('{:.8f}'.format(E) for E in Results["E_extrap"]), flush = True)
+    print("", flush = True)
+
+def PT2CacheKey(mVHCI, eps):
+    '''
+    Key of the PT2 correction at eps in PT2Cache. It holds a fingerprint of the basis and of the coefficients, so
+    a correction is never reused once either has changed, and entries with any other fingerprint are dropped.
+    '''
+    Fingerprint = hash((BasisToArray(mVHCI.Basis).tobytes(), np.ascontiguousarray(mVHCI.C[:, :mVHCI.NStatesPT2]).tobytes()))
+    for Key in [Key for Key in mVHCI.PT2Cache if Key[2] != Fingerprint]:
+        del mVHCI.PT2Cache[Key]
+    return (eps, mVHCI.NStatesPT2, Fingerprint)
+
+def DeterministicPT2(mVHCI, eps):
+    '''
+    Deterministic PT2 correction at eps, cached on the current basis so that the SPT2 and SSPT2 runs can share it
+    '''
+    Key = PT2CacheKey(mVHCI, eps)
+    if Key not in mVHCI.PT2Cache:
+        mVHCI.PT2Cache[Key] = np.asarray(DoPT2Batched(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, eps, mVHCI.NStatesPT2, mVHCI.PT2Batches, mVHCI.PT2MaxMem))
+    return mVHCI.PT2Cache[Key]
+
+def MakeSorted2Mode(mVHCI):
+    '''
+    Sorts the target occupations of each 2-mode integral block by magnitude for heat bath screening
+    '''
+    K = mVHCI.mol.ngridpts
+    ints2 = mVHCI.mol.ints[1].reshape(mVHCI.mol.Nm, mVHCI.mol.Nm, K, K, K, K) # kernel flattens the integrals
+    Sorted2Mode = np.empty((mVHCI.mol.Nm, mVHCI.mol.Nm, K, K, K**2, 2), dtype = np.int32)
+    for i in range(mVHCI.mol.Nm):
+        for j in range(mVHCI.mol.Nm):
+            for ni in range(K):
+                for nj in range(K):
+                    Sorted = np.argsort(-abs(ints2[i, j, ni, nj].reshape(-1)))
+                    Sorted = np.unravel_index(Sorted, (K, K))
+                    Sorted2Mode[i, j, ni, nj] = np.vstack((Sorted[0], Sorted[1])).T
+    mVHCI.Sorted2Mode = Sorted2Mode.ravel()
+
+def MakeSorted3Mode(mVHCI):
+    '''
+    Sorts the target occupations of each 3-mode integral block by magnitude, for mode triples i < j < k in
+    combination order, and stores the largest magnitude of each block for early exit during screening
+    '''
+    K = mVHCI.mol.ngridpts
+    Triples = list(itertools.combinations(range(mVHCI.mol.Nm), 3))
+    ints3 = mVHCI.mol.ints[2].reshape((mVHCI.mol.Nm,) * 3 + (K**3, K**3))
+    Sorted3Mode = np.empty((len(Triples), K**3, K**3), dtype = np.int32)
+    Max3Mode = np.empty((len(Triples), K**3))
+    for t, (i, j, k) in enumerate(Triples):
+        V = abs(ints3[i, j, k])
+        Sorted3Mode[t] = np.argsort(-V, axis = 1)
+        Max3Mode[t] = V.max(axis = 1)
+    mVHCI.Sorted3Mode = Sorted3Mode.ravel()
+    mVHCI.Max3Mode = Max3Mode.ravel()
+
+def DeterministicPT2NMode(mVHCI, eps):
+    '''
+    Epstein-Nesbet PT2 correction on the n-mode integrals, screened through Sorted2Mode
+    '''
+    if mVHCI.HBMethod.upper() == 'QFF':
+        return DeterministicPT2(mVHCI, eps)
+    assert(mVHCI.mol.use_onemode_states)
+    Key = PT2CacheKey(mVHCI, eps)
+    if Key not in mVHCI.PT2Cache:
+        mVHCI.PT2Cache[Key] = np.asarray(DoPT2NModeArray(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], mVHCI.Sorted2Mode, eps, mVHCI.NStatesPT2, mVHCI.mol.Order, mVHCI.N, mVHCI.K))
+    return mVHCI.PT2Cache[Key]
+
+def CheckMemoryNMode(mVHCI, doPT2 = False):
+    '''
+    Plans the memory of the run before the heat bath indices and the Hamiltonian are allocated, screening
+    the estimates of the variational and PT2 spaces with the 2-mode integrals when they are dense
+    '''
+    Density = None
+    ints2 = mVHCI.mol.ints[1] if mVHCI.mol.Order >= 2 else None
+    if isinstance(ints2, np.ndarray) and ints2.dtype.kind == 'f':
+        Density = lambda eps: ScreenedFraction(ints2, eps)
+    Budget = None if mVHCI.MemoryBudget is None else mVHCI.MemoryBudget * GB
+    Layouts = ['dense', 'ooc'] if mVHCI.mol.IntsStore is not None else ['dense']
+    CacheSize = mVHCI.mol.IntsStore.CacheBytes / GB if 'ooc' in Layouts else 1.0
+    eps1 = mVHCI.eps1 if mVHCI.eps1Schedule is None else min(mVHCI.eps1Schedule)
+    mVHCI.MemoryPlan = PlanMemory(mVHCI.NModes, mVHCI.mol.ngridpts, mVHCI.mol.Order, NStates = mVHCI.NStates, MaxTotalQuanta = mVHCI.MaxTotalQuanta, eps1 = eps1, eps2 = mVHCI.eps2, HBMethod = mVHCI.HBMethod, Use3ModeHB = mVHCI.Use3ModeHB, doPT2 = doPT2, Density = Density, Storage = mVHCI.Storage, Layouts = Layouts, CacheSize = CacheSize, Precision = mVHCI.mol.IntsPrecision, Budget = Budget, Allocated = ['Integrals'])
+    mVHCI.Storage = mVHCI.MemoryPlan['Storage']
+    if mVHCI.PrintMemory:
+        PrintMemoryPlan(mVHCI.MemoryPlan)
+    if mVHCI.Storage == 'ooc':
+        if mVHCI.mol.IntsStore is None:
+            raise ValueError("Storage = 'ooc' needs the integrals on disk, read them with Molecule.Storage = 'ooc'")
+        if mVHCI.HBMethod.upper() == 'CIPSI' or (doPT2 and mVHCI.HBMethod.upper() != 'QFF'):
+            raise ValueError("CIPSI screening and n-mode PT2 need the dense integrals, use HBMethod = '2mode' or 'qff' with Storage = 'ooc'")
+    return CheckMemory(mVHCI.MemoryPlan, Mode = mVHCI.MemoryCheck)
+
+def AdaptiveSPT2(mVHCI, SemiStochastic = False):
+    '''
+    Draws seeded SPT2 samples in batches of SPT2Batch until the standard error of every root is below SPT2Tol,
+    or NSamples samples are drawn. For SSPT2, the deterministic part at eps2 is taken from DeterministicPT2.
+    Without SPT2Seed a fresh seed is drawn, it is kept in SPT2SeedUsed so the run can be repeated.
+    '''
+    Seed = mVHCI.SPT2Seed
+    if Seed is None:
+        Seed = np.random.SeedSequence().entropy % 2**32
+    mVHCI.SPT2SeedUsed = int(Seed)
+    dE, sE, mVHCI.NSamplesPT2 = DoSPT2Adaptive(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2, mVHCI.NWalkers, mVHCI.SPT2Batch, mVHCI.NSamples, mVHCI.SPT2Tol, int(Seed), SemiStochastic, mVHCI.eps3)
+    dE = np.asarray(dE)
+    if SemiStochastic:
+        dE = dE + DeterministicPT2(mVHCI, mVHCI.eps2)
+    print("SPT2 samples drawn per state:", mVHCI.NSamplesPT2, "with seed", Seed, flush = True)
+    return dE, np.asarray(sE)
+
 def PT2(mVHCI, doStochastic = False):
     assert(mVHCI.eps2 < mVHCI.eps1)
     if doStochastic:
         if mVHCI.eps3 < 0:
             mVHCI.Timer.start(4)
-            mVHCI.dE_PT2, mVHCI.sE_PT2 = DoSPT2(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2, mVHCI.NWalkers, mVHCI.NSamples, False, mVHCI.eps3)
+            if mVHCI.SPT2Tol is not None:
+                mVHCI.dE_PT2, mVHCI.sE_PT2 = mVHCI.AdaptiveSPT2(SemiStochastic = False)
+            else:
+                mVHCI.dE_PT2, mVHCI.sE_PT2 = DoSPT2(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2, mVHCI.NWalkers, mVHCI.NSamples, False, mVHCI.eps3)
             mVHCI.Timer.stop(4)
         else:
             mVHCI.Timer.start(5)
             assert (mVHCI.eps3 < mVHCI.eps2)
-            mVHCI.dE_PT2, mVHCI.sE_PT2 = DoSPT2(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2, mVHCI.NWalkers, mVHCI.NSamples, True, mVHCI.eps3)
+            if mVHCI.SPT2Tol is not None:
+                mVHCI.dE_PT2, mVHCI.sE_PT2 = mVHCI.AdaptiveSPT2(SemiStochastic = True)
+            else:
+                mVHCI.dE_PT2, mVHCI.sE_PT2 = DoSPT2(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2, mVHCI.NWalkers, mVHCI.NSamples, True, mVHCI.eps3)
             mVHCI.Timer.stop(5)
     else:
         mVHCI.Timer.start(3)
-        mVHCI.dE_PT2 = DoPT2(mVHCI.C, mVHCI.E, mVHCI.Basis, mVHCI.PotentialListFull, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3], mVHCI.Ys, mVHCI.eps2, mVHCI.NStatesPT2)
+        mVHCI.dE_PT2 = mVHCI.DeterministicPT2(mVHCI.eps2)
         mVHCI.Timer.stop(3)
     mVHCI.E_HCI_PT2 = mVHCI.E_HCI[:mVHCI.NStatesPT2] + mVHCI.dE_PT2
 
@@ -189,21 +372,186 @@ def Diagonalize(mVHCI):
     mVHCI.Timer.stop(0)
     mVHCI.E_HCI = mVHCI.E[:mVHCI.NStates].copy()
 
-def SparseDiagonalize(mVHCI):
-    mVHCI.Timer.start(1)
+def CountHamiltonian(mVHCI, HOld):
+    '''
+    Counts the matrix elements kept when H is built or extended from HOld
+    '''
+    if isinstance(mVHCI.H, sparse.linalg.LinearOperator):
+        return
+    NNZOld = 0
+    if HOld is not None and not isinstance(HOld, sparse.linalg.LinearOperator):
+        NNZOld = HOld.nnz
+    mVHCI.Timer.count("matrix elements kept", mVHCI.H.nnz - NNZOld)
+
+def DetectSymmetry(mVHCI):
+    '''
+    Finds the sign symmetries of the force field, see utils.symmetry_utils
+    '''
+    Rows = ParityRowsQFF(mVHCI.PotentialList, mVHCI.NModes)
+    mVHCI.SymGenerators = NullSpaceGF2(Rows, mVHCI.NModes)
+    PrintSymmetry(mVHCI)
+
+def DetectSymmetryNMode(mVHCI):
+    '''
+    Finds the sign symmetries of the n-mode integrals, which make the Hamiltonian whatever HBMethod is
+    '''
+    Store = mVHCI.mol.IntsStore if mVHCI.Storage == 'ooc' else None
+    Rows = ParityRowsNMode(mVHCI.mol.ints, mVHCI.N, mVHCI.K, mVHCI.mol.Order, Store = Store, tol = mVHCI.SymmetryTol)
+    mVHCI.SymGenerators = NullSpaceGF2(Rows, mVHCI.N)
+    PrintSymmetry(mVHCI)
+
+def PrintSymmetry(mVHCI):
+    print("Found", mVHCI.SymGenerators.shape[0], "symmetry generators and", 2**mVHCI.SymGenerators.shape[0], "irreps", flush = True)
+    for g, G in enumerate(mVHCI.SymGenerators):
+        print("  Generator", g, "flips modes", np.flatnonzero(G).tolist(), flush = True)
+
+def InitSymmetry(mVHCI):
+    '''
+    Detects the symmetry unless SymGenerators is given and drops the configurations of the initial basis
+    outside TargetIrreps
+    '''
+    if not mVHCI.Symmetry:
+        return
+    if mVHCI.SymGenerators is None:
+        mVHCI.DetectSymmetry()
+    mVHCI._BasisIrreps = None
+    if not mVHCI.ReadFromFile:
+        mVHCI.Basis = mVHCI.SelectIrreps(mVHCI.Basis)
+    if len(mVHCI.Basis) == 0:
+        raise ValueError("The initial basis has no configurations in the irreps %s" % (mVHCI.TargetIrreps))
+
+def Irreps(mVHCI, Basis):
+    '''
+    Irrep labels of the configurations in Basis, bit g being the parity under generator g
+    '''
+    return IrrepLabels(BasisToArray(Basis), mVHCI.SymGenerators)
+
+def BasisIrreps(mVHCI):
+    '''
+    Irrep labels of mVHCI.Basis, only labelling the configurations added since the last call
+    '''
+    if mVHCI._IrrepBasis is not mVHCI.Basis or mVHCI._BasisIrreps is None or len(mVHCI._BasisIrreps) > len(mVHCI.Basis):
+        mVHCI._IrrepBasis = mVHCI.Basis
+        mVHCI._BasisIrreps = np.zeros(0, dtype = int)
+    NOld = len(mVHCI._BasisIrreps)
+    if NOld < len(mVHCI.Basis):
+        mVHCI._BasisIrreps = np.concatenate((mVHCI._BasisIrreps, mVHCI.Irreps(mVHCI.Basis[NOld:])))
+    return mVHCI._BasisIrreps
+
+def SelectIrreps(mVHCI, Basis):
+    '''
+    Configurations of Basis in TargetIrreps
+    '''
+    if mVHCI.TargetIrreps is None or len(Basis) == 0:
+        return Basis
+    Keep = np.isin(mVHCI.Irreps(Basis), mVHCI.TargetIrreps)
+    return [B for B, k in zip(Basis, Keep) if k]
+
+def ExtendHamiltonian(mVHCI, Extend):
+    '''
+    Builds mVHCI.H for the whole basis, or extends it by mVHCI.NewBasis. Extend(Old, New) returns the
+    coupling of the configurations Old to New, None if Old is empty, and the block of New with itself.
+    With Symmetry, Extend is called once for each irrep of the new configurations so that couplings
+    between irreps, which vanish, are never evaluated.
+    '''
     if mVHCI.H is None:
-        mVHCI.H = GenerateSparseHamV(mVHCI.Basis, mVHCI.Frequencies, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3])
+        Old, New = [], mVHCI.Basis
+        NNZOld = 0
     else:
-        if len(mVHCI.NewBasis) != 0:
-            HIJ = GenerateSparseHamVOD(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3])
-            HJJ = GenerateSparseHamV(mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3])
-            mVHCI.H = sparse.hstack([mVHCI.H, HIJ])
-            mVHCI.H = sparse.vstack([mVHCI.H, sparse.hstack([HIJ.transpose(), HJJ])])
+        if len(mVHCI.NewBasis) == 0:
+            return
+        Old, New = mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis
+        NNZOld = mVHCI.H.nnz
+    NOld, NNew = len(Old), len(New)
+    if not mVHCI.Symmetry:
+        HIJ, HJJ = Extend(Old, New)
+    else:
+        Labels = mVHCI.BasisIrreps()
+        OldLabels, NewLabels = Labels[:NOld], Labels[NOld:]
+        IJ = [[], [], []]
+        JJ = [[], [], []]
+        for g in np.unique(NewLabels):
+            I = np.flatnonzero(OldLabels == g)
+            J = np.flatnonzero(NewLabels == g)
+            HIJg, HJJg = Extend([Old[i] for i in I], [New[j] for j in J])
+            if HIJg is not None:
+                HIJg = sparse.coo_matrix(HIJg)
+                IJ[0].append(I[HIJg.row])
+                IJ[1].append(J[HIJg.col])
+                IJ[2].append(HIJg.data)
+            HJJg = sparse.coo_matrix(HJJg)
+            JJ[0].append(J[HJJg.row])
+            JJ[1].append(J[HJJg.col])
+            JJ[2].append(HJJg.data)
+        HJJ = sparse.csr_matrix((np.concatenate(JJ[2]), (np.concatenate(JJ[0]), np.concatenate(JJ[1]))), shape = (NNew, NNew))
+        HIJ = None
+        if NOld > 0:
+            if len(IJ[0]) == 0:
+                HIJ = sparse.csr_matrix((NOld, NNew))
+            else:
+                HIJ = sparse.csr_matrix((np.concatenate(IJ[2]), (np.concatenate(IJ[0]), np.concatenate(IJ[1]))), shape = (NOld, NNew))
+    if mVHCI.H is None:
+        mVHCI.H = HJJ
+    else:
+        mVHCI.H = sparse.hstack([mVHCI.H, HIJ])
+        mVHCI.H = sparse.vstack([mVHCI.H, sparse.hstack([HIJ.transpose(), HJJ])])
+    mVHCI.Timer.count("matrix elements kept", mVHCI.H.nnz - NNZOld)
+
+def Eigensolve(mVHCI):
+    '''
+    Lowest NStates eigenpairs of mVHCI.H. With Symmetry, each irrep block, or each one in TargetIrreps,
+    is diagonalized on its own and the lowest NStates over all of them are kept, with their irreps in
+    StateIrreps.
+    '''
+    if not mVHCI.Symmetry:
+        mVHCI.E, mVHCI.C = sparse.linalg.eigsh(mVHCI.H, k = mVHCI.NStates, which = 'SA')
+        mVHCI.E_HCI = mVHCI.E[:mVHCI.NStates].copy()
+        return
+    H = sparse.csr_matrix(mVHCI.H)
+    Labels = mVHCI.BasisIrreps()
+    Blocks = np.unique(Labels)
+    if mVHCI.TargetIrreps is not None:
+        Blocks = Blocks[np.isin(Blocks, mVHCI.TargetIrreps)]
+    Es, Vs, Is, Gs = [], [], [], []
+    for g in Blocks:
+        I = np.flatnonzero(Labels == g)
+        Hg = H[I][:, I]
+        k = min(mVHCI.NStates, len(I))
+        # ARPACK needs k < dim, and small blocks are faster dense anyway
+        if len(I) <= max(2 * k, 200):
+            e, v = np.linalg.eigh(Hg.toarray())
+            e, v = e[:k], v[:, :k]
+        else:
+            e, v = sparse.linalg.eigsh(Hg, k = k, which = 'SA')
+        for n in range(k):
+            Es.append(e[n])
+            Vs.append(v[:, n])
+            Is.append(I)
+            Gs.append(g)
+    if len(Es) < mVHCI.NStates:
+        raise ValueError("Only %d states in the irreps %s, fewer than NStates = %d" % (len(Es), Blocks.tolist(), mVHCI.NStates))
+    Order = np.argsort(Es, kind = 'stable')[:mVHCI.NStates]
+    mVHCI.E = np.asarray(Es)[Order]
+    mVHCI.C = np.zeros((H.shape[0], mVHCI.NStates))
+    for n, s in enumerate(Order):
+        mVHCI.C[Is[s], n] = Vs[s]
+    mVHCI.StateIrreps = np.asarray(Gs)[Order]
+    mVHCI.E_HCI = mVHCI.E[:mVHCI.NStates].copy()
+
+def SparseDiagonalize(mVHCI):
+    def Extend(Old, New):
+        HIJ = None
+        if len(Old) != 0:
+            HIJ = GenerateSparseHamVOD(Old, New, mVHCI.Frequencies, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3])
+        HJJ = GenerateSparseHamV(New, mVHCI.Frequencies, mVHCI.PotentialList, mVHCI.Potential[0], mVHCI.Potential[1], mVHCI.Potential[2], mVHCI.Potential[3])
+        return HIJ, HJJ
+
+    mVHCI.Timer.start(1)
+    ExtendHamiltonian(mVHCI, Extend)
     mVHCI.Timer.stop(1)
     mVHCI.Timer.start(0)
-    mVHCI.E, mVHCI.C = sparse.linalg.eigsh(mVHCI.H, k = mVHCI.NStates, which = 'SA')
+    mVHCI.Eigensolve()
     mVHCI.Timer.stop(0)
-    mVHCI.E_HCI = mVHCI.E[:mVHCI.NStates].copy()
 
 def pyCalcDiffModes(B1, B2):
     Diffs = []
@@ -275,6 +623,133 @@ def pyVCISparseHamNMode(Basis1, Basis2, Frequencies, V0, onemode_eig, ints, isDi
 
     return H
 
+def MatchConfigurations(Keys1, Keys2, Upper = False):
+    '''
+    All pairs (i, j) with Keys1[i] == Keys2[j], and i <= j if Upper
+    '''
+    Order = np.argsort(Keys2, kind = 'stable')
+    Sorted = Keys2[Order]
+    Lo = np.searchsorted(Sorted, Keys1, side = 'left')
+    Counts = np.searchsorted(Sorted, Keys1, side = 'right') - Lo
+    I = np.repeat(np.arange(Keys1.shape[0]), Counts)
+    J = Order[np.repeat(Lo - np.cumsum(Counts) + Counts, Counts) + np.arange(Counts.sum())]
+    if Upper:
+        Keep = I <= J
+        I, J = I[Keep], J[Keep]
+    return I, J
+
+def VCISparseHamNModeOOC(Basis1, Basis2, Frequencies, V0, OneModeEig, TwoModePotential, Store, DiagonalBlock, MaxNMode, MaxQ, BlockSize = 2**24, thr = 1e-4):
+    '''
+    Same Hamiltonian as VCISparseHamNModeFromOMArray, with the 3-mode and higher integrals read block by
+    block from an IntegralStore. The work is ordered by mode tuple: for each tuple, the pairs of
+    configurations that agree on every other mode are matched by hashing the occupations outside the
+    tuple, and the block is only read if there are any. TwoModePotential is the dense 2-mode array.
+    '''
+    N = len(Frequencies)
+    K = MaxQ
+    Q1 = BasisToArray(Basis1)
+    Q2 = Q1 if DiagonalBlock else BasisToArray(Basis2)
+    W = np.random.default_rng(0).integers(1, 2**63, N, dtype = np.uint64)
+    h1 = (Q1.astype(np.uint64) * W).sum(axis = 1)
+    h2 = h1 if DiagonalBlock else (Q2.astype(np.uint64) * W).sum(axis = 1)
+    Shape = (Q1.shape[0], Q2.shape[0])
+    H = sparse.csr_matrix(Shape)
+    Rows, Cols, Vals = [], [], []
+    NTrip = 0
+
+    def Flush(H, Rows, Cols, Vals):
+        if len(Rows) > 0:
+            H = H + sparse.coo_matrix((np.concatenate(Vals), (np.concatenate(Rows), np.concatenate(Cols))), shape = Shape).tocsr()
+        return H, [], [], []
+
+    # Identical configurations carry V0 and the 1-mode energies
+    I, J = MatchConfigurations(h1, h2, Upper = DiagonalBlock)
+    Same = (Q1[I] == Q2[J]).all(axis = 1)
+    I, J = I[Same], J[Same]
+    E1 = np.full(I.shape[0], V0)
+    if MaxNMode >= 1:
+        for m in range(N):
+            E1 += np.asarray(OneModeEig[m])[Q1[I, m]]
+    Rows.append(I)
+    Cols.append(J)
+    Vals.append(E1)
+
+    Orders = list(range(2, MaxNMode + 1))
+    if Store is not None and Store.Sweeps % 2:
+        Orders = Orders[::-1]
+    ints2 = np.asarray(TwoModePotential).reshape(N, N, K * K, K * K) if MaxNMode >= 2 else None
+    for k in Orders:
+        Tuples = itertools.combinations(range(N), k) if k == 2 else Store.tuples(k)
+        Dims = (K,) * k
+        for T in Tuples:
+            T = list(T)
+            k1 = h1 - (Q1[:, T].astype(np.uint64) * W[T]).sum(axis = 1)
+            k2 = k1 if DiagonalBlock else h2 - (Q2[:, T].astype(np.uint64) * W[T]).sum(axis = 1)
+            I, J = MatchConfigurations(k1, k2, Upper = DiagonalBlock)
+            if I.shape[0] == 0:
+                continue
+            Diff = Q1[I] != Q2[J]
+            Diff[:, T] = False
+            Keep = ~Diff.any(axis = 1)
+            I, J = I[Keep], J[Keep]
+            if I.shape[0] == 0:
+                continue
+            V = ints2[T[0], T[1]] if k == 2 else Store.block(T)
+            a = np.ravel_multi_index(Q1[I][:, T].T, Dims)
+            b = np.ravel_multi_index(Q2[J][:, T].T, Dims)
+            Rows.append(I)
+            Cols.append(J)
+            Vals.append(V[a, b])
+            NTrip += I.shape[0]
+            if NTrip > BlockSize:
+                H, Rows, Cols, Vals = Flush(H, Rows, Cols, Vals)
+                NTrip = 0
+    H, Rows, Cols, Vals = Flush(H, Rows, Cols, Vals)
+    if Store is not None:
+        Store.Sweeps += 1
+
+    H.data[abs(H.data) < thr] = 0.0
+    H.eliminate_zeros()
+    if DiagonalBlock:
+        H = H + sparse.triu(H, k = 1).T.tocsr()
+    return H
+
+def AddStatesHB3ModeOOC(BasisSet, TwoModePotential, SortedIndices, Store, C, eps, ExactSingles, NModes, MaxQ, MaxExcitedModes = -1):
+    '''
+    AddStatesHB3ModeArray with the 3-mode blocks read from an IntegralStore. The largest element of
+    each row of a block decides whether the block is read at all.
+    '''
+    NewBasis = AddStatesHB2ModeArray(BasisSet, TwoModePotential, SortedIndices, C, eps, ExactSingles, NModes, MaxQ, MaxExcitedModes)
+    K = MaxQ
+    C = abs(np.asarray(C))
+    Q = BasisToArray(BasisSet)
+    NExcited = np.count_nonzero(Q, axis = 1)
+    Seen = set(map(tuple, Q))
+    Seen.update(tuple(HO.Quanta for HO in WF.Modes) for WF in NewBasis)
+    Frequencies = [HO.Freq for HO in BasisSet[0].Modes]
+    for T in Store.tuples(3):
+        T = list(T)
+        Src = np.ravel_multi_index(Q[:, T].T, (K, K, K))
+        Rows = np.flatnonzero(C * Store.rowmax(T)[Src] >= eps)
+        if Rows.shape[0] == 0:
+            continue
+        V = abs(Store.block(T)[Src[Rows]]) * C[Rows, None]
+        r, t = np.nonzero(V >= eps)
+        Targets = np.stack(np.unravel_index(t, (K, K, K)), axis = 1)
+        Diff = (Targets != Q[Rows[r]][:, T]).all(axis = 1)
+        if MaxExcitedModes >= 0:
+            Change = np.count_nonzero(Targets, axis = 1) - np.count_nonzero(Q[Rows[r]][:, T], axis = 1)
+            Diff &= NExcited[Rows[r]] + Change <= MaxExcitedModes
+        for n, Occ in zip(Rows[r[Diff]], Targets[Diff]):
+            B = Q[n].copy()
+            B[T] = Occ
+            B = tuple(B)
+            if B not in Seen:
+                Seen.add(B)
+                NewBasis.append(WaveFunction(list(B), Frequencies))
+    Store.Sweeps += 1
+    return NewBasis
+
 def SparseDiagonalizeNMode(mVHCI):
     mVHCI.Timer.start(1)
    
@@ -303,32 +778,47 @@ def SparseDiagonalizeNMode(mVHCI):
         ThreeModeInts = np.array([0.0])
     '''
 
-    if mVHCI.H is None:
-        if mVHCI.mol.use_onemode_states:
-            #mVHCI.H = VCISparseHamNModeFromOM(mVHCI.Basis, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
-            mVHCI.H = VCISparseHamNModeFromOMArray(mVHCI.Basis, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], True, mVHCI.mol.Order, mVHCI.K)
-        else:
-            mVHCI.H = VCISparseHamNMode(mVHCI.Basis, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0].tolist(), mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
+    if mVHCI.Storage == 'ooc':
+        Store = mVHCI.mol.IntsStore
+        Hits, Misses = Store.Hits, Store.Misses
+
+        def Extend(Old, New):
+            if len(Old) == 0:
+                return None, VCISparseHamNModeOOC(New, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], Store, True, mVHCI.mol.Order, mVHCI.K)
+            # One sweep over the blocks gives both the coupling to the old configurations and the new diagonal block
+            HNew = VCISparseHamNModeOOC(Old + New, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], Store, False, mVHCI.mol.Order, mVHCI.K)
+            return HNew[:len(Old)], HNew[len(Old):]
+
+        ExtendHamiltonian(mVHCI, Extend)
+        mVHCI.Timer.count("integral blocks read", Store.Misses - Misses)
+        mVHCI.Timer.count("integral block cache hits", Store.Hits - Hits)
+    elif mVHCI.mol.use_onemode_states:
+        def Extend(Old, New):
+            HIJ = None
+            if len(Old) != 0:
+                #HIJ = VCISparseHamNModeFromOM(Old, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), False)
+                HIJ = VCISparseHamNModeFromOMArray(Old, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], False, mVHCI.mol.Order, mVHCI.K)
+            #HJJ = VCISparseHamNModeFromOM(New, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
+            HJJ = VCISparseHamNModeFromOMArray(New, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], True, mVHCI.mol.Order, mVHCI.K)
+            return HIJ, HJJ
+
+        ExtendHamiltonian(mVHCI, Extend)
     else:
-        if len(mVHCI.NewBasis) != 0:
-            if mVHCI.mol.use_onemode_states:
-                #HIJ = VCISparseHamNModeFromOM(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), False)
-                HIJ = VCISparseHamNModeFromOMArray(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], False, mVHCI.mol.Order, mVHCI.K)
-                #HJJ = VCISparseHamNModeFromOM(mVHCI.NewBasis, mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
-                HJJ = VCISparseHamNModeFromOMArray(mVHCI.NewBasis, mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.onemode_eig, mVHCI.mol.ints[1], mVHCI.mol.ints[2], mVHCI.mol.ints[3], mVHCI.mol.ints[4], True, mVHCI.mol.Order, mVHCI.K)
-            else:
-                HIJ = VCISparseHamNMode(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0].tolist(), mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), False)
-                HJJ = VCISparseHamNMode(mVHCI.NewBasis, mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0].tolist(), mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
-            mVHCI.H = sparse.hstack([mVHCI.H, HIJ])
-            mVHCI.H = sparse.vstack([mVHCI.H, sparse.hstack([HIJ.transpose(), HJJ])])
+        def Extend(Old, New):
+            HIJ = None
+            if len(Old) != 0:
+                HIJ = VCISparseHamNMode(Old, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0].tolist(), mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), False)
+            HJJ = VCISparseHamNMode(New, New, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.ints[0].tolist(), mVHCI.mol.ints[1].tolist(), mVHCI.mol.ints[2].tolist(), True)
+            return HIJ, HJJ
+
+        ExtendHamiltonian(mVHCI, Extend)
     mVHCI.Timer.stop(1)
     mVHCI.Timer.start(0)
-    mVHCI.E, mVHCI.C = sparse.linalg.eigsh(mVHCI.H, k = mVHCI.NStates, which = 'SA')
+    mVHCI.Eigensolve()
     mVHCI.Timer.stop(0)
-    mVHCI.E_HCI = mVHCI.E[:mVHCI.NStates].copy()
 
-def VCISparseHamTCI(Basis1, Basis2, Frequencies, V0, CoreTensors, OffDiagonal):
-    T = VCISparseT(Basis1, Basis2, Frequencies, OffDiagonal)
+def pyVCISparseHamTCI(Basis1, Basis2, Frequencies, V0, CoreTensors, OffDiagonal):
+    T = VCISparseT(Basis1, Basis2, Frequencies, False) # every element of the block, the last argument is DiagonalBlock
     N1 = len(Basis1)
     N2 = len(Basis2)
     V = sparse.lil_matrix((N1, N2))
@@ -355,16 +845,238 @@ def VCISparseHamTCI(Basis1, Basis2, Frequencies, V0, CoreTensors, OffDiagonal):
     V = V * constants.AU_TO_INVCM
     return T + V
 
+def BasisToArray(Basis):
+    NModes = len(Basis[0].Modes) if len(Basis) > 0 else 0
+    return np.asarray([[HO.Quanta for HO in B.Modes] for B in Basis], dtype = int).reshape(len(Basis), NModes)
+
+def TTPartialConfigs(Q, Modes):
+    '''
+    Builds the tree of partial configurations over Modes, in the order given. At each
+    level, every unique partial configuration is stored as the index of its parent
+    at the previous level and the quanta of the mode that was added. Also returns the
+    index of the final partial configuration of each row of Q.
+    '''
+    Parents = []
+    Quanta = []
+    Ind = np.zeros(Q.shape[0], dtype = int)
+    for m in Modes:
+        Key = np.stack([Ind, Q[:, m]], axis = 1)
+        U, Ind = np.unique(Key, axis = 0, return_inverse = True)
+        Ind = Ind.ravel()
+        Parents.append(U[:, 0])
+        Quanta.append(U[:, 1])
+    return Parents, Quanta, Ind
+
+def TTEnvironment(CoreTensors, Modes, Tree1, Tree2, Left = True):
+    '''
+    Contracts the core chain over Modes for every pair of partial configurations in
+    Tree1 x Tree2. Pairs that share a parent share all of the work above them, and
+    within a level the slices are grouped by quanta so each group is one batched
+    matmul. Returns an array of shape (P1, P2, r) where r is the open bond.
+    '''
+    E = np.ones((1, 1, 1))
+    for l, m in enumerate(Modes):
+        G = CoreTensors[m]
+        Par1, Q1 = Tree1[0][l], Tree1[1][l]
+        Par2, Q2 = Tree2[0][l], Tree2[1][l]
+        r = G.shape[1] if Left else G.shape[0]
+        ENew = np.zeros((Par1.shape[0], Par2.shape[0], r))
+        for n in np.unique(Q1):
+            A = np.where(Q1 == n)[0]
+            for k in np.unique(Q2):
+                B = np.where(Q2 == k)[0]
+                EP = E[np.ix_(Par1[A], Par2[B])]
+                if Left:
+                    ENew[np.ix_(A, B)] = EP @ G[:, :, n, k]
+                else:
+                    ENew[np.ix_(A, B)] = EP @ G[:, :, n, k].T
+        E = ENew
+    return E
+
+def TTSplit(Q1, Q2):
+    '''
+    Picks the bond at which to split the core chain, minimizing the size of the
+    left and right environments that are kept.
+    '''
+    M = Q1.shape[1]
+    Best = None
+    Cut = M // 2
+    for c in range(1, M):
+        P1 = np.unique(Q1[:, :c], axis = 0).shape[0]
+        P2 = np.unique(Q2[:, :c], axis = 0).shape[0]
+        S1 = np.unique(Q1[:, c:], axis = 0).shape[0]
+        S2 = np.unique(Q2[:, c:], axis = 0).shape[0]
+        Cost = P1 * P2 + S1 * S2
+        if Best is None or Cost < Best:
+            Best = Cost
+            Cut = c
+    return Cut
+
+def TTEnvironments(Q1, Q2, CoreTensors, Cut = None):
+    M = Q1.shape[1]
+    if Cut is None:
+        Cut = TTSplit(Q1, Q2)
+    LModes = list(range(Cut))
+    RModes = list(range(M - 1, Cut - 1, -1))
+    LTree1 = TTPartialConfigs(Q1, LModes)
+    LTree2 = TTPartialConfigs(Q2, LModes)
+    RTree1 = TTPartialConfigs(Q1, RModes)
+    RTree2 = TTPartialConfigs(Q2, RModes)
+    L = TTEnvironment(CoreTensors, LModes, LTree1, LTree2, Left = True)
+    R = TTEnvironment(CoreTensors, RModes, RTree1, RTree2, Left = False)
+    return L, R, LTree1[2], LTree2[2], RTree1[2], RTree2[2]
+
+def VCISparseHamTCI(Basis1, Basis2, Frequencies, V0, CoreTensors, OffDiagonal, MaxCoupledModes = None, BlockSize = 2**24, thr = 1e-12):
+    '''
+    Batched TT Hamiltonian. The core chain is split at one bond, and the left and right
+    environments are contracted once per pair of unique half configurations. Each
+    element is then the dot product of one left and one right environment, done in
+    blocks of rows and written straight into CSR. MaxCoupledModes drops pairs that
+    differ in more than that many modes before they are contracted.
+    '''
+    T = VCISparseT(Basis1, Basis2, Frequencies, False) # every element of the block, the last argument is DiagonalBlock
+    N1 = len(Basis1)
+    N2 = len(Basis2)
+    if N1 == 0 or N2 == 0:
+        return T
+    Q1 = BasisToArray(Basis1)
+    Q2 = BasisToArray(Basis2)
+    if Q1.shape[1] == 1:
+        V = sparse.csr_matrix(CoreTensors[0][0, 0][np.ix_(Q1[:, 0], Q2[:, 0])] * constants.AU_TO_INVCM)
+        return T + V
+
+    L, R, p1, p2, s1, s2 = TTEnvironments(Q1, Q2, CoreTensors)
+    r = L.shape[2]
+    NRows = max(1, BlockSize // (N2 * r))
+    Rows = []
+    Cols = []
+    Vals = []
+    for i0 in range(0, N1, NRows):
+        I = np.arange(i0, min(i0 + NRows, N1))
+        # Pairs are screened before they are contracted, so the pairs that are cut cost no work
+        Keep = np.ones((I.shape[0], N2), dtype = bool)
+        if not OffDiagonal:
+            Keep &= I[:, None] <= np.arange(N2)[None, :]
+        if MaxCoupledModes is not None:
+            NDiff = np.zeros((I.shape[0], N2), dtype = np.int32)
+            for m in range(Q1.shape[1]):
+                NDiff += Q1[I, m, None] != Q2[None, :, m]
+            Keep &= NDiff <= MaxCoupledModes
+        ib, jb = np.nonzero(Keep)
+        Vb = np.einsum('kr,kr->k', L[p1[I[ib]], p2[jb]], R[s1[I[ib]], s2[jb]])
+        NonZero = abs(Vb) > thr
+        Rows.append(I[ib[NonZero]])
+        Cols.append(jb[NonZero])
+        Vals.append(Vb[NonZero])
+    Rows = np.concatenate(Rows)
+    Cols = np.concatenate(Cols)
+    Vals = np.concatenate(Vals) * constants.AU_TO_INVCM
+    V = sparse.csr_matrix((Vals, (Rows, Cols)), shape = (N1, N2))
+    if not OffDiagonal:
+        V = V + sparse.triu(V, k = 1).T.tocsr()
+    return T + V
+
+def TTDiagonal(Q, CoreTensors):
+    '''
+    Diagonal of the TT potential in cm-1 for each configuration of Q. One row vector per
+    configuration is swept through the cores, grouped by quanta, so memory is O(N r).
+    '''
+    v = np.ones((Q.shape[0], 1))
+    for m, G in enumerate(CoreTensors):
+        vNew = np.zeros((Q.shape[0], G.shape[1]))
+        for n in np.unique(Q[:, m]):
+            A = np.where(Q[:, m] == n)[0]
+            vNew[A] = v[A] @ G[:, :, n, n]
+        v = vNew
+    return v[:, 0] * constants.AU_TO_INVCM
+
+class TCIHamiltonianOperator(sparse.linalg.LinearOperator):
+    '''
+    Matrix-free H for TCIVHCI. The kinetic part is VCISparseT and the potential is
+    applied one block of rows at a time: the environments of the partial
+    configurations of the block with those of the whole basis are contracted, used
+    and dropped. A block holds about BlockSize elements, and the rest of the operator
+    is the O(N r) diagonal and the O(N M) trees of partial configurations, so memory
+    is linear in the basis. Previous is the operator of a basis this one extends, its
+    kinetic part and diagonal are kept and only the new configurations are contracted.
+    '''
+    def __init__(self, Basis, Frequencies, CoreTensors, Previous = None, BlockSize = 2**24):
+        N = len(Basis)
+        super().__init__(dtype = np.float64, shape = (N, N))
+        self.Q = BasisToArray(Basis)
+        self.CoreTensors = CoreTensors
+        self.BlockSize = BlockSize
+        NOld = 0
+        if Previous is not None and Previous.shape[0] <= N and np.array_equal(Previous.Q, self.Q[:Previous.shape[0]]):
+            NOld = Previous.shape[0]
+        if NOld > 0:
+            Old, New = Basis[:NOld], Basis[NOld:]
+            TIJ = VCISparseT(Old, New, Frequencies, False)
+            TJJ = VCISparseT(New, New, Frequencies, False)
+            self.TMat = sparse.vstack([sparse.hstack([Previous.TMat, TIJ]), sparse.hstack([TIJ.transpose(), TJJ])]).tocsr()
+            self.Diagonal = np.concatenate((Previous.Diagonal, TJJ.diagonal() + TTDiagonal(self.Q[NOld:], CoreTensors)))
+        else:
+            self.TMat = VCISparseT(Basis, Basis, Frequencies, False)
+            self.Diagonal = self.TMat.diagonal() + TTDiagonal(self.Q, CoreTensors)
+
+        Cut = TTSplit(self.Q, self.Q)
+        self.LModes = list(range(Cut))
+        self.RModes = list(range(self.Q.shape[1] - 1, Cut - 1, -1))
+        self.LTree = TTPartialConfigs(self.Q, self.LModes)
+        self.RTree = TTPartialConfigs(self.Q, self.RModes)
+        self.p = self.LTree[2]
+        self.s = self.RTree[2]
+        self.NPrefix = self.p.max() + 1
+        self.NSuffix = self.s.max() + 1
+        # Rows sharing a prefix go to the same block, so their left environments are contracted once
+        self.Order = np.argsort(self.p, kind = 'stable')
+        r = CoreTensors[Cut - 1].shape[1]
+        self.NRows = max(1, BlockSize // (max(self.NPrefix, self.NSuffix) * r))
+
+    def diagonal(self):
+        return self.Diagonal
+
+    def copy(self):
+        return self
+
+    def _matvec(self, c):
+        c = np.asarray(c).ravel()
+        N = self.shape[0]
+        V = np.zeros(N, dtype = np.result_type(c.dtype, np.float64))
+        # Each configuration is a unique (suffix, prefix) pair, so Y holds c exactly once
+        Y = sparse.csr_matrix((c, (self.s, self.p)), shape = (self.NSuffix, self.NPrefix))
+        for i0 in range(0, N, self.NRows):
+            I = self.Order[i0:i0 + self.NRows]
+            LTree = TTPartialConfigs(self.Q[I], self.LModes)
+            RTree = TTPartialConfigs(self.Q[I], self.RModes)
+            L = TTEnvironment(self.CoreTensors, self.LModes, LTree, self.LTree, Left = True)
+            R = TTEnvironment(self.CoreTensors, self.RModes, RTree, self.RTree, Left = False)
+            SI, _, r = R.shape
+            # X[p, u] sums c_j R[u, s_j] over the configurations j with prefix p
+            X = (Y.transpose() @ R.transpose(1, 0, 2).reshape(self.NSuffix, SI * r)).reshape(self.NPrefix, SI, r)
+            V[I] = np.einsum('ipr,pir->i', L[LTree[2]], X[:, RTree[2]])
+        return self.TMat @ c + V * constants.AU_TO_INVCM
+
+    def _rmatvec(self, c):
+        return self._matvec(c)
+
 def SparseDiagonalizeTCI(mVHCI):
     mVHCI.Timer.start(1)
-    if mVHCI.H is None:
-        mVHCI.H = VCISparseHamTCI(mVHCI.Basis, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, False)
+    HOld = mVHCI.H
+    if mVHCI.MatrixFree:
+        if mVHCI.MaxCoupledModes is not None:
+            raise ValueError("MaxCoupledModes cannot be applied to the matrix-free TCI Hamiltonian, which sums the whole TT potential")
+        Previous = HOld if isinstance(HOld, TCIHamiltonianOperator) else None
+        mVHCI.H = TCIHamiltonianOperator(mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.core_tensors, Previous = Previous)
+    elif mVHCI.H is None:
+        mVHCI.H = VCISparseHamTCI(mVHCI.Basis, mVHCI.Basis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, False, MaxCoupledModes = mVHCI.MaxCoupledModes)
     else:
         if len(mVHCI.NewBasis) != 0:
-            HIJ = VCISparseHamTCI(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, True)
-            HJJ = VCISparseHamTCI(mVHCI.NewBasis, mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, False)
+            HIJ = VCISparseHamTCI(mVHCI.Basis[:-len(mVHCI.NewBasis)], mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, True, MaxCoupledModes = mVHCI.MaxCoupledModes)
+            HJJ = VCISparseHamTCI(mVHCI.NewBasis, mVHCI.NewBasis, mVHCI.Frequencies, mVHCI.mol.V0, mVHCI.mol.core_tensors, False, MaxCoupledModes = mVHCI.MaxCoupledModes)
             mVHCI.H = sparse.hstack([mVHCI.H, HIJ])
             mVHCI.H = sparse.vstack([mVHCI.H, sparse.hstack([HIJ.transpose(), HJJ])])
+    CountHamiltonian(mVHCI, HOld)
     mVHCI.Timer.stop(1)
     mVHCI.Timer.start(0)
     mVHCI.E, mVHCI.C = sparse.linalg.eigsh(mVHCI.H, k = mVHCI.NStates, which = 'SA')
@@ -475,6 +1187,8 @@ def PrintResults(mVHCI, thr = 2.5e-1):
         Outline += '\t%s' % (BString)
         LCString = mVHCI.LCLine(n, thr = thr)
         Outline += '\t%s' % (LCString)
+        if mVHCI.Symmetry and mVHCI.StateIrreps is not None:
+            Outline += '\tirrep %d' % (mVHCI.StateIrreps[n])
         print(Outline, flush = True)
          
 def PrintParameters(mVHCI):
@@ -490,6 +1204,8 @@ def PrintParameters(mVHCI):
     print("NWalkers       :", mVHCI.NWalkers)
     print("NSamples       :", mVHCI.NSamples)
     print("HB Criterion   :", mVHCI.HBMethod)
+    if mVHCI.MaxExcitedModes is not None:
+        print("MCR            :", mVHCI.MaxExcitedModes)
     print("", flush = True)
   
 '''
@@ -500,11 +1216,21 @@ class VHCI:
     FormWSD = FormWSD
     MakeAnharmTensor = MakeAnharmTensor
     HCI = HCI
+    Continuation = Continuation
+    PrintSchedule = PrintSchedule
     Diagonalize = Diagonalize
     SparseDiagonalize = SparseDiagonalize
+    Eigensolve = Eigensolve
+    DetectSymmetry = DetectSymmetry
+    InitSymmetry = InitSymmetry
+    Irreps = Irreps
+    BasisIrreps = BasisIrreps
+    SelectIrreps = SelectIrreps
     HCIStep = HCIStep
     ScreenBasis = ScreenBasis
     PT2 = PT2
+    DeterministicPT2 = DeterministicPT2
+    AdaptiveSPT2 = AdaptiveSPT2
     InitTruncatedBasis = InitTruncatedBasis
     InitC = InitC
     ExpectedQ = ExpectedQ
@@ -537,6 +1263,7 @@ class VHCI:
             self.MaxQuanta = [MaxQuanta] * self.NModes
         
         self.MaxTotalQuanta = MaxTotalQuanta
+        self.MaxExcitedModes = None # Mode combination range, the most modes excited at once in any configuration, None means no limit
         self._HighestQuanta = [MaxTotalQuanta] * self.NModes
         self.H = None
         self.eps1 = 0.1 # HB epsilon
@@ -548,23 +1275,41 @@ class VHCI:
         self.NStatesPT2 = NStates
         self.NWalkers = 200
         self.NSamples = 50
+        self.PT2Batches = 1 # Number of hash partitions of the PT2 external space
+        self.PT2MaxMem = 0.0 # GB per partition, more partitions are made if exceeded, <= 0 means no budget
+        self.SPT2Tol = None # Target standard error of SPT2 on every root, None runs a fixed NSamples
+        self.SPT2Batch = 10 # Samples drawn between convergence checks
+        self.SPT2Seed = None # Seed of the SPT2 sample streams, None draws a new one for every run
+        self.SPT2SeedUsed = None # Seed of the last SPT2 run
+        self.NSamplesPT2 = None
+        self.PT2Cache = {}
         self.dE_PT2 = None
         self.sE_PT2 = None
         self.HBMethod = 'exact' #['orig', 'max', 'exact']
+        self.eps1Schedule = None # Descending eps1 values run in turn by kernel instead of eps1, see Continuation
+        self.ScheduleResults = None
+        self.Ys = None # Anharmonic tensors for the exact heat bath criterion, made by kernel if not given
+        self.Symmetry = False # Block H by the irreps of the sign symmetries of the potential, see utils.symmetry_utils
+        self.TargetIrreps = None # Irrep labels to keep in the basis and solve for with Symmetry, None means all
+        self.SymGenerators = None # Made by DetectSymmetry if not given
+        self.StateIrreps = None
+        self._BasisIrreps = None
+        self._IrrepBasis = None
 
         self.CHKFile = None
+        self.ProfileFile = None
         self.ReadFromFile = False
         self.SaveToFile = False
         self.PrintHCISteps = False
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(6)
         self.TimerNames = ['Diagonalize', 'Form Hamiltonian', 'Screen Basis', 'PT2 correction', 'SPT2 correction', 'SSPT2 correction']
+        self.Timer = PROFILER(self.TimerNames, name = "VHCI")
 
     def kernel(self, doVCI = True, doVHCI = True, doPT2 = False, doSPT2 = False, ComparePT2 = False):
         assert(self.HBMethod in ['orig', 'max', 'exact'])
-        if self.HBMethod == 'exact':
+        if self.HBMethod == 'exact' and self.Ys is None:
             self.Ys = [self.MakeAnharmTensor()] * self.NModes
             #Is = []
             #for n in self.MaxQuanta:
@@ -577,7 +1322,8 @@ class VHCI:
         if self.ReadFromFile:
             self.ReadBasisFromFile(self.CHKFile)
         else:
-            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta)
+            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta, MaxExcitedModes = self.MaxExcitedModes)
+        self.InitSymmetry()
 
         self.PrintParameters()
 
@@ -592,7 +1338,10 @@ class VHCI:
         
         if doVHCI:
             print("===== VHCI RESULTS =====", flush = True)
-            self.HCI()
+            if self.eps1Schedule is None:
+                self.HCI()
+            else:
+                self.Continuation(doPT2 = doPT2)
             self.PrintResults()
             print("")
 
@@ -616,6 +1365,8 @@ class VHCI:
             self.PrintResults()
             print("")
         self.Timer.report(self.TimerNames)
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 
     @property
@@ -644,6 +1395,11 @@ class VHCI:
             
 class NModeVHCI(VHCI):
     SparseDiagonalize = SparseDiagonalizeNMode
+    MakeSorted2Mode = MakeSorted2Mode
+    MakeSorted3Mode = MakeSorted3Mode
+    DeterministicPT2 = DeterministicPT2NMode
+    CheckMemory = CheckMemoryNMode
+    DetectSymmetry = DetectSymmetryNMode
     
     def __init__(self, mol, NStates = 10, **kwargs):
         self.mol = mol
@@ -652,6 +1408,7 @@ class NModeVHCI(VHCI):
         self.MaxQuanta = [mol.ngridpts] * self.NModes
         
         self.MaxTotalQuanta = 5
+        self.MaxExcitedModes = None # Mode combination range, None means no limit
         for m in self.MaxQuanta:
             assert(m <= mol.ngridpts)
         self.H = None
@@ -664,19 +1421,47 @@ class NModeVHCI(VHCI):
         self.NStatesPT2 = NStates
         self.NWalkers = 200
         self.NSamples = 50
+        self.PT2Batches = 1
+        self.PT2MaxMem = 0.0
+        self.SPT2Tol = None
+        self.SPT2Batch = 10
+        self.SPT2Seed = None
+        self.SPT2SeedUsed = None
+        self.NSamplesPT2 = None
+        self.PT2Cache = {}
         self.dE_PT2 = None
         self.sE_PT2 = None
-        self.HBMethod = 'qff' #['qff', '2mode']
+        self.HBMethod = 'qff' #['qff', '2mode', 'cipsi']
+        self.eps1Schedule = None
+        self.ScheduleResults = None
+        self.CIPSIMaxAdd = 0 # Largest number of configurations CIPSI adds per iteration, <= 0 adds all above eps1
+        self.Use3ModeHB = True # Also screen through sorted 3-mode integrals with HBMethod = '2mode' when mol.Order >= 3
+        self.Sorted2Mode = None # Heat bath indices, made by kernel if not given so that runs on the same mol can share them
+        self.Sorted3Mode = None
+        self.Max3Mode = None
+        self.Symmetry = False
+        self.TargetIrreps = None
+        self.SymmetryTol = 1e-6 # Integrals below this do not break a symmetry
+        self.SymGenerators = None
+        self.StateIrreps = None
+        self._BasisIrreps = None
+        self._IrrepBasis = None
+        self.Storage = mol.Storage # Layout of the n-mode integrals, 'dense' or 'ooc', see utils.memory_utils.STORAGE_LAYOUTS
+        self.MemoryBudget = None # GB for the whole run, None means the available physical memory
+        self.MemoryCheck = 'warn' # 'warn', 'refuse' or None when the integrals and heat bath indices do not fit
+        self.PrintMemory = False
+        self.MemoryPlan = None
 
         self.CHKFile = None
+        self.ProfileFile = None
         self.ReadFromFile = False
         self.SaveToFile = False
         self.PrintHCISteps = False
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(6)
         self.TimerNames = ['Diagonalize', 'Form Hamiltonian', 'Screen Basis', 'PT2 correction', 'SPT2 correction', 'SSPT2 correction']
+        self.Timer = PROFILER(self.TimerNames, name = "NModeVHCI")
 
     def kernel(self, doVCI = True, doVHCI = True, doPT2 = False, doSPT2 = False, ComparePT2 = False):
         if self.HBMethod.upper() == 'QFF':
@@ -699,17 +1484,11 @@ class NModeVHCI(VHCI):
         else:
             self.PotentialListFull = []
 
-        if self.HBMethod.upper() == '2MODE':
-            self.Sorted2Mode = np.empty((self.mol.Nm, self.mol.Nm, self.mol.ngridpts, self.mol.ngridpts, self.mol.ngridpts**2, 2), dtype = np.int8)
-            for i in range(self.mol.Nm):
-                for j in range(self.mol.Nm):
-                    for ni in range(self.mol.ngridpts):
-                        for nj in range(self.mol.ngridpts):
-                            Sorted = np.argsort(-abs(self.mol.ints[1][i, j][ni, nj].reshape(-1)))
-                            Sorted = np.unravel_index(Sorted, (self.mol.ngridpts, self.mol.ngridpts))
-                            Sorted = np.vstack((Sorted[0], Sorted[1]))
-                            self.Sorted2Mode[i, j, ni, nj] = Sorted.T
-            self.Sorted2Mode = np.array(self.Sorted2Mode.tolist()).ravel()
+        self.CheckMemory(doPT2 = doPT2)
+        if (self.HBMethod.upper() == '2MODE' or (doPT2 and self.HBMethod.upper() != 'QFF')) and self.Sorted2Mode is None:
+            self.MakeSorted2Mode()
+        if self.HBMethod.upper() == '2MODE' and self.mol.Order >= 3 and self.Use3ModeHB and self.Storage != 'ooc' and self.Sorted3Mode is None:
+            self.MakeSorted3Mode()
 
         if self.SaveToFile or self.ReadFromFile:
             assert(self.CHKFile is not None)
@@ -717,7 +1496,7 @@ class NModeVHCI(VHCI):
         if self.ReadFromFile:
             self.ReadBasisFromFile(self.CHKFile)
         else:
-            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta)
+            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta, MaxExcitedModes = self.MaxExcitedModes)
 
         self.PrintParameters()
 
@@ -731,7 +1510,12 @@ class NModeVHCI(VHCI):
             if self.mol.Order >= 2:
                 #self.mol.ints[1] = np.array(self.mol.ints[1].tolist())
                 self.mol.ints[1].resize((N * N * K * K * K * K))
-                if self.mol.Order >= 3:
+                if self.Storage == 'ooc':
+                    # Higher orders are read from mol.IntsStore
+                    self.mol.ints[2] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                    self.mol.ints[3] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                    self.mol.ints[4] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                elif self.mol.Order >= 3:
                     #self.mol.ints[2] = np.array(self.mol.ints[2].tolist())
                     self.mol.ints[2].resize((N * N * N * K * K * K * K * K * K))
                     if self.mol.Order >= 4:
@@ -741,14 +1525,15 @@ class NModeVHCI(VHCI):
                             #self.mol.ints[4] = np.array(self.mol.ints[4].tolist())
                             self.mol.ints[4].resize((N * N * N * N * N * K * K * K * K * K * K * K * K * K * K))
                         else:
-                            self.mol.ints[4] = np.array([0.0])
+                            self.mol.ints[4] = np.array([0.0], dtype = self.mol.IntsPrecision)
                     else:
-                        self.mol.ints[3] = np.array([0.0])
-                        self.mol.ints[4] = np.array([0.0])
+                        self.mol.ints[3] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                        self.mol.ints[4] = np.array([0.0], dtype = self.mol.IntsPrecision)
                 else:
-                    self.mol.ints[2] = np.array([0.0])
-                    self.mol.ints[3] = np.array([0.0])
-                    self.mol.ints[4] = np.array([0.0])
+                    self.mol.ints[2] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                    self.mol.ints[3] = np.array([0.0], dtype = self.mol.IntsPrecision)
+                    self.mol.ints[4] = np.array([0.0], dtype = self.mol.IntsPrecision)
+        self.InitSymmetry()
 
         if doVCI:
             self.Timer.start(0)
@@ -761,7 +1546,10 @@ class NModeVHCI(VHCI):
         
         if doVHCI:
             print("===== VHCI RESULTS =====", flush = True)
-            self.HCI()
+            if self.eps1Schedule is None:
+                self.HCI()
+            else:
+                self.Continuation(doPT2 = doPT2)
             self.PrintResults()
             print("")
 
@@ -785,6 +1573,8 @@ class NModeVHCI(VHCI):
             self.PrintResults()
             print("")
         self.Timer.report(self.TimerNames)
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 class TCIVHCI(VHCI):
     SparseDiagonalize = SparseDiagonalizeTCI
@@ -795,6 +1585,7 @@ class TCIVHCI(VHCI):
         self.MaxQuanta = [mol.ngridpts] * self.NModes
         
         self.MaxTotalQuanta = 5
+        self.MaxExcitedModes = None # Mode combination range, None means no limit
         for m in self.MaxQuanta:
             assert(m <= mol.ngridpts)
         self.H = None
@@ -810,18 +1601,25 @@ class TCIVHCI(VHCI):
         self.dE_PT2 = None
         self.sE_PT2 = None
         self.HBMethod = 'pass' #['qff', '2mode']
+        self.eps1Schedule = None
+        self.ScheduleResults = None
+        self.MaxCoupledModes = None # Drop TT elements between configurations differing in more modes
+        self.MatrixFree = False # Use TCIHamiltonianOperator instead of building H, not with MaxCoupledModes
+        self.Symmetry = False # Symmetry blocking needs the n-mode integrals and is not available here
 
         self.CHKFile = None
+        self.ProfileFile = None
         self.ReadFromFile = False
         self.SaveToFile = False
         self.PrintHCISteps = False
 
         self.__dict__.update(kwargs)
 
-        self.Timer = TIMER(6)
         self.TimerNames = ['Diagonalize', 'Form Hamiltonian', 'Screen Basis', 'PT2 correction', 'SPT2 correction', 'SSPT2 correction']
+        self.Timer = PROFILER(self.TimerNames, name = "TCIVHCI")
     
     def kernel(self, doVCI = True, doVHCI = True, doPT2 = False, doSPT2 = False, ComparePT2 = False):
+        assert(not self.Symmetry)
         if self.HBMethod.upper() == 'MAXTENSOR':
             self.MaxTensors = [abs(G.reshape(G.shape[0] * G.shape[1], G.shape[2], G.shape[3])).max(axis = 0) for G in self.mol.core_tensors]
             self.MSortedIndices = [np.argsort(-abs(M), axis = 0) for M in self.MaxTensors]
@@ -832,7 +1630,7 @@ class TCIVHCI(VHCI):
         if self.ReadFromFile:
             self.ReadBasisFromFile(self.CHKFile)
         else:
-            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta)
+            self.Basis = init_funcs.InitTruncatedBasis(self.NModes, self.Frequencies, self.MaxQuanta, MaxTotalQuanta = self.MaxTotalQuanta, MaxExcitedModes = self.MaxExcitedModes)
 
         self.PrintParameters()
 
@@ -847,7 +1645,10 @@ class TCIVHCI(VHCI):
         
         if doVHCI:
             print("===== VHCI RESULTS =====", flush = True)
-            self.HCI()
+            if self.eps1Schedule is None:
+                self.HCI()
+            else:
+                self.Continuation(doPT2 = doPT2)
             self.PrintResults()
             print("")
 
@@ -871,6 +1672,8 @@ class TCIVHCI(VHCI):
             self.PrintResults()
             print("")
         self.Timer.report(self.TimerNames)
+        if self.ProfileFile is not None:
+            self.Timer.export(self.ProfileFile)
 
 
 if __name__ == "__main__":